@@ -5,57 +5,72 @@ Handles real-time voice conversations with OpenAI integration
 """
 
 import asyncio
+import hashlib
 import os
 import logging
 import json
-from typing import Optional, List, Dict, Any
-from dotenv import load_dotenv
-import openai
+import threading
+import time
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime
 
-# Load environment variables
-load_dotenv()
+from service_common import tracing
+from alignment import Alignment, align
+from context_builder import ContextBuilder, RollingSummarizer, TokenCounter, extractive_summary
+from history_store import DEFAULT_SESSION, HistoryStore, SharedStateHistoryStore, create_history_store
+from model_router import RouterMetrics, classify
+from shared_state import StateBackend, InMemoryStateBackend, create_backend
+from speech_formats import FORMATS, SpeechFormat, encode, stats as speech_stats
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = "You are a helpful AI learning assistant focused on helping users with pronunciation, reading skills, and educational topics. Be friendly, encouraging, and provide practical advice. Keep responses concise but informative."
+
 class AIVoiceAgent:
     """Simplified AI Voice Agent for real-time conversations"""
     
-    def __init__(self):
-        self.openai_client = openai.OpenAI(
-            api_key=os.getenv('OPENAI_API_KEY')
-        )
-        self.conversation_history: List[Dict[str, str]] = []
+    def __init__(self, state: Optional[StateBackend] = None, history_store: Optional[HistoryStore] = None):
+        self._openai_client = None
+        self._openai_lock = threading.Lock()
         self.max_history_length = 50
+        # Shared between workers when SHARED_STATE_URL points at Redis
+        self.state = state or InMemoryStateBackend()
+        self.history = history_store or SharedStateHistoryStore(self.state, self.max_history_length)
+        self.speech_cache_ttl = float(os.getenv('SPEECH_CACHE_TTL', '86400'))
+        self.chat_model = "gpt-4o"
+        # Each message is routed to a model and token budget (model_router.TIERS)
+        self.router_metrics = RouterMetrics()
+        self.summary_model = os.getenv('SUMMARY_MODEL', 'gpt-4o-mini')
+        self.context_builder = ContextBuilder(
+            TokenCounter(self.chat_model),
+            RollingSummarizer(self.state, self.summarize_turns)
+        )
+    
+    @property
+    def openai_client(self):
+        """OpenAI client, created on first use
+
+        Importing the openai package is the slowest part of worker startup, so
+        it happens here (normally during readiness warm-up) rather than at import.
+        """
+        if self._openai_client is None:
+            with self._openai_lock:
+                if self._openai_client is None:
+                    import openai
+
+                    self._openai_client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+        return self._openai_client
         
-    def process_text_message(self, message: str, context: str = "") -> str:
+    def process_text_message(self, message: str, context: str = "", session_id: str = DEFAULT_SESSION) -> str:
         """Process incoming text message and generate AI response"""
         try:
-            # Add user message to history
-            self.conversation_history.append({
-                "role": "user",
-                "content": message,
-                "timestamp": datetime.now().isoformat()
-            })
+            started_at = datetime.now().isoformat()
             
             # Generate AI response
-            ai_response = self.generate_ai_response(message, context)
+            ai_response = self.generate_ai_response(message, context, session_id)
             
-            # Add AI response to history
-            self.conversation_history.append({
-                "role": "assistant", 
-                "content": ai_response,
-                "timestamp": datetime.now().isoformat()
-            })
-            
-            # Trim history if too long
-            if len(self.conversation_history) > self.max_history_length:
-                self.conversation_history = self.conversation_history[-self.max_history_length:]
+            # Add both sides of the exchange to history
+            self.record_exchange(session_id, message, ai_response, started_at)
             
             return ai_response
             
@@ -63,65 +78,190 @@ class AIVoiceAgent:
             logger.error(f"Error processing text message: {e}")
             return self.get_fallback_response(message)
     
-    def generate_ai_response(self, message: str, context: str = "") -> str:
-        """Generate AI response using OpenAI GPT-4"""
+    def record_exchange(self, session_id: str, message: str, ai_response: str, started_at: Optional[str] = None) -> None:
+        """Add a user message and the AI response to a session's history"""
+        self.history.append(session_id, {
+            "role": "user",
+            "content": message,
+            "timestamp": started_at or datetime.now().isoformat()
+        })
+        self.history.append(session_id, {
+            "role": "assistant",
+            "content": ai_response,
+            "timestamp": datetime.now().isoformat()
+        })
+    
+    def generate_ai_response(self, message: str, context: str = "", session_id: Optional[str] = None) -> str:
+        """Generate AI response using the model tier the message is routed to
+
+        When a session is given, its earlier turns are included as far as the
+        context token budget allows.
+        """
+        route = None
+        started = time.perf_counter()
         try:
-            # Prepare conversation context
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful AI learning assistant focused on helping users with pronunciation, reading skills, and educational topics. Be friendly, encouraging, and provide practical advice. Keep responses concise but informative."
-                }
-            ]
-            
             # Add context if provided
             if context:
-                messages.append({
-                    "role": "user",
-                    "content": f"Context: {context}\n\nCurrent message: {message}"
-                })
+                user_content = f"Context: {context}\n\nCurrent message: {message}"
             else:
-                messages.append({
-                    "role": "user",
-                    "content": message
-                })
+                user_content = message
             
-            # Call OpenAI API
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=300,
-                temperature=0.7
+            # Prepare conversation context
+            history = self.history.recent(session_id) if session_id else []
+            route = classify(message, len(history))
+            messages, report = self.context_builder.build(SYSTEM_PROMPT, user_content, history, session_id)
+            logger.debug(
+                "Prompt for session %s: %d tokens (%d saved), %d/%d turns, summary=%s",
+                session_id, report["prompt_tokens"], report["tokens_saved"],
+                report["turns_included"], report["turns_total"], report["summary_used"]
             )
             
-            return response.choices[0].message.content.strip()
+            # Call OpenAI API
+            tier = route.tier
+            with tracing.span("llm.chat", kind="client", model=tier.model, tier=tier.name) as span:
+                span.set("prompt_tokens.estimated", report["prompt_tokens"])
+                response = self.openai_client.chat.completions.create(
+                    model=tier.model,
+                    messages=messages,
+                    max_tokens=tier.max_tokens,
+                    temperature=tier.temperature
+                )
+                
+                choice = response.choices[0]
+                usage = getattr(response, "usage", None)
+                span.set("prompt_tokens", getattr(usage, "prompt_tokens", None))
+                span.set("completion_tokens", getattr(usage, "completion_tokens", None))
+                span.set("finish_reason", getattr(choice, "finish_reason", None))
+            self.router_metrics.record(
+                route, message, time.perf_counter() - started,
+                prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+                finish_reason=getattr(choice, "finish_reason", None)
+            )
+            return choice.message.content.strip()
             
         except Exception as e:
             logger.error(f"Error generating AI response: {e}")
+            if route is not None:
+                self.router_metrics.record(route, message, time.perf_counter() - started, error=str(e))
             return self.get_fallback_response(message)
     
-    def generate_speech(self, text: str, voice: str = "alloy") -> bytes:
-        """Generate speech from text using OpenAI TTS"""
+    def summarize_turns(self, turns: List[Dict[str, Any]]) -> str:
+        """Summarize older conversation turns; runs off the request path"""
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
         try:
-            logger.info(f"Generating speech for: {text[:50]}...")
-            
-            # Call OpenAI TTS API
-            response = self.openai_client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text
+            response = self.openai_client.chat.completions.create(
+                model=self.summary_model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Summarize this tutoring conversation in at most five short sentences. Keep the learner's goals, words they struggled with and advice already given."
+                    },
+                    {"role": "user", "content": transcript}
+                ],
+                max_tokens=150,
+                temperature=0.2
             )
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            logger.warning(f"Summary model unavailable, using extractive summary: {e}")
+            return extractive_summary(turns)
+    
+    @staticmethod
+    def speech_cache_key(text: str, voice: str, audio_format: str = "mp3") -> str:
+        """Cache key for generated speech; MP3 keeps the key it had before formats existed"""
+        prefix = f"{voice}\0" if audio_format == "mp3" else f"{voice}\0{audio_format}\0"
+        digest = hashlib.sha256(f"{prefix}{text}".encode()).hexdigest()
+        return f"speech:{digest}"
+    
+    def generate_speech(self, text: str, voice: str = "alloy", audio_format: str = "mp3") -> bytes:
+        """Generate speech from text using OpenAI TTS, in one of speech_formats.FORMATS"""
+        fmt = FORMATS[audio_format]
+        cache_key = self.speech_cache_key(text, voice, fmt.name)
+        if self.speech_cache_ttl > 0:
+            cached = self.state.get(cache_key)
+            if cached is not None:
+                logger.info("Speech cache hit (%s), size: %d bytes", fmt.name, len(cached), extra={"route": "tts"})
+                return cached
+        
+        try:
+            if fmt.upstream is None:
+                # Re-encoded from the MP3, which is usually cached already
+                audio_data = encode(self.generate_speech(text, voice, "mp3"), fmt)
+                if audio_data is None:
+                    raise RuntimeError(f"Could not encode speech as {fmt.name}")
+            else:
+                audio_data = self._synthesize(text, voice, fmt)
             
-            # Get the audio data
-            audio_data = response.content
-            
-            logger.info(f"Speech generated successfully, size: {len(audio_data)} bytes")
+            logger.info("Speech generated successfully (%s), size: %d bytes", fmt.name, len(audio_data), extra={"route": "tts"})
+            if self.speech_cache_ttl > 0:
+                self.state.set(cache_key, audio_data, self.speech_cache_ttl)
             return audio_data
             
         except Exception as e:
             logger.error(f"Error generating speech: {e}")
             raise
     
+    def _synthesize(self, text: str, voice: str, fmt: SpeechFormat) -> bytes:
+        """One OpenAI TTS call, streamed so the time to its first byte is measured"""
+        logger.info("Generating speech (%d chars, voice %s, %s)", len(text), voice, fmt.name, extra={"route": "tts"})
+        with tracing.span("tts.synthesize", kind="client", model="tts-1", voice=voice, chars=len(text), format=fmt.name) as span:
+            started = time.perf_counter()
+            first_byte = None
+            chunks = []
+            with self.openai_client.audio.speech.with_streaming_response.create(
+                model="tts-1",
+                voice=voice,
+                input=text,
+                response_format=fmt.upstream
+            ) as response:
+                for chunk in response.iter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+                    chunks.append(chunk)
+            elapsed = time.perf_counter() - started
+            audio_data = b"".join(chunks)
+            span.update({"bytes": len(audio_data), "first_byte_ms": round((first_byte or elapsed) * 1000, 1)})
+        speech_stats.record_upstream(fmt.name, first_byte or elapsed, elapsed)
+        return audio_data
+    
+    def transcribe(self, audio: bytes, filename: str = "audio.wav", mime: str = "audio/wav") -> str:
+        """Transcribe one upload (or chunk) with OpenAI Whisper"""
+        with tracing.span("stt.transcribe", kind="client", model="whisper-1", bytes=len(audio), mime=mime):
+            response = self.openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(filename, audio, mime),
+                response_format="text"
+            )
+        return response.strip()
+    
+    def transcribe_timed(
+        self, audio: bytes, filename: str = "audio.wav", mime: str = "audio/wav"
+    ) -> Tuple[str, List[Tuple[str, float, float]]]:
+        """Transcribe one chunk with each word's start and end, so chunks can be joined by time"""
+        with tracing.span("stt.transcribe", kind="client", model="whisper-1", bytes=len(audio), mime=mime, timestamps="word"):
+            response = self.openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(filename, audio, mime),
+                response_format="verbose_json",
+                timestamp_granularities=["word"]
+            )
+        words = [(word.word, word.start, word.end) for word in (response.words or [])]
+        return response.text.strip(), words
+    
+    def align_speech(self, text: str, voice: str, audio_data: bytes) -> Alignment:
+        """Word timings for generated speech, cached next to the audio"""
+        cache_key = "align:" + self.speech_cache_key(text, voice).partition(":")[2]
+        if self.speech_cache_ttl > 0:
+            cached = self.state.get(cache_key)
+            if cached is not None:
+                return Alignment.from_bytes(cached)
+        
+        alignment = align(text, audio_data)
+        if self.speech_cache_ttl > 0:
+            self.state.set(cache_key, alignment.to_bytes(), self.speech_cache_ttl)
+        return alignment
+    
     def get_fallback_response(self, message: str) -> str:
         """Provide fallback response when AI is unavailable"""
         fallback_responses = [
@@ -133,30 +273,49 @@ class AIVoiceAgent:
         import random
         return random.choice(fallback_responses)
     
-    def get_conversation_history(self) -> List[Dict[str, str]]:
+    def get_conversation_history(self, session_id: str = DEFAULT_SESSION) -> List[Dict[str, str]]:
         """Get conversation history"""
-        return self.conversation_history.copy()
+        return self.history.recent(session_id)
     
-    def clear_conversation_history(self) -> None:
+    def get_conversation_page(self, session_id: str = DEFAULT_SESSION, limit: int = 50, before: Optional[str] = None) -> Dict[str, Any]:
+        """One page of conversation history, newest page first, with the cursor for older entries"""
+        entries, next_cursor = self.history.page(session_id, limit, before)
+        return {
+            "history": entries,
+            "next_cursor": next_cursor,
+            "total": self.history.count(session_id)
+        }
+    
+    def clear_conversation_history(self, session_id: str = DEFAULT_SESSION) -> None:
         """Clear conversation history"""
-        self.conversation_history.clear()
+        self.history.clear(session_id)
+        self.context_builder.summarizer.clear(session_id)
         logger.info("Conversation history cleared")
     
     def get_status(self) -> Dict[str, Any]:
         """Get agent status information"""
         return {
             "status": "active",
-            "conversation_count": len(self.conversation_history),
+            "conversation_count": self.history.count(DEFAULT_SESSION),
             "max_history_length": self.max_history_length,
+            "state_backend": self.state.name,
             "openai_configured": bool(os.getenv('OPENAI_API_KEY')),
             "timestamp": datetime.now().isoformat()
         }
 
-# Global agent instance
-agent = AIVoiceAgent()
+# Global agent instance; history is durable (HISTORY_URL, SQLite by default)
+_state = create_backend()
+agent = AIVoiceAgent(state=_state, history_store=create_history_store(_state))
 
 if __name__ == "__main__":
     """Test the agent directly"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
     try:
         logger.info("Starting AI Voice Agent...")
         
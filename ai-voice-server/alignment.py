@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Word Timing Alignment
+Per-word start/end times for generated speech, for read-along highlighting
+
+The text is known, so only the timing needs recovering. A loudness envelope
+is taken from the audio: MP3 granule bit counts (no decoding), or RMS for
+WAV/PCM. Pauses in it are matched to the word boundaries most likely to
+carry one (sentence ends, commas), and the words between two anchors share
+the time in proportion to their estimated length. When the envelope is flat
+the words are spread over the whole clip by estimated length.
+
+Word ``i`` of an alignment is the ``i``-th whitespace-separated token of the
+text. Timings are kept as two ``array('I')`` of milliseconds, 8 bytes per
+word when stored.
+"""
+
+import io
+import math
+import re
+import struct
+import wave
+from array import array
+from typing import List, Optional, Sequence, Tuple
+
+import mp3_frames
+
+# Shortest silence treated as a pause between words
+MIN_PAUSE_SECONDS = 0.12
+# Voiced blips shorter than this inside a pause are ignored
+MIN_VOICED_SECONDS = 0.03
+PCM_HOP_SECONDS = 0.01
+
+_HEADER = struct.Struct("<3sBII")  # magic, method, word count, duration ms
+_MAGIC = b"AL1"
+METHODS = ("proportional", "energy")
+
+_VOWEL_GROUPS = re.compile(r"[aeiouy]+", re.IGNORECASE)
+
+
+class Alignment:
+    """Word timings in milliseconds, array-backed"""
+
+    __slots__ = ("starts", "ends", "duration_ms", "method")
+
+    def __init__(self, starts: array, ends: array, duration_ms: int, method: str):
+        self.starts = starts
+        self.ends = ends
+        self.duration_ms = duration_ms
+        self.method = method
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def to_bytes(self) -> bytes:
+        starts, ends = array("I", self.starts), array("I", self.ends)
+        if struct.pack("=I", 1) != struct.pack("<I", 1):
+            starts.byteswap()
+            ends.byteswap()
+        header = _HEADER.pack(_MAGIC, METHODS.index(self.method), len(starts), self.duration_ms)
+        return header + starts.tobytes() + ends.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Alignment":
+        magic, method, count, duration_ms = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("Not an alignment record")
+        body = data[_HEADER.size:]
+        starts, ends = array("I"), array("I")
+        starts.frombytes(body[:4 * count])
+        ends.frombytes(body[4 * count:8 * count])
+        if struct.pack("=I", 1) != struct.pack("<I", 1):
+            starts.byteswap()
+            ends.byteswap()
+        return cls(starts, ends, duration_ms, METHODS[method])
+
+    def to_dict(self, words: Sequence[str]) -> dict:
+        """Columnar JSON form: parallel word/start/end lists"""
+        return {
+            "method": self.method,
+            "duration_ms": self.duration_ms,
+            "words": list(words),
+            "start_ms": self.starts.tolist(),
+            "end_ms": self.ends.tolist()
+        }
+
+    @classmethod
+    def concat(cls, parts: Sequence["Alignment"]) -> "Alignment":
+        """Join the alignments of consecutive clips, shifting each by the clips before it"""
+        starts, ends = array("I"), array("I")
+        offset = 0
+        for part in parts:
+            starts.extend(start + offset for start in part.starts)
+            ends.extend(end + offset for end in part.ends)
+            offset += part.duration_ms
+        methods = {part.method for part in parts}
+        return cls(starts, ends, offset, "energy" if methods == {"energy"} else "proportional")
+
+
+def word_weight(word: str) -> float:
+    """Rough relative speaking time of a word"""
+    core = re.sub(r"[^\w]", "", word)
+    if not core:
+        return 0.2
+    if core.isdigit():
+        return 0.6 * len(core)  # digits are read one number-word at a time
+    syllables = max(1, len(_VOWEL_GROUPS.findall(core)))
+    return 0.4 + syllables + 0.03 * len(core)
+
+
+def pause_prior(word: str) -> float:
+    """How likely a pause is after ``word``, from its trailing punctuation"""
+    stripped = word.rstrip("\"')]”’")
+    if stripped.endswith((".", "!", "?", "…")):
+        return 3.0
+    if stripped.endswith((",", ";", ":", "—", "-")):
+        return 1.5
+    return 0.3
+
+
+def mp3_envelope(data: bytes) -> Tuple[List[float], float]:
+    values, hop = mp3_frames.granule_bits(data)
+    return [float(value) for value in values], hop
+
+
+def wav_envelope(data: bytes) -> Tuple[List[float], float]:
+    with wave.open(io.BytesIO(data)) as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError("Only 16-bit WAV is supported")
+        channels, rate = wav.getnchannels(), wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    return pcm_envelope(frames, rate, channels)
+
+
+def pcm_envelope(data: bytes, sample_rate: int = 24000, channels: int = 1, stride: int = 1) -> Tuple[List[float], float]:
+    """RMS per 10 ms hop of signed 16-bit little-endian PCM
+
+    With ``stride`` > 1 only every stride-th frame of the first channel is
+    used, which is plenty for finding pauses in long recordings.
+    """
+    samples = array("h")
+    samples.frombytes(data[:len(data) - len(data) % 2])
+    if struct.pack("=h", 1) != struct.pack("<h", 1):
+        samples.byteswap()
+    hop = max(1, int(sample_rate * PCM_HOP_SECONDS)) * channels
+    step = stride * channels if stride > 1 else 1
+    values = []
+    for start in range(0, len(samples), hop):
+        window = samples[start:start + hop:step]
+        values.append(math.sqrt(sum(sample * sample for sample in window) / len(window)))
+    return values, hop / channels / sample_rate
+
+
+def detect_voicing(envelope: List[float], hop: float) -> Optional[List[bool]]:
+    """Voiced/unvoiced per hop, or None when the envelope carries no signal"""
+    ordered = sorted(envelope)
+    floor = ordered[len(ordered) // 10]
+    peak = ordered[min(len(ordered) - 1, len(ordered) * 9 // 10)]
+    if peak <= floor or peak <= 0:
+        return None
+    threshold = floor + 0.2 * (peak - floor)
+    voiced = [value > threshold for value in envelope]
+
+    # Drop voiced blips (clicks, breaths) too short to be speech
+    shortest = max(1, round(MIN_VOICED_SECONDS / hop))
+    index = 0
+    while index < len(voiced):
+        if voiced[index]:
+            end = index
+            while end < len(voiced) and voiced[end]:
+                end += 1
+            if end - index < shortest:
+                voiced[index:end] = [False] * (end - index)
+            index = end
+        else:
+            index += 1
+    return voiced if any(voiced) else None
+
+
+def _pauses(voiced: List[bool], hop: float) -> Tuple[float, float, List[Tuple[float, float]]]:
+    """Speech span and the pauses inside it, in seconds"""
+    first = voiced.index(True)
+    last = len(voiced) - 1 - voiced[::-1].index(True)
+    pauses = []
+    index = first
+    while index <= last:
+        if not voiced[index]:
+            end = index
+            while end <= last and not voiced[end]:
+                end += 1
+            if (end - index) * hop >= MIN_PAUSE_SECONDS:
+                pauses.append((index * hop, end * hop))
+            index = end
+        else:
+            index += 1
+    return first * hop, (last + 1) * hop, pauses
+
+
+def _spread(weights: Sequence[float], start: float, end: float) -> List[Tuple[float, float]]:
+    total = sum(weights) or 1.0
+    spans, position = [], start
+    for weight in weights:
+        length = (end - start) * weight / total
+        spans.append((position, position + length))
+        position += length
+    return spans
+
+
+def _match_pauses(
+    boundary_times: List[float],
+    priors: List[float],
+    pauses: List[Tuple[float, float]],
+    word_seconds: float
+) -> List[Tuple[int, int]]:
+    """Monotonic best matching of pauses to word boundaries (dynamic programming)
+
+    A match scores higher for a likely boundary and a long pause, lower the
+    further the pause is from where the boundary was expected.
+    """
+    boundaries, count = len(boundary_times), len(pauses)
+    if not boundaries or not count:
+        return []
+
+    def score(pause: int, boundary: int) -> float:
+        start, end = pauses[pause]
+        strength = min(2.0, (end - start) / MIN_PAUSE_SECONDS)
+        distance = abs(boundary_times[boundary] - (start + end) / 2) / max(word_seconds, 1e-3)
+        return priors[boundary] * strength - distance
+
+    # best[p][b]: best total using the first p pauses and first b boundaries
+    best = [[0.0] * (boundaries + 1) for _ in range(count + 1)]
+    for p in range(1, count + 1):
+        row, previous = best[p], best[p - 1]
+        for b in range(1, boundaries + 1):
+            row[b] = max(previous[b], row[b - 1], previous[b - 1] + score(p - 1, b - 1))
+
+    matches = []
+    p, b = count, boundaries
+    while p > 0 and b > 0:
+        if best[p][b] == best[p - 1][b]:
+            p -= 1
+        elif best[p][b] == best[p][b - 1]:
+            b -= 1
+        else:
+            matches.append((p - 1, b - 1))
+            p -= 1
+            b -= 1
+    matches.reverse()
+    return [(pause, boundary) for pause, boundary in matches if score(pause, boundary) > 0]
+
+
+def align(text: str, audio: bytes, audio_format: str = "mp3", duration: Optional[float] = None) -> Alignment:
+    """Word timings for ``text`` spoken in ``audio`` (``mp3``, ``wav`` or 24 kHz mono ``pcm``)"""
+    words = text.split()
+    if audio_format == "wav":
+        envelope, hop = wav_envelope(audio)
+    elif audio_format == "pcm":
+        envelope, hop = pcm_envelope(audio)
+    else:
+        envelope, hop = mp3_envelope(audio)
+    if duration is None:
+        duration = len(envelope) * hop
+
+    weights = [word_weight(word) for word in words]
+    voiced = detect_voicing(envelope, hop) if envelope else None
+    if not words:
+        spans, method = [], "proportional"
+    elif voiced is None:
+        # Nothing to anchor on; spread words, leaving room for likely pauses
+        padded = [weight + 0.5 * pause_prior(word) for weight, word in zip(weights, words)]
+        spans = [(start, start + (end - start) * weight / padded_weight)
+                 for (start, end), weight, padded_weight in zip(_spread(padded, 0.0, duration), weights, padded)]
+        method = "proportional"
+    else:
+        speech_start, speech_end, pauses = _pauses(voiced, hop)
+        spoken = speech_end - speech_start - sum(end - start for start, end in pauses)
+        expected = _spread(weights, speech_start, speech_end)
+        matches = _match_pauses(
+            [end for _, end in expected[:-1]],
+            [pause_prior(word) for word in words[:-1]],
+            pauses,
+            spoken / len(words)
+        )
+
+        # Anchors: (first word index, start time) ... closed by the speech end
+        spans, segment_start, first_word = [], speech_start, 0
+        for pause, boundary in matches + [(None, len(words) - 1)]:
+            segment_end = pauses[pause][0] if pause is not None else speech_end
+            spans.extend(_spread(weights[first_word:boundary + 1], segment_start, segment_end))
+            if pause is not None:
+                segment_start = pauses[pause][1]
+            first_word = boundary + 1
+        method = "energy"
+
+    starts = array("I", (int(round(start * 1000)) for start, _ in spans))
+    ends = array("I", (int(round(end * 1000)) for _, end in spans))
+    return Alignment(starts, ends, int(round(duration * 1000)), method)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark Harness Helpers
+Process management and latency statistics shared by the benchmark scripts
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import aiohttp
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+BENCHMARK_DIR = Path(__file__).resolve().parent
+# Where service_common lives
+REPO_DIR = SERVER_DIR.parent
+
+# Simulated clients all share one address; per-client limits would throttle the run
+UNLIMITED_ENV = {"RATE_LIMIT_RPS": "0", "RATE_LIMIT_IP_RPS": "0", "TOKEN_QUOTA": "0", "AUDIO_QUOTA_SECONDS": "0",
+                 "TOKEN_QUOTA_IP": "0", "AUDIO_QUOTA_IP_SECONDS": "0"}
+
+
+def with_repo_path(env: Dict[str, str]) -> Dict[str, str]:
+    """``env`` with the repository root on PYTHONPATH, so service_common imports"""
+    paths = [str(REPO_DIR)] + [path for path in env.get("PYTHONPATH", "").split(os.pathsep) if path]
+    return {**env, "PYTHONPATH": os.pathsep.join(paths)}
+
+
+def start_process(args: List[str], env: Dict[str, str], cwd: Path = SERVER_DIR) -> subprocess.Popen:
+    """Start a Python child process with output discarded"""
+    return subprocess.Popen(
+        [sys.executable, *args],
+        cwd=cwd,
+        env=with_repo_path(env),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+
+def stop_process(proc: subprocess.Popen, timeout: float = 15.0) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+async def wait_until_up(url: str, timeout: float = 30.0, interval: float = 0.2) -> None:
+    """Poll ``url`` until it answers 200"""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(interval)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of ``values``"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/mean/max in milliseconds"""
+    if not latencies:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "max": 0.0}
+    return {
+        "p50": round(percentile(latencies, 50) * 1000, 2),
+        "p95": round(percentile(latencies, 95) * 1000, 2),
+        "p99": round(percentile(latencies, 99) * 1000, 2),
+        "mean": round(sum(latencies) / len(latencies) * 1000, 2),
+        "max": round(max(latencies) * 1000, 2)
+    }
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+Voice Server Load Test
+Concurrent load generator for the HTTP endpoints and /ws, with a JSON report
+
+Each virtual user (think: one student's browser tab) loops over the scenario
+mix until the duration is up. With --spawn the mock OpenAI upstream and the
+server are started locally, so runs are fully offline and comparable between
+versions of server.py.
+
+Scenarios: chat, chat_repeat (identical prompts, exercises coalescing),
+speech, stt, ws, health.
+
+Usage:
+    python benchmarks/load_test.py --spawn --users 50 --duration 30 --mix chat=3 speech=1 ws=2
+    python benchmarks/load_test.py --base-url http://localhost:8000 --users 20 --output report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from harness import BENCHMARK_DIR, SERVER_DIR, UNLIMITED_ENV, latency_summary, start_process, stop_process, wait_until_up
+
+PROMPTS = [
+    "How do I pronounce 'necessary'?",
+    "What does the word 'photosynthesis' mean?",
+    "Can you split 'comfortable' into syllables?",
+    "Give me a tip for reading long words.",
+    "What's the difference between 'their' and 'there'?",
+]
+
+PASSAGE = (
+    "Bees visit flowers to collect nectar. As they move from flower to flower, "
+    "they carry pollen, which helps plants make seeds."
+)
+
+AUDIO_SAMPLE = SERVER_DIR / "test_audio.mp3"
+
+
+class Recorder:
+    """Collects per-scenario latencies, status codes and errors"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.statuses: Dict[str, Counter] = defaultdict(Counter)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def record(self, scenario: str, started: float, status: Any, ok: bool) -> None:
+        self.latencies[scenario].append(time.perf_counter() - started)
+        self.statuses[scenario][str(status)] += 1
+        if not ok:
+            self.errors[scenario] += 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        scenarios = {}
+        for name, latencies in sorted(self.latencies.items()):
+            count = len(latencies)
+            scenarios[name] = {
+                "requests": count,
+                "errors": self.errors[name],
+                "error_rate": round(self.errors[name] / count, 4) if count else 0.0,
+                "throughput_rps": round(count / elapsed, 2),
+                "latency_ms": latency_summary(latencies),
+                "status_codes": dict(self.statuses[name])
+            }
+        everything = [value for latencies in self.latencies.values() for value in latencies]
+        total_errors = sum(self.errors.values())
+        return {
+            "overall": {
+                "requests": len(everything),
+                "errors": total_errors,
+                "error_rate": round(total_errors / len(everything), 4) if everything else 0.0,
+                "throughput_rps": round(len(everything) / elapsed, 2),
+                "latency_ms": latency_summary(everything)
+            },
+            "scenarios": scenarios
+        }
+
+
+class VirtualUser:
+    """One simulated client with its own session and, lazily, its own WebSocket"""
+
+    def __init__(self, base_url: str, http: aiohttp.ClientSession, recorder: Recorder, protocol: str):
+        self.base_url = base_url
+        self.http = http
+        self.recorder = recorder
+        self.protocol = protocol
+        self.session_id = uuid.uuid4().hex
+        self.ws: Optional[aiohttp.ClientWebSocketResponse] = None
+
+    async def _request(self, scenario: str, method: str, path: str, **kwargs: Any) -> None:
+        started = time.perf_counter()
+        try:
+            async with self.http.request(method, self.base_url + path, **kwargs) as response:
+                await response.read()
+                self.recorder.record(scenario, started, response.status, response.status < 400)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.recorder.record(scenario, started, type(e).__name__, False)
+
+    async def chat(self) -> None:
+        prompt = f"{random.choice(PROMPTS)} (request {uuid.uuid4().hex[:6]})"
+        await self._request("chat", "POST", "/chat", json={"message": prompt},
+                            headers={"X-Session-ID": self.session_id})
+
+    async def chat_repeat(self) -> None:
+        # Fresh session each time so the prompt is eligible for cross-session coalescing
+        await self._request("chat_repeat", "POST", "/chat", json={"message": PROMPTS[0]},
+                            headers={"X-Session-ID": uuid.uuid4().hex})
+
+    async def speech(self) -> None:
+        await self._request("speech", "POST", "/speech", json={"text": PASSAGE, "voice": "alloy"})
+
+    async def stt(self) -> None:
+        form = aiohttp.FormData()
+        form.add_field("audio_file", AUDIO_SAMPLE.read_bytes(), filename="sample.mp3", content_type="audio/mpeg")
+        await self._request("stt", "POST", "/speech-to-text", data=form)
+
+    async def health(self) -> None:
+        await self._request("health", "GET", "/health")
+
+    async def ws_chat(self) -> None:
+        started = time.perf_counter()
+        try:
+            if self.ws is None or self.ws.closed:
+                url = self.base_url.replace("http", "ws", 1)
+                self.ws = await self.http.ws_connect(f"{url}/ws?session={self.session_id}&protocol={self.protocol}")
+            message = {"type": "chat", "message": random.choice(PROMPTS)}
+            if self.protocol == "msgpack":
+                import msgpack
+
+                await self.ws.send_bytes(msgpack.packb(message))
+            else:
+                await self.ws.send_str(json.dumps(message))
+            frame = await self.ws.receive(timeout=60)
+            ok = frame.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY)
+            self.recorder.record("ws", started, "message" if ok else frame.type.name, ok)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.recorder.record("ws", started, type(e).__name__, False)
+            self.ws = None
+
+    async def close(self) -> None:
+        if self.ws is not None:
+            await self.ws.close()
+
+
+SCENARIOS = {
+    "chat": VirtualUser.chat,
+    "chat_repeat": VirtualUser.chat_repeat,
+    "speech": VirtualUser.speech,
+    "stt": VirtualUser.stt,
+    "ws": VirtualUser.ws_chat,
+    "health": VirtualUser.health,
+}
+
+
+async def run_load(
+    base_url: str,
+    users: int,
+    duration: float,
+    mix: Dict[str, float],
+    ramp_up: float,
+    protocol: str
+) -> Dict[str, Any]:
+    recorder = Recorder()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=120)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+        started = time.perf_counter()
+        deadline = time.monotonic() + duration
+
+        async def user_loop(index: int) -> None:
+            # Spread connection setup over the ramp-up period
+            await asyncio.sleep(ramp_up * index / max(users, 1))
+            user = VirtualUser(base_url, http, recorder, protocol)
+            try:
+                while time.monotonic() < deadline:
+                    scenario = random.choices(names, weights)[0]
+                    await SCENARIOS[scenario](user)
+            finally:
+                await user.close()
+
+        await asyncio.gather(*(user_loop(i) for i in range(users)))
+        elapsed = time.perf_counter() - started
+
+        try:
+            async with http.get(f"{base_url}/metrics") as response:
+                server_metrics = await response.json()
+        except (aiohttp.ClientError, ValueError):
+            server_metrics = None
+
+    report = recorder.report(elapsed)
+    report["elapsed_s"] = round(elapsed, 2)
+    report["server_metrics"] = server_metrics
+    return report
+
+
+def parse_mix(values: List[str]) -> Dict[str, float]:
+    mix = {}
+    for value in values:
+        name, _, weight = value.partition("=")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=20, help="Concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--ramp-up", type=float, default=2.0)
+    parser.add_argument("--mix", nargs="+", default=["chat=3", "chat_repeat=1", "speech=1", "stt=1", "ws=2"])
+    parser.add_argument("--protocol", choices=["json", "msgpack"], default="json", help="/ws wire protocol")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--label", help="Free-form label stored in the report, e.g. a git revision")
+
+    spawn = parser.add_argument_group("local stack")
+    spawn.add_argument("--spawn", action="store_true", help="Start the mock upstream and server locally")
+    spawn.add_argument("--workers", type=int, default=1)
+    spawn.add_argument("--port", type=int, default=8766)
+    spawn.add_argument("--mock-port", type=int, default=9100)
+    spawn.add_argument("--mock-latency", action="append", default=[], help="Passed to mock_openai.py --latency")
+    spawn.add_argument("--mock-error-rate", action="append", default=[], help="Passed to mock_openai.py --error-rate")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    mix = parse_mix(args.mix)
+
+    procs = []
+    base_url = args.base_url
+    try:
+        if args.spawn:
+            env = dict(os.environ)
+            env["OPENAI_API_KEY"] = "sk-mock"
+            env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.mock_port}/v1"
+            env.update(UNLIMITED_ENV)
+            mock_args = [str(BENCHMARK_DIR / "mock_openai.py"), "--port", str(args.mock_port)]
+            for spec in args.mock_latency:
+                mock_args += ["--latency", spec]
+            for spec in args.mock_error_rate:
+                mock_args += ["--error-rate", spec]
+            if args.seed is not None:
+                mock_args += ["--seed", str(args.seed)]
+            procs.append(start_process(mock_args, env))
+            procs.append(start_process([
+                "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(args.port),
+                "--workers", str(args.workers), "--log-level", "warning"
+            ], env))
+            base_url = f"http://127.0.0.1:{args.port}"
+            asyncio.run(wait_until_up(f"{base_url}/health"))
+
+        report = asyncio.run(run_load(base_url, args.users, args.duration, mix, args.ramp_up, args.protocol))
+    finally:
+        for proc in reversed(procs):
+            stop_process(proc)
+
+    report["config"] = {
+        "label": args.label,
+        "base_url": base_url,
+        "users": args.users,
+        "duration_s": args.duration,
+        "mix": mix,
+        "protocol": args.protocol,
+        "spawned": args.spawn,
+        "workers": args.workers if args.spawn else None
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
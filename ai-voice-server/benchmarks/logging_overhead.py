@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Logging Overhead Benchmark
+Per-request logging cost on the calling thread, before and after structured_logging
+
+A "request" is the log traffic of one /chat call: the access line, the chat
+message, the TTS lines, plus a /health probe's access line. It is replayed
+through three setups writing to the sink, os.devnull or, with --sink pipe,
+a pipe drained by a child process as a container's log driver would:
+
+    before      basicConfig text handler, f-strings with the full message,
+                formatted and written on the caller's thread
+    json_sync   the structured JSON lines, still formatted and written inline
+    after       structured_logging.LogPipeline: sampled, truncated and
+                queued; a background thread formats and writes
+
+Caller CPU and wall time are what the event loop pays per request; wall
+time adds waiting on a full pipe. For "after" the writer starts once the
+requests are queued, so on a small machine it does not share the caller's
+core. Total CPU is the whole process's, writer included, per request until
+the queue has drained. Results are printed as JSON.
+
+Usage: python benchmarks/logging_overhead.py [--requests 20000] [--message-chars 2000] [--sink pipe]
+"""
+
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.parent))
+
+from service_common.structured_logging import LogPipeline, TEXT_FORMAT, create_formatter  # noqa: E402
+
+ACCESS = '%s - "%s %s HTTP/%s" %d'
+
+
+def before(logger: logging.Logger, access: logging.Logger, message: str) -> None:
+    access.info(ACCESS, "10.0.0.7:52114", "GET", "/health", "1.1", 200)
+    logger.info(f"Chat message received: {message}")
+    logger.info(f"Generating speech for: {message[:50]}...")
+    logger.info(f"Speech generated successfully, size: {48213} bytes")
+    access.info(ACCESS, "10.0.0.7:52114", "POST", "/chat", "1.1", 200)
+
+
+def after(logger: logging.Logger, access: logging.Logger, message: str) -> None:
+    access.info(ACCESS, "10.0.0.7:52114", "GET", "/health", "1.1", 200)
+    logger.info("Chat message received (%d chars)", len(message), extra={"route": "chat"})
+    logger.info("Generating speech (%d chars, voice %s)", len(message), "alloy", extra={"route": "tts"})
+    logger.info("Speech generated successfully, size: %d bytes", 48213, extra={"route": "tts"})
+    access.info(ACCESS, "10.0.0.7:52114", "POST", "/chat", "1.1", 200)
+
+
+def loggers(handler: logging.Handler) -> List[logging.Logger]:
+    """A fresh app and access logger, both writing only to ``handler``"""
+    created = []
+    for name in ("bench.server", "bench.access"):
+        logger = logging.getLogger(name)
+        logger.handlers[:] = [handler]
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        created.append(logger)
+    # The sampler recognises access lines by uvicorn's logger name
+    created[1].name = "uvicorn.access"
+    return created
+
+
+def measure(requests: int, emit: Callable[[], None], drain: Callable[[], None] = lambda: None) -> Dict[str, float]:
+    cpu, wall = [], []
+    process_started = time.process_time()
+    for _ in range(requests):
+        started, cpu_started = time.perf_counter(), time.thread_time()
+        emit()
+        cpu.append(time.thread_time() - cpu_started)
+        wall.append(time.perf_counter() - started)
+    drain()
+    total = time.process_time() - process_started
+    wall.sort()
+    return {
+        "caller_cpu_us": round(statistics.fmean(cpu) * 1e6, 2),
+        "caller_wall_us": round(statistics.fmean(wall) * 1e6, 2),
+        "caller_wall_p99_us": round(wall[int(len(wall) * 0.99)] * 1e6, 2),
+        "total_cpu_us": round(total / requests * 1e6, 2)
+    }
+
+
+def run(requests: int, message: str, sink: str) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    reader = None
+    if sink == "pipe":
+        reader = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+        devnull = reader.stdin
+    else:
+        devnull = open(os.devnull, "w")
+    with devnull:
+        text = logging.StreamHandler(devnull)
+        text.setFormatter(logging.Formatter(TEXT_FORMAT))
+        app, access = loggers(text)
+        results["before"] = measure(requests, lambda: before(app, access, message))
+
+        inline = logging.StreamHandler(devnull)
+        inline.setFormatter(create_formatter("json", "bench"))
+        app, access = loggers(inline)
+        results["json_sync"] = measure(requests, lambda: after(app, access, message))
+
+        # Large enough that the comparison is not about drops
+        pipeline = LogPipeline("bench", "json", queue_size=requests * 5, stream=devnull)
+        app, access = loggers(pipeline.handler)
+        results["after"] = measure(requests, lambda: after(app, access, message), lambda: pipeline.start().stop())
+        stats = pipeline.get_stats()
+        results["after"].update({"written": stats["enqueued"], "dropped": stats["dropped"], "sampled_out": stats["sampled_out"]})
+    if reader is not None:
+        reader.wait()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--message-chars", type=int, default=2000, help="Length of the chat message")
+    parser.add_argument("--sink", choices=("devnull", "pipe"), default="devnull")
+    args = parser.parse_args()
+
+    message = ("How do I pronounce 'necessary'? " * (args.message_chars // 32 + 1))[:args.message_chars]
+    print(json.dumps({
+        "requests": args.requests,
+        "message_chars": args.message_chars,
+        "sink": args.sink,
+        "per_request": run(args.requests, message, args.sink)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
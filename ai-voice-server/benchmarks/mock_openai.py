@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI Upstream
+Local stand-in for the OpenAI endpoints the voice server calls, for offline load tests
+
+Serves chat completions (plain and streamed), TTS and Whisper transcription
+with configurable latency distributions and error rates. Point the server at
+it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Latency specs:
+    fixed:<s>                 always <s> seconds
+    uniform:<lo>:<hi>         uniformly distributed
+    normal:<mean>:<stddev>    normal, clamped at zero
+    lognormal:<median>:<sigma>
+
+Usage: python benchmarks/mock_openai.py --port 9100 --latency chat=lognormal:0.6:0.4 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from typing import Callable, Dict
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LATENCY = {
+    "chat": "lognormal:0.6:0.4",
+    "speech": "lognormal:0.9:0.3",
+    "transcription": "lognormal:0.8:0.3",
+}
+
+# One silent MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, 417 bytes, 26 ms
+MP3_FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+
+# 16-bit mono PCM at tts-1's 24 kHz
+PCM_RATE = 24000
+
+
+def silent_audio(response_format: str, seconds: float) -> bytes:
+    """``seconds`` of silence shaped like tts-1's output in each format
+
+    Sizes and durations are what the voice server measures; the Ogg pages
+    carry no checksums and the AAC frames no audio, so players would reject them.
+    """
+    if response_format == "pcm":
+        return bytes(int(seconds * PCM_RATE) * 2)
+    if response_format == "wav":
+        pcm = bytes(int(seconds * PCM_RATE) * 2)
+        return (
+            b"RIFF" + (36 + len(pcm)).to_bytes(4, "little") + b"WAVEfmt "
+            + (16).to_bytes(4, "little") + (1).to_bytes(2, "little") + (1).to_bytes(2, "little")
+            + PCM_RATE.to_bytes(4, "little") + (PCM_RATE * 2).to_bytes(4, "little")
+            + (2).to_bytes(2, "little") + (16).to_bytes(2, "little")
+            + b"data" + len(pcm).to_bytes(4, "little") + pcm
+        )
+    if response_format == "opus":
+        # One page per second of ~32 kbps audio; granule positions count 48 kHz samples
+        pre_skip = 312
+        head = b"OpusHead" + bytes([1, 1]) + pre_skip.to_bytes(2, "little") + PCM_RATE.to_bytes(4, "little") + bytes(3)
+        pages = [_ogg_page(head, 0, 0)]
+        for second in range(1, math.ceil(seconds) + 1):
+            granule = pre_skip + int(min(second, seconds) * 48000)
+            pages.append(_ogg_page(bytes(4000), granule, second))
+        return b"".join(pages)
+    if response_format == "aac":
+        # ADTS at 24 kHz (sampling index 6), ~64 kbps: 1024 samples per frame
+        length = 341
+        header = bytes([
+            0xFF, 0xF1, (1 << 6) | (6 << 2), 0x40 | (length >> 11),
+            (length >> 3) & 0xFF, ((length & 0x07) << 5) | 0x1F, 0xFC
+        ])
+        return (header + bytes(length - 7)) * max(1, int(seconds * PCM_RATE / 1024))
+    return MP3_FRAME * max(1, int(seconds / 0.026))
+
+
+def _ogg_page(payload: bytes, granule: int, sequence: int) -> bytes:
+    segments = [255] * (len(payload) // 255) + [len(payload) % 255]
+    return (
+        b"OggS" + bytes([0, 0]) + granule.to_bytes(8, "little") + (1).to_bytes(4, "little")
+        + sequence.to_bytes(4, "little") + bytes(4) + bytes([len(segments)]) + bytes(segments) + payload
+    )
+
+
+REPLY = (
+    "Great question! Try breaking the word into syllables and saying each part slowly, "
+    "then blend them together. Practice it three times and you'll have it."
+)
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Build a sampler returning a delay in seconds from a latency spec"""
+    kind, *params = spec.split(":")
+    values = [float(p) for p in params]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class MockOpenAI:
+    """Request handlers plus per-endpoint latency and error injection"""
+
+    def __init__(self, latency: Dict[str, str], error_rate: Dict[str, float], bytes_per_char: int = 600):
+        self.latency = {name: parse_latency(spec) for name, spec in latency.items()}
+        self.error_rate = error_rate
+        # Roughly what tts-1 MP3 output weighs per input character
+        self.bytes_per_char = bytes_per_char
+        self.requests: Dict[str, int] = {name: 0 for name in latency}
+        self.errors: Dict[str, int] = {name: 0 for name in latency}
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        failure = await self._guard("chat")
+        if failure is not None:
+            return failure
+        model = body.get("model", "gpt-4o")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": REPLY},
+                    "finish_reason": "stop"
+                }],
+                "usage": {"prompt_tokens": 50, "completion_tokens": 40, "total_tokens": 90}
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in REPLY.split(" "):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.01)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def speech(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        failure = await self._guard("speech")
+        if failure is not None:
+            return failure
+        size = max(1024, len(body.get("input", "")) * self.bytes_per_char)
+        response_format = body.get("response_format", "mp3")
+        if response_format == "mp3":
+            return web.Response(body=MP3_FRAME * max(1, size // len(MP3_FRAME)), content_type="audio/mpeg")
+        # The same speech length the MP3 would have had
+        seconds = size // len(MP3_FRAME) * 0.026
+        return web.Response(body=silent_audio(response_format, seconds), content_type="application/octet-stream")
+
+    async def transcriptions(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        failure = await self._guard("transcription")
+        if failure is not None:
+            return failure
+        text = "The quick brown fox jumps over the lazy dog."
+        if form.get("response_format") != "verbose_json":
+            return web.Response(text=text, content_type="text/plain")
+        # A word every 0.4 s, as timestamp_granularities=["word"] gives them
+        words = [
+            {"word": word.strip(".,"), "start": round(index * 0.4, 2), "end": round(index * 0.4 + 0.3, 2)}
+            for index, word in enumerate(text.split())
+        ]
+        return web.json_response({"task": "transcribe", "language": "english", "duration": len(words) * 0.4, "text": text, "words": words})
+
+    async def _guard(self, endpoint: str):
+        """Apply the endpoint's latency; return an error response if one is injected"""
+        self.requests[endpoint] += 1
+        await asyncio.sleep(self.latency[endpoint]())
+        if random.random() < self.error_rate.get(endpoint, 0.0):
+            self.errors[endpoint] += 1
+            return web.json_response(
+                {"error": {"message": "Injected failure", "type": "mock_error"}},
+                status=random.choice((429, 500, 503))
+            )
+        return None
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"requests": self.requests, "errors": self.errors})
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/v1/audio/speech", self.speech)
+        app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def parse_pairs(values, cast):
+    """Parse ``endpoint=value`` options; a bare value applies to every endpoint"""
+    result = {}
+    for value in values or ():
+        if "=" in value:
+            name, _, setting = value.partition("=")
+            result[name] = cast(setting)
+        else:
+            for name in DEFAULT_LATENCY:
+                result[name] = cast(value)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", action="append", help="[endpoint=]spec, endpoints: chat, speech, transcription")
+    parser.add_argument("--error-rate", action="append", help="[endpoint=]fraction of requests to fail")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    latency = dict(DEFAULT_LATENCY)
+    latency.update(parse_pairs(args.latency, str))
+    mock = MockOpenAI(latency, parse_pairs(args.error_rate, float))
+
+    logging.basicConfig(level=logging.WARNING)
+    web.run_app(mock.build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+WebSocket Protocol Microbenchmark
+Per-message CPU cost and size of the /ws codecs, plus the cost of payload logging
+
+Each codec is timed on a decode of an incoming frame plus an encode of the
+reply, the work /ws does per message. Results are printed as JSON.
+
+Usage: python benchmarks/protocol_codec.py [--iterations 20000]
+"""
+
+import argparse
+import io
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import protocol  # noqa: E402
+
+PASSAGE = (
+    "The quick brown fox jumps over the lazy dog. Reading aloud helps learners "
+    "connect letters to sounds, and hearing a word while seeing it builds recognition. "
+) * 4
+
+MESSAGES: Dict[str, Dict[str, Any]] = {
+    "chat": {"type": "chat", "message": "How do I pronounce 'necessary'?"},
+    "response": {"type": "response", "message": PASSAGE, "timestamp": 1234.5678},
+    "status": {
+        "type": "status",
+        "data": {
+            "status": "active",
+            "conversation_count": 42,
+            "max_history_length": 50,
+            "openai_configured": True,
+            "timestamp": "2025-01-01T12:00:00"
+        },
+        "timestamp": 1234.5678
+    },
+    "broadcast": {
+        "type": "broadcast",
+        "room": "class-7b",
+        "message": PASSAGE,
+        "data": {"passage_id": "p-1029", "words": PASSAGE.split()},
+        "timestamp": 1234.5678
+    }
+}
+
+
+def time_per_call(fn: Callable[[], Any], iterations: int) -> float:
+    """Best-of-three mean time per call in microseconds"""
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fn()
+        best = min(best, time.perf_counter() - started)
+    return best / iterations * 1e6
+
+
+def bench_codecs(iterations: int) -> Dict[str, Any]:
+    codecs = {"json-stdlib": None}
+    if protocol.ORJSON_AVAILABLE:
+        codecs["json-orjson"] = protocol.JSONCodec()
+    if protocol.MSGPACK_AVAILABLE:
+        codecs["msgpack"] = protocol.MsgpackCodec()
+
+    results: Dict[str, Any] = {}
+    for name, codec in codecs.items():
+        if codec is None:
+            encode, decode = json.dumps, json.loads
+        else:
+            encode, decode = codec.encode, codec.decode
+        per_message = {}
+        for kind, message in MESSAGES.items():
+            frame = encode(message)
+            per_message[kind] = {
+                "bytes": len(frame.encode() if isinstance(frame, str) else frame),
+                "round_trip_us": round(time_per_call(lambda: encode(decode(frame)), iterations), 3)
+            }
+        results[name] = per_message
+    return results
+
+
+def bench_logging(iterations: int) -> Dict[str, float]:
+    """Compare the previous INFO f-string payload log with the leveled DEBUG log"""
+    logger = logging.getLogger("protocol-bench")
+    logger.propagate = False
+    logger.addHandler(logging.StreamHandler(io.StringIO()))
+    logger.setLevel(logging.INFO)
+    data = json.dumps(MESSAGES["broadcast"])
+
+    def eager() -> None:
+        logger.info(f"Received WebSocket message: {data}")
+
+    def lazy() -> None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Received WebSocket message: %r", data)
+
+    return {
+        "info_fstring_us": round(time_per_call(eager, iterations), 3),
+        "debug_leveled_us": round(time_per_call(lazy, iterations), 3)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(json.dumps({
+        "iterations": args.iterations,
+        "codecs": bench_codecs(args.iterations),
+        "logging": bench_logging(args.iterations)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Speech Format Benchmark
+Bytes per second of speech and time to first byte for each /speech output format
+
+For every format, --runs passages the server has not seen (an upstream TTS
+call each) are requested, then the same passages again (served from the
+speech cache). Time to first byte and total time are measured at the client;
+size and X-Audio-Duration give the bytes, and kilobits, per second of
+speech. The server's own per-format upstream figures from /metrics are
+included. Results are printed as JSON.
+
+Against the real OpenAI API these are the numbers to pick a default from;
+with --spawn the mock upstream only models sizes, not encoders.
+
+Usage:
+    python benchmarks/speech_formats.py --spawn
+    python benchmarks/speech_formats.py --base-url http://localhost:8000 --formats mp3 opus pcm --runs 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List
+
+import aiohttp
+
+from harness import BENCHMARK_DIR, UNLIMITED_ENV, latency_summary, start_process, stop_process, wait_until_up
+
+PASSAGE = (
+    "Reading aloud helps learners connect letters to sounds, and hearing a word "
+    "while seeing it builds recognition. Try the next sentence slowly, then again "
+    "at your normal pace."
+)
+
+
+async def fetch(session: aiohttp.ClientSession, base_url: str, text: str, audio_format: str) -> Dict[str, Any]:
+    started = time.perf_counter()
+    async with session.post(f"{base_url}/speech", params={"format": audio_format}, json={"text": text, "voice": "alloy"}) as response:
+        first = await response.content.readany()
+        first_byte = time.perf_counter() - started
+        body = first + await response.read()
+        total = time.perf_counter() - started
+        if response.status != 200:
+            raise RuntimeError(f"/speech?format={audio_format} answered {response.status}: {body[:200]!r}")
+        return {
+            "first_byte": first_byte,
+            "total": total,
+            "bytes": len(body),
+            "seconds": float(response.headers.get("X-Audio-Duration", "0")),
+            "content_type": response.headers.get("Content-Type")
+        }
+
+
+def summarize(results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    size = sum(r["bytes"] for r in results)
+    seconds = sum(r["seconds"] for r in results)
+    return {
+        "requests": len(results),
+        "bytes_avg": round(size / len(results)),
+        "bytes_per_second": round(size / seconds) if seconds else None,
+        "kbps": round(size * 8 / seconds / 1000, 1) if seconds else None,
+        "ttfb_ms": latency_summary([r["first_byte"] for r in results]),
+        "total_ms": latency_summary([r["total"] for r in results])
+    }
+
+
+async def run(base_url: str, formats: List[str], runs: int) -> Dict[str, Any]:
+    report: Dict[str, Any] = {}
+    async with aiohttp.ClientSession() as session:
+        for audio_format in formats:
+            # A fresh passage per run and format, so the first pass really calls upstream
+            texts = [f"{PASSAGE} ({uuid.uuid4().hex[:8]})" for _ in range(runs)]
+            cold = [await fetch(session, base_url, text, audio_format) for text in texts]
+            warm = [await fetch(session, base_url, text, audio_format) for text in texts]
+            report[audio_format] = {
+                "content_type": cold[0]["content_type"],
+                "generated": summarize(cold),
+                "cached": summarize(warm)
+            }
+        async with session.get(f"{base_url}/metrics") as response:
+            server = (await response.json()).get("speech_formats", {})
+    for audio_format, entry in server.get("formats", {}).items():
+        if audio_format in report:
+            report[audio_format]["server"] = {
+                key: entry[key] for key in ("upstream_first_byte_ms_avg", "upstream_ms_avg", "response_ms_avg")
+            }
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--formats", nargs="+", default=["mp3", "mp3-low", "opus", "aac", "pcm"])
+    parser.add_argument("--runs", type=int, default=3)
+    spawn = parser.add_argument_group("local stack")
+    spawn.add_argument("--spawn", action="store_true", help="Start the mock upstream and server locally")
+    spawn.add_argument("--port", type=int, default=8766)
+    spawn.add_argument("--mock-port", type=int, default=9100)
+    args = parser.parse_args()
+
+    procs = []
+    base_url = args.base_url
+    try:
+        if args.spawn:
+            env = dict(os.environ)
+            env["OPENAI_API_KEY"] = "sk-mock"
+            env["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.mock_port}/v1"
+            env.update(UNLIMITED_ENV)
+            procs.append(start_process([
+                str(BENCHMARK_DIR / "mock_openai.py"), "--port", str(args.mock_port), "--latency", "speech=fixed:0.3"
+            ], env))
+            procs.append(start_process([
+                "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"
+            ], env))
+            base_url = f"http://127.0.0.1:{args.port}"
+            asyncio.run(wait_until_up(f"{base_url}/health"))
+
+        async def available() -> List[str]:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{base_url}/metrics") as response:
+                    return (await response.json())["speech_formats"]["available"]
+
+        offered = asyncio.run(available())
+        formats = [name for name in args.formats if name in offered]
+        report = asyncio.run(run(base_url, formats, args.runs))
+    finally:
+        for proc in reversed(procs):
+            stop_process(proc)
+
+    print(json.dumps({
+        "base_url": base_url,
+        "runs": args.runs,
+        "skipped": [name for name in args.formats if name not in formats],
+        "formats": report
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Startup Profile
+Import-time breakdown and cold-start timings for a service
+
+Runs ``python -X importtime`` on the service module and lists the slowest
+imports, then starts the service under uvicorn several times and measures
+how long it takes until /health (process is up) and /ready (components warm)
+first answer 200. Results are printed as JSON.
+
+Works for the OCR service too: point --dir at it and pass --app app:app.
+
+Usage:
+    python benchmarks/startup_profile.py --runs 5
+    python benchmarks/startup_profile.py --dir ../ocr-service --app app:app --top 15
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from harness import SERVER_DIR, start_process, stop_process, wait_until_up, with_repo_path
+
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def import_profile(service_dir: Path, module: str, env: Dict[str, str], top: int) -> Dict[str, Any]:
+    """Parse ``-X importtime`` output into totals and the slowest imports"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=service_dir, env=with_repo_path(env), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append({
+                "module": name,
+                "depth": len(indent) // 2,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            })
+
+    top_level = [entry for entry in entries if entry["depth"] == 0]
+    target = next((entry for entry in top_level if entry["module"] == module), None)
+    # Direct imports of the service module are what a lazy import can move off the startup path
+    return {
+        "total_ms": round(sum(entry["cumulative_ms"] for entry in top_level), 1),
+        "module_ms": round(target["cumulative_ms"], 1) if target else None,
+        "modules_imported": len(entries),
+        "slowest_top_level": [
+            {"module": entry["module"], "cumulative_ms": round(entry["cumulative_ms"], 1)}
+            for entry in sorted(entries, key=lambda e: e["cumulative_ms"], reverse=True)
+            if entry["depth"] <= 1
+        ][:top],
+        "slowest_self": [
+            {"module": entry["module"], "self_ms": round(entry["self_ms"], 1)}
+            for entry in sorted(entries, key=lambda e: e["self_ms"], reverse=True)
+        ][:top],
+    }
+
+
+async def time_until(url: str, started: float, timeout: float) -> float:
+    await wait_until_up(url, timeout=timeout, interval=0.01)
+    return time.perf_counter() - started
+
+
+def cold_start(service_dir: Path, app: str, port: int, env: Dict[str, str], timeout: float) -> Dict[str, float]:
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = start_process([
+        "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"
+    ], env, cwd=service_dir)
+    try:
+        health = asyncio.run(time_until(f"{base_url}/health", started, timeout))
+        ready = asyncio.run(time_until(f"{base_url}/ready", started, timeout))
+    finally:
+        stop_process(server)
+    return {"health_s": round(health, 3), "ready_s": round(ready, 3)}
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    return {
+        "median": round(statistics.median(samples), 3),
+        "min": round(min(samples), 3),
+        "max": round(max(samples), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", type=Path, default=SERVER_DIR, help="Service directory")
+    parser.add_argument("--app", default="server:app", help="uvicorn application, module:attribute")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts to time")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "sk-startup-profile")
+    module = args.app.partition(":")[0]
+
+    report: Dict[str, Any] = {"app": args.app, "imports": import_profile(args.dir.resolve(), module, env, args.top)}
+    if args.runs > 0:
+        runs = [cold_start(args.dir.resolve(), args.app, args.port, env, args.timeout) for _ in range(args.runs)]
+        report["cold_start"] = {
+            "runs": runs,
+            "health_s": summarize([run["health_s"] for run in runs]),
+            "ready_s": summarize([run["ready_s"] for run in runs]),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
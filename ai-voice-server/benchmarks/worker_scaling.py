@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Worker Scaling Benchmark
+Measures voice server throughput as the number of uvicorn workers grows
+
+For each worker count the server is started against a shared Redis stand-in,
+a set of WebSocket clients joins a room to check that broadcasts reach sockets
+on every worker, and then HTTP load is driven from several client processes.
+Results are printed as JSON.
+
+Usage: python benchmarks/worker_scaling.py --workers 1 2 4 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List
+
+import aiohttp
+
+from harness import UNLIMITED_ENV, latency_summary, start_process, stop_process, wait_until_up
+
+# Requests that exercise the shared backend without calling OpenAI
+REQUEST_MIX = [
+    ("GET", "/conversation/history?session_id=bench-{n}", None),
+    ("GET", "/metrics", None),
+    ("POST", "/rooms/bench-idle/broadcast", {"message": "tick"}),
+]
+
+# Broadcasting needs a named caller; the server trusts these headers from loopback
+BENCH_CALLER = {"X-User-ID": "bench"}
+
+
+async def check_broadcast(base_url: str, clients: int) -> Dict[str, Any]:
+    """Connect ``clients`` sockets to one room and count who receives a broadcast"""
+    ws_url = base_url.replace("http", "ws", 1) + "/ws?room=bench"
+    async with aiohttp.ClientSession() as session:
+        sockets = [await session.ws_connect(ws_url) for _ in range(clients)]
+        # Let every worker register its sockets before publishing
+        await asyncio.sleep(0.5)
+        async with session.post(f"{base_url}/rooms/bench/broadcast", json={"message": "check"}, headers=BENCH_CALLER) as response:
+            published = await response.json()
+
+        async def receive(ws: aiohttp.ClientWebSocketResponse) -> bool:
+            try:
+                msg = await ws.receive(timeout=5)
+                return msg.type == aiohttp.WSMsgType.TEXT and json.loads(msg.data).get("type") == "broadcast"
+            except asyncio.TimeoutError:
+                return False
+
+        received = await asyncio.gather(*(receive(ws) for ws in sockets))
+        for ws in sockets:
+            await ws.close()
+    return {"clients": clients, "received": sum(received), "workers_subscribed": published.get("workers")}
+
+
+async def drive_load(base_url: str, concurrency: int, duration: float, seed: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def worker(index: int) -> None:
+        nonlocal errors
+        n = seed * concurrency + index
+        async with aiohttp.ClientSession(headers=BENCH_CALLER) as session:
+            while time.monotonic() < deadline:
+                method, path, body = REQUEST_MIX[n % len(REQUEST_MIX)]
+                n += 1
+                started = time.perf_counter()
+                try:
+                    async with session.request(method, base_url + path.format(n=n % 100), json=body) as response:
+                        await response.read()
+                        if response.status >= 400:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return {"requests": len(latencies), "errors": errors, "latencies": latencies}
+
+
+def load_process(base_url: str, concurrency: int, duration: float, seed: int, results: "multiprocessing.Queue") -> None:
+    results.put(asyncio.run(drive_load(base_url, concurrency, duration, seed)))
+
+
+def run_for_workers(workers: int, args: argparse.Namespace, env: Dict[str, str]) -> Dict[str, Any]:
+    port = args.port
+    base_url = f"http://127.0.0.1:{port}"
+    server = start_process([
+        "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning"
+    ], env)
+    try:
+        asyncio.run(wait_until_up(f"{base_url}/health"))
+        # Give the remaining workers time to boot and subscribe
+        time.sleep(1.0 + 0.25 * workers)
+        broadcast = asyncio.run(check_broadcast(base_url, args.ws_clients))
+
+        results: "multiprocessing.Queue" = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(target=load_process, args=(base_url, args.concurrency, args.duration, i, results))
+            for i in range(args.clients)
+        ]
+        started = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        parts = [results.get() for _ in procs]
+        elapsed = time.perf_counter() - started
+        for proc in procs:
+            proc.join()
+    finally:
+        stop_process(server)
+
+    latencies = [value for part in parts for value in part["latencies"]]
+    requests = sum(part["requests"] for part in parts)
+    return {
+        "workers": workers,
+        "requests": requests,
+        "errors": sum(part["errors"] for part in parts),
+        "throughput_rps": round(requests / elapsed, 1),
+        "latency_ms": latency_summary(latencies),
+        "broadcast": broadcast
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load per worker count")
+    parser.add_argument("--clients", type=int, default=max(2, (os.cpu_count() or 2) // 2), help="Load generator processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent requests per load process")
+    parser.add_argument("--ws-clients", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--redis-port", type=int, default=6399)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    env["SHARED_STATE_URL"] = f"redis://127.0.0.1:{args.redis_port}/0"
+    env.update(UNLIMITED_ENV)
+
+    standin = start_process(["redis_standin.py", "--port", str(args.redis_port)], env)
+    try:
+        time.sleep(0.5)
+        runs = [run_for_workers(workers, args, env) for workers in args.workers]
+    finally:
+        stop_process(standin)
+
+    baseline = runs[0]["throughput_rps"] or 1.0
+    for run in runs:
+        run["speedup"] = round(run["throughput_rps"] / baseline, 2)
+    print(json.dumps({"cpu_count": os.cpu_count(), "runs": runs}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
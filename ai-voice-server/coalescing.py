@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Request Coalescing
+Single-flight execution so concurrent identical requests share one upstream call
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, TypeVar
+
+from service_common import tracing
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def normalize_prompt(text: str) -> str:
+    """Normalize a chat prompt so trivially different spellings share a key"""
+    return " ".join(text.split()).casefold()
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into a single upstream call
+
+    The first caller for a key (the leader) starts the upstream call as its own
+    task; callers arriving while it is in flight await the same task instead of
+    starting another one. The task is shielded, so a disconnecting client does
+    not cancel the call the other waiters depend on. Results are not cached:
+    once the call completes the key is released.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[Hashable, "asyncio.Task[Any]"] = {}
+        self.requests = 0
+        self.upstream_calls = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Run ``fn`` for ``key`` unless an identical call is already in flight"""
+        self.requests += 1
+        task = self._in_flight.get(key)
+        span = tracing.current_span()
+        if span is not None:
+            # A coalesced request's upstream span is in the leader's trace
+            span.set(f"{self.name}.coalesced", task is not None)
+        if task is not None:
+            self.coalesced += 1
+            logger.debug("Coalesced %s request onto in-flight call", self.name)
+        else:
+            self.upstream_calls += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t, k=key: self._finish(k, t))
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: "asyncio.Task[Any]") -> None:
+        """Release the key and account for the outcome of a finished call"""
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Retrieving the exception here also keeps asyncio from warning when
+        # every waiter has gone away before the call failed.
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get coalescing counters"""
+        return {
+            "requests": self.requests,
+            "upstream_calls": self.upstream_calls,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "in_flight": len(self._in_flight),
+            "coalesced_ratio": round(self.coalesced / self.requests, 4) if self.requests else 0.0,
+        }
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+WebSocket Connection Manager
+Connection registry with per-connection send queues, rooms and concurrent fan-out
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Set, Union
+
+from fastapi import WebSocket
+
+from service_common import tracing
+from protocol import DEFAULT_CODEC
+
+logger = logging.getLogger(__name__)
+
+Payload = Union[str, bytes]
+
+
+class TracedPayload(NamedTuple):
+    """A queued payload sent while a traced request was handled; the span ends once it is written"""
+    payload: Payload
+    span: tracing.Span
+
+# What to do when a client's send queue is full:
+#   "disconnect"  - close the socket so the client reconnects and resyncs
+#   "drop_oldest" - discard the oldest queued message to make room
+SLOW_CONSUMER_POLICIES = ("disconnect", "drop_oldest")
+
+# WebSocket close code 1013 is "Try Again Later"
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class Connection:
+    """A registered WebSocket with its own bounded send queue and writer task"""
+
+    __slots__ = ("id", "websocket", "codec", "queue", "rooms", "writer", "dropped", "closed", "closing")
+
+    def __init__(self, websocket: WebSocket, max_queue: int, codec=DEFAULT_CODEC):
+        self.id = uuid.uuid4().hex
+        self.websocket = websocket
+        self.codec = codec
+        self.queue: "asyncio.Queue[Union[Payload, TracedPayload, None]]" = asyncio.Queue(maxsize=max_queue)
+        self.rooms: Set[str] = set()
+        self.writer: Optional["asyncio.Task[None]"] = None
+        self.dropped = 0
+        self.closed = False
+        # Set once close_all() has queued the None that stops the writer: nothing may follow it
+        self.closing = False
+
+
+class ConnectionManager:
+    """Registry of active WebSocket connections
+
+    Connections are stored in dicts keyed by socket and room, so add, remove
+    and room membership changes are O(1). Messages are never sent inline:
+    they are put on each connection's bounded queue and written by that
+    connection's writer task, so a broadcast costs one non-blocking enqueue
+    per recipient and a slow client only ever delays itself.
+    """
+
+    def __init__(
+        self,
+        max_queue: int = int(os.getenv("WS_SEND_QUEUE_SIZE", "64")),
+        send_timeout: float = float(os.getenv("WS_SEND_TIMEOUT", "10")),
+        slow_consumer_policy: str = os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect")
+    ):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy}")
+        self.max_queue = max_queue
+        self.send_timeout = send_timeout
+        self.slow_consumer_policy = slow_consumer_policy
+        self.active_connections: Dict[WebSocket, Connection] = {}
+        self.rooms: Dict[str, Set[Connection]] = {}
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.evictions = 0
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        rooms: Iterable[str] = (),
+        codec=DEFAULT_CODEC,
+        subprotocol: Optional[str] = None
+    ) -> Connection:
+        """Accept a socket, register it and start its writer task"""
+        await websocket.accept(subprotocol=subprotocol)
+        conn = Connection(websocket, self.max_queue, codec)
+        self.active_connections[websocket] = conn
+        for room in rooms:
+            self.join(conn, room)
+        conn.writer = asyncio.create_task(self._writer(conn))
+        logger.info("WebSocket connected. Total connections: %d", len(self.active_connections), extra={"route": "ws.connect"})
+        return conn
+
+    def disconnect(self, websocket: WebSocket) -> None:
+        """Unregister a socket; safe to call more than once"""
+        conn = self.active_connections.pop(websocket, None)
+        if conn is None:
+            return
+        for room in list(conn.rooms):
+            self.leave(conn, room)
+        conn.closed = True
+        if conn.writer is not None and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+        self._discard(conn, "connection closed")
+        logger.info("WebSocket disconnected. Total connections: %d", len(self.active_connections), extra={"route": "ws.connect"})
+
+    def get(self, websocket: WebSocket) -> Optional[Connection]:
+        """Look up the registered connection for a socket"""
+        return self.active_connections.get(websocket)
+
+    def join(self, conn: Connection, room: str) -> None:
+        """Add a connection to a room (e.g. a classroom)"""
+        self.rooms.setdefault(room, set()).add(conn)
+        conn.rooms.add(room)
+
+    def leave(self, conn: Connection, room: str) -> None:
+        """Remove a connection from a room, dropping the room once empty"""
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(conn)
+            if not members:
+                del self.rooms[room]
+        conn.rooms.discard(room)
+
+    async def send_personal_message(self, message: Union[Payload, Dict[str, Any]], websocket: WebSocket) -> bool:
+        """Queue a message for a single socket, encoding dicts with its codec"""
+        conn = self.active_connections.get(websocket)
+        if conn is None:
+            return False
+        if isinstance(message, dict):
+            message = conn.codec.encode(message)
+        return self._enqueue(conn, message)
+
+    async def broadcast(self, message: Union[Payload, Dict[str, Any]], room: Optional[str] = None) -> int:
+        """Queue a message for every connection, or every member of a room
+
+        A dict is encoded at most once per codec in use, not once per
+        recipient. Returns the number of connections the message was queued for.
+        """
+        if room is None:
+            targets = list(self.active_connections.values())
+        else:
+            targets = list(self.rooms.get(room, ()))
+
+        frames: Dict[str, Payload] = {}
+        queued = 0
+        for conn in targets:
+            if isinstance(message, dict):
+                frame = frames.get(conn.codec.name)
+                if frame is None:
+                    frame = frames[conn.codec.name] = conn.codec.encode(message)
+            else:
+                frame = message
+            if self._enqueue(conn, frame):
+                queued += 1
+        return queued
+
+    def _enqueue(self, conn: Connection, payload: Payload) -> bool:
+        """Put a payload on a connection's queue, applying the slow consumer policy"""
+        if conn.closed or conn.closing:
+            return False
+        # Covers the time queued as well as the write: a slow consumer shows up in the trace
+        span = tracing.start_span("ws.send", kind="producer", connection=conn.id, bytes=len(payload))
+        item = TracedPayload(payload, span) if span is not None else payload
+        try:
+            conn.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.slow_consumer_policy == "drop_oldest":
+            # Never the close sentinel: nothing is queued after it, see close_all()
+            self._end_span(conn.queue.get_nowait(), "dropped: send queue full")
+            conn.queue.put_nowait(item)
+            conn.dropped += 1
+            self.messages_dropped += 1
+            return True
+
+        self._evict(conn, "send queue full")
+        self._end_span(item, "evicted: send queue full")
+        return False
+
+    @staticmethod
+    def _end_span(item: Union[Payload, TracedPayload, None], reason: str) -> None:
+        """End the span of a queued payload that will never be written"""
+        if isinstance(item, TracedPayload):
+            item.span.record_error(reason)
+            item.span.end()
+
+    def _discard(self, conn: Connection, reason: str) -> None:
+        """Empty the queue of a connection whose writer is gone, ending each payload's span"""
+        while True:
+            try:
+                self._end_span(conn.queue.get_nowait(), reason)
+            except asyncio.QueueEmpty:
+                return
+
+    def _evict(self, conn: Connection, reason: str) -> None:
+        """Disconnect a consumer that cannot keep up"""
+        if conn.closed:
+            return
+        self.evictions += 1
+        self.messages_dropped += conn.queue.qsize()
+        logger.warning(f"Evicting slow WebSocket consumer {conn.id}: {reason}")
+        self.disconnect(conn.websocket)
+        asyncio.create_task(self._close(conn.websocket))
+
+    async def _close(self, websocket: WebSocket) -> None:
+        try:
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+        except Exception:
+            pass
+
+    async def _writer(self, conn: Connection) -> None:
+        """Drain a connection's queue onto its socket"""
+        websocket = conn.websocket
+        try:
+            while True:
+                payload = await conn.queue.get()
+                if payload is None:
+                    break
+                span = None
+                if isinstance(payload, TracedPayload):
+                    payload, span = payload
+                if isinstance(payload, bytes):
+                    send = websocket.send_bytes(payload)
+                else:
+                    send = websocket.send_text(payload)
+                try:
+                    await asyncio.wait_for(send, timeout=self.send_timeout)
+                except BaseException as e:
+                    if span is not None:
+                        span.record_error(e)
+                    raise
+                finally:
+                    if span is not None:
+                        span.end()
+                self.messages_sent += 1
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            self._evict(conn, "send timed out")
+        except Exception as e:
+            logger.error(f"Error sending to WebSocket {conn.id}: {e}")
+            self.disconnect(websocket)
+
+    async def close_all(self, code: int = 1001, flush_timeout: float = 0.0) -> None:
+        """Close every registered socket (1001 = going away)
+
+        With ``flush_timeout`` the writers first get up to that long to send
+        what is already queued, e.g. a notice telling clients to reconnect.
+        """
+        if flush_timeout > 0:
+            writers = []
+            for conn in self.active_connections.values():
+                if conn.writer is not None and not conn.writer.done():
+                    try:
+                        conn.queue.put_nowait(None)
+                        conn.closing = True
+                        writers.append(conn.writer)
+                    except asyncio.QueueFull:
+                        pass
+            if writers:
+                await asyncio.wait(writers, timeout=flush_timeout)
+        for websocket in list(self.active_connections):
+            self.disconnect(websocket)
+            try:
+                await websocket.close(code=code)
+            except Exception:
+                pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get connection and delivery counters"""
+        return {
+            "active_connections": len(self.active_connections),
+            "rooms": len(self.rooms),
+            "messages_sent": self.messages_sent,
+            "messages_dropped": self.messages_dropped,
+            "evictions": self.evictions,
+            "queued": sum(conn.queue.qsize() for conn in self.active_connections.values()),
+            "slow_consumer_policy": self.slow_consumer_policy
+        }
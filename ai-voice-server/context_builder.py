@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Conversation Context Builder
+Assembles chat prompts from session history under a token budget
+"""
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from shared_state import StateBackend
+
+logger = logging.getLogger(__name__)
+
+# Rough per-message framing overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class TokenCounter:
+    """Counts tokens locally, caching counts per distinct text
+
+    Uses tiktoken when it is installed and its encoding can be loaded,
+    otherwise a characters-per-token estimate. History turns are re-counted
+    on every request, so the LRU cache turns repeat counts into dict lookups.
+    """
+
+    def __init__(self, model: str = "gpt-4o", max_entries: int = 4096):
+        self.model = model
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._encoding = None
+        self._encoding_loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    def _load_encoding(self) -> None:
+        self._encoding_loaded = True
+        try:
+            import tiktoken
+
+            self._encoding = tiktoken.encoding_for_model(self.model)
+        except Exception as e:
+            # Not installed, or the encoding file cannot be fetched offline
+            logger.warning(f"tiktoken unavailable, estimating token counts: {e}")
+
+    def _count_uncached(self, text: str) -> int:
+        if not self._encoding_loaded:
+            self._load_encoding()
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        # English prose averages about four characters per token
+        return max(1, (len(text) + 3) // 4)
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return cached
+            self.misses += 1
+        tokens = self._count_uncached(text)
+        with self._lock:
+            self._cache[text] = tokens
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def count_message(self, message: Dict[str, str]) -> int:
+        return self.count(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "tokenizer": "tiktoken" if self._encoding is not None else "estimate",
+            "cache_entries": len(self._cache),
+            "cache_hits": self.hits,
+            "cache_misses": self.misses
+        }
+
+
+def extractive_summary(turns: List[Dict[str, Any]], max_chars: int = 600) -> str:
+    """Cheap local summary: the first sentence of each turn, newest kept last"""
+    lines = []
+    for turn in turns:
+        if turn["role"] == "summary":
+            # A previous summary being folded in is already condensed
+            lines.append(turn["content"])
+            continue
+        content = " ".join(turn["content"].split())
+        first = content.split(". ")[0][:160]
+        lines.append(f"{turn['role']}: {first}")
+    summary = "\n".join(lines)
+    if len(summary) > max_chars:
+        # Keep the newest lines, starting on a line boundary
+        summary = summary[-max_chars:].partition("\n")[2]
+    return summary
+
+
+class RollingSummarizer:
+    """Maintains a per-session summary of turns that no longer fit the budget
+
+    Summaries are refreshed on a background thread, never on the request
+    path: a request uses whatever summary is already stored and, if older
+    turns have fallen out of the window since, schedules a refresh.
+
+    Clearing a session bumps its generation in the shared state. A refresh
+    that started before the clear, on any worker, finds the generation
+    changed and drops its result rather than writing the summary back.
+    """
+
+    def __init__(
+        self,
+        state: StateBackend,
+        summarize: Callable[[List[Dict[str, Any]]], str],
+        refresh_after: int = int(os.getenv("SUMMARY_REFRESH_TURNS", "6")),
+        ttl: float = float(os.getenv("SUMMARY_TTL_SECONDS", "604800"))
+    ):
+        self.state = state
+        self.summarize = summarize
+        # Re-summarize only once this many turns have fallen out of the window
+        # since the stored summary, not on every request
+        self.refresh_after = refresh_after
+        # Summaries of sessions that are never continued expire with their generation
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summarizer")
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self.summaries_computed = 0
+        self.summary_failures = 0
+        self.summaries_discarded = 0
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"summary:{session_id}"
+
+    @staticmethod
+    def _generation_key(session_id: str) -> str:
+        return f"summary-generation:{session_id}"
+
+    def _generation(self, session_id: str) -> int:
+        return int(self.state.get(self._generation_key(session_id)) or 0)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """Get the stored summary: {"summary": str, "through": timestamp, "turns": int}"""
+        raw = self.state.get(self._key(session_id))
+        return json.loads(raw) if raw else None
+
+    def clear(self, session_id: str) -> None:
+        # Bumped before the delete, so a refresh writing after the delete sees it
+        self.state.incr(self._generation_key(session_id), ttl=self.ttl)
+        self.state.delete(self._key(session_id))
+
+    def is_stale(self, dropped: List[Dict[str, Any]], stored: Optional[Dict[str, Any]]) -> bool:
+        """Whether enough turns have left the window to refresh the summary"""
+        if stored is None:
+            return True
+        unsummarized = sum(1 for turn in dropped if turn.get("timestamp", "") > stored["through"])
+        return unsummarized >= self.refresh_after
+
+    def schedule(self, session_id: str, dropped: List[Dict[str, Any]], previous: Optional[Dict[str, Any]]) -> None:
+        """Refresh a session's summary in the background, at most one job per session"""
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        try:
+            generation = self._generation(session_id)
+        except Exception:
+            with self._lock:
+                self._pending.discard(session_id)
+            raise
+        self._executor.submit(self._refresh, session_id, list(dropped), previous, generation)
+
+    def _refresh(
+        self,
+        session_id: str,
+        dropped: List[Dict[str, Any]],
+        previous: Optional[Dict[str, Any]],
+        generation: int
+    ) -> None:
+        try:
+            turns = dropped
+            if previous:
+                # Fold the earlier summary in as the oldest "turn"
+                turns = [{"role": "summary", "content": previous["summary"]}] + [
+                    turn for turn in dropped if turn.get("timestamp", "") > previous["through"]
+                ]
+            summary = self.summarize(turns)
+            if self._generation(session_id) != generation:
+                self.summaries_discarded += 1
+                return
+            self.state.set(self._key(session_id), json.dumps({
+                "summary": summary,
+                "through": dropped[-1].get("timestamp", ""),
+                "turns": len(dropped)
+            }).encode(), self.ttl)
+            if self._generation(session_id) != generation:
+                # Cleared while it was being written: the clear's delete may have come first
+                self.state.delete(self._key(session_id))
+                self.summaries_discarded += 1
+                return
+            self.summaries_computed += 1
+        except Exception as e:
+            self.summary_failures += 1
+            logger.error(f"Error summarizing history for session {session_id}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(session_id)
+
+
+class ContextBuilder:
+    """Builds the message list for a chat completion within a token budget
+
+    The system prompt and the current message are always included. Prior
+    turns are added newest first while they fit; turns that do not fit are
+    represented by the session's rolling summary when one is available.
+    """
+
+    def __init__(
+        self,
+        counter: TokenCounter,
+        summarizer: Optional[RollingSummarizer] = None,
+        token_budget: int = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+    ):
+        self.counter = counter
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.naive_prompt_tokens = 0
+
+    def build(
+        self,
+        system_prompt: str,
+        message: str,
+        history: List[Dict[str, Any]],
+        session_id: Optional[str] = None
+    ) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+        """Return the messages to send and a report of the tokens used"""
+        system = {"role": "system", "content": system_prompt}
+        current = {"role": "user", "content": message}
+        used = self.counter.count_message(system) + self.counter.count_message(current)
+        naive = used
+
+        turns = [{"role": turn["role"], "content": turn["content"]} for turn in history]
+        turn_tokens = [self.counter.count_message(turn) for turn in turns]
+        naive += sum(turn_tokens)
+
+        # Newest turns first, until the budget is spent
+        first_included = len(turns)
+        for index in range(len(turns) - 1, -1, -1):
+            if used + turn_tokens[index] > self.token_budget:
+                break
+            used += turn_tokens[index]
+            first_included = index
+
+        messages = [system]
+        summary_used = False
+        if first_included > 0 and self.summarizer is not None and session_id is not None:
+            stored = self.summarizer.get(session_id)
+            if stored is not None:
+                summary = {"role": "system", "content": f"Summary of the earlier conversation:\n{stored['summary']}"}
+                summary_tokens = self.counter.count_message(summary)
+                # Make room for the summary by giving up the oldest included turns
+                while used + summary_tokens > self.token_budget and first_included < len(turns):
+                    used -= turn_tokens[first_included]
+                    first_included += 1
+                if used + summary_tokens <= self.token_budget:
+                    messages.append(summary)
+                    used += summary_tokens
+                    summary_used = True
+            dropped = history[:first_included]
+            if self.summarizer.is_stale(dropped, stored):
+                self.summarizer.schedule(session_id, dropped, stored)
+
+        messages.extend(turns[first_included:])
+        messages.append(current)
+
+        self.requests += 1
+        self.prompt_tokens += used
+        self.naive_prompt_tokens += naive
+        return messages, {
+            "prompt_tokens": used,
+            "naive_prompt_tokens": naive,
+            "tokens_saved": naive - used,
+            "turns_total": len(turns),
+            "turns_included": len(turns) - first_included,
+            "summary_used": summary_used
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {
+            "token_budget": self.token_budget,
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "naive_prompt_tokens": self.naive_prompt_tokens,
+            "tokens_saved": self.naive_prompt_tokens - self.prompt_tokens,
+            "counter": self.counter.get_stats()
+        }
+        if self.summarizer is not None:
+            stats["summaries_computed"] = self.summarizer.summaries_computed
+            stats["summary_failures"] = self.summarizer.summary_failures
+            stats["summaries_discarded"] = self.summarizer.summaries_discarded
+        return stats
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""
+Conversation History Storage
+Per-session conversation history in SQLite or the shared state backend
+
+``HISTORY_URL`` picks the store:
+
+- ``sqlite:///path/to/history.db`` (the default): durable, in WAL mode so
+  every worker on the host can share the file. Appends are written behind,
+  in batches on a background thread, so requests never wait on disk.
+- ``state://``: a capped list per session in the shared state backend,
+  for multi-node deployments where workers do not share a disk.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from shared_state import StateBackend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION = "default"
+DEFAULT_HISTORY_URL = "sqlite:///history/conversations.db"
+
+# Write-behind: flush when this many entries are pending or after this long
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "200"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.05"))
+
+Page = Tuple[List[Dict[str, Any]], Optional[str]]
+
+
+class HistoryStore:
+    """Interface for per-session conversation history"""
+
+    def append(self, session_id: str, entry: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def recent(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Get the newest ``limit`` entries (all retained entries if None), oldest first"""
+        raise NotImplementedError
+
+    def count(self, session_id: str) -> int:
+        raise NotImplementedError
+
+    def clear(self, session_id: str) -> None:
+        raise NotImplementedError
+
+    def page(self, session_id: str, limit: int = 50, before: Optional[str] = None) -> Page:
+        """Up to ``limit`` entries older than cursor ``before`` (newest page if None), oldest first
+
+        Returns the entries and the cursor for the next older page, or None
+        when there is nothing older.
+        """
+        entries = self.recent(session_id)
+        end = len(entries) - int(before) if before else len(entries)
+        start = max(0, end - limit)
+        return entries[start:end], (str(len(entries) - start) if start > 0 else None)
+
+    def close(self) -> None:
+        pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"store": type(self).__name__}
+
+
+class SharedStateHistoryStore(HistoryStore):
+    """History kept as a capped list per session in a StateBackend"""
+
+    def __init__(self, state: StateBackend, max_length: int = 50):
+        self.state = state
+        self.max_length = max_length
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"history:{session_id}"
+
+    def append(self, session_id: str, entry: Dict[str, Any]) -> None:
+        self.state.list_push(self._key(session_id), json.dumps(entry).encode(), self.max_length)
+
+    def recent(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        start = -limit if limit else 0
+        return [json.loads(item) for item in self.state.list_range(self._key(session_id), start, -1)]
+
+    def count(self, session_id: str) -> int:
+        return self.state.list_length(self._key(session_id))
+
+    def clear(self, session_id: str) -> None:
+        self.state.delete(self._key(session_id))
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """Durable history in SQLite with write-behind batching
+
+    ``append`` only queues the entry; a writer thread inserts queued entries
+    in one transaction per batch. Reads merge the queued entries of the
+    session, so a session always sees its own writes, and never wait for the
+    queue to be written. Per-session counts are kept in their own table,
+    updated in the same transaction, so ``count`` is a primary-key lookup
+    rather than a scan or a list copy.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_session_id ON messages (session_id, id);
+        CREATE INDEX IF NOT EXISTS messages_session_timestamp ON messages (session_id, timestamp);
+        CREATE TABLE IF NOT EXISTS session_counts (
+            session_id TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_length: int = 50,
+        batch_size: int = HISTORY_BATCH_SIZE,
+        flush_interval: float = HISTORY_FLUSH_INTERVAL
+    ):
+        self.path = path
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Held while a batch is written and taken off the queue, and by reads that must
+        # see each entry exactly once: in the table or in the queue, never both
+        self._commit_lock = threading.Lock()
+        self._pending: Deque[Tuple[str, Dict[str, Any]]] = deque()
+        self._pending_counts: Dict[str, int] = {}
+        self._wake = threading.Event()
+        self._flushed = threading.Condition(self._lock)
+        self._closed = False
+        self.batches_written = 0
+        self.rows_written = 0
+        # Queued entries cleared before they were written
+        self.rows_discarded = 0
+        self.last_batch_ms = 0.0
+
+        with self._connection() as db:
+            db.executescript(self.SCHEMA)
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection; sqlite3 connections are not shared across threads"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    def append(self, session_id: str, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._pending.append((session_id, entry))
+            self._pending_counts[session_id] = self._pending_counts.get(session_id, 0) + 1
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _write_loop(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self._write_batch()
+            except Exception as e:
+                logger.error(f"Failed to write history batch: {e}")
+                time.sleep(self.flush_interval)
+
+    def _write_batch(self) -> None:
+        with self._commit_lock:
+            self._write_pending()
+
+    def _write_pending(self) -> None:
+        with self._lock:
+            batch = list(self._pending)
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        rows, counts = [], {}
+        for session_id, entry in batch:
+            extra = {key: value for key, value in entry.items() if key not in ("role", "content", "timestamp")}
+            rows.append((
+                session_id,
+                entry["role"],
+                entry["content"],
+                entry.get("timestamp", ""),
+                json.dumps(extra) if extra else None
+            ))
+            counts[session_id] = counts.get(session_id, 0) + 1
+        db = self._connection()
+        with db:
+            db.executemany(
+                "INSERT INTO messages (session_id, role, content, timestamp, extra) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            db.executemany(
+                "INSERT INTO session_counts (session_id, count) VALUES (?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET count = count + excluded.count",
+                counts.items()
+            )
+
+        # Entries are only dropped from the queue once they are readable from disk
+        with self._lock:
+            for _ in range(len(batch)):
+                session_id, _ = self._pending.popleft()
+                remaining = self._pending_counts[session_id] - 1
+                if remaining:
+                    self._pending_counts[session_id] = remaining
+                else:
+                    del self._pending_counts[session_id]
+            self.batches_written += 1
+            self.rows_written += len(batch)
+            self.last_batch_ms = round((time.perf_counter() - started) * 1000, 2)
+            self._flushed.notify_all()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until everything queued so far is on disk"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            target = self.rows_written + self.rows_discarded + len(self._pending)
+            self._wake.set()
+            while self.rows_written + self.rows_discarded < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._writer.is_alive():
+                    return False
+                self._flushed.wait(remaining)
+        return True
+
+    @staticmethod
+    def _entry(row: sqlite3.Row) -> Dict[str, Any]:
+        entry = {"role": row["role"], "content": row["content"], "timestamp": row["timestamp"]}
+        if row["extra"]:
+            entry.update(json.loads(row["extra"]))
+        return entry
+
+    def _pending_for(self, session_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            if session_id not in self._pending_counts:
+                return []
+            return [entry for pending_session, entry in self._pending if pending_session == session_id]
+
+    def recent(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Newest ``limit`` entries, or the newest ``max_length`` when None"""
+        limit = limit or self.max_length
+        # Read the queue before the table: an entry written in between shows
+        # up twice rather than not at all, and is deduplicated below
+        pending = self._pending_for(session_id)
+        rows = self._connection().execute(
+            "SELECT role, content, timestamp, extra FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+            (session_id, limit)
+        ).fetchall()
+        stored = [self._entry(row) for row in reversed(rows)]
+        if pending and stored:
+            overlap = min(len(pending), len(stored))
+            while overlap and stored[-overlap:] != pending[:overlap]:
+                overlap -= 1
+            pending = pending[overlap:]
+        return (stored + pending)[-limit:]
+
+    def page(self, session_id: str, limit: int = 50, before: Optional[str] = None) -> Page:
+        """Keyset pagination on the (session_id, id) index; the cursor is a message id
+
+        Queued entries are newer than every stored one, so they only ever
+        appear on the newest page.
+        """
+        if before:
+            rows = self._connection().execute(
+                "SELECT id, role, content, timestamp, extra FROM messages "
+                "WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (session_id, int(before), limit + 1)
+            ).fetchall()
+            pending = []
+        else:
+            with self._commit_lock:
+                pending = self._pending_for(session_id)
+                if len(pending) >= limit:
+                    # A page of entries not yet written has no message id to continue from
+                    self._write_pending()
+                    pending = []
+                rows = self._connection().execute(
+                    "SELECT id, role, content, timestamp, extra FROM messages "
+                    "WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                    (session_id, limit - len(pending) + 1)
+                ).fetchall()
+        more = len(rows) > limit - len(pending)
+        rows = rows[:limit - len(pending)]
+        entries = [self._entry(row) for row in reversed(rows)] + pending
+        return entries, (str(rows[-1]["id"]) if more else None)
+
+    def since(self, session_id: str, timestamp: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """Entries at or after an ISO ``timestamp``, oldest first"""
+        with self._commit_lock:
+            pending = [entry for entry in self._pending_for(session_id) if entry.get("timestamp", "") >= timestamp]
+            rows = self._connection().execute(
+                "SELECT role, content, timestamp, extra FROM messages "
+                "WHERE session_id = ? AND timestamp >= ? ORDER BY timestamp, id LIMIT ?",
+                (session_id, timestamp, limit)
+            ).fetchall()
+        return ([self._entry(row) for row in rows] + pending)[:limit]
+
+    def count(self, session_id: str) -> int:
+        with self._commit_lock:
+            with self._lock:
+                pending = self._pending_counts.get(session_id, 0)
+            row = self._connection().execute(
+                "SELECT count FROM session_counts WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0] if row else 0) + pending
+
+    def clear(self, session_id: str) -> None:
+        with self._commit_lock:
+            with self._lock:
+                if self._pending_counts.pop(session_id, None):
+                    kept = [item for item in self._pending if item[0] != session_id]
+                    self.rows_discarded += len(self._pending) - len(kept)
+                    self._pending.clear()
+                    self._pending.extend(kept)
+                    self._flushed.notify_all()
+            db = self._connection()
+            with db:
+                db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+                db.execute("DELETE FROM session_counts WHERE session_id = ?", (session_id,))
+
+    def close(self) -> None:
+        if not self.flush():
+            logger.warning(f"History writer did not flush before shutdown ({len(self._pending)} entries pending)")
+        self._closed = True
+        self._wake.set()
+        self._writer.join(timeout=1.0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "store": "sqlite",
+            "path": self.path,
+            "pending": pending,
+            "batches_written": self.batches_written,
+            "rows_written": self.rows_written,
+            "last_batch_ms": self.last_batch_ms
+        }
+
+
+def create_history_store(state: StateBackend, max_length: int = 50, url: Optional[str] = None) -> HistoryStore:
+    """Create the store named by ``url`` or the HISTORY_URL env var"""
+    url = url or os.getenv("HISTORY_URL", DEFAULT_HISTORY_URL)
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):]
+        logger.info(f"Using SQLite conversation history at {path}")
+        return SQLiteHistoryStore(path, max_length)
+    if url.startswith("state://"):
+        return SharedStateHistoryStore(state, max_length)
+    raise ValueError(f"Unsupported HISTORY_URL: {url}")
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Worker Lifecycle
+Readiness, in-flight tracking and graceful draining for rolling deploys
+
+On SIGTERM a worker does not stop straight away. It:
+
+1. reports not-ready on /ready and refuses new WebSockets,
+2. waits DRAIN_GRACE_SECONDS so load balancers stop routing to it,
+3. tells connected WebSocket clients to reconnect elsewhere,
+4. waits for in-flight generations (chat, TTS, transcription) until
+   DRAIN_TIMEOUT_SECONDS after the signal,
+5. closes the remaining sockets with 1012 (service restart),
+6. hands over to uvicorn's normal shutdown.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from connection_manager import ConnectionManager
+from service_common.readiness import ReadinessTracker
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code 1012 is "Service Restart"
+CLOSE_SERVICE_RESTART = 1012
+
+STARTING, RUNNING, DRAINING, STOPPED = "starting", "running", "draining", "stopped"
+
+
+class LifecycleManager:
+    """Owns a worker's serving state from warm-up to drained"""
+
+    def __init__(
+        self,
+        readiness: ReadinessTracker,
+        connections: ConnectionManager,
+        drain_grace: float = float(os.getenv("DRAIN_GRACE_SECONDS", "5")),
+        drain_timeout: float = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "25"))
+    ):
+        self.readiness = readiness
+        self.connections = connections
+        self.drain_grace = drain_grace
+        self.drain_timeout = drain_timeout
+        self.draining_since: Optional[float] = None
+        self.stopped = False
+        self.in_flight: Counter = Counter()
+        self.completed_while_draining = 0
+        self.rejected_connections = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._drain_task: Optional[asyncio.Task] = None
+
+    @property
+    def state(self) -> str:
+        if self.stopped:
+            return STOPPED
+        if self.draining_since is not None:
+            return DRAINING
+        return RUNNING if self.readiness.ready else STARTING
+
+    @property
+    def ready(self) -> bool:
+        return self.state == RUNNING
+
+    @property
+    def accepting(self) -> bool:
+        """Whether new WebSocket connections should be accepted"""
+        return self.draining_since is None
+
+    def reject_connection(self) -> None:
+        self.rejected_connections += 1
+
+    @asynccontextmanager
+    async def track(self, kind: str) -> AsyncIterator[None]:
+        """Count a unit of work that draining should wait for"""
+        self.in_flight[kind] += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self.in_flight[kind] -= 1
+            if self.draining_since is not None:
+                self.completed_while_draining += 1
+            if not any(self.in_flight.values()):
+                self._idle.set()
+
+    def install_signal_handlers(self) -> None:
+        """Drain on SIGTERM before letting uvicorn shut down
+
+        Call from a startup hook: uvicorn installs its handlers before startup,
+        so this replaces its SIGTERM handler. SIGINT (Ctrl+C) is left alone.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self._on_sigterm)
+        except (NotImplementedError, RuntimeError, ValueError) as e:
+            # Windows, or not running in the main thread (e.g. under a test client)
+            logger.warning(f"SIGTERM draining unavailable: {e}")
+
+    def _on_sigterm(self) -> None:
+        logger.info("SIGTERM received, draining worker")
+        if self._drain_task is None:
+            self._drain_task = asyncio.ensure_future(self._drain_then_exit())
+
+    async def _drain_then_exit(self) -> None:
+        try:
+            await self.drain()
+        finally:
+            # uvicorn's SIGINT handler starts its graceful shutdown
+            os.kill(os.getpid(), signal.SIGINT)
+
+    async def drain(self) -> Dict[str, Any]:
+        """Run the drain sequence; returns a summary of what was waited for"""
+        if self.draining_since is None:
+            self.draining_since = time.monotonic()
+        deadline = self.draining_since + self.drain_timeout
+
+        await asyncio.sleep(max(0.0, min(self.drain_grace, deadline - time.monotonic())))
+
+        notified = await self.connections.broadcast({
+            "type": "server_draining",
+            "reconnect": True,
+            "message": "This server is restarting; please reconnect",
+            "deadline_ms": int(max(0.0, deadline - time.monotonic()) * 1000),
+            "timestamp": time.time()
+        })
+
+        pending = sum(self.in_flight.values())
+        remaining = deadline - time.monotonic()
+        if pending and remaining > 0:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        abandoned = sum(self.in_flight.values())
+        if abandoned:
+            logger.warning(f"Drain deadline reached with {abandoned} request(s) still in flight")
+
+        await self.connections.close_all(code=CLOSE_SERVICE_RESTART, flush_timeout=1.0)
+        self.stopped = True
+        summary = {
+            "notified_connections": notified,
+            "in_flight_at_signal": pending,
+            "abandoned": abandoned,
+            "drain_seconds": round(time.monotonic() - self.draining_since, 3)
+        }
+        logger.info(f"Drain complete: {summary}")
+        return summary
+
+    def report(self) -> Dict[str, Any]:
+        report = self.readiness.report()
+        report.update({
+            "ready": self.ready,
+            "state": self.state,
+            "in_flight": {kind: count for kind, count in self.in_flight.items() if count},
+            "draining_for": round(time.monotonic() - self.draining_since, 3) if self.draining_since else None,
+            "rejected_connections": self.rejected_connections
+        })
+        return report
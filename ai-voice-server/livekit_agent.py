@@ -7,28 +7,22 @@ Real-time voice conversations using LiveKit Agents framework
 import os
 import logging
 import asyncio
-from typing import Dict, Any
+import importlib.util
+import threading
+from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-try:
-    from livekit_agents import MultimodalAgent
-    from livekit_agents.agents import AgentConfig
-    from livekit_agents.llm import OpenAILLM
-    from livekit_agents.tts import OpenAITTS
-    from livekit_agents.stt import OpenAIWhisperSTT
-    
-    LIVEKIT_AVAILABLE = True
-    logger.info("LiveKit Agents framework imported successfully")
-except ImportError as e:
-    LIVEKIT_AVAILABLE = False
-    logger.warning(f"LiveKit Agents not available: {e}")
+# The agents stack (plugins, media codecs) is only imported when an agent is
+# first needed; checking for the package here is cheap
+LIVEKIT_AVAILABLE = importlib.util.find_spec("livekit_agents") is not None
+
+AGENT_IDENTITY = "ai-learning-assistant"
+DEFAULT_TOKEN_TTL = 6 * 3600
 
 class LiveKitVoiceAgent:
     """LiveKit-based voice agent for real-time conversations"""
@@ -38,19 +32,37 @@ class LiveKitVoiceAgent:
         self.livekit_api_key = os.getenv('LIVEKIT_API_KEY')
         self.livekit_api_secret = os.getenv('LIVEKIT_API_SECRET')
         self.openai_api_key = os.getenv('OPENAI_API_KEY')
-        
-        if not all([self.livekit_url, self.livekit_api_key, self.livekit_api_secret, self.openai_api_key]):
-            logger.error("Missing required environment variables for LiveKit")
-            return
-        
-        if LIVEKIT_AVAILABLE:
-            self.setup_livekit_agent()
-        else:
-            logger.warning("Using fallback agent without LiveKit")
+        self.agent = None
+        self._setup_attempted = False
+        self._setup_lock = threading.Lock()
+    
+    @property
+    def configured(self) -> bool:
+        return all([self.livekit_url, self.livekit_api_key, self.livekit_api_secret, self.openai_api_key])
+    
+    def ensure_agent(self):
+        """Set the agent up on first use; returns None when LiveKit is unusable"""
+        if not self._setup_attempted:
+            with self._setup_lock:
+                if not self._setup_attempted:
+                    self._setup_attempted = True
+                    if not self.configured:
+                        logger.error("Missing required environment variables for LiveKit")
+                    elif LIVEKIT_AVAILABLE:
+                        self.setup_livekit_agent()
+                    else:
+                        logger.warning("Using fallback agent without LiveKit")
+        return self.agent
     
     def setup_livekit_agent(self):
         """Setup LiveKit MultimodalAgent"""
         try:
+            from livekit_agents import MultimodalAgent
+            from livekit_agents.agents import AgentConfig
+            from livekit_agents.llm import OpenAILLM
+            from livekit_agents.tts import OpenAITTS
+            from livekit_agents.stt import OpenAIWhisperSTT
+            
             # Configure OpenAI components
             llm = OpenAILLM(
                 api_key=self.openai_api_key,
@@ -85,27 +97,44 @@ class LiveKitVoiceAgent:
             logger.error(f"Failed to setup LiveKit agent: {e}")
             self.agent = None
     
-    async def start_conversation(self, room_name: str, participant_name: str = "User"):
-        """Start a LiveKit conversation session"""
-        if not self.agent:
+    def create_token(self, room_name: str, identity: str, ttl: float, name: Optional[str] = None) -> str:
+        """Signed join token for ``identity`` in ``room_name``, valid for ``ttl`` seconds
+
+        ``identity`` must be unique in the room: LiveKit disconnects a
+        participant when another joins with the same one. ``name`` is what
+        others see.
+        """
+        from livekit_server_sdk import AccessToken, VideoGrant
+        
+        token = AccessToken(
+            self.livekit_api_key, self.livekit_api_secret, identity=identity, name=name or identity, ttl=int(ttl)
+        )
+        token.add_grant(VideoGrant(
+            room_join=True,
+            room=room_name,
+            can_publish=True,
+            can_subscribe=True
+        ))
+        return token.to_jwt()
+    
+    async def start_conversation(self, room_name: str, participant_name: str = "User", token: Optional[str] = None):
+        """Start a LiveKit conversation session
+        
+        ``token`` is the agent's join token; pass one from a token cache to
+        avoid signing a new one per session.
+        """
+        if not await asyncio.to_thread(self.ensure_agent):
             raise Exception("LiveKit agent not available")
         
         try:
-            # Generate room token
-            from livekit_server_sdk import AccessToken, VideoGrant
-            
-            token = AccessToken()
-            token.add_grant(VideoGrant(
-                room_join=True,
-                room=room_name,
-                can_publish=True,
-                can_subscribe=True
-            ))
+            if token is None:
+                token = self.create_token(room_name, AGENT_IDENTITY, DEFAULT_TOKEN_TTL)
             
             # Start agent session
             session = await self.agent.start_session(
                 room_name=room_name,
-                participant_name=participant_name
+                participant_name=participant_name,
+                token=token
             )
             
             logger.info(f"Started LiveKit conversation in room: {room_name}")
@@ -125,5 +154,5 @@ class LiveKitVoiceAgent:
             "agent_ready": bool(self.agent)
         }
 
-# Global agent instance
+# Global agent instance; the LiveKit stack is loaded by ensure_agent()
 livekit_agent = LiveKitVoiceAgent()
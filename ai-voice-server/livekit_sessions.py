@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+LiveKit Session Manager
+Room placement, capacity limits, token reuse and per-room stats for LiveKit agents
+
+Every server worker runs a ``LiveKitSessionManager``. At startup it
+pre-warms the agent's LLM/TTS/STT components, so the first room does not
+pay for it, and announces its load in the shared state backend. A new room
+is placed on the least loaded live worker; when that is another process the
+request is handed over on its dispatch channel. A room already running
+somewhere stays there. Each worker hosts at most LIVEKIT_MAX_ROOMS rooms.
+
+Every participant joins with an identity of its own: LiveKit disconnects
+whoever held an identity when someone else joins with it. A verified caller
+(user or session, see caller_identity) keeps theirs across joins; anyone
+else gets a new guest identity each time. Join tokens are cached per room
+and identity and reused until LIVEKIT_TOKEN_REFRESH_SECONDS before they
+expire.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from livekit_agent import AGENT_IDENTITY, LiveKitVoiceAgent
+from shared_state import WORKER_ID, StateBackend
+
+logger = logging.getLogger(__name__)
+
+LIVEKIT_MAX_ROOMS = int(os.getenv("LIVEKIT_MAX_ROOMS", "20"))
+LIVEKIT_TOKEN_TTL = float(os.getenv("LIVEKIT_TOKEN_TTL", str(6 * 3600)))
+LIVEKIT_TOKEN_REFRESH_SECONDS = float(os.getenv("LIVEKIT_TOKEN_REFRESH_SECONDS", "600"))
+LIVEKIT_HEARTBEAT_SECONDS = float(os.getenv("LIVEKIT_HEARTBEAT_SECONDS", "5"))
+
+WORKERS_KEY = "livekit:workers"
+LATENCY_SAMPLES = 256
+
+STARTING, ACTIVE, CLOSED, FAILED = "starting", "active", "closed", "failed"
+
+
+class RoomCapacityExceeded(Exception):
+    """No worker can take another room"""
+
+
+def participant_identity(caller: Optional[str] = None) -> str:
+    """LiveKit identity for a caller key (``tenant/user:...``), or a new guest identity without one"""
+    return caller if caller else f"guest-{uuid.uuid4().hex}"
+
+
+class TokenCache:
+    """Join tokens reused until shortly before they expire"""
+
+    def __init__(
+        self,
+        agent: LiveKitVoiceAgent,
+        ttl: float = LIVEKIT_TOKEN_TTL,
+        refresh_before: float = LIVEKIT_TOKEN_REFRESH_SECONDS,
+        max_entries: int = 10000
+    ):
+        self.agent = agent
+        self.ttl = ttl
+        self.refresh_before = min(refresh_before, ttl / 2)
+        self.max_entries = max_entries
+        self._tokens: Dict[Tuple[str, str], Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.reused = 0
+
+    def get(self, room: str, identity: str, name: Optional[str] = None) -> Tuple[str, float]:
+        """Token for ``identity`` in ``room`` and its expiry (epoch seconds)
+
+        ``name`` is only used when a token is signed; one cached for the
+        identity keeps the name it was signed with.
+        """
+        now = time.time()
+        with self._lock:
+            cached = self._tokens.get((room, identity))
+            if cached is not None and cached[1] - now > self.refresh_before:
+                self.reused += 1
+                return cached
+        token = self.agent.create_token(room, identity, self.ttl, name)
+        entry = (token, now + self.ttl)
+        with self._lock:
+            if len(self._tokens) >= self.max_entries:
+                self._tokens = {key: value for key, value in self._tokens.items() if value[1] - now > self.refresh_before}
+            if len(self._tokens) >= self.max_entries:
+                # Guests get a new identity per join, so live tokens can fill it too: drop the oldest half
+                self._tokens = dict(list(self._tokens.items())[self.max_entries // 2:])
+            self._tokens[(room, identity)] = entry
+            self.issued += 1
+        return entry
+
+    def forget_room(self, room: str) -> None:
+        with self._lock:
+            for key in [key for key in self._tokens if key[0] == room]:
+                del self._tokens[key]
+
+
+class RoomSession:
+    """One room hosted by this worker"""
+
+    __slots__ = ("room", "participant", "state", "session", "created_at", "started_at", "closed_at", "error", "latencies")
+
+    def __init__(self, room: str, participant: str):
+        self.room = room
+        self.participant = participant
+        self.state = STARTING
+        self.session = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.closed_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.latencies: Dict[str, Deque[float]] = {}
+
+    def observe(self, metric: str, seconds: float) -> None:
+        samples = self.latencies.get(metric)
+        if samples is None:
+            samples = self.latencies[metric] = deque(maxlen=LATENCY_SAMPLES)
+        samples.append(seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = {}
+        for metric, samples in self.latencies.items():
+            ordered = sorted(samples)
+            latencies[metric] = {
+                "count": len(ordered),
+                "mean_ms": round(statistics.fmean(ordered) * 1000, 1),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1)
+            }
+        return {
+            "room": self.room,
+            "participant": self.participant,
+            "state": self.state,
+            "created_at": self.created_at,
+            "uptime_s": round((self.closed_at or time.time()) - (self.started_at or self.created_at), 1),
+            "error": self.error,
+            "latency": latencies
+        }
+
+
+class LiveKitSessionManager:
+    """Hosts LiveKit agent sessions for this worker and places rooms across workers"""
+
+    def __init__(
+        self,
+        agent: LiveKitVoiceAgent,
+        state: StateBackend,
+        max_rooms: int = LIVEKIT_MAX_ROOMS,
+        heartbeat_interval: float = LIVEKIT_HEARTBEAT_SECONDS
+    ):
+        self.agent = agent
+        self.state = state
+        self.max_rooms = max_rooms
+        self.heartbeat_interval = heartbeat_interval
+        self.tokens = TokenCache(agent)
+        self.sessions: Dict[str, RoomSession] = {}
+        self.counters: Counter = Counter()
+        self.prewarm_seconds: Optional[float] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    @property
+    def active_rooms(self) -> int:
+        return sum(1 for session in self.sessions.values() if session.state in (STARTING, ACTIVE))
+
+    def _worker_key(self, worker_id: str) -> str:
+        return f"livekit:worker:{worker_id}"
+
+    def _room_key(self, room: str) -> str:
+        return f"livekit:room:{room}"
+
+    async def start(self) -> None:
+        """Pre-warm the agent, join the worker registry and start heartbeats"""
+        self._loop = asyncio.get_running_loop()
+        await asyncio.to_thread(self.state.list_push, WORKERS_KEY, WORKER_ID.encode(), 1024)
+        await asyncio.to_thread(self.state.subscribe, f"livekit:dispatch:{WORKER_ID}", self._on_dispatch)
+        self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+
+        if not self.agent.configured:
+            return  # LiveKit is not set up for this deployment
+        started = time.perf_counter()
+        if await asyncio.to_thread(self.agent.ensure_agent):
+            self.prewarm_seconds = round(time.perf_counter() - started, 3)
+            logger.info(f"LiveKit agent pre-warmed in {self.prewarm_seconds}s")
+
+    async def stop(self) -> None:
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+        for room in [room for room, session in self.sessions.items() if session.state in (STARTING, ACTIVE)]:
+            await self.close_room(room)
+        await asyncio.to_thread(self.state.delete, self._worker_key(WORKER_ID))
+
+    async def _heartbeat(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self._publish_load)
+            except Exception as e:
+                logger.warning(f"LiveKit heartbeat failed: {e}")
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def _publish_load(self) -> None:
+        load = {"rooms": self.active_rooms, "capacity": self.max_rooms, "ready": self.agent.agent is not None}
+        self.state.set(self._worker_key(WORKER_ID), json.dumps(load).encode(), ttl=3 * self.heartbeat_interval)
+
+    def _choose_worker(self) -> Optional[str]:
+        """Least loaded live worker with free capacity (this one on ties)"""
+        candidates: List[Tuple[float, int, str]] = []
+        seen = set()
+        for raw in self.state.list_range(WORKERS_KEY):
+            worker_id = raw.decode()
+            if worker_id in seen:
+                continue
+            seen.add(worker_id)
+            if worker_id == WORKER_ID:
+                load = {"rooms": self.active_rooms, "capacity": self.max_rooms, "ready": True}
+            else:
+                data = self.state.get(self._worker_key(worker_id))
+                if data is None:
+                    continue  # no heartbeat: the worker is gone
+                load = json.loads(data)
+            if load["ready"] and load["rooms"] < load["capacity"]:
+                candidates.append((load["rooms"] / load["capacity"], worker_id != WORKER_ID, worker_id))
+        return min(candidates)[2] if candidates else None
+
+    async def open_room(self, room: str, identity: Optional[str] = None, participant: str = "User") -> Dict[str, Any]:
+        """Place a room on a worker and return how a participant joins it
+
+        ``identity`` is the participant's LiveKit identity (see
+        participant_identity; a guest one when None) and ``participant``
+        their display name.
+        """
+        identity = participant_identity(identity)
+        assigned = await asyncio.to_thread(self.state.get, self._room_key(room))
+        worker_id = assigned.decode() if assigned is not None else None
+        if worker_id is not None and worker_id != WORKER_ID:
+            if await asyncio.to_thread(self.state.get, self._worker_key(worker_id)) is None:
+                worker_id = None  # its worker died; place it again
+        if worker_id is None:
+            worker_id = await asyncio.to_thread(self._choose_worker)
+            if worker_id is None:
+                self.counters["rejected"] += 1
+                raise RoomCapacityExceeded("All LiveKit workers are at capacity")
+
+        if worker_id == WORKER_ID:
+            await self._start_local(room, participant)
+        else:
+            # Claim the room for that worker now so repeated opens do not place it twice
+            await asyncio.to_thread(self.state.set, self._room_key(room), worker_id.encode())
+            message = json.dumps({"action": "start", "room": room, "participant": participant}).encode()
+            await asyncio.to_thread(self.state.publish, f"livekit:dispatch:{worker_id}", message)
+            self.counters["dispatched"] += 1
+
+        token, expires_at = await asyncio.to_thread(self.tokens.get, room, identity, participant)
+        return {
+            "room": room,
+            "worker": worker_id,
+            "identity": identity,
+            "livekit_url": self.agent.livekit_url,
+            "token": token,
+            "token_expires_at": expires_at
+        }
+
+    def _on_dispatch(self, data: bytes) -> None:
+        # May run on the backend's subscriber thread
+        message = json.loads(data)
+        if message.get("action") == "start" and self._loop is not None:
+            self._loop.call_soon_threadsafe(
+                asyncio.ensure_future,
+                self._start_local(message["room"], message.get("participant", "User"), raise_errors=False)
+            )
+
+    async def _start_local(self, room: str, participant: str, raise_errors: bool = True) -> Optional[RoomSession]:
+        existing = self.sessions.get(room)
+        if existing is not None and existing.state in (STARTING, ACTIVE):
+            return existing
+        if self.active_rooms >= self.max_rooms:
+            self.counters["rejected"] += 1
+            if raise_errors:
+                raise RoomCapacityExceeded(f"Worker {WORKER_ID} is hosting {self.max_rooms} rooms")
+            return None
+
+        record = RoomSession(room, participant)
+        self.sessions[room] = record
+        await asyncio.to_thread(self.state.set, self._room_key(room), WORKER_ID.encode())
+        started = time.perf_counter()
+        try:
+            token, _ = await asyncio.to_thread(self.tokens.get, room, AGENT_IDENTITY)
+            record.session = await self.agent.start_conversation(room, participant, token=token)
+        except Exception as e:
+            record.state = FAILED
+            record.error = str(e)
+            record.closed_at = time.time()
+            self.counters["failed"] += 1
+            await asyncio.to_thread(self.state.delete, self._room_key(room))
+            if raise_errors:
+                raise
+            logger.error(f"Dispatched room {room} failed to start: {e}")
+            return record
+
+        record.observe("session_start", time.perf_counter() - started)
+        record.state = ACTIVE
+        record.started_at = time.time()
+        self.counters["started"] += 1
+        return record
+
+    def observe(self, room: str, metric: str, seconds: float) -> None:
+        """Record a latency sample (e.g. response time) for a hosted room"""
+        session = self.sessions.get(room)
+        if session is not None:
+            session.observe(metric, seconds)
+
+    async def close_room(self, room: str) -> bool:
+        """End a room hosted here; returns False if this worker does not host it"""
+        record = self.sessions.get(room)
+        if record is None or record.state not in (STARTING, ACTIVE):
+            return False
+        session = record.session
+        try:
+            if hasattr(session, "aclose"):
+                await session.aclose()
+            elif hasattr(session, "close"):
+                result = session.close()
+                if asyncio.iscoroutine(result):
+                    await result
+        except Exception as e:
+            logger.warning(f"Error closing LiveKit room {room}: {e}")
+        record.state = CLOSED
+        record.closed_at = time.time()
+        record.session = None
+        self.counters["closed"] += 1
+        self.tokens.forget_room(room)
+        await asyncio.to_thread(self.state.delete, self._room_key(room))
+        # Keep the records of recently ended rooms for stats, not all of them
+        ended = [name for name, item in self.sessions.items() if item.state in (CLOSED, FAILED)]
+        for name in ended[:-100]:
+            del self.sessions[name]
+        return True
+
+    def get_room(self, room: str) -> Optional[Dict[str, Any]]:
+        session = self.sessions.get(room)
+        return session.to_dict() if session is not None else None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "worker_id": WORKER_ID,
+            "active_rooms": self.active_rooms,
+            "max_rooms": self.max_rooms,
+            "prewarm_seconds": self.prewarm_seconds,
+            "agent_ready": self.agent.agent is not None,
+            "counters": dict(self.counters),
+            "tokens": {"issued": self.tokens.issued, "reused": self.tokens.reused},
+            "rooms": [session.to_dict() for session in self.sessions.values()]
+        }
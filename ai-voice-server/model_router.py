@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Chat Model Routing
+Local classification of chat messages into model/latency tiers and token budgets
+
+Most learner messages are short lookups ("what does *brisk* mean?", "how do
+you say *colonel*?") that a small model answers well in a few sentences.
+Messages are classified with cheap heuristics, no model call, into:
+
+- ``quick``: definitions, spellings, pronunciations, yes/no; small model, short answer
+- ``standard``: ordinary questions; small model
+- ``deep``: explanations, comparisons, writing help, long or multi-part messages; large model
+
+Each decision can be logged (ROUTER_LOG) as JSON lines together with the
+latency, tokens and finish reason of the call. Learners' messages are not
+written, only their length, a hash and the features they were routed on.
+``replay`` re-runs the current rules over those features offline and
+reports how routing, cost and truncation would change.
+
+Usage:
+    python model_router.py replay logs/routing.jsonl
+    python model_router.py classify "what does brisk mean?"
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import statistics
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Deque, Dict, Iterable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# off: every message gets the model and budget used before routing
+ROUTER_MODE = os.getenv("ROUTER_MODE", "auto")
+ROUTER_LOG = os.getenv("ROUTER_LOG")
+LATENCY_SAMPLES = 512
+
+# USD per million tokens (input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+}
+
+
+class Tier(NamedTuple):
+    name: str
+    model: str
+    max_tokens: int
+    temperature: float
+
+
+TIERS = {
+    "quick": Tier("quick", os.getenv("ROUTER_QUICK_MODEL", "gpt-4o-mini"), 120, 0.3),
+    "standard": Tier("standard", os.getenv("ROUTER_STANDARD_MODEL", "gpt-4o-mini"), 300, 0.7),
+    "deep": Tier("deep", os.getenv("ROUTER_DEEP_MODEL", "gpt-4o"), 500, 0.7),
+    # ROUTER_MODE=off
+    "unrouted": Tier("unrouted", "gpt-4o", 300, 0.7),
+}
+
+_QUICK_PATTERNS = re.compile(
+    r"^(what\s+(does|is)\s+(the\s+)?(word\s+)?\S+(\s+\S+)?\s+mean"
+    r"|(what\s+is\s+the\s+)?(meaning|definition|synonym|antonym|opposite|plural|past\s+tense)\s+of"
+    r"|define\b|meaning\s+of"
+    r"|how\s+(do\s+(you|i)|to)\s+(say|spell|pronounce|write)"
+    r"|how\s+is\s+\S+\s+(spelled|pronounced)"
+    r"|(is|are|does|do|can|was)\s+\S+(\s+\S+){0,4}\?$"
+    r"|(hi|hello|hey|thanks|thank\s+you|ok|okay|bye)[!. ]*$)",
+    re.IGNORECASE
+)
+_DEEP_PATTERNS = re.compile(
+    r"\b(explain|why|compare|difference\s+between|step\s+by\s+step|in\s+detail|examples?"
+    r"|write\s+(me\s+)?(a|an)|essay|story|paragraph|summari[sz]e|plan|practice\s+(plan|exercises?)"
+    r"|correct\s+(my|this)|check\s+my|rewrite|help\s+me\s+(understand|write|improve))\b",
+    re.IGNORECASE
+)
+
+
+class Route(NamedTuple):
+    tier: Tier
+    reason: str
+    features: Dict[str, Any]
+
+
+def features(message: str, history_turns: int = 0) -> Dict[str, Any]:
+    words = message.split()
+    return {
+        "words": len(words),
+        "questions": message.count("?"),
+        "sentences": max(1, len(re.findall(r"[.!?]+(\s|$)", message))),
+        "history_turns": history_turns,
+        "quick_cue": bool(_QUICK_PATTERNS.search(message.strip())),
+        "deep_cue": bool(_DEEP_PATTERNS.search(message)),
+    }
+
+
+def classify(message: str, history_turns: int = 0, mode: str = ROUTER_MODE) -> Route:
+    """Pick a tier for ``message``; cost is a regex pass and a split"""
+    return route_features(features(message, history_turns), mode)
+
+
+def route_features(found: Dict[str, Any], mode: str = ROUTER_MODE) -> Route:
+    """Pick a tier from a message's features"""
+    if mode == "off":
+        return Route(TIERS["unrouted"], "routing disabled", found)
+    if found["deep_cue"]:
+        return Route(TIERS["deep"], "asks for explanation or writing", found)
+    if found["words"] > 60 or found["questions"] > 2 or found["sentences"] > 4:
+        return Route(TIERS["deep"], "long or multi-part message", found)
+    if found["quick_cue"] and found["words"] <= 12:
+        return Route(TIERS["quick"], "short lookup", found)
+    if found["words"] <= 4 and found["questions"] <= 1:
+        return Route(TIERS["quick"], "very short message", found)
+    return Route(TIERS["standard"], "general question", found)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    input_price, output_price = MODEL_PRICES.get(model, MODEL_PRICES["gpt-4o"])
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+class RouterMetrics:
+    """Per-tier request counts, latency, tokens, cost and truncations"""
+
+    def __init__(self, log_path: Optional[str] = ROUTER_LOG):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self.counts: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.truncated: Counter = Counter()
+        self.prompt_tokens: Counter = Counter()
+        self.completion_tokens: Counter = Counter()
+        self.cost: Dict[str, float] = {}
+        self.latencies: Dict[str, Deque[float]] = {}
+
+    def record(
+        self,
+        route: Route,
+        message: str,
+        latency: float,
+        prompt_tokens: int = 0,
+        completion_tokens: int = 0,
+        finish_reason: Optional[str] = None,
+        error: Optional[str] = None
+    ) -> None:
+        tier = route.tier
+        cost = estimate_cost(tier.model, prompt_tokens, completion_tokens)
+        with self._lock:
+            self.counts[tier.name] += 1
+            if error:
+                self.errors[tier.name] += 1
+            if finish_reason == "length":
+                self.truncated[tier.name] += 1
+            self.prompt_tokens[tier.name] += prompt_tokens
+            self.completion_tokens[tier.name] += completion_tokens
+            self.cost[tier.name] = self.cost.get(tier.name, 0.0) + cost
+            self.latencies.setdefault(tier.name, deque(maxlen=LATENCY_SAMPLES)).append(latency)
+        if self.log_path:
+            # Written outside the lock: a slow disk must not hold up other requests' metrics
+            self._log({
+                "ts": time.time(),
+                "message_sha256": hashlib.sha256(message.encode("utf-8")).hexdigest()[:16],
+                "message_chars": len(message),
+                "tier": tier.name,
+                "model": tier.model,
+                "max_tokens": tier.max_tokens,
+                "reason": route.reason,
+                "features": route.features,
+                "latency_ms": round(latency * 1000, 1),
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "finish_reason": finish_reason,
+                "error": error
+            })
+
+    def _log(self, record: Dict[str, Any]) -> None:
+        try:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write routing log: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tiers = {}
+            for name, count in self.counts.items():
+                ordered = sorted(self.latencies.get(name, ()))
+                tiers[name] = {
+                    "model": TIERS[name].model,
+                    "requests": count,
+                    "errors": self.errors[name],
+                    "truncated": self.truncated[name],
+                    "prompt_tokens": self.prompt_tokens[name],
+                    "completion_tokens": self.completion_tokens[name],
+                    "cost_usd": round(self.cost.get(name, 0.0), 6),
+                    "latency_p50_ms": round(ordered[len(ordered) // 2] * 1000, 1) if ordered else None,
+                    "latency_p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1) if ordered else None
+                }
+        return {"mode": ROUTER_MODE, "tiers": tiers}
+
+
+def replay(records: Iterable[Dict[str, Any]], mode: str = "auto") -> Dict[str, Any]:
+    """Re-route logged traffic with the current rules and compare
+
+    Records are re-routed on their logged features, so new thresholds are
+    evaluated but changed patterns are not; a record that still carries its
+    ``message`` (a hand-made test set) is classified again in full.
+    Costs for the new routing reuse each record's logged token counts, with
+    completion tokens capped at the new tier's budget. Records may carry an
+    ``expected_tier`` label (added by hand) to measure routing accuracy.
+    """
+    transitions: Counter = Counter()
+    latency_by_tier: Dict[str, List[float]] = {}
+    logged_cost = replayed_cost = 0.0
+    labelled = correct = would_truncate = total = 0
+    changed_examples = []
+
+    for record in records:
+        total += 1
+        if "message" in record:
+            route = classify(record["message"], record.get("features", {}).get("history_turns", 0), mode)
+        else:
+            route = route_features(record["features"], mode)
+        transitions[(record["tier"], route.tier.name)] += 1
+        if record.get("latency_ms") is not None and not record.get("error"):
+            latency_by_tier.setdefault(record["tier"], []).append(record["latency_ms"])
+
+        prompt_tokens = record.get("prompt_tokens", 0)
+        completion_tokens = record.get("completion_tokens", 0)
+        logged_cost += estimate_cost(record.get("model", TIERS[record["tier"]].model), prompt_tokens, completion_tokens)
+        replayed_cost += estimate_cost(route.tier.model, prompt_tokens, min(completion_tokens, route.tier.max_tokens))
+        if completion_tokens >= route.tier.max_tokens:
+            would_truncate += 1
+
+        if record.get("expected_tier"):
+            labelled += 1
+            correct += route.tier.name == record["expected_tier"]
+        if record["tier"] != route.tier.name and len(changed_examples) < 20:
+            changed_examples.append({
+                "message": record["message"][:120] if "message" in record else record.get("message_sha256"),
+                "logged": record["tier"],
+                "replayed": route.tier.name,
+                "reason": route.reason
+            })
+
+    return {
+        "records": total,
+        "transitions": {f"{before}->{after}": count for (before, after), count in sorted(transitions.items())},
+        "changed": sum(count for (before, after), count in transitions.items() if before != after),
+        "logged_cost_usd": round(logged_cost, 6),
+        "replayed_cost_usd": round(replayed_cost, 6),
+        "would_truncate": would_truncate,
+        "accuracy": round(correct / labelled, 4) if labelled else None,
+        "labelled": labelled,
+        "logged_latency_ms": {
+            tier: {"median": round(statistics.median(values), 1), "count": len(values)}
+            for tier, values in sorted(latency_by_tier.items())
+        },
+        "changed_examples": changed_examples
+    }
+
+
+def read_log(path: str) -> List[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser("replay", help="Evaluate the current routing rules over a routing log")
+    replay_parser.add_argument("log", help="JSON lines written via ROUTER_LOG")
+    replay_parser.add_argument("--mode", default="auto", choices=["auto", "off"])
+
+    classify_parser = commands.add_parser("classify", help="Show the route for one message")
+    classify_parser.add_argument("message")
+
+    args = parser.parse_args()
+    if args.command == "replay":
+        print(json.dumps(replay(read_log(args.log), args.mode), indent=2, ensure_ascii=False))
+    else:
+        route = classify(args.message)
+        print(json.dumps({"tier": route.tier._asdict(), "reason": route.reason, "features": route.features}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
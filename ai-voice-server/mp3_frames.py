@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+MP3 Frame Utilities
+Duration, tag stripping, concatenation and a loudness envelope for MPEG Layer III streams
+
+Only frame headers and side information are parsed, nothing is decoded, so these are cheap
+enough to run on every generated clip. TTS output is Layer III; other
+layers are not supported.
+"""
+
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# Bitrates in kbps, indexed by the header's 4-bit bitrate field
+_BITRATES_MPEG1 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0)
+_BITRATES_MPEG2 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0)
+_SAMPLE_RATES = (44100, 48000, 32000)
+
+# Version field values
+_MPEG25, _MPEG2, _MPEG1 = 0, 2, 3
+
+
+class Frame(NamedTuple):
+    offset: int
+    length: int
+    samples: int
+    sample_rate: int
+    bitrate: int  # bits per second
+
+
+def id3v2_size(data: bytes) -> int:
+    """Length of a leading ID3v2 tag, or 0"""
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def parse_header(data: bytes, offset: int) -> Optional[Frame]:
+    """Parse the Layer III frame header at ``offset``"""
+    if offset + 4 > len(data) or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2 = data[offset + 1], data[offset + 2]
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    padding = (b2 >> 1) & 0x01
+    if version == 1 or layer != 1 or rate_index == 3 or bitrate_index in (0, 15):
+        return None
+
+    sample_rate = _SAMPLE_RATES[rate_index]
+    if version == _MPEG1:
+        bitrate = _BITRATES_MPEG1[bitrate_index] * 1000
+        samples, coefficient = 1152, 144
+    else:
+        sample_rate //= 2 if version == _MPEG2 else 4
+        bitrate = _BITRATES_MPEG2[bitrate_index] * 1000
+        samples, coefficient = 576, 72
+    length = coefficient * bitrate // sample_rate + padding
+    return Frame(offset, length, samples, sample_rate, bitrate)
+
+
+def iter_frames(data: bytes) -> Iterator[Frame]:
+    """Yield audio frames, skipping tags and resynchronizing over junk"""
+    offset = id3v2_size(data)
+    end = len(data)
+    if end >= 128 and data[-128:-125] == b"TAG":
+        end -= 128  # ID3v1 trailer
+    while offset + 4 <= end:
+        frame = parse_header(data, offset)
+        if frame is None or offset + frame.length > end:
+            offset = data.find(b"\xff", offset + 1, end)
+            if offset < 0:
+                return
+            continue
+        yield frame
+        offset += frame.length
+
+
+def is_info_frame(data: bytes, frame: Frame) -> bool:
+    """Whether a frame is a Xing/Info/VBRI header rather than audio"""
+    body = data[frame.offset + 4:frame.offset + min(frame.length, 64)]
+    return b"Xing" in body or b"Info" in body or b"VBRI" in body
+
+
+def duration(data: bytes) -> float:
+    """Playing time in seconds"""
+    return sum(
+        frame.samples / frame.sample_rate
+        for frame in iter_frames(data)
+        if not is_info_frame(data, frame)
+    )
+
+
+def audio_frames(data: bytes) -> bytes:
+    """Only the audio frames: no ID3 tags and no Xing/Info header"""
+    return b"".join(
+        data[frame.offset:frame.offset + frame.length]
+        for frame in iter_frames(data)
+        if not is_info_frame(data, frame)
+    )
+
+
+def _read_bits(data: bytes, bit_offset: int, count: int) -> int:
+    value = 0
+    for position in range(bit_offset, bit_offset + count):
+        value = (value << 1) | ((data[position >> 3] >> (7 - (position & 7))) & 1)
+    return value
+
+
+def granule_bits(data: bytes) -> Tuple[List[int], float]:
+    """Bits the encoder spent on each granule, and the granule length in seconds
+
+    Layer III side information records ``part2_3_length`` per granule and
+    channel without any decoding. Encoders spend almost nothing on silence,
+    so this doubles as a cheap loudness envelope (~13 ms resolution at 44.1 kHz).
+    """
+    values: List[int] = []
+    seconds = 0.0
+    for frame in iter_frames(data):
+        if is_info_frame(data, frame):
+            continue
+        header = data[frame.offset:frame.offset + 4]
+        version = (header[1] >> 3) & 0x03
+        protected = not header[1] & 0x01
+        channels = 1 if header[3] >> 6 == 3 else 2
+        side = frame.offset + 4 + (2 if protected else 0)
+
+        if version == _MPEG1:
+            granules = 2
+            first = 9 + (5 if channels == 1 else 3) + 4 * channels  # main_data_begin, private bits, scfsi
+            block = 59
+            side_length = 17 if channels == 1 else 32
+        else:
+            granules = 1
+            first = 8 + channels  # main_data_begin, private bits
+            block = 63
+            side_length = 9 if channels == 1 else 17
+        if side + side_length > len(data):
+            break
+
+        for granule in range(granules):
+            total = 0
+            for channel in range(channels):
+                total += _read_bits(data, side * 8 + first + (granule * channels + channel) * block, 12)
+            values.append(total)
+        seconds = 576 / frame.sample_rate
+    return values, seconds
+
+
+def concat(clips: Iterable[bytes]) -> bytes:
+    """Join MP3 clips into one stream
+
+    Tags and Xing headers are dropped from every clip: a Xing header left at
+    the front would make players report the first clip's length as the total.
+    """
+    return b"".join(audio_frames(clip) for clip in clips)
@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""
+Narration Pre-generation
+Offline pipeline that turns markdown articles into stored, segmented speech
+
+Articles are stripped of markdown, split into paragraph/sentence segments
+and synthesized concurrently under a request rate limit. Segment audio is
+content-addressed by the same key as the speech cache, so any passage made
+of whole segments can be served (or stitched) straight from disk by /speech.
+Word timings for read-along highlighting are aligned once and stored next
+to each segment. A manifest per article and voice records segment order
+and timings.
+
+Whole-article MP3s in ``audio/`` are a cache: every rebuild of an article
+stitches a new one. prune_audio() removes those no manifest names once they
+are NARRATION_AUDIO_TTL seconds old, and the oldest of the rest while
+``audio/`` holds more than NARRATION_AUDIO_MAX_BYTES (they are stitched
+again on their next request). It runs after each build and, at most every
+NARRATION_PRUNE_INTERVAL seconds, when the server stitches a file.
+
+Usage:
+    python narration.py build ../blog-content-for-audio.md --voice alloy
+    python narration.py list
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import mp3_frames
+from alignment import Alignment, align
+
+logger = logging.getLogger(__name__)
+
+NARRATION_DIR = os.getenv("NARRATION_DIR", "narration")
+SEGMENT_MAX_CHARS = int(os.getenv("NARRATION_SEGMENT_CHARS", "600"))
+# Stitched articles: how long an outdated one is kept for listeners still on it, and a size cap (0: none)
+NARRATION_AUDIO_TTL = float(os.getenv("NARRATION_AUDIO_TTL", "86400"))
+NARRATION_AUDIO_MAX_BYTES = int(os.getenv("NARRATION_AUDIO_MAX_BYTES", "0"))
+NARRATION_PRUNE_INTERVAL = float(os.getenv("NARRATION_PRUNE_INTERVAL", "600"))
+
+# OpenAI TTS voices; with document ids, the only names manifests are stored under
+VOICES = ("alloy", "ash", "coral", "echo", "fable", "nova", "onyx", "sage", "shimmer")
+_DOCUMENT_ID = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])[\"')\]]*\s+(?=[\"'(\[]?[A-Z0-9])")
+
+
+def markdown_to_text(markdown: str) -> str:
+    """Plain narration text from markdown; paragraphs stay separated by blank lines"""
+    text = re.sub(r"\A---\n.*?\n---\n", "", markdown, flags=re.DOTALL)  # front matter
+    text = re.sub(r"```.*?```", "", text, flags=re.DOTALL)  # code blocks are not read aloud
+    text = re.sub(r"<[^>]+>", "", text)
+    text = re.sub(r"!\[[^\]]*\]\([^)]*\)", "", text)  # images
+    text = re.sub(r"\[([^\]]+)\]\([^)]*\)", r"\1", text)  # links keep their text
+    text = re.sub(r"`([^`]*)`", r"\1", text)
+
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if re.fullmatch(r"[-*_]{3,}|\|?[\s:|-]+\|?", stripped) and stripped:
+            continue  # horizontal rules and table separators
+        stripped = re.sub(r"^#{1,6}\s+", "", stripped)
+        stripped = re.sub(r"^(>\s*)+", "", stripped)
+        stripped = re.sub(r"^([-*+]|\d+[.)])\s+", "", stripped)
+        stripped = stripped.strip("|").replace(" | ", ", ")
+        stripped = re.sub(r"(\*\*|__|\*|_|~~)(\S.*?\S|\S)\1", r"\2", stripped)
+        if stripped and not re.search(r"[.!?:;…\"')]$", stripped):
+            # Headings, list items and other unpunctuated lines get a pause
+            stripped += "."
+        lines.append(stripped)
+
+    paragraphs, current = [], []
+    for line in lines:
+        if line:
+            current.append(line)
+        elif current:
+            paragraphs.append(" ".join(current))
+            current = []
+    if current:
+        paragraphs.append(" ".join(current))
+    return "\n\n".join(paragraphs)
+
+
+def split_segments(text: str, max_chars: int = SEGMENT_MAX_CHARS) -> List[str]:
+    """Split text into segments of whole paragraphs or, for long ones, whole sentences
+
+    Splitting only looks inside one paragraph at a time, so a passage made
+    of whole paragraphs always yields the same segments as the full article.
+    """
+    segments = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = " ".join(paragraph.split())
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            segments.append(paragraph)
+            continue
+        current = ""
+        for sentence in _SENTENCE_END.split(paragraph):
+            if current and len(current) + 1 + len(sentence) > max_chars:
+                segments.append(current)
+                current = sentence
+            else:
+                current = f"{current} {sentence}" if current else sentence
+        if current:
+            segments.append(current)
+    return segments
+
+
+def is_document_id(document_id: str) -> bool:
+    return _DOCUMENT_ID.fullmatch(document_id) is not None
+
+
+def segment_key(text: str, voice: str) -> str:
+    """Content address of a segment; matches AIVoiceAgent.speech_cache_key"""
+    return hashlib.sha256(f"{voice}\0{text}".encode()).hexdigest()
+
+
+def _audio_digest(keys: List[str]) -> str:
+    return hashlib.sha256("\n".join(keys).encode()).hexdigest()
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class NarrationStore:
+    """Segment audio and manifests on disk (a shared volume for multiple workers)
+
+    Layout: ``segments/<key>.mp3``, word timings in ``segments/<key>.align``,
+    ``manifests/<document>.<voice>.json`` and whole articles stitched from
+    their segments in ``audio/<hash of the segment keys>.mp3``.
+    Writes are atomic renames, so readers never see partial files.
+    """
+
+    def __init__(
+        self,
+        root: str = NARRATION_DIR,
+        audio_ttl: float = NARRATION_AUDIO_TTL,
+        audio_max_bytes: int = NARRATION_AUDIO_MAX_BYTES,
+        prune_interval: float = NARRATION_PRUNE_INTERVAL
+    ):
+        self.root = Path(root)
+        self.segments_dir = self.root / "segments"
+        self.manifests_dir = self.root / "manifests"
+        self.audio_dir = self.root / "audio"
+        self.audio_ttl = audio_ttl
+        self.audio_max_bytes = audio_max_bytes
+        self.prune_interval = prune_interval
+        self._prune_lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def segment_path(self, key: str) -> Path:
+        return self.segments_dir / f"{key}.mp3"
+
+    def has_segment(self, key: str) -> bool:
+        return self.segment_path(key).is_file()
+
+    def read_segment(self, key: str) -> Optional[bytes]:
+        try:
+            return self.segment_path(key).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def write_segment(self, key: str, audio: bytes) -> None:
+        _write_atomic(self.segment_path(key), audio)
+
+    def alignment_path(self, key: str) -> Path:
+        return self.segments_dir / f"{key}.align"
+
+    def read_alignment(self, key: str) -> Optional[Alignment]:
+        try:
+            return Alignment.from_bytes(self.alignment_path(key).read_bytes())
+        except FileNotFoundError:
+            return None
+
+    def write_alignment(self, key: str, alignment: Alignment) -> None:
+        _write_atomic(self.alignment_path(key), alignment.to_bytes())
+
+    def segment_alignment(self, key: str, text: str) -> Alignment:
+        """Stored word timings for a segment, aligning it first if needed"""
+        alignment = self.read_alignment(key)
+        if alignment is None:
+            audio = self.read_segment(key)
+            if audio is None:
+                raise FileNotFoundError("Narration segment missing")
+            alignment = align(text, audio)
+            self.write_alignment(key, alignment)
+        return alignment
+
+    def manifest_path(self, document_id: str, voice: str) -> Optional[Path]:
+        """Where a manifest lives; None unless ``document_id`` and ``voice`` are valid, so no path escapes the root"""
+        if not is_document_id(document_id) or voice not in VOICES:
+            return None
+        return self.manifests_dir / f"{document_id}.{voice}.json"
+
+    def read_manifest(self, document_id: str, voice: str) -> Optional[Dict[str, Any]]:
+        path = self.manifest_path(document_id, voice)
+        if path is None:
+            return None
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+
+    def write_manifest(self, manifest: Dict[str, Any]) -> None:
+        path = self.manifest_path(manifest["document_id"], manifest["voice"])
+        if path is None:
+            raise ValueError(f"Invalid document id or voice: {manifest['document_id']!r}, {manifest['voice']!r}")
+        data = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+        _write_atomic(path, data)
+
+    def list_manifests(self) -> List[Dict[str, Any]]:
+        if not self.manifests_dir.is_dir():
+            return []
+        manifests = []
+        for path in sorted(self.manifests_dir.glob("*.json")):
+            manifest = json.loads(path.read_text(encoding="utf-8"))
+            manifests.append({key: manifest[key] for key in ("document_id", "title", "voice", "segment_count", "duration_s", "created_at")})
+        return manifests
+
+    def lookup(self, text: str, voice: str, max_chars: int = SEGMENT_MAX_CHARS) -> Optional[List[str]]:
+        """Segment keys for ``text`` if every segment is stored, else None"""
+        keys = [segment_key(segment, voice) for segment in split_segments(text, max_chars)]
+        if keys and all(self.has_segment(key) for key in keys):
+            return keys
+        return None
+
+    def stitch(self, keys: List[str]) -> bytes:
+        clips = [self.read_segment(key) for key in keys]
+        if any(clip is None for clip in clips):
+            raise FileNotFoundError("Narration segment missing")
+        return clips[0] if len(clips) == 1 else mp3_frames.concat(clips)
+
+    def article_audio(self, keys: List[str]) -> Path:
+        """One MP3 of the given segments on disk, stitched on first use
+
+        Named by the segment keys, so a rebuilt article gets a new file and
+        the old one is never modified under a reader.
+        """
+        path = self.audio_dir / f"{_audio_digest(keys)}.mp3"
+        if not path.is_file():
+            _write_atomic(path, self.stitch(keys))
+            if time.time() - self._pruned_at >= self.prune_interval:
+                self.prune_audio()
+        return path
+
+    def prune_audio(self) -> Dict[str, int]:
+        """Remove outdated stitched articles, then the oldest while over the size cap"""
+        with self._prune_lock:
+            now = time.time()
+            self._pruned_at = now
+            if not self.audio_dir.is_dir():
+                return {"removed": 0, "removed_bytes": 0}
+            current = set()
+            if self.manifests_dir.is_dir():
+                for manifest_path in self.manifests_dir.glob("*.json"):
+                    try:
+                        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+                    except (OSError, ValueError):
+                        continue
+                    current.add(f"{_audio_digest([s['key'] for s in manifest['segments']])}.mp3")
+
+            files = []
+            for path in self.audio_dir.iterdir():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                # Leftover temporaries of interrupted writes are outdated too
+                files.append((stat.st_mtime, stat.st_size, path, path.name in current))
+            files.sort()
+            removed = removed_bytes = 0
+            total = sum(size for _, size, _, _ in files)
+            for mtime, size, path, is_current in files:
+                expired = not is_current and now - mtime > self.audio_ttl
+                # A temporary still being written is left to its writer
+                over = bool(self.audio_max_bytes) and total > self.audio_max_bytes and not path.name.startswith(".")
+                if expired or over:
+                    # An open download keeps reading the unlinked file
+                    path.unlink(missing_ok=True)
+                    total -= size
+                    removed += 1
+                    removed_bytes += size
+        if removed:
+            logger.info(f"Pruned {removed} stitched narration files ({removed_bytes} bytes)")
+        return {"removed": removed, "removed_bytes": removed_bytes}
+
+
+class RequestRateLimiter:
+    """Spaces upstream requests to at most ``per_minute`` (evenly, no bursts)"""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class NarrationPipeline:
+    """Synthesizes article segments through AIVoiceAgent.generate_speech"""
+
+    def __init__(
+        self,
+        agent,
+        store: NarrationStore,
+        concurrency: int = int(os.getenv("NARRATION_CONCURRENCY", "4")),
+        requests_per_minute: float = float(os.getenv("NARRATION_RPM", "50")),
+        max_attempts: int = 3,
+        max_chars: int = SEGMENT_MAX_CHARS
+    ):
+        self.agent = agent
+        self.store = store
+        self.concurrency = concurrency
+        self.limiter = RequestRateLimiter(requests_per_minute)
+        self.max_attempts = max_attempts
+        self.max_chars = max_chars
+
+    async def _synthesize(self, text: str, voice: str, key: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+        audio = self.store.read_segment(key)
+        reused = audio is not None
+        attempt = 0
+        while audio is None:
+            attempt += 1
+            await self.limiter.acquire()
+            try:
+                async with semaphore:
+                    audio = await asyncio.to_thread(self.agent.generate_speech, text, voice)
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    raise
+                backoff = 2 ** attempt
+                logger.warning(f"Segment {key[:12]} failed (attempt {attempt}), retrying in {backoff}s: {e}")
+                await asyncio.sleep(backoff)
+                continue
+            await asyncio.to_thread(self.store.write_segment, key, audio)
+        await asyncio.to_thread(self.store.segment_alignment, key, text)
+        return {"bytes": len(audio), "duration_s": round(mp3_frames.duration(audio), 3), "reused": reused}
+
+    async def narrate(self, document_id: str, markdown: str, voice: str = "alloy", title: Optional[str] = None) -> Dict[str, Any]:
+        """Synthesize every segment not already stored and write the manifest"""
+        if not is_document_id(document_id) or voice not in VOICES:
+            raise ValueError(f"Invalid document id or voice: {document_id!r}, {voice!r}")
+        started = time.perf_counter()
+        segments = split_segments(markdown_to_text(markdown), self.max_chars)
+        keys = [segment_key(text, voice) for text in segments]
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(
+            self._synthesize(text, voice, key, semaphore) for text, key in zip(segments, keys)
+        ))
+
+        entries, position = [], 0.0
+        for index, (text, key, result) in enumerate(zip(segments, keys, results)):
+            entries.append({
+                "index": index,
+                "key": key,
+                "text": text,
+                "bytes": result["bytes"],
+                "start_s": round(position, 3),
+                "end_s": round(position + result["duration_s"], 3)
+            })
+            position += result["duration_s"]
+
+        if title is None:
+            heading = re.search(r"^#\s+(.+)$", markdown, flags=re.MULTILINE)
+            title = heading.group(1).strip() if heading else document_id
+        manifest = {
+            "document_id": document_id,
+            "title": title,
+            "voice": voice,
+            "model": "tts-1",
+            "source_sha256": hashlib.sha256(markdown.encode("utf-8")).hexdigest(),
+            "created_at": datetime.now().isoformat(),
+            "segment_count": len(entries),
+            "duration_s": round(position, 3),
+            "segments": entries
+        }
+        await asyncio.to_thread(self.store.write_manifest, manifest)
+        # Stitch the whole-article MP3 now rather than on its first request, and drop the one it replaces
+        await asyncio.to_thread(self.store.article_audio, keys)
+        await asyncio.to_thread(self.store.prune_audio)
+
+        synthesized = sum(1 for result in results if not result["reused"])
+        logger.info(
+            f"Narrated {document_id} ({voice}): {len(entries)} segments, {synthesized} synthesized, "
+            f"{position:.1f}s of audio in {time.perf_counter() - started:.1f}s"
+        )
+        return manifest
+
+
+def document_id_for(path: Path) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", path.stem.lower()).strip("-")
+
+
+async def build(paths: List[Path], voices: List[str], store: NarrationStore, concurrency: int, rpm: float) -> None:
+    from agent import agent
+
+    pipeline = NarrationPipeline(agent, store, concurrency=concurrency, requests_per_minute=rpm)
+    for path in paths:
+        markdown = path.read_text(encoding="utf-8")
+        for voice in voices:
+            manifest = await pipeline.narrate(document_id_for(path), markdown, voice)
+            print(f"{manifest['document_id']:<40} {voice:<8} {manifest['segment_count']:>4} segments {manifest['duration_s']:>8.1f}s")
+
+
+def main() -> None:
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=NARRATION_DIR, help="Narration store directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="Pre-generate narration for markdown files")
+    build_parser.add_argument("paths", nargs="+", type=Path)
+    build_parser.add_argument("--voice", action="append", dest="voices", choices=VOICES, help="Repeat for several voices (default alloy)")
+    build_parser.add_argument("--concurrency", type=int, default=int(os.getenv("NARRATION_CONCURRENCY", "4")))
+    build_parser.add_argument("--rpm", type=float, default=float(os.getenv("NARRATION_RPM", "50")), help="Upstream requests per minute")
+    commands.add_parser("list", help="List stored narrations")
+    args = parser.parse_args()
+
+    store = NarrationStore(args.dir)
+    if args.command == "build":
+        asyncio.run(build(args.paths, args.voices or ["alloy"], store, args.concurrency, args.rpm))
+    else:
+        print(json.dumps(store.list_manifests(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
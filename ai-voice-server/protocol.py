@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+WebSocket Wire Protocols
+Negotiated message codecs for /ws: JSON (orjson when installed) and msgpack
+"""
+
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+try:
+    import msgpack
+
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+Frame = Union[str, bytes]
+
+
+class ProtocolError(ValueError):
+    """Raised when a frame cannot be decoded with the connection's codec"""
+
+
+class JSONCodec:
+    """JSON in text frames; uses orjson when installed"""
+
+    name = "json"
+    subprotocol = "lexitune.json"
+    binary = False
+
+    def encode(self, message: Dict[str, Any]) -> Frame:
+        if ORJSON_AVAILABLE:
+            return orjson.dumps(message).decode()
+        return json.dumps(message)
+
+    def decode(self, frame: Frame) -> Dict[str, Any]:
+        try:
+            message = orjson.loads(frame) if ORJSON_AVAILABLE else json.loads(frame)
+        except ValueError as e:
+            raise ProtocolError("Invalid JSON format") from e
+        if not isinstance(message, dict):
+            raise ProtocolError("Message must be a JSON object")
+        return message
+
+
+class MsgpackCodec:
+    """msgpack in binary frames"""
+
+    name = "msgpack"
+    subprotocol = "lexitune.msgpack"
+    binary = True
+
+    def encode(self, message: Dict[str, Any]) -> Frame:
+        return msgpack.packb(message)
+
+    def decode(self, frame: Frame) -> Dict[str, Any]:
+        if isinstance(frame, str):
+            raise ProtocolError("msgpack messages must be sent as binary frames")
+        try:
+            message = msgpack.unpackb(frame)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise ProtocolError("Invalid msgpack format") from e
+        if not isinstance(message, dict):
+            raise ProtocolError("Message must be a msgpack map")
+        return message
+
+
+DEFAULT_CODEC = JSONCodec()
+
+CODECS: Dict[str, Any] = {DEFAULT_CODEC.name: DEFAULT_CODEC}
+if MSGPACK_AVAILABLE:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+SUBPROTOCOLS = {codec.subprotocol: codec for codec in CODECS.values()}
+
+
+def negotiate(requested: Optional[str] = None, offered: Iterable[str] = ()):
+    """Pick a codec for a connection
+
+    An explicit ``?protocol=`` query parameter wins; otherwise the first
+    ``Sec-WebSocket-Protocol`` the client offers that we support. Returns the
+    codec and the subprotocol to echo back on accept (None if not negotiated
+    that way).
+    """
+    if requested:
+        codec = CODECS.get(requested)
+        if codec is None:
+            raise ProtocolError(f"Unsupported protocol: {requested}")
+        return codec, None
+    for subprotocol in offered:
+        codec = SUBPROTOCOLS.get(subprotocol.strip())
+        if codec is not None:
+            return codec, subprotocol.strip()
+    return DEFAULT_CODEC, None
+
+
+def offered_subprotocols(header: Optional[str]) -> Iterable[str]:
+    """Split a Sec-WebSocket-Protocol header into its values"""
+    return [value.strip() for value in header.split(",")] if header else []
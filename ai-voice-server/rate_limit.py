@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Rate Limiting and Quotas
+Per-client request limits and usage quotas for the endpoints that call OpenAI
+
+Each client is the user, else session, else IP address of the caller
+within its tenant (e.g. a school), as caller_identity establishes them: from
+a signed identity token, or from ``X-User-ID``, ``X-Session-ID`` and
+``X-Tenant-ID`` set by a trusted proxy. Headers straight from a client are
+ignored, so no one can spend or reset another user's quota. Three limits
+apply, each O(1) per request:
+
+- a token bucket on request rate, in-process per worker by default or a
+  sliding-window counter in the shared state backend (RATE_LIMIT_SHARED=1);
+  clients known only by IP address share it with everyone behind the same
+  NAT (a classroom), so they get their own RATE_LIMIT_IP_RPS and
+  RATE_LIMIT_IP_BURST,
+- a sliding-window quota on chat tokens,
+- a sliding-window quota on audio seconds (TTS output and transcribed input).
+
+For the same reason the two quotas of a client known only by address are
+TOKEN_QUOTA_IP and AUDIO_QUOTA_IP_SECONDS rather than a single user's.
+
+Quotas live in the shared state backend, so with Redis they hold across all
+workers. Usage is also counted per tenant for /usage and /metrics.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import threading
+import time
+import wave
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import mp3_frames
+from service_common.caller_identity import identify_caller
+from shared_state import StateBackend
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "1"))  # 0 disables the request limit
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+# For callers known only by address, often a whole classroom
+RATE_LIMIT_IP_RPS = float(os.getenv("RATE_LIMIT_IP_RPS", "10"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "60"))
+RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "0").lower() in ("1", "true", "yes")
+QUOTA_WINDOW_SECONDS = float(os.getenv("QUOTA_WINDOW_SECONDS", "3600"))
+# 0 disables a quota
+TOKEN_QUOTA = int(os.getenv("TOKEN_QUOTA", "100000"))
+AUDIO_QUOTA_SECONDS = float(os.getenv("AUDIO_QUOTA_SECONDS", "1800"))
+# For callers known only by address
+TOKEN_QUOTA_IP = int(os.getenv("TOKEN_QUOTA_IP", "1000000"))
+AUDIO_QUOTA_IP_SECONDS = float(os.getenv("AUDIO_QUOTA_IP_SECONDS", "18000"))
+
+# Uploads that are neither MP3 nor WAV (usually WebM/Opus from browsers)
+# are assumed to be ~32 kbps
+COMPRESSED_BYTES_PER_SECOND = 4000
+
+
+class Identity(NamedTuple):
+    tenant: str
+    client: str  # "user:<id>", "session:<id>" or "ip:<address>"
+
+    @property
+    def key(self) -> str:
+        return f"{self.tenant}/{self.client}"
+
+    @property
+    def by_address(self) -> bool:
+        return self.client.startswith("ip:")
+
+
+def identify(headers, client_host: Optional[str], token: Optional[str] = None) -> Identity:
+    """Identity of the caller; ``token`` is an identity token from a WebSocket query parameter
+
+    Raises caller_identity.InvalidIdentity for a bad or expired token.
+    """
+    caller = identify_caller(headers, client_host, token)
+    return Identity(caller.tenant, caller.owner.partition("/")[2])
+
+
+class RateLimited(Exception):
+    """A request was refused; ``retry_after`` is in seconds"""
+
+    def __init__(self, limit: str, retry_after: float):
+        super().__init__(f"Rate limit exceeded: {limit}")
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """In-process token buckets, one per key, least recently used evicted"""
+
+    def __init__(self, rate: float = RATE_LIMIT_RPS, burst: float = RATE_LIMIT_BURST, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float = 1.0) -> float:
+        """Spend ``cost`` tokens; returns 0 if allowed, else seconds until it would be"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [self.burst, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            return (cost - bucket[0]) / self.rate
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"type": "token_bucket", "rate": self.rate, "burst": self.burst, "tracked_clients": len(self._buckets)}
+
+
+class SlidingWindowCounter:
+    """Approximate sliding-window sums kept in a state backend
+
+    Each key has one counter per fixed window; the sliding value is the
+    current window plus the previous window weighted by how much of it still
+    overlaps. Two reads and one atomic increment per request, and shared by
+    every worker when the backend is Redis. Values are integers, so callers
+    scale fractional amounts.
+    """
+
+    def __init__(self, state: StateBackend, name: str, window: float):
+        self.state = state
+        self.name = name
+        self.window = window
+
+    def _keys(self, key: str, now: float):
+        index = int(now // self.window)
+        prefix = f"ratelimit:{self.name}:{key}:"
+        return prefix + str(index), prefix + str(index - 1), (now % self.window) / self.window
+
+    def value(self, key: str, now: Optional[float] = None) -> float:
+        current, previous, elapsed = self._keys(key, time.time() if now is None else now)
+        current_count = int(self.state.get(current) or 0)
+        previous_count = int(self.state.get(previous) or 0)
+        return current_count + previous_count * (1.0 - elapsed)
+
+    def add(self, key: str, amount: int, now: Optional[float] = None) -> None:
+        if amount:
+            current, _, _ = self._keys(key, time.time() if now is None else now)
+            self.state.incr(current, amount, ttl=2 * self.window)
+
+    def retry_after(self, key: str, limit: float, now: Optional[float] = None) -> float:
+        """Seconds until the sliding value drops below ``limit``, roughly"""
+        now = time.time() if now is None else now
+        current, previous, elapsed = self._keys(key, now)
+        previous_count = int(self.state.get(previous) or 0)
+        current_count = int(self.state.get(current) or 0)
+        if current_count >= limit or previous_count <= 0:
+            return self.window * (1.0 - elapsed)
+        # The previous window's share decays linearly until the window ends
+        excess = current_count + previous_count * (1.0 - elapsed) - limit + 1
+        return max(0.0, min(self.window * (1.0 - elapsed), excess / previous_count * self.window))
+
+
+class SharedRequestLimiter:
+    """Request rate limit enforced across workers through the state backend
+
+    A sliding window of ``burst / rate`` seconds admitting ``burst`` requests
+    approximates the token bucket with the same parameters.
+    """
+
+    def __init__(self, state: StateBackend, rate: float = RATE_LIMIT_RPS, burst: float = RATE_LIMIT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.counter = SlidingWindowCounter(state, "requests", max(1.0, burst / rate) if rate > 0 else 1.0)
+
+    def take(self, key: str, cost: float = 1.0) -> float:
+        if self.rate <= 0:
+            return 0.0
+        now = time.time()
+        if self.counter.value(key, now) + cost > self.burst:
+            return max(self.counter.retry_after(key, self.burst, now), 1.0 / self.rate)
+        self.counter.add(key, int(cost), now)
+        return 0.0
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"type": "shared_window", "rate": self.rate, "burst": self.burst, "window_seconds": self.counter.window}
+
+
+def audio_seconds(data: bytes) -> float:
+    """Playing time of uploaded or generated audio, estimated when the format is unknown"""
+    if data[:4] == b"RIFF":
+        try:
+            with wave.open(io.BytesIO(data)) as wav:
+                return wav.getnframes() / wav.getframerate()
+        except (wave.Error, EOFError, ZeroDivisionError):
+            pass
+    seconds = mp3_frames.duration(data)
+    if seconds:
+        return seconds
+    return len(data) / COMPRESSED_BYTES_PER_SECOND
+
+
+class RateLimiter:
+    """Request limits, token and audio quotas, and per-tenant usage counters"""
+
+    def __init__(
+        self,
+        state: StateBackend,
+        shared: bool = RATE_LIMIT_SHARED,
+        rate: float = RATE_LIMIT_RPS,
+        burst: float = RATE_LIMIT_BURST,
+        ip_rate: float = RATE_LIMIT_IP_RPS,
+        ip_burst: float = RATE_LIMIT_IP_BURST,
+        token_quota: int = TOKEN_QUOTA,
+        audio_quota_seconds: float = AUDIO_QUOTA_SECONDS,
+        ip_token_quota: int = TOKEN_QUOTA_IP,
+        ip_audio_quota_seconds: float = AUDIO_QUOTA_IP_SECONDS,
+        window: float = QUOTA_WINDOW_SECONDS
+    ):
+        self.state = state
+        self.requests = SharedRequestLimiter(state, rate, burst) if shared else TokenBucket(rate, burst)
+        self.ip_requests = SharedRequestLimiter(state, ip_rate, ip_burst) if shared else TokenBucket(ip_rate, ip_burst)
+        self.token_quota = token_quota
+        self.audio_quota_ms = int(audio_quota_seconds * 1000)
+        self.ip_token_quota = ip_token_quota
+        self.ip_audio_quota_ms = int(ip_audio_quota_seconds * 1000)
+        self.tokens = SlidingWindowCounter(state, "tokens", window)
+        self.audio_ms = SlidingWindowCounter(state, "audio_ms", window)
+        # This worker's counts; the shared backend holds the totals of all workers
+        self.usage: Dict[str, Counter] = {}
+        self.rejected: Counter = Counter()
+
+    def _count(self, tenant: str, **amounts: float) -> None:
+        counts = self.usage.setdefault(tenant, Counter())
+        for metric, amount in amounts.items():
+            if amount:
+                counts[metric] += amount
+                self.state.incr(f"usage:{tenant}:{metric}", int(amount))
+
+    def quotas(self, identity: Identity) -> Tuple[int, int]:
+        """Token and audio (ms) quotas of a client; 0 means unlimited"""
+        if identity.by_address:
+            return self.ip_token_quota, self.ip_audio_quota_ms
+        return self.token_quota, self.audio_quota_ms
+
+    def check(self, identity: Identity, kind: str) -> None:
+        """Admit one request of ``kind`` (chat, speech, transcription, ws) or raise RateLimited"""
+        retry_after = (self.ip_requests if identity.by_address else self.requests).take(identity.key)
+        limit = "requests" if retry_after else None
+        token_quota, audio_quota_ms = self.quotas(identity)
+        if limit is None and kind == "chat" and token_quota:
+            if self.tokens.value(identity.key) >= token_quota:
+                limit, retry_after = "tokens", self.tokens.retry_after(identity.key, token_quota)
+        if limit is None and kind in ("speech", "transcription") and audio_quota_ms:
+            if self.audio_ms.value(identity.key) >= audio_quota_ms:
+                limit, retry_after = "audio_seconds", self.audio_ms.retry_after(identity.key, audio_quota_ms)
+
+        if limit is not None:
+            self.rejected[limit] += 1
+            self._count(identity.tenant, rejected=1)
+            raise RateLimited(limit, retry_after)
+        self._count(identity.tenant, requests=1)
+
+    def record(self, identity: Identity, tokens: int = 0, audio_seconds: float = 0.0) -> None:
+        """Charge what a completed request consumed against the caller's quotas"""
+        audio_ms = int(audio_seconds * 1000)
+        self.tokens.add(identity.key, tokens)
+        self.audio_ms.add(identity.key, audio_ms)
+        self._count(identity.tenant, tokens=tokens, audio_ms=audio_ms)
+
+    async def acheck(self, identity: Identity, kind: str) -> None:
+        # Process-local state is cheap enough to touch on the event loop
+        if self.state.name == "memory":
+            self.check(identity, kind)
+        else:
+            await asyncio.to_thread(self.check, identity, kind)
+
+    async def arecord(self, identity: Identity, tokens: int = 0, audio_seconds: float = 0.0) -> None:
+        if self.state.name == "memory":
+            self.record(identity, tokens, audio_seconds)
+        else:
+            await asyncio.to_thread(self.record, identity, tokens, audio_seconds)
+
+    def quota_status(self, identity: Identity) -> Dict[str, Any]:
+        """Sliding-window usage of one client against its quotas"""
+        token_quota, audio_quota_ms = self.quotas(identity)
+        return {
+            "tenant": identity.tenant,
+            "client": identity.client,
+            "window_seconds": self.tokens.window,
+            "tokens": {"used": round(self.tokens.value(identity.key)), "limit": token_quota or None},
+            "audio_seconds": {
+                "used": round(self.audio_ms.value(identity.key) / 1000, 1),
+                "limit": audio_quota_ms / 1000 if audio_quota_ms else None
+            }
+        }
+
+    def tenant_usage(self, tenant: str) -> Dict[str, Any]:
+        """Totals for a tenant across all workers sharing the state backend"""
+        totals = {
+            metric: int(self.state.get(f"usage:{tenant}:{metric}") or 0)
+            for metric in ("requests", "rejected", "tokens", "audio_ms")
+        }
+        totals["audio_seconds"] = round(totals.pop("audio_ms") / 1000, 1)
+        return {"tenant": tenant, **totals}
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests.get_stats(),
+            "ip_requests": self.ip_requests.get_stats(),
+            "token_quota": self.token_quota,
+            "audio_quota_seconds": self.audio_quota_ms / 1000,
+            "ip_token_quota": self.ip_token_quota,
+            "ip_audio_quota_seconds": self.ip_audio_quota_ms / 1000,
+            "window_seconds": self.tokens.window,
+            "rejected": dict(self.rejected),
+            "tenants": {tenant: dict(counts) for tenant, counts in self.usage.items()}
+        }
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Redis Stand-in
+Minimal Redis-protocol (RESP2) server for local multi-worker runs and benchmarks
+
+Implements only the commands RedisStateBackend uses. Not for production:
+there is no persistence, authentication or eviction.
+
+Usage: python redis_standin.py [--host 127.0.0.1] [--port 6399]
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+Reply = object
+
+
+class RespError(Exception):
+    """Error reply sent back to the client"""
+
+
+class RedisStandin:
+    """In-memory keyspace plus pub/sub, served over the Redis protocol"""
+
+    def __init__(self):
+        self.values: Dict[bytes, bytes] = {}
+        self.lists: Dict[bytes, List[bytes]] = {}
+        self.expiry: Dict[bytes, float] = {}
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+
+    # -- RESP encoding ---------------------------------------------------
+
+    @classmethod
+    def encode(cls, reply: Reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, bool):
+            return b":1\r\n" if reply else b":0\r\n"
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, RespError):
+            return b"-ERR %s\r\n" % str(reply).encode()
+        if isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode()
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        if isinstance(reply, (list, tuple)):
+            return b"*%d\r\n" % len(reply) + b"".join(cls.encode(item) for item in reply)
+        raise TypeError(f"Cannot encode {type(reply)!r}")
+
+    @staticmethod
+    async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, e.g. from telnet or redis-cli PING
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            size = int(header[1:])
+            data = await reader.readexactly(size + 2)
+            args.append(data[:-2])
+        return args
+
+    # -- keyspace helpers ------------------------------------------------
+
+    def _expire_if_due(self, key: bytes) -> None:
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self._delete(key)
+
+    def _delete(self, key: bytes) -> int:
+        self.expiry.pop(key, None)
+        found = self.values.pop(key, None) is not None
+        found = self.lists.pop(key, None) is not None or found
+        return int(found)
+
+    @staticmethod
+    def _list_slice(items: List[bytes], start: int, stop: int) -> Tuple[int, int]:
+        size = len(items)
+        if start < 0:
+            start = max(size + start, 0)
+        if stop < 0:
+            stop = size + stop
+        return start, min(stop, size - 1) + 1
+
+    # -- commands --------------------------------------------------------
+
+    def execute(self, args: List[bytes]) -> Reply:
+        name = args[0].upper().decode()
+        handler = getattr(self, f"cmd_{name.lower()}", None)
+        if handler is None:
+            return RespError(f"unknown command '{name}'")
+        if len(args) > 1 and name not in ("PING", "PUBLISH", "CLIENT", "SELECT", "FLUSHALL", "MULTI", "EXEC"):
+            self._expire_if_due(args[1])
+        try:
+            return handler(*args[1:])
+        except (TypeError, ValueError) as e:
+            return RespError(f"wrong arguments for '{name}': {e}")
+
+    def cmd_ping(self, message: Optional[bytes] = None) -> Reply:
+        return message if message is not None else "PONG"
+
+    def cmd_client(self, *args: bytes) -> Reply:
+        return "OK"
+
+    def cmd_select(self, db: bytes) -> Reply:
+        return "OK"
+
+    def cmd_flushall(self, *args: bytes) -> Reply:
+        self.values.clear()
+        self.lists.clear()
+        self.expiry.clear()
+        return "OK"
+
+    def cmd_get(self, key: bytes) -> Reply:
+        return self.values.get(key)
+
+    def cmd_set(self, key: bytes, value: bytes, *options: bytes) -> Reply:
+        self._delete(key)
+        self.values[key] = value
+        opts = [opt.upper() for opt in options]
+        if b"EX" in opts:
+            self.expiry[key] = time.monotonic() + int(options[opts.index(b"EX") + 1])
+        elif b"PX" in opts:
+            self.expiry[key] = time.monotonic() + int(options[opts.index(b"PX") + 1]) / 1000
+        return "OK"
+
+    def cmd_del(self, *keys: bytes) -> Reply:
+        return sum(self._delete(key) for key in keys)
+
+    def cmd_exists(self, *keys: bytes) -> Reply:
+        return sum(1 for key in keys if key in self.values or key in self.lists)
+
+    def cmd_incrby(self, key: bytes, amount: bytes) -> Reply:
+        value = int(self.values.get(key, b"0")) + int(amount)
+        self.values[key] = str(value).encode()
+        return value
+
+    def cmd_incr(self, key: bytes) -> Reply:
+        return self.cmd_incrby(key, b"1")
+
+    def cmd_pexpire(self, key: bytes, ms: bytes) -> Reply:
+        if key not in self.values and key not in self.lists:
+            return 0
+        self.expiry[key] = time.monotonic() + int(ms) / 1000
+        return 1
+
+    def cmd_expire(self, key: bytes, seconds: bytes) -> Reply:
+        return self.cmd_pexpire(key, str(int(seconds) * 1000).encode())
+
+    def cmd_pttl(self, key: bytes) -> Reply:
+        if key not in self.values and key not in self.lists:
+            return -2
+        deadline = self.expiry.get(key)
+        return -1 if deadline is None else int((deadline - time.monotonic()) * 1000)
+
+    def cmd_rpush(self, key: bytes, *values: bytes) -> Reply:
+        items = self.lists.setdefault(key, [])
+        items.extend(values)
+        return len(items)
+
+    def cmd_lrange(self, key: bytes, start: bytes, stop: bytes) -> Reply:
+        items = self.lists.get(key, [])
+        begin, end = self._list_slice(items, int(start), int(stop))
+        return items[begin:end]
+
+    def cmd_ltrim(self, key: bytes, start: bytes, stop: bytes) -> Reply:
+        items = self.lists.get(key)
+        if items is not None:
+            begin, end = self._list_slice(items, int(start), int(stop))
+            self.lists[key] = items[begin:end]
+            if not self.lists[key]:
+                del self.lists[key]
+        return "OK"
+
+    def cmd_llen(self, key: bytes) -> Reply:
+        return len(self.lists.get(key, []))
+
+    def cmd_publish(self, channel: bytes, message: bytes) -> Reply:
+        subscribers = self.channels.get(channel, set())
+        frame = self.encode([b"message", channel, message])
+        for writer in subscribers:
+            writer.write(frame)
+        return len(subscribers)
+
+    # -- connection handling ---------------------------------------------
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        subscriptions: Set[bytes] = set()
+        transaction: Optional[List[List[bytes]]] = None
+        try:
+            while True:
+                args = await self.read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].upper()
+                if name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                    channels = args[1:] or list(subscriptions)
+                    for channel in channels:
+                        if name == b"SUBSCRIBE":
+                            subscriptions.add(channel)
+                            self.channels.setdefault(channel, set()).add(writer)
+                        else:
+                            subscriptions.discard(channel)
+                            self.channels.get(channel, set()).discard(writer)
+                        kind = b"subscribe" if name == b"SUBSCRIBE" else b"unsubscribe"
+                        writer.write(self.encode([kind, channel, len(subscriptions)]))
+                elif name == b"MULTI":
+                    transaction = []
+                    writer.write(self.encode("OK"))
+                elif name == b"EXEC" and transaction is not None:
+                    writer.write(self.encode([self.execute(queued) for queued in transaction]))
+                    transaction = None
+                elif transaction is not None:
+                    transaction.append(args)
+                    writer.write(self.encode("QUEUED"))
+                else:
+                    writer.write(self.encode(self.execute(args)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscriptions:
+                self.channels.get(channel, set()).discard(writer)
+            writer.close()
+
+
+async def serve(host: str, port: int) -> None:
+    standin = RedisStandin()
+    server = await asyncio.start_server(standin.handle, host, port)
+    logger.info(f"Redis stand-in listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6399)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
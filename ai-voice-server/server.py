@@ -8,29 +8,53 @@ import asyncio
 import logging
 import os
 import json
-from typing import Dict, Any
+import math
+from typing import Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 import time
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Response, UploadFile, File
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request, Response, UploadFile, File, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-# Import our agent
-from agent import agent
-
-# Load environment variables
+# Load environment variables before our modules read their configuration
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Import our agent
+from agent import agent
+from coalescing import SingleFlight, normalize_prompt
+from connection_manager import ConnectionManager
+from protocol import ProtocolError, negotiate, offered_subprotocols
+from service_common.caller_identity import InvalidIdentity
+from rate_limit import Identity, RateLimited, RateLimiter, audio_seconds, identify
+from history_store import DEFAULT_SESSION
+from lifecycle import LifecycleManager
+from livekit_agent import livekit_agent
+from livekit_sessions import LiveKitSessionManager, RoomCapacityExceeded
+from alignment import Alignment
+from service_common.artifact_serving import ArtifactResponse, stats as serving_stats
+from narration import VOICES as NARRATION_VOICES, NarrationStore, is_document_id, split_segments
+from service_common.readiness import ReadinessTracker
+from shared_state import WORKER_ID
+from speech_formats import (
+    NotAcceptable, UnsupportedFormat, duration as speech_duration, encode as encode_speech,
+    negotiate as negotiate_speech_format, stats as speech_stats
 )
+from service_common.structured_logging import configure_logging
+from service_common.tracing import TraceMiddleware, create_tracer, parse_traceparent
+from transcription import MODES as TRANSCRIPTION_MODES, ChunkedTranscriber
+
+# Configure logging: JSON lines written off the event loop, probes sampled
+log_pipeline = configure_logging("ai-voice-server")
 logger = logging.getLogger(__name__)
 
+# Chat text and WebSocket payloads are user content; only log them when
+# explicitly enabled, and then truncated (LOG_MAX_CHARS)
+LOG_WS_PAYLOADS = os.getenv("WS_LOG_PAYLOADS", "").lower() in ("1", "true", "yes")
+
 # Pydantic models
 class HealthResponse(BaseModel):
     status: str
@@ -58,6 +82,13 @@ class SpeechRequest(BaseModel):
     text: str
     voice: str = "alloy"
 
+class RoomRequest(BaseModel):
+    participant: str = "User"  # display name; the LiveKit identity comes from the caller
+
+class BroadcastRequest(BaseModel):
+    message: str
+    data: Dict[str, Any] = {}
+
 # Global variables
 app = FastAPI(
     title="AI Voice Agent Server",
@@ -74,38 +105,131 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"WebSocket connected. Total connections: {len(self.active_connections)}")
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting message: {e}")
-                # Remove broken connections
-                self.active_connections.remove(connection)
+# Spans for requests and the OpenAI calls they make, continuing the caller's
+# trace from its traceparent header; added last, so it sees every request first
+tracer = create_tracer("ai-voice-server")
+app.add_middleware(TraceMiddleware, tracer=tracer)
 
+# WebSocket connection manager
 manager = ConnectionManager()
 
+# Heavy components are initialized after the port is bound; /ready reports
+# when they are done so orchestrators only route traffic to warm workers
+readiness = ReadinessTracker()
+readiness.register("openai_client", lambda: agent.openai_client)
+readiness.register("state_backend", lambda: agent.state.get("readiness:probe"))
+readiness.register("tokenizer", lambda: agent.context_builder.counter.count("warm up"))
+
+# Flips readiness off and drains sockets and in-flight work on SIGTERM
+lifecycle = LifecycleManager(readiness, manager)
+
+# Articles pre-generated with `python narration.py build`; /speech serves any
+# passage made of stored segments without calling OpenAI
+narration_store = NarrationStore()
+
+# LiveKit rooms: pre-warmed agent, per-worker room cap, placement across workers
+livekit_sessions = LiveKitSessionManager(livekit_agent, agent.state)
+
+# Per-client request limits and token/audio quotas on everything that spends
+# OpenAI quota; quotas are shared between workers through the state backend
+rate_limiter = RateLimiter(agent.state)
+
+# Speech-to-text; long recordings are split at pauses and transcribed in parallel
+transcriber = ChunkedTranscriber(agent.transcribe, agent.transcribe_timed)
+
+def request_identity(request: Request) -> Identity:
+    try:
+        return identify(request.headers, request.client.host if request.client else None)
+    except InvalidIdentity as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+def history_session(identity: Identity, session_id: str) -> str:
+    """Key a client's session id is stored under: one caller cannot name another's history"""
+    return f"{identity.key}|{session_id}"
+
+async def enforce_rate_limit(identity: Identity, kind: str) -> None:
+    """Admit a request or answer 429 with Retry-After"""
+    try:
+        await rate_limiter.acheck(identity, kind)
+    except RateLimited as e:
+        logger.info("Rate limited %s (%s)", identity.key, e.limit, extra={"route": kind})
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+
+def chat_tokens(user_message: str, ai_response: str) -> int:
+    """Approximate tokens a chat exchange charges against the sender's quota"""
+    counter = agent.context_builder.counter
+    return counter.count(user_message) + counter.count(ai_response)
+
+# Identical concurrent requests (e.g. a passage pushed to a whole classroom)
+# share one upstream OpenAI call
+speech_flight = SingleFlight("speech")
+chat_flight = SingleFlight("chat")
+
+async def coalesced_chat(user_message: str, session_id: str = DEFAULT_SESSION) -> str:
+    """Process a chat message, sharing the upstream call with identical in-flight prompts
+
+    Prompts from sessions without history are shared across sessions; once a
+    session has history its prompt depends on it, so only that session's
+    identical requests are shared. Each caller's session records the exchange.
+    """
+    prompt = normalize_prompt(user_message)
+    async with lifecycle.track("chat"):
+        if await asyncio.to_thread(agent.history.count, session_id):
+            ai_response = await chat_flight.do(
+                (session_id, prompt),
+                lambda: asyncio.to_thread(agent.generate_ai_response, user_message, "", session_id)
+            )
+        else:
+            ai_response = await chat_flight.do(
+                prompt,
+                lambda: asyncio.to_thread(agent.generate_ai_response, user_message, "")
+            )
+        await asyncio.to_thread(agent.record_exchange, session_id, user_message, ai_response)
+    return ai_response
+
+async def coalesced_speech(text: str, voice: str, audio_format: str = "mp3") -> bytes:
+    """Generate speech, sharing the upstream call with identical in-flight requests"""
+    async with lifecycle.track("speech"):
+        return await speech_flight.do(
+            (text, voice, audio_format),
+            lambda: asyncio.to_thread(agent.generate_speech, text, voice, audio_format)
+        )
+
+# Broadcasts go through the shared state backend so sockets held by every
+# worker receive them, not just those on the worker that took the request
+BROADCAST_CHANNEL = "ws:broadcast"
+
+def subscribe_to_broadcasts(loop: asyncio.AbstractEventLoop) -> None:
+    """Deliver broadcasts published by any worker to this worker's sockets"""
+    def on_broadcast(data: bytes) -> None:
+        message = json.loads(data)
+        loop.call_soon_threadsafe(
+            asyncio.ensure_future,
+            manager.broadcast(message["payload"], room=message.get("room"))
+        )
+    
+    agent.state.subscribe(BROADCAST_CHANNEL, on_broadcast)
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize the application on startup"""
-    logger.info("AI Voice Agent Server starting up...")
+    logger.info(f"AI Voice Agent Server starting up (worker {WORKER_ID})...")
+    
+    # Upstream OpenAI calls block a thread each for their full latency; the
+    # default executor (cpu_count + 4 threads) caps concurrent calls far below
+    # the number of students a worker can otherwise serve
+    upstream_threads = int(os.getenv("UPSTREAM_THREADS", "64"))
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=upstream_threads, thread_name_prefix="upstream")
+    )
+    subscribe_to_broadcasts(asyncio.get_running_loop())
+    readiness.start()
+    lifecycle.install_signal_handlers()
+    asyncio.ensure_future(livekit_sessions.start())
     
     # Validate environment variables
     required_vars = ["OPENAI_API_KEY", "LIVEKIT_URL", "LIVEKIT_API_KEY", "LIVEKIT_API_SECRET"]
@@ -122,6 +246,12 @@ async def startup_event():
 async def shutdown_event():
     """Cleanup on shutdown"""
     logger.info("AI Voice Agent Server shutting down...")
+    await readiness.stop()
+    await livekit_sessions.stop()
+    # Without a SIGTERM drain (e.g. Ctrl+C) sockets are still open here
+    await manager.close_all(code=1001)
+    await asyncio.to_thread(agent.history.close)
+    await asyncio.to_thread(agent.state.close)
 
 @app.get("/", response_model=Dict[str, str])
 async def root():
@@ -144,6 +274,19 @@ async def health_check():
         version="1.0.0"
     )
 
+@app.get("/livez", response_class=PlainTextResponse)
+async def liveness_probe():
+    """Minimal liveness probe for high-frequency checks: no models, no I/O"""
+    return "ok"
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """Readiness endpoint; 503 until every component has warmed up and while draining"""
+    report = lifecycle.report()
+    if not report["ready"]:
+        response.status_code = 503
+    return report
+
 @app.get("/status", response_model=AgentStatusResponse)
 async def agent_status():
     """Get agent status and configuration"""
@@ -176,17 +319,23 @@ async def get_config():
     }
 
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request, x_session_id: str = Header(DEFAULT_SESSION)):
     """HTTP endpoint for chat messages"""
+    identity = request_identity(http_request)
+    await enforce_rate_limit(identity, "chat")
     try:
         user_message = request.message
         if not user_message or not user_message.strip():
             raise HTTPException(status_code=400, detail="Message is required")
         
-        logger.info(f"Chat message received: {user_message}")
+        logger.info(
+            "Chat message received (%d chars)", len(user_message),
+            extra={"route": "chat", **({"text": user_message} if LOG_WS_PAYLOADS else {})}
+        )
         
         # Process message through AI agent
-        ai_response = agent.process_text_message(user_message.strip(), "")
+        ai_response = await coalesced_chat(user_message.strip(), history_session(identity, x_session_id))
+        await rate_limiter.arecord(identity, tokens=chat_tokens(user_message, ai_response))
         
         response = ChatResponse(
             response=ai_response,
@@ -201,8 +350,27 @@ async def chat_endpoint(request: ChatRequest):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/speech")
-async def generate_speech_endpoint(request: SpeechRequest):
-    """Generate speech from text using OpenAI TTS"""
+async def generate_speech_endpoint(
+    request: SpeechRequest,
+    http_request: Request,
+    audio_format: Optional[str] = Query(None, alias="format"),
+    accept: Optional[str] = Header(None),
+    save_data: Optional[str] = Header(None)
+):
+    """Generate speech from text using OpenAI TTS
+    
+    The format is ``?format=`` if given, else negotiated from Accept and
+    Save-Data (see speech_formats); the default is MP3.
+    """
+    try:
+        speech_format = negotiate_speech_format(audio_format, accept, save_data)
+    except UnsupportedFormat as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotAcceptable as e:
+        raise HTTPException(status_code=406, detail=str(e))
+    identity = request_identity(http_request)
+    await enforce_rate_limit(identity, "speech")
+    started = time.perf_counter()
     try:
         text = request.text
         voice = request.voice
@@ -210,17 +378,40 @@ async def generate_speech_endpoint(request: SpeechRequest):
         if not text or not text.strip():
             raise HTTPException(status_code=400, detail="Text is required")
         
-        logger.info(f"Speech generation requested for: {text[:50]}...")
+        logger.info(
+            "Speech generation requested (%d chars, voice %s, %s)", len(text), voice, speech_format.name,
+            extra={"route": "speech"}
+        )
         
-        # Generate speech using agent
-        audio_data = agent.generate_speech(text.strip(), voice)
+        # Precomputed narration first (MP3, re-encoded for other formats), then the agent
+        text = text.strip()
+        source = "precomputed"
+        audio_data = None
+        keys = await asyncio.to_thread(narration_store.lookup, text, voice)
+        if keys:
+            audio_data = await asyncio.to_thread(narration_store.stitch, keys)
+            if speech_format.name != "mp3":
+                audio_data = await asyncio.to_thread(encode_speech, audio_data, speech_format)
+        seconds = None
+        if audio_data is None:
+            source = "generated"
+            audio_data = await coalesced_speech(text, voice, speech_format.name)
+            seconds = await asyncio.to_thread(speech_duration, audio_data, speech_format)
+            await rate_limiter.arecord(identity, audio_seconds=seconds)
         
         if audio_data:
+            if seconds is None:
+                seconds = await asyncio.to_thread(speech_duration, audio_data, speech_format)
+            speech_stats.record_response(speech_format.name, len(audio_data), seconds, time.perf_counter() - started)
             return Response(
                 content=audio_data,
-                media_type="audio/mpeg",
+                media_type=speech_format.media_type,
                 headers={
-                    "Content-Disposition": f"attachment; filename=speech_{int(time.time())}.mp3"
+                    "Content-Disposition": f"attachment; filename=speech_{int(time.time())}.{speech_format.extension}",
+                    "X-Speech-Source": source,
+                    "X-Speech-Format": speech_format.name,
+                    "X-Audio-Duration": f"{seconds:.3f}",
+                    "Vary": "Accept, Save-Data"
                 }
             )
         else:
@@ -230,14 +421,110 @@ async def generate_speech_endpoint(request: SpeechRequest):
         logger.error(f"Error generating speech: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/speech/alignment")
+async def speech_alignment_endpoint(request: SpeechRequest, http_request: Request):
+    """Per-word start/end times (ms) for the audio /speech returns for the same body
+    
+    Word ``i`` is the ``i``-th whitespace-separated token of the text.
+    """
+    identity = request_identity(http_request)
+    # May synthesize the speech, so it answers to the audio quota like /speech
+    await enforce_rate_limit(identity, "speech")
+    text = request.text.strip()
+    voice = request.voice
+    if not text:
+        raise HTTPException(status_code=400, detail="Text is required")
+    
+    try:
+        keys = await asyncio.to_thread(narration_store.lookup, text, voice)
+        if keys:
+            segments = split_segments(text)
+            parts = [
+                await asyncio.to_thread(narration_store.segment_alignment, key, segment)
+                for key, segment in zip(keys, segments)
+            ]
+            alignment = Alignment.concat(parts)
+            words = [word for segment in segments for word in segment.split()]
+            source = "precomputed"
+        else:
+            audio_data = await coalesced_speech(text, voice)
+            await rate_limiter.arecord(identity, audio_seconds=await asyncio.to_thread(audio_seconds, audio_data))
+            alignment = await asyncio.to_thread(agent.align_speech, text, voice, audio_data)
+            words = text.split()
+            source = "generated"
+    except Exception as e:
+        logger.error(f"Error aligning speech: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+    
+    return JSONResponse(alignment.to_dict(words), headers={"X-Speech-Source": source})
+
+@app.get("/narration")
+async def list_narrations():
+    """List pre-generated narrations"""
+    return {"narrations": await asyncio.to_thread(narration_store.list_manifests)}
+
+@app.get("/narration/segments/{key}")
+async def get_narration_segment(key: str):
+    """Audio for one pre-generated segment"""
+    if len(key) != 64 or any(c not in "0123456789abcdef" for c in key):
+        raise HTTPException(status_code=400, detail="Invalid segment key")
+    path = narration_store.segment_path(key)
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Segment not found")
+    # Content-addressed: the key is the validator and the file never changes
+    return ArtifactResponse(path, "audio/mpeg", headers={"Cache-Control": "public, max-age=31536000, immutable"}, etag=key)
+
+def check_narration_name(document_id: str, voice: str) -> None:
+    """Both end up in a file name; anything but a plain id and a known voice is refused"""
+    if not is_document_id(document_id):
+        raise HTTPException(status_code=400, detail="Invalid document id")
+    if voice not in NARRATION_VOICES:
+        raise HTTPException(status_code=400, detail=f"voice must be one of {', '.join(NARRATION_VOICES)}")
+
+@app.get("/narration/{document_id}")
+async def get_narration_manifest(document_id: str, voice: str = "alloy"):
+    """Segment manifest with per-segment audio URLs and timings"""
+    check_narration_name(document_id, voice)
+    manifest = await asyncio.to_thread(narration_store.read_manifest, document_id, voice)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Narration not found")
+    for segment in manifest["segments"]:
+        segment["url"] = f"/narration/segments/{segment['key']}"
+    return manifest
+
+@app.get("/narration/{document_id}/audio")
+async def get_narration_audio(document_id: str, voice: str = "alloy"):
+    """Whole article as one MP3, stitched from its segments; supports Range requests for seeking"""
+    check_narration_name(document_id, voice)
+    manifest = await asyncio.to_thread(narration_store.read_manifest, document_id, voice)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="Narration not found")
+    try:
+        path = await asyncio.to_thread(narration_store.article_audio, [s["key"] for s in manifest["segments"]])
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Narration is incomplete")
+    # The URL keeps its name when the article is rebuilt; the ETag (the stitched file's hash) changes
+    return ArtifactResponse(
+        path,
+        "audio/mpeg",
+        headers={"Cache-Control": "public, no-cache"},
+        etag=path.stem,
+        filename=f"{document_id}.mp3"
+    )
+
 @app.post("/speech-to-text")
-async def convert_speech_to_text():
-    """Convert uploaded audio to text using OpenAI Whisper"""
+async def convert_speech_to_text(http_request: Request, audio_file: UploadFile = File(...), mode: str = "auto"):
+    """Convert uploaded audio to text using OpenAI Whisper
+    
+    ``mode`` is "auto" (chunk recordings longer than LONG_AUDIO_SECONDS),
+    "single" (one call) or "chunked". Chunked results list per-chunk timings
+    and are "partial" when a chunk could not be transcribed.
+    """
+    if mode not in TRANSCRIPTION_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(TRANSCRIPTION_MODES)}")
+    identity = request_identity(http_request)
+    await enforce_rate_limit(identity, "transcription")
     try:
-        
-        # Get the uploaded audio file
-        audio_file = await File(...)
-        
         if not audio_file:
             raise HTTPException(status_code=400, detail="Audio file is required")
         
@@ -245,26 +532,38 @@ async def convert_speech_to_text():
         if not audio_file.content_type.startswith('audio/'):
             raise HTTPException(status_code=400, detail="File must be an audio file")
         
-        logger.info(f"Speech-to-text requested for file: {audio_file.filename}")
+        logger.info("Speech-to-text requested for file: %s", audio_file.filename, extra={"route": "speech-to-text"})
         
         # Read the audio file
         audio_content = await audio_file.read()
         
         # Convert to text using OpenAI Whisper
         try:
-            response = agent.openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=("audio.wav", audio_content, "audio/wav"),
-                response_format="text"
-            )
+            async with lifecycle.track("transcription"):
+                result = await transcriber.run(
+                    audio_content,
+                    filename=audio_file.filename or "audio.wav",
+                    mime=audio_file.content_type,
+                    mode=mode
+                )
             
-            transcribed_text = response.strip()
-            logger.info(f"Speech-to-text successful: {transcribed_text[:50]}...")
+            seconds = result["duration_s"]
+            if seconds is None:
+                seconds = await asyncio.to_thread(audio_seconds, audio_content)
+            await rate_limiter.arecord(identity, audio_seconds=seconds)
+            transcribed_text = result["text"]
+            logger.info(
+                "Speech-to-text successful (%s, %d chars)", result["mode"], len(transcribed_text),
+                extra={"route": "speech-to-text"}
+            )
             
             return {
-                "status": "success",
+                "status": "partial" if result["partial"] else "success",
                 "text": transcribed_text,
-                "confidence": "high"  # Whisper doesn't provide confidence scores
+                "confidence": "high",  # Whisper doesn't provide confidence scores
+                "mode": result["mode"],
+                "duration_s": result["duration_s"],
+                "chunks": result["chunks"]
             }
             
         except Exception as e:
@@ -276,24 +575,38 @@ async def convert_speech_to_text():
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/conversation/history")
-async def get_conversation_history():
-    """Get conversation history"""
+async def get_conversation_history(
+    http_request: Request,
+    session_id: str = DEFAULT_SESSION,
+    limit: int = 50,
+    before: Optional[str] = None
+):
+    """Get the caller's conversation history, newest page first
+    
+    Pass the returned ``next_cursor`` as ``before`` to fetch older entries.
+    """
+    identity = request_identity(http_request)
+    limit = max(1, min(limit, 500))
     try:
-        history = agent.get_conversation_history()
+        page = await asyncio.to_thread(agent.get_conversation_page, history_session(identity, session_id), limit, before)
         return {
             "status": "success",
-            "conversation_count": len(history),
-            "history": history
+            "conversation_count": page["total"],
+            "history": page["history"],
+            "next_cursor": page["next_cursor"]
         }
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"Error getting conversation history: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.delete("/conversation/history")
-async def clear_conversation_history():
-    """Clear conversation history"""
+async def clear_conversation_history(http_request: Request, session_id: str = DEFAULT_SESSION):
+    """Clear the caller's conversation history"""
+    identity = request_identity(http_request)
     try:
-        agent.clear_conversation_history()
+        await asyncio.to_thread(agent.clear_conversation_history, history_session(identity, session_id))
         return {
             "status": "success",
             "message": "Conversation history cleared"
@@ -304,67 +617,151 @@ async def clear_conversation_history():
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    """WebSocket endpoint for real-time communication"""
-    await manager.connect(websocket)
+    """WebSocket endpoint for real-time communication
+
+    Clients may join rooms (e.g. a classroom) with ``/ws?room=<name>`` or by
+    sending ``{"type": "join", "room": "<name>"}``. Messages are JSON text
+    frames unless msgpack binary frames are negotiated with ``?protocol=msgpack``
+    or the ``lexitune.msgpack`` subprotocol.
+    """
+    rooms = websocket.query_params.getlist("room")
+    session_id = websocket.query_params.get("session", DEFAULT_SESSION)
+    try:
+        codec, subprotocol = negotiate(
+            websocket.query_params.get("protocol"),
+            offered_subprotocols(websocket.headers.get("sec-websocket-protocol"))
+        )
+    except ProtocolError as e:
+        logger.warning(f"Rejecting WebSocket: {e}")
+        await websocket.close(code=1008)
+        return
+    if not lifecycle.accepting:
+        # Draining: the client should retry and land on another worker
+        lifecycle.reject_connection()
+        await websocket.close(code=1013)
+        return
+    try:
+        # Browsers cannot set WebSocket headers, so the identity token may come as ?token=
+        identity = identify(
+            websocket.headers,
+            websocket.client.host if websocket.client else None,
+            token=websocket.query_params.get("token")
+        )
+    except InvalidIdentity as e:
+        logger.warning(f"Rejecting WebSocket: {e}")
+        await websocket.close(code=1008)
+        return
+    try:
+        await rate_limiter.acheck(identity, "ws")
+    except RateLimited:
+        await websocket.close(code=1013)
+        return
+    
+    conn = await manager.connect(websocket, rooms, codec, subprotocol)
+    # Each message is its own span, in the trace the client opened the socket with if it
+    # sent one; browsers cannot set WebSocket headers, so ?traceparent= works too
+    trace_parent = parse_traceparent(websocket.query_params.get("traceparent")) or tracer.extract(websocket.headers)
     try:
         while True:
             # Receive message from client
-            data = await websocket.receive_text()
-            logger.info(f"Received WebSocket message: {data}")
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            data = frame.get("text")
+            if data is None:
+                data = frame.get("bytes") or b""
+
+            with tracer.span("ws.message", parent=trace_parent, kind="server", connection=conn.id, bytes=len(data)) as span:
+                if logger.isEnabledFor(logging.DEBUG):
+                    if LOG_WS_PAYLOADS:
+                        logger.debug("Received WebSocket message: %r", data, extra={"route": "ws.message"})
+                    else:
+                        logger.debug("Received WebSocket %s frame (%d bytes)", codec.name, len(data), extra={"route": "ws.message"})
             
-            try:
-                # Parse JSON message
-                message_data = json.loads(data)
-                message_type = message_data.get("type", "chat")
+                try:
+                    # Parse message
+                    message_data = codec.decode(data)
+                    message_type = message_data.get("type", "chat")
+                    span.set("message.type", message_type)
                 
-                if message_type == "chat":
-                    # Handle chat message
-                    user_message = message_data.get("message", "")
-                    if user_message:
-                        # Process through AI agent
-                        ai_response = agent.process_text_message(user_message, "")
+                    if message_type == "chat":
+                        # Handle chat message
+                        user_message = message_data.get("message", "")
+                        if user_message:
+                            try:
+                                await rate_limiter.acheck(identity, "chat")
+                            except RateLimited as e:
+                                await manager.send_personal_message({
+                                    "type": "error",
+                                    "code": "rate_limited",
+                                    "limit": e.limit,
+                                    "retry_after": round(e.retry_after, 1),
+                                    "message": str(e),
+                                    "timestamp": asyncio.get_event_loop().time()
+                                }, websocket)
+                                continue
                         
-                        # Send response back
-                        response = {
-                            "type": "response",
-                            "message": ai_response,
-                            "timestamp": asyncio.get_event_loop().time()
-                        }
+                            # Process through AI agent
+                            ai_response = await coalesced_chat(user_message, history_session(identity, session_id))
+                            await rate_limiter.arecord(identity, tokens=chat_tokens(user_message, ai_response))
                         
-                        await websocket.send_text(json.dumps(response))
-                    else:
-                        await websocket.send_text(json.dumps({
-                            "type": "error",
-                            "message": "Message is required",
+                            # Send response back
+                            response = {
+                                "type": "response",
+                                "message": ai_response,
+                                "timestamp": asyncio.get_event_loop().time()
+                            }
+                        
+                            await manager.send_personal_message(response, websocket)
+                        else:
+                            await manager.send_personal_message({
+                                "type": "error",
+                                "message": "Message is required",
+                                "timestamp": asyncio.get_event_loop().time()
+                            }, websocket)
+                
+                    elif message_type == "status":
+                        # Send agent status
+                        status = agent.get_status()
+                        await manager.send_personal_message({
+                            "type": "status",
+                            "data": status,
                             "timestamp": asyncio.get_event_loop().time()
-                        }))
+                        }, websocket)
                 
-                elif message_type == "status":
-                    # Send agent status
-                    status = agent.get_status()
-                    await websocket.send_text(json.dumps({
-                        "type": "status",
-                        "data": status,
-                        "timestamp": asyncio.get_event_loop().time()
-                    }))
+                    elif message_type in ("join", "leave"):
+                        # Room membership changes
+                        room = message_data.get("room")
+                        if room:
+                            if message_type == "join":
+                                manager.join(conn, room)
+                            else:
+                                manager.leave(conn, room)
+                        await manager.send_personal_message({
+                            "type": message_type,
+                            "room": room,
+                            "rooms": sorted(conn.rooms),
+                            "timestamp": asyncio.get_event_loop().time()
+                        }, websocket)
                 
-                else:
-                    # Echo back for unknown message types
+                    else:
+                        # Echo back for unknown message types
+                        echoed = data if isinstance(data, str) else json.dumps(message_data, default=str)
+                        response = {
+                            "type": "echo",
+                            "message": f"Echo: {echoed}",
+                            "timestamp": asyncio.get_event_loop().time()
+                        }
+                        await manager.send_personal_message(response, websocket)
+                    
+                except ProtocolError as e:
+                    # Handle undecodable messages
                     response = {
-                        "type": "echo",
-                        "message": f"Echo: {data}",
+                        "type": "error",
+                        "message": str(e),
                         "timestamp": asyncio.get_event_loop().time()
                     }
-                    await websocket.send_text(json.dumps(response))
-                    
-            except json.JSONDecodeError:
-                # Handle non-JSON messages
-                response = {
-                    "type": "error",
-                    "message": "Invalid JSON format",
-                    "timestamp": asyncio.get_event_loop().time()
-                }
-                await websocket.send_text(json.dumps(response))
+                    await manager.send_personal_message(response, websocket)
             
     except WebSocketDisconnect:
         manager.disconnect(websocket)
@@ -372,12 +769,99 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"WebSocket error: {e}")
         manager.disconnect(websocket)
 
+@app.post("/rooms/{room}/broadcast")
+async def broadcast_to_room(room: str, request: BroadcastRequest, http_request: Request):
+    """Push a message to every WebSocket in a room (e.g. a passage to a classroom)"""
+    # Anyone could otherwise push text to a classroom: only named callers may broadcast
+    identity = request_identity(http_request)
+    if identity.by_address:
+        raise HTTPException(
+            status_code=401,
+            detail="Broadcasting needs an identity token or a trusted proxy",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+    await enforce_rate_limit(identity, "broadcast")
+    logger.info("Broadcast to room %s by %s", room, identity.key, extra={"route": "broadcast"})
+    # Published as a dict so each worker encodes it once per wire protocol
+    payload = {
+        "type": "broadcast",
+        "room": room,
+        "message": request.message,
+        "data": request.data,
+        "timestamp": time.time()
+    }
+    message = json.dumps({"room": room, "payload": payload}).encode()
+    workers = await asyncio.to_thread(agent.state.publish, BROADCAST_CHANNEL, message)
+    return {
+        "status": "success",
+        "room": room,
+        "workers": workers
+    }
+
+@app.post("/livekit/rooms/{room}")
+async def open_livekit_room(room: str, request: RoomRequest, http_request: Request):
+    """Start (or find) the agent session for a room and return a join token"""
+    identity = request_identity(http_request)
+    await enforce_rate_limit(identity, "livekit")
+    try:
+        # Callers known only by address (e.g. a classroom behind one NAT) each join as a new guest
+        return await livekit_sessions.open_room(
+            room, None if identity.by_address else identity.key, request.participant
+        )
+    except RoomCapacityExceeded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+    except Exception as e:
+        logger.error(f"Error opening LiveKit room {room}: {e}")
+        raise HTTPException(status_code=503, detail="LiveKit agent not available")
+
+@app.get("/livekit/rooms/{room}")
+async def get_livekit_room(room: str):
+    """Lifecycle and latency stats of a room hosted by this worker"""
+    session = livekit_sessions.get_room(room)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Room not hosted by this worker")
+    return session
+
+@app.delete("/livekit/rooms/{room}")
+async def close_livekit_room(room: str):
+    """End the agent session for a room hosted by this worker"""
+    if not await livekit_sessions.close_room(room):
+        raise HTTPException(status_code=404, detail="Room not hosted by this worker")
+    return {"status": "success", "room": room}
+
+@app.get("/usage")
+async def get_usage(http_request: Request):
+    """The caller's quota usage and its tenant's totals across workers"""
+    identity = request_identity(http_request)
+    return {
+        "quota": await asyncio.to_thread(rate_limiter.quota_status, identity),
+        "tenant": await asyncio.to_thread(rate_limiter.tenant_usage, identity.tenant)
+    }
+
 @app.get("/metrics")
 async def get_metrics():
     """Get server metrics"""
     return {
         "active_connections": len(manager.active_connections),
-        "conversation_count": len(agent.get_conversation_history()),
+        "websocket": manager.get_stats(),
+        "conversation_count": await asyncio.to_thread(agent.history.count, DEFAULT_SESSION),
+        "history": agent.history.get_stats(),
+        "worker_id": WORKER_ID,
+        "state": agent.state.get_status(),
+        "lifecycle": lifecycle.report(),
+        "context": agent.context_builder.get_stats(),
+        "routing": agent.router_metrics.get_stats(),
+        "rate_limit": rate_limiter.get_stats(),
+        "livekit": livekit_sessions.get_stats(),
+        "coalescing": {
+            "chat": chat_flight.get_stats(),
+            "speech": speech_flight.get_stats()
+        },
+        "artifacts": serving_stats.get_stats(),
+        "transcription": transcriber.get_stats(),
+        "speech_formats": speech_stats.get_stats(),
+        "tracing": tracer.get_stats(),
+        "logging": log_pipeline.get_stats(),
         "uptime": "running",
         "memory_usage": "N/A",  # Would implement in real implementation
         "cpu_usage": "N/A"      # Would implement in real implementation
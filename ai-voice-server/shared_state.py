@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Shared State Backends
+Key/value, list and pub/sub storage shared by every worker of the voice server
+"""
+
+import importlib.util
+import logging
+import os
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# redis-py is only imported when a Redis backend is created; importing it
+# costs a noticeable share of worker startup
+REDIS_AVAILABLE = importlib.util.find_spec("redis") is not None
+
+# Identifies this process in metrics and pub/sub fan-out
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+MessageHandler = Callable[[bytes], None]
+
+
+class StateBackend:
+    """Interface for state shared between worker processes
+
+    The API is synchronous: the agent runs in worker threads, and Redis calls
+    are short. Subscription callbacks may be invoked from a background thread,
+    so handlers that touch the event loop must hop onto it themselves.
+    """
+
+    name = "base"
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Increment a counter, setting its expiry when it is first created"""
+        raise NotImplementedError
+
+    def list_push(self, key: str, value: bytes, max_length: Optional[int] = None) -> int:
+        """Append to a list, keeping only the newest ``max_length`` items"""
+        raise NotImplementedError
+
+    def list_range(self, key: str, start: int = 0, end: int = -1) -> List[bytes]:
+        raise NotImplementedError
+
+    def list_length(self, key: str) -> int:
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: bytes) -> int:
+        """Publish a message; returns the number of subscribers that received it"""
+        raise NotImplementedError
+
+    def subscribe(self, channel: str, handler: MessageHandler) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def get_status(self) -> Dict[str, str]:
+        return {"backend": self.name, "worker_id": WORKER_ID}
+
+
+class InMemoryStateBackend(StateBackend):
+    """Process-local backend; the default for a single worker"""
+
+    name = "memory"
+
+    # Expired values are dropped on access, plus a full sweep every N writes
+    # so entries that are never read again do not accumulate
+    SWEEP_INTERVAL = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._values: Dict[str, Tuple[bytes, Optional[float]]] = {}
+        self._lists: Dict[str, Deque[bytes]] = {}
+        self._subscribers: Dict[str, List[MessageHandler]] = {}
+
+    @staticmethod
+    def _deadline(ttl: Optional[float]) -> Optional[float]:
+        return time.monotonic() + ttl if ttl else None
+
+    @staticmethod
+    def _expired(deadline: Optional[float]) -> bool:
+        return deadline is not None and deadline <= time.monotonic()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                return None
+            if self._expired(item[1]):
+                del self._values[key]
+                return None
+            return item[0]
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._values[key] = (value, self._deadline(ttl))
+            self._writes += 1
+            if self._writes % self.SWEEP_INTERVAL == 0:
+                self._sweep()
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, (_, deadline) in self._values.items() if deadline is not None and deadline <= now]
+        for key in expired:
+            del self._values[key]
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._values.pop(key, None)
+            self._lists.pop(key, None)
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        with self._lock:
+            item = self._values.get(key)
+            if item is None or self._expired(item[1]):
+                item = (b"0", self._deadline(ttl))
+            value = int(item[0]) + amount
+            self._values[key] = (str(value).encode(), item[1])
+            return value
+
+    def list_push(self, key: str, value: bytes, max_length: Optional[int] = None) -> int:
+        with self._lock:
+            items = self._lists.get(key)
+            if items is None or items.maxlen != max_length:
+                items = deque(items or (), maxlen=max_length)
+                self._lists[key] = items
+            items.append(value)
+            return len(items)
+
+    def list_range(self, key: str, start: int = 0, end: int = -1) -> List[bytes]:
+        with self._lock:
+            items = list(self._lists.get(key, ()))
+        # Redis LRANGE semantics: ``end`` is inclusive
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def list_length(self, key: str) -> int:
+        with self._lock:
+            return len(self._lists.get(key, ()))
+
+    def publish(self, channel: str, message: bytes) -> int:
+        handlers = list(self._subscribers.get(channel, ()))
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error(f"Error in subscriber for {channel}: {e}")
+        return len(handlers)
+
+    def subscribe(self, channel: str, handler: MessageHandler) -> None:
+        self._subscribers.setdefault(channel, []).append(handler)
+
+
+class RedisStateBackend(StateBackend):
+    """Backend for multi-worker and multi-node deployments
+
+    Works against Redis or any server speaking its protocol, including the
+    local stand-in in ``redis_standin.py``.
+    """
+
+    name = "redis"
+
+    def __init__(self, url: str):
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("The redis package is required for a redis:// SHARED_STATE_URL")
+        import redis
+
+        self.url = url
+        # RESP2 is understood by every Redis version and by the stand-in
+        self._client = redis.Redis.from_url(url, protocol=2)
+        self._pubsub = None
+        self._listener = None
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        if ttl:
+            self._client.set(key, value, px=int(ttl * 1000))
+        else:
+            self._client.set(key, value)
+
+    def delete(self, key: str) -> None:
+        self._client.delete(key)
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        value = self._client.incrby(key, amount)
+        if ttl and value == amount:
+            self._client.pexpire(key, int(ttl * 1000))
+        return value
+
+    def list_push(self, key: str, value: bytes, max_length: Optional[int] = None) -> int:
+        pipe = self._client.pipeline()
+        pipe.rpush(key, value)
+        if max_length:
+            pipe.ltrim(key, -max_length, -1)
+        length = pipe.execute()[0]
+        return min(length, max_length) if max_length else length
+
+    def list_range(self, key: str, start: int = 0, end: int = -1) -> List[bytes]:
+        return self._client.lrange(key, start, end)
+
+    def list_length(self, key: str) -> int:
+        return self._client.llen(key)
+
+    def publish(self, channel: str, message: bytes) -> int:
+        return self._client.publish(channel, message)
+
+    def subscribe(self, channel: str, handler: MessageHandler) -> None:
+        if self._pubsub is None:
+            self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{channel: lambda message: handler(message["data"])})
+        if self._listener is None:
+            self._listener = self._pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+        self._client.close()
+
+    def get_status(self) -> Dict[str, str]:
+        status = super().get_status()
+        status["url"] = self.url.split("@")[-1]  # drop credentials
+        return status
+
+
+def create_backend(url: Optional[str] = None) -> StateBackend:
+    """Create the backend named by ``url`` or the SHARED_STATE_URL env var
+
+    ``memory://`` (the default) keeps state in-process; ``redis://host:port/db``
+    shares it between workers.
+    """
+    url = url or os.getenv("SHARED_STATE_URL", "memory://")
+    if url.startswith("memory://"):
+        return InMemoryStateBackend()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        logger.info(f"Using shared state backend at {url.split('@')[-1]}")
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Speech Formats
+Output formats for generated speech, picked per request, with their durations and per-format stats
+
+/speech answers in the format the client asks for: ``?format=`` if given,
+else the best match in its Accept header, else SPEECH_DEFAULT_FORMAT. A
+client sending ``Save-Data: on`` (browser data saver, or the reader on a
+metered school network) gets low-bitrate MP3 where it would have got MP3.
+
+    mp3      audio/mpeg, tts-1's own MP3
+    mp3-low  audio/mpeg, mono at SPEECH_LOW_BITRATE, re-encoded from the MP3
+             with ffmpeg; offered only when ffmpeg is installed
+    opus     audio/ogg, Opus in Ogg, compact and quick to start playing
+    aac      audio/aac, ADTS
+    wav      audio/wav, 24 kHz 16-bit mono
+    pcm      raw 24 kHz 16-bit little-endian mono, for the realtime pipeline,
+             which would otherwise decode MP3 before playing it
+
+Every format but mp3-low is generated by OpenAI directly (``response_format``),
+so asking for Opus costs no more than asking for MP3. Precomputed narration
+is stored as MP3 and re-encoded with ffmpeg for other formats.
+
+duration() reads the playing time from the audio itself for every format,
+so quotas and the bytes-per-second figures in ``stats`` are exact.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import mp3_frames
+from rate_limit import COMPRESSED_BYTES_PER_SECOND, audio_seconds
+
+logger = logging.getLogger(__name__)
+
+SPEECH_DEFAULT_FORMAT = os.getenv("SPEECH_DEFAULT_FORMAT", "mp3")
+SPEECH_LOW_BITRATE = os.getenv("SPEECH_LOW_BITRATE", "32k")
+
+PCM_RATE = 24000
+PCM_BYTES_PER_SECOND = PCM_RATE * 2
+# ADTS sampling_frequency_index values
+ADTS_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+
+
+class SpeechFormat(NamedTuple):
+    name: str
+    media_type: str
+    extension: str
+    upstream: Optional[str]  # OpenAI response_format; None when re-encoded from MP3
+    encode: Tuple[str, ...]  # ffmpeg output options producing this format from other audio
+
+
+FORMATS: Dict[str, SpeechFormat] = {
+    "mp3": SpeechFormat("mp3", "audio/mpeg", "mp3", "mp3", ("-c:a", "libmp3lame", "-f", "mp3")),
+    "mp3-low": SpeechFormat(
+        "mp3-low", "audio/mpeg", "mp3", None,
+        ("-ac", "1", "-ar", "22050", "-c:a", "libmp3lame", "-b:a", SPEECH_LOW_BITRATE, "-f", "mp3")
+    ),
+    "opus": SpeechFormat("opus", "audio/ogg; codecs=opus", "opus", "opus", ("-c:a", "libopus", "-b:a", "32k", "-f", "ogg")),
+    "aac": SpeechFormat("aac", "audio/aac", "aac", "aac", ("-c:a", "aac", "-f", "adts")),
+    "wav": SpeechFormat("wav", "audio/wav", "wav", "wav", ("-ac", "1", "-ar", str(PCM_RATE), "-f", "wav")),
+    "pcm": SpeechFormat(
+        "pcm", f"audio/pcm; rate={PCM_RATE}; channels=1; bits=16", "pcm", "pcm",
+        ("-ac", "1", "-ar", str(PCM_RATE), "-f", "s16le")
+    )
+}
+
+# Accept media types (lower case, without parameters) and the format each names
+MEDIA_TYPES = {
+    "audio/mpeg": "mp3",
+    "audio/mp3": "mp3",
+    "audio/ogg": "opus",
+    "audio/opus": "opus",
+    "audio/aac": "aac",
+    "audio/wav": "wav",
+    "audio/wave": "wav",
+    "audio/x-wav": "wav",
+    "audio/pcm": "pcm",
+    "audio/l16": "pcm"
+}
+
+
+class UnsupportedFormat(ValueError):
+    """``?format=`` named a format this server cannot produce"""
+
+
+class NotAcceptable(ValueError):
+    """Nothing in the Accept header is a format this server can produce"""
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def available_formats() -> List[str]:
+    """Formats this server can produce: re-encoded ones need ffmpeg"""
+    encoder = ffmpeg_available()
+    return [name for name, fmt in FORMATS.items() if fmt.upstream is not None or encoder]
+
+
+def _accept_ranges(accept: str) -> List[Tuple[str, float]]:
+    """Media ranges in preference order: by q, then as listed"""
+    ranges = []
+    for position, item in enumerate(accept.split(",")):
+        media, *params = [part.strip() for part in item.split(";")]
+        if not media:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            ranges.append((-q, position, media.lower()))
+    return [(media, -q) for q, _, media in sorted(ranges)]
+
+
+def negotiate(
+    requested: Optional[str] = None,
+    accept: Optional[str] = None,
+    save_data: Optional[str] = None,
+    default: str = SPEECH_DEFAULT_FORMAT
+) -> SpeechFormat:
+    """The format to answer in; raises UnsupportedFormat or NotAcceptable"""
+    available = available_formats()
+    if requested:
+        if requested not in available:
+            raise UnsupportedFormat(f"format must be one of {', '.join(available)}")
+        return FORMATS[requested]
+
+    if default not in available:
+        default = "mp3"
+    chosen = None
+    if not accept or not accept.strip():
+        chosen = default
+    else:
+        for media, _ in _accept_ranges(accept):
+            if media in ("*/*", "audio/*"):
+                chosen = default
+            elif MEDIA_TYPES.get(media) in available:
+                chosen = MEDIA_TYPES[media]
+            if chosen is not None:
+                break
+        if chosen is None:
+            raise NotAcceptable(f"Speech is available as {', '.join(sorted({FORMATS[name].media_type for name in available}))}")
+
+    if chosen == "mp3" and (save_data or "").strip().lower() == "on" and "mp3-low" in available:
+        chosen = "mp3-low"
+    return FORMATS[chosen]
+
+
+def encode(data: bytes, fmt: SpeechFormat) -> Optional[bytes]:
+    """``data`` (MP3, or any format ffmpeg reads) re-encoded as ``fmt``; None when ffmpeg is missing or fails"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    # MP3, Ogg, ADTS and WAV are all readable from a pipe
+    try:
+        result = subprocess.run(
+            [ffmpeg, "-nostdin", "-v", "error", "-i", "pipe:0", *fmt.encode, "pipe:1"],
+            input=data,
+            capture_output=True,
+            timeout=120,
+            check=True
+        )
+    except (subprocess.SubprocessError, OSError) as e:
+        logger.warning(f"ffmpeg could not encode speech as {fmt.name}: {e}")
+        return None
+    return result.stdout
+
+
+def ogg_opus_seconds(data: bytes) -> Optional[float]:
+    """Playing time of Ogg Opus: the last page's granule position, less the pre-skip, at 48 kHz"""
+    last = data.rfind(b"OggS")
+    head = data.find(b"OpusHead")
+    if last < 0 or len(data) < last + 14:
+        return None
+    granule = int.from_bytes(data[last + 6:last + 14], "little")
+    pre_skip = int.from_bytes(data[head + 10:head + 12], "little") if 0 <= head and len(data) >= head + 12 else 0
+    return max(0, granule - pre_skip) / 48000
+
+
+def adts_seconds(data: bytes) -> Optional[float]:
+    """Playing time of ADTS AAC: 1024 samples per frame"""
+    position = mp3_frames.id3v2_size(data)
+    frames, rate = 0, None
+    while position + 7 <= len(data):
+        if data[position] != 0xFF or data[position + 1] & 0xF6 != 0xF0:
+            break
+        index = (data[position + 2] >> 2) & 0x0F
+        length = ((data[position + 3] & 0x03) << 11) | (data[position + 4] << 3) | (data[position + 5] >> 5)
+        if index >= len(ADTS_RATES) or length < 7:
+            break
+        rate = ADTS_RATES[index]
+        frames += 1
+        position += length
+    if not frames or rate is None:
+        return None
+    return frames * 1024 / rate
+
+
+def duration(data: bytes, fmt: SpeechFormat) -> float:
+    """Playing time of speech in ``fmt``, in seconds"""
+    if fmt.name == "pcm":
+        return len(data) / PCM_BYTES_PER_SECOND
+    if fmt.name == "opus":
+        seconds = ogg_opus_seconds(data)
+    elif fmt.name == "aac":
+        seconds = adts_seconds(data)
+    else:
+        return audio_seconds(data)
+    return seconds if seconds is not None else len(data) / COMPRESSED_BYTES_PER_SECOND
+
+
+class SpeechFormatStats:
+    """Per-format response sizes, speech length and timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.formats: Dict[str, Dict[str, float]] = {}
+
+    def _entry(self, name: str) -> Dict[str, float]:
+        return self.formats.setdefault(name, {
+            "responses": 0, "bytes": 0, "audio_seconds": 0.0, "response_seconds": 0.0,
+            "upstream": 0, "upstream_first_byte_seconds": 0.0, "upstream_seconds": 0.0
+        })
+
+    def record_response(self, name: str, size: int, seconds: float, elapsed: float) -> None:
+        """One /speech response: bytes sent, seconds of speech, time to produce it"""
+        with self._lock:
+            entry = self._entry(name)
+            entry["responses"] += 1
+            entry["bytes"] += size
+            entry["audio_seconds"] += seconds
+            entry["response_seconds"] += elapsed
+
+    def record_upstream(self, name: str, first_byte: float, elapsed: float) -> None:
+        """One OpenAI TTS call: time to its first audio byte and to its last"""
+        with self._lock:
+            entry = self._entry(name)
+            entry["upstream"] += 1
+            entry["upstream_first_byte_seconds"] += first_byte
+            entry["upstream_seconds"] += elapsed
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            formats = {}
+            for name, entry in self.formats.items():
+                responses, upstream = entry["responses"], entry["upstream"]
+                formats[name] = {
+                    "responses": responses,
+                    "bytes": entry["bytes"],
+                    "audio_seconds": round(entry["audio_seconds"], 1),
+                    "bytes_per_second": round(entry["bytes"] / entry["audio_seconds"]) if entry["audio_seconds"] else None,
+                    "response_ms_avg": round(entry["response_seconds"] / responses * 1000, 1) if responses else None,
+                    "upstream_calls": upstream,
+                    "upstream_first_byte_ms_avg": round(entry["upstream_first_byte_seconds"] / upstream * 1000, 1) if upstream else None,
+                    "upstream_ms_avg": round(entry["upstream_seconds"] / upstream * 1000, 1) if upstream else None
+                }
+            return {"available": available_formats(), "default": SPEECH_DEFAULT_FORMAT, "formats": formats}
+
+
+stats = SpeechFormatStats()
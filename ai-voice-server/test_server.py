@@ -2,6 +2,11 @@
 """
 Test script for AI Voice Agent Server
 Tests basic functionality and endpoints
+
+This is a one-request-per-endpoint smoke test. For throughput and latency
+under concurrent load, use benchmarks/load_test.py.
+
+Usage: python test_server.py [base_url]
 """
 
 import asyncio
@@ -27,7 +32,7 @@ async def test_endpoint(session: aiohttp.ClientSession, url: str, method: str =
         print(f"❌ {method} {url} - Error: {e}")
         return {}
 
-async def test_websocket(url: str):
+async def test_websocket(url: str) -> bool:
     """Test WebSocket connection"""
     try:
         async with aiohttp.ClientSession() as session:
@@ -44,17 +49,55 @@ async def test_websocket(url: str):
                     if msg.type == aiohttp.WSMsgType.TEXT:
                         response = json.loads(msg.data)
                         print(f"📥 Received: {response}")
-                        break
+                        return True
                     elif msg.type == aiohttp.WSMsgType.ERROR:
                         print(f"❌ WebSocket error: {ws.exception()}")
-                        break
+                        return False
+                return False
                         
     except Exception as e:
         print(f"❌ WebSocket test failed: {e}")
+        return False
+
+async def test_websocket_handshakes(url: str) -> bool:
+    """Each way of choosing a /ws codec must complete the handshake and answer a status request"""
+    import msgpack
+    
+    cases = [
+        ("json", url, ()),
+        ("msgpack via ?protocol=", f"{url}?protocol=msgpack", ()),
+        ("msgpack via subprotocol", url, ("lexitune.msgpack",))
+    ]
+    passed = True
+    async with aiohttp.ClientSession() as session:
+        for name, case_url, protocols in cases:
+            try:
+                async with session.ws_connect(case_url, protocols=protocols) as ws:
+                    if protocols and ws.protocol not in protocols:
+                        raise RuntimeError(f"server chose subprotocol {ws.protocol!r}")
+                    request = {"type": "status"}
+                    if "msgpack" in name:
+                        await ws.send_bytes(msgpack.packb(request))
+                    else:
+                        await ws.send_str(json.dumps(request))
+                    msg = await ws.receive(timeout=10)
+                    if msg.type == aiohttp.WSMsgType.BINARY:
+                        reply = msgpack.unpackb(msg.data)
+                    elif msg.type == aiohttp.WSMsgType.TEXT:
+                        reply = json.loads(msg.data)
+                    else:
+                        raise RuntimeError(f"connection closed ({msg.type.name}, {msg.data})")
+                    if reply.get("type") != "status":
+                        raise RuntimeError(f"unexpected reply {reply}")
+                    print(f"✅ WebSocket handshake ({name})")
+            except Exception as e:
+                print(f"❌ WebSocket handshake ({name}) failed: {e}")
+                passed = False
+    return passed
 
 async def main():
     """Main test function"""
-    base_url = "http://localhost:8000"
+    base_url = sys.argv[1].rstrip("/") if len(sys.argv) > 1 else "http://localhost:8000"
     
     print("🧪 Testing AI Voice Agent Server...")
     print(f"🌐 Base URL: {base_url}")
@@ -105,8 +148,10 @@ async def main():
     
     # Test WebSocket
     print("\n🔌 Testing WebSocket:")
-    ws_url = "ws://localhost:8000/ws"
-    await test_websocket(ws_url)
+    ws_url = base_url.replace("http", "ws", 1) + "/ws"
+    websocket_ok = await test_websocket(ws_url)
+    # The handshake broke once when another module's negotiate() shadowed the codec one
+    handshakes_ok = await test_websocket_handshakes(ws_url)
     
     print("\n" + "=" * 50)
     print("🎯 Testing completed!")
@@ -114,14 +159,19 @@ async def main():
     # Summary
     print("\n📊 Test Summary:")
     print("✅ HTTP endpoints tested")
+    if not (websocket_ok and handshakes_ok):
+        print("❌ WebSocket connection failed")
+        return False
     print("✅ WebSocket connection tested")
     print("✅ Basic functionality verified")
     
     print("\n🚀 Server is ready for AI voice conversations!")
+    return True
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if not asyncio.run(main()):
+            sys.exit(1)
     except KeyboardInterrupt:
         print("\n⏹️ Testing interrupted by user")
         sys.exit(0)
@@ -0,0 +1,10 @@
+"""Make the server's modules and service_common importable from the tests"""
+
+import sys
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+
+for path in (SERVER_DIR.parent, SERVER_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
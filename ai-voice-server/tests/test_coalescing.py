@@ -0,0 +1,100 @@
+"""SingleFlight: concurrent identical calls share one upstream call"""
+
+import asyncio
+
+import pytest
+
+from coalescing import SingleFlight, normalize_prompt
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    async def run():
+        flight = SingleFlight("test")
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        results = await asyncio.gather(*(flight.do("key", upstream) for _ in range(5)))
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(run())
+    assert calls == 1
+    assert results == ["answer"] * 5
+    stats = flight.get_stats()
+    assert stats["upstream_calls"] == 1
+    assert stats["coalesced"] == 4
+    assert stats["in_flight"] == 0
+
+
+def test_different_keys_are_not_coalesced():
+    async def run():
+        flight = SingleFlight("test")
+
+        async def upstream(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        return await asyncio.gather(flight.do("a", lambda: upstream("a")), flight.do("b", lambda: upstream("b")))
+
+    assert asyncio.run(run()) == ["a", "b"]
+
+
+def test_key_is_released_once_the_call_completes():
+    async def run():
+        flight = SingleFlight("test")
+        calls = 0
+
+        async def upstream():
+            nonlocal calls
+            calls += 1
+            return calls
+
+        first = await flight.do("key", upstream)
+        second = await flight.do("key", upstream)
+        return first, second
+
+    # Results are not cached: a later call goes upstream again
+    assert asyncio.run(run()) == (1, 2)
+
+
+def test_failure_reaches_every_waiter():
+    async def run():
+        flight = SingleFlight("test")
+
+        async def upstream():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream down")
+
+        results = await asyncio.gather(*(flight.do("key", upstream) for _ in range(3)), return_exceptions=True)
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flight.get_stats()["failures"] == 1
+
+
+def test_cancelled_waiter_does_not_cancel_the_shared_call():
+    async def run():
+        flight = SingleFlight("test")
+
+        async def upstream():
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        leader = asyncio.ensure_future(flight.do("key", upstream))
+        follower = asyncio.ensure_future(flight.do("key", upstream))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(run()) == "answer"
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  How do I   say\tTHIS? ") == normalize_prompt("how do i say this?")
@@ -0,0 +1,141 @@
+"""ConnectionManager: slow consumer policies, eviction, close and send spans"""
+
+import asyncio
+from typing import List
+
+from connection_manager import CLOSE_TRY_AGAIN_LATER, ConnectionManager
+from service_common import tracing
+
+
+class FakeWebSocket:
+    """Records what is sent; each send takes ``delay`` seconds"""
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.sent: List[object] = []
+        self.close_code = None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        await asyncio.sleep(self.delay)
+        self.sent.append(text)
+
+    async def send_bytes(self, data):
+        await asyncio.sleep(self.delay)
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+
+class CollectingExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, service, spans):
+        self.spans.extend(spans)
+
+
+def test_messages_are_written_in_order():
+    async def run():
+        manager = ConnectionManager(max_queue=8)
+        websocket = FakeWebSocket()
+        await manager.connect(websocket)
+        for index in range(3):
+            assert await manager.send_personal_message(f"m{index}", websocket)
+        await asyncio.sleep(0.01)
+        return manager, websocket
+
+    manager, websocket = asyncio.run(run())
+    assert websocket.sent == ["m0", "m1", "m2"]
+    assert manager.get_stats()["messages_sent"] == 3
+
+
+def test_broadcast_reaches_room_members_only():
+    async def run():
+        manager = ConnectionManager()
+        inside, outside = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(inside, rooms=["class-1"])
+        await manager.connect(outside)
+        queued = await manager.broadcast({"type": "broadcast", "message": "hello"}, room="class-1")
+        await asyncio.sleep(0.01)
+        return queued, inside, outside
+
+    queued, inside, outside = asyncio.run(run())
+    assert queued == 1
+    assert len(inside.sent) == 1
+    assert outside.sent == []
+
+
+def test_full_queue_evicts_under_disconnect_policy():
+    async def run():
+        manager = ConnectionManager(max_queue=1, slow_consumer_policy="disconnect")
+        websocket = FakeWebSocket(delay=1.0)
+        await manager.connect(websocket)
+        results = [await manager.send_personal_message(f"m{index}", websocket) for index in range(3)]
+        await asyncio.sleep(0.01)
+        return manager, websocket, results
+
+    manager, websocket, results = asyncio.run(run())
+    assert results == [True, False, False]
+    stats = manager.get_stats()
+    assert stats["evictions"] == 1
+    assert stats["active_connections"] == 0
+    assert stats["queued"] == 0
+    assert websocket.close_code == CLOSE_TRY_AGAIN_LATER
+
+
+def test_drop_oldest_keeps_the_newest_messages():
+    async def run():
+        manager = ConnectionManager(max_queue=2, slow_consumer_policy="drop_oldest")
+        websocket = FakeWebSocket()
+        await manager.connect(websocket)
+        for index in range(4):
+            assert await manager.send_personal_message(f"m{index}", websocket)
+        await asyncio.sleep(0.01)
+        return manager, websocket
+
+    manager, websocket = asyncio.run(run())
+    assert websocket.sent == ["m2", "m3"]
+    assert manager.get_stats()["messages_dropped"] == 2
+
+
+def test_close_all_flushes_queued_messages_and_stops_writers():
+    async def run():
+        manager = ConnectionManager(max_queue=2, slow_consumer_policy="drop_oldest")
+        websocket = FakeWebSocket(delay=0.01)
+        conn = await manager.connect(websocket)
+        await manager.send_personal_message("reconnect", websocket)
+        await manager.close_all(code=1001, flush_timeout=1.0)
+        # Nothing is queued behind the close sentinel, even under drop_oldest
+        late = manager._enqueue(conn, "late")
+        return manager, websocket, conn, late
+
+    manager, websocket, conn, late = asyncio.run(run())
+    assert websocket.sent == ["reconnect"]
+    assert websocket.close_code == 1001
+    assert conn.writer.done()
+    assert late is False
+    assert manager.get_stats()["active_connections"] == 0
+
+
+def test_send_spans_end_when_a_connection_is_evicted():
+    exporter = CollectingExporter()
+    tracer = tracing.Tracer("test", exporter, sample_rate=1.0)
+
+    async def run():
+        manager = ConnectionManager(max_queue=1, slow_consumer_policy="disconnect")
+        websocket = FakeWebSocket(delay=1.0)
+        await manager.connect(websocket)
+        with tracer.span("request"):
+            # The first is queued and dropped with the connection, the second evicts it
+            await manager.send_personal_message("m0", websocket)
+            await manager.send_personal_message("m1", websocket)
+
+    asyncio.run(run())
+    tracer.flush()
+    sends = [span for span in exporter.spans if span.name == "ws.send"]
+    assert len(sends) == 2
+    assert all(span.end_ns is not None and span.error for span in sends)
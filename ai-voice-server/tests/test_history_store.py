@@ -0,0 +1,83 @@
+"""SQLiteHistoryStore: write-behind reads, keyset pagination, count and clear"""
+
+import pytest
+
+from history_store import SQLiteHistoryStore
+
+
+def entry(index):
+    return {"role": "user", "content": f"message {index}", "timestamp": f"2024-01-01T00:00:{index:02d}"}
+
+
+def contents(entries):
+    return [item["content"] for item in entries]
+
+
+@pytest.fixture
+def store(tmp_path):
+    # A long flush interval keeps appended entries queued until flush()
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"), batch_size=1000, flush_interval=60)
+    yield store
+    store.close()
+
+
+def test_reads_see_queued_entries(store):
+    for index in range(3):
+        store.append("s1", entry(index))
+    assert store.get_stats()["pending"] == 3
+    assert contents(store.recent("s1")) == ["message 0", "message 1", "message 2"]
+    assert store.count("s1") == 3
+    assert store.recent("s2") == []
+
+
+def test_count_does_not_double_count_written_entries(store):
+    for index in range(3):
+        store.append("s1", entry(index))
+    assert store.flush()
+    store.append("s1", entry(3))
+    assert store.count("s1") == 4
+    assert contents(store.recent("s1", 2)) == ["message 2", "message 3"]
+
+
+def test_pages_span_stored_and_queued_entries(store):
+    for index in range(5):
+        store.append("s1", entry(index))
+    assert store.flush()
+    for index in range(5, 7):
+        store.append("s1", entry(index))
+
+    entries, cursor = store.page("s1", limit=3)
+    assert contents(entries) == ["message 4", "message 5", "message 6"]
+    assert cursor is not None
+    entries, cursor = store.page("s1", limit=3, before=cursor)
+    assert contents(entries) == ["message 1", "message 2", "message 3"]
+    entries, cursor = store.page("s1", limit=3, before=cursor)
+    assert contents(entries) == ["message 0"]
+    assert cursor is None
+
+
+def test_a_page_of_queued_entries_still_has_a_cursor(store):
+    for index in range(4):
+        store.append("s1", entry(index))
+    entries, cursor = store.page("s1", limit=2)
+    assert contents(entries) == ["message 2", "message 3"]
+    entries, cursor = store.page("s1", limit=2, before=cursor)
+    assert contents(entries) == ["message 0", "message 1"]
+    assert cursor is None
+
+
+def test_clear_removes_stored_and_queued_entries(store):
+    store.append("s1", entry(0))
+    store.append("s2", entry(0))
+    assert store.flush()
+    store.append("s1", entry(1))
+    store.append("s2", entry(1))
+
+    store.clear("s1")
+    assert store.recent("s1") == []
+    assert store.count("s1") == 0
+    assert store.page("s1") == ([], None)
+    assert store.count("s2") == 2
+    # The discarded entries are not waited for
+    assert store.flush(timeout=1.0)
+    assert store.count("s2") == 2
@@ -0,0 +1,84 @@
+"""RateLimiter: request buckets, token and audio quotas, caller identity"""
+
+import pytest
+
+from rate_limit import Identity, RateLimited, RateLimiter, identify
+from shared_state import InMemoryStateBackend
+
+USER = Identity("acme", "user:alice")
+OTHER_USER = Identity("acme", "user:bob")
+ADDRESS = Identity("default", "ip:10.0.0.7")
+
+
+def limiter(**overrides):
+    options = dict(
+        rate=0.001, burst=3, ip_rate=0.001, ip_burst=5,
+        token_quota=100, audio_quota_seconds=10, ip_token_quota=1000, ip_audio_quota_seconds=100
+    )
+    options.update(overrides)
+    return RateLimiter(InMemoryStateBackend(), shared=False, **options)
+
+
+def test_burst_is_exhausted_per_client():
+    limits = limiter()
+    for _ in range(3):
+        limits.check(USER, "chat")
+    with pytest.raises(RateLimited) as raised:
+        limits.check(USER, "chat")
+    assert raised.value.limit == "requests"
+    assert raised.value.retry_after > 0
+    # Another user has a bucket of their own
+    limits.check(OTHER_USER, "chat")
+    assert limits.get_stats()["rejected"] == {"requests": 1}
+
+
+def test_anonymous_callers_use_the_address_bucket():
+    limits = limiter()
+    for _ in range(5):
+        limits.check(ADDRESS, "chat")
+    with pytest.raises(RateLimited):
+        limits.check(ADDRESS, "chat")
+    limits.check(USER, "chat")
+
+
+def test_token_quota_applies_to_chat_only():
+    limits = limiter(rate=0)
+    limits.check(USER, "chat")
+    limits.record(USER, tokens=100)
+    with pytest.raises(RateLimited) as raised:
+        limits.check(USER, "chat")
+    assert raised.value.limit == "tokens"
+    limits.check(USER, "speech")
+    assert limits.quota_status(USER)["tokens"] == {"used": 100, "limit": 100}
+
+
+def test_audio_quota():
+    limits = limiter(rate=0)
+    limits.record(USER, audio_seconds=10)
+    with pytest.raises(RateLimited) as raised:
+        limits.check(USER, "transcription")
+    assert raised.value.limit == "audio_seconds"
+    limits.check(USER, "chat")
+
+
+def test_anonymous_callers_get_their_own_quotas():
+    limits = limiter(ip_rate=0)
+    assert limits.quotas(ADDRESS) == (1000, 100000)
+    limits.record(ADDRESS, tokens=500)
+    limits.check(ADDRESS, "chat")
+
+
+def test_usage_is_counted_per_tenant():
+    limits = limiter(rate=0)
+    limits.check(USER, "chat")
+    limits.record(USER, tokens=40, audio_seconds=1.5)
+    assert limits.tenant_usage("acme") == {
+        "tenant": "acme", "requests": 1, "rejected": 0, "tokens": 40, "audio_seconds": 1.5
+    }
+
+
+def test_identify_uses_headers_from_trusted_hosts_only():
+    # Starlette's Headers are read case-insensitively; a dict needs the lowercase names
+    headers = {"x-tenant-id": "acme", "x-user-id": "alice"}
+    assert identify(headers, "127.0.0.1") == USER
+    assert identify(headers, "203.0.113.9").by_address
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+"""
+Chunked Transcription
+Long recordings split at pauses and transcribed in parallel
+
+Whisper takes one upload of at most 25 MB per call, so a ten-minute reading
+assessment used to be one long serial request with nothing to show until it
+finished. Recordings longer than LONG_AUDIO_SECONDS are now cut into chunks
+of about TRANSCRIBE_CHUNK_SECONDS. Each cut is placed in the middle of the
+longest pause found within TRANSCRIBE_SEARCH_SECONDS of its target time (the
+energy envelope from alignment.py, PCM at ~1 kHz or MP3 granule bits), so
+words are rarely split, and chunks overlap by TRANSCRIBE_OVERLAP_SECONDS on
+either side in case one is.
+
+WAV is sliced by frames and re-wrapped, MP3 at frame boundaries; anything
+else is first converted to 16 kHz mono WAV with ffmpeg when it is installed,
+and sent in one call otherwise. Chunks run concurrently under a per-worker
+limit of TRANSCRIBE_CONCURRENCY calls, which is also capped by the upstream
+thread pool.
+
+Speech in an overlap is heard by both neighbouring chunks and must appear
+once. Chunks are transcribed with word timestamps, and each keeps only the
+words whose middle falls between its own two cuts, so the join is by time,
+not by text. Without timestamps (a ``transcribe`` with no timed variant),
+stitch() joins transcripts on a run of words that ends one and starts the
+next, no longer than the overlap can hold. A chunk that still fails after a
+retry leaves a gap and the result is marked partial rather than failing the
+whole recording.
+"""
+
+import asyncio
+import difflib
+import io
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import mp3_frames
+from service_common import tracing
+from alignment import detect_voicing, pcm_envelope
+from rate_limit import audio_seconds
+
+logger = logging.getLogger(__name__)
+
+LONG_AUDIO_SECONDS = float(os.getenv("LONG_AUDIO_SECONDS", "120"))
+TRANSCRIBE_CHUNK_SECONDS = float(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "60"))
+TRANSCRIBE_OVERLAP_SECONDS = float(os.getenv("TRANSCRIBE_OVERLAP_SECONDS", "1.5"))
+TRANSCRIBE_SEARCH_SECONDS = float(os.getenv("TRANSCRIBE_SEARCH_SECONDS", "10"))
+TRANSCRIBE_CONCURRENCY = min(
+    int(os.getenv("TRANSCRIBE_CONCURRENCY", "8")),
+    int(os.getenv("UPSTREAM_THREADS", "64"))
+)
+TRANSCRIBE_ATTEMPTS = 2
+# Whisper's upload limit, with room for the multipart envelope
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024 - 64 * 1024
+
+MODES = ("auto", "single", "chunked")
+FORMATS = {"wav": ("audio.wav", "audio/wav"), "mp3": ("audio.mp3", "audio/mpeg")}
+# Envelope sample rate used for finding pauses in PCM
+_ENVELOPE_RATE = 1000
+
+Transcribe = Callable[[bytes, str, str], str]
+# Transcript plus (word, start, end) seconds for every word, as Whisper's verbose_json gives them
+TranscribeTimed = Callable[[bytes, str, str], Tuple[str, List[Tuple[str, float, float]]]]
+
+
+class Chunk(NamedTuple):
+    index: int
+    start: float  # seconds, widened by the overlap
+    end: float
+    cut_start: float  # the cuts this chunk's words are kept between
+    cut_end: float
+
+
+class TimedWord(NamedTuple):
+    text: str  # as written in the transcript, punctuation included
+    start: float
+    end: float
+
+
+def detect_format(data: bytes) -> Optional[str]:
+    """"wav", "mp3", or None for anything that cannot be sliced here"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    # Demand a frame right after any ID3 tag: sync-like bytes turn up in other containers
+    start = mp3_frames.id3v2_size(data)
+    first = mp3_frames.parse_header(data, start)
+    if first is not None and mp3_frames.parse_header(data, start + first.length) is not None:
+        return "mp3"
+    return None
+
+
+def convert_to_wav(data: bytes) -> Optional[bytes]:
+    """16 kHz mono 16-bit WAV via ffmpeg, or None when ffmpeg is missing or fails"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    # A file rather than a pipe: MP4/M4A keep their index at the end
+    with tempfile.NamedTemporaryFile() as source:
+        source.write(data)
+        source.flush()
+        try:
+            result = subprocess.run(
+                [ffmpeg, "-nostdin", "-v", "error", "-i", source.name, "-ac", "1", "-ar", "16000", "-f", "wav", "pipe:1"],
+                capture_output=True,
+                timeout=300,
+                check=True
+            )
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.warning(f"ffmpeg could not convert upload: {e}")
+            return None
+    return result.stdout
+
+
+class SlicedAudio:
+    """A recording that can be cut into standalone WAV or MP3 pieces"""
+
+    format = ""
+    duration = 0.0
+
+    def envelope(self) -> Tuple[List[float], float]:
+        raise NotImplementedError
+
+    def slice(self, start: float, end: float) -> bytes:
+        raise NotImplementedError
+
+
+class WavAudio(SlicedAudio):
+    format = "wav"
+
+    def __init__(self, data: bytes):
+        with wave.open(io.BytesIO(data)) as wav:
+            self.params = wav.getparams()
+            self.frames = wav.readframes(wav.getnframes())
+        self.frame_size = self.params.sampwidth * self.params.nchannels
+        self.frame_count = len(self.frames) // self.frame_size
+        self.duration = self.frame_count / self.params.framerate
+        self.bytes_per_second = self.frame_size * self.params.framerate
+
+    def envelope(self) -> Tuple[List[float], float]:
+        if self.params.sampwidth != 2:
+            return [], 0.0  # cut at fixed times
+        stride = max(1, self.params.framerate // _ENVELOPE_RATE)
+        return pcm_envelope(self.frames, self.params.framerate, self.params.nchannels, stride)
+
+    def slice(self, start: float, end: float) -> bytes:
+        first = max(0, int(start * self.params.framerate))
+        last = min(self.frame_count, int(math.ceil(end * self.params.framerate)))
+        output = io.BytesIO()
+        with wave.open(output, "wb") as wav:
+            wav.setparams(self.params)
+            wav.writeframes(self.frames[first * self.frame_size:last * self.frame_size])
+        return output.getvalue()
+
+
+class Mp3Audio(SlicedAudio):
+    format = "mp3"
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.frames = [frame for frame in mp3_frames.iter_frames(data) if not mp3_frames.is_info_frame(data, frame)]
+        self.starts: List[float] = []
+        position = 0.0
+        for frame in self.frames:
+            self.starts.append(position)
+            position += frame.samples / frame.sample_rate
+        self.duration = position
+        self.bytes_per_second = len(data) / position if position else 0.0
+
+    def envelope(self) -> Tuple[List[float], float]:
+        values, hop = mp3_frames.granule_bits(self.data)
+        return [float(value) for value in values], hop
+
+    def slice(self, start: float, end: float) -> bytes:
+        # Frames may borrow bits from the one before (the bit reservoir), so the
+        # first frame of a slice can decode as a click; the overlap covers it
+        return b"".join(
+            self.data[frame.offset:frame.offset + frame.length]
+            for frame, at in zip(self.frames, self.starts)
+            if start <= at < end
+        )
+
+
+def load_audio(data: bytes) -> Optional[SlicedAudio]:
+    """The recording as sliceable audio, converting it with ffmpeg if needed"""
+    kind = detect_format(data)
+    if kind is None:
+        data = convert_to_wav(data)
+        kind = "wav" if data else None
+    try:
+        if kind == "wav":
+            return WavAudio(data)
+        if kind == "mp3":
+            audio = Mp3Audio(data)
+            return audio if audio.duration else None
+    except (wave.Error, EOFError, ZeroDivisionError) as e:
+        logger.warning(f"Unreadable {kind} upload, sending it whole: {e}")
+    return None
+
+
+def _pause_runs(voiced: List[bool], hop: float) -> List[Tuple[float, float]]:
+    runs, index = [], 0
+    while index < len(voiced):
+        if voiced[index]:
+            index += 1
+            continue
+        end = index
+        while end < len(voiced) and not voiced[end]:
+            end += 1
+        runs.append((index * hop, end * hop))
+        index = end
+    return runs
+
+
+def plan_chunks(
+    duration: float,
+    pauses: List[Tuple[float, float]],
+    chunk_seconds: float = TRANSCRIBE_CHUNK_SECONDS,
+    overlap: float = TRANSCRIBE_OVERLAP_SECONDS,
+    search: float = TRANSCRIBE_SEARCH_SECONDS
+) -> List[Chunk]:
+    """Chunk spans, cut mid-pause near every ``chunk_seconds`` and widened by ``overlap``
+
+    ``pauses`` are (start, end) seconds of silence in time order.
+    """
+    cuts = [0.0]
+    while duration - cuts[-1] > chunk_seconds * 1.25:
+        target = cuts[-1] + chunk_seconds
+        # Never so early that a chunk is less than half the intended length
+        low, high = max(target - search, cuts[-1] + chunk_seconds / 2), target + search
+        best: Optional[Tuple[float, float]] = None
+        for start, end in pauses:
+            if end <= low:
+                continue
+            if start >= high:
+                break
+            span = min(end, high) - max(start, low)
+            # Longest pause wins; between equals, the one closer to the target
+            key = (round(span, 3), -abs((start + end) / 2 - target))
+            if best is None or key > best[0]:
+                best = (key, (max(start, low) + min(end, high)) / 2)
+        cuts.append(best[1] if best is not None else target)
+    cuts.append(duration)
+    return [
+        Chunk(index, max(0.0, start - overlap), min(duration, end + overlap), start, end)
+        for index, (start, end) in enumerate(zip(cuts, cuts[1:]))
+    ]
+
+
+def _normalize(word: str) -> str:
+    return re.sub(r"[^\w']+", "", word.lower())
+
+
+def timed_words(text: str, words: List[Tuple[str, float, float]]) -> List[TimedWord]:
+    """The transcript's words with the timestamps of the ones Whisper timed
+
+    Whisper times words without their punctuation; matching them back onto
+    the transcript keeps it. A word left unmatched takes the end of the one
+    before it.
+    """
+    tokens = text.split()
+    matcher = difflib.SequenceMatcher(
+        None, [_normalize(token) for token in tokens], [_normalize(word) for word, _, _ in words], autojunk=False
+    )
+    times: List[Optional[Tuple[float, float]]] = [None] * len(tokens)
+    for block in matcher.get_matching_blocks():
+        for offset in range(block.size):
+            _, start, end = words[block.b + offset]
+            times[block.a + offset] = (start, end)
+    if not any(times):
+        # Nothing to go on: the words as Whisper timed them
+        return [TimedWord(word.strip(), start, end) for word, start, end in words if word.strip()]
+    timed, last = [], next(time for time in times if time is not None)
+    for token, time_span in zip(tokens, times):
+        if time_span is None:
+            time_span = (last[1], last[1])
+        timed.append(TimedWord(token, *time_span))
+        last = time_span
+    return timed
+
+
+def words_between(words: List[TimedWord], offset: float, start: float, end: float) -> List[str]:
+    """Words of a chunk that began at ``offset`` whose middle lies in [start, end) of the recording"""
+    return [word.text for word in words if start <= offset + (word.start + word.end) / 2 < end]
+
+
+def stitch(left: str, right: str, overlap: float = TRANSCRIBE_OVERLAP_SECONDS, words_per_second: float = 3.0) -> str:
+    """Join two neighbouring transcripts, dropping words both chunks heard in the overlap
+
+    For chunks transcribed without timestamps. Speech both chunks heard ends
+    ``left`` and starts ``right``, so only a run of words in that position
+    counts, one word of slack at either end for a word the cut garbled; a
+    run elsewhere is the reader repeating themselves. The run is at most
+    what the ``2 * overlap`` seconds both chunks share hold at a brisk
+    reading pace, and at least two words, or one of five letters or more.
+    Without such a run both transcripts are kept whole: a repeated word
+    reads better than a lost one.
+    """
+    left_words, right_words = left.split(), right.split()
+    if not left_words or not right_words:
+        return " ".join(left_words + right_words)
+    longest = max(2, math.ceil(2 * overlap * words_per_second))
+    slack = 1
+    tail = [_normalize(word) for word in left_words[-(longest + slack):]]
+    head = [_normalize(word) for word in right_words[:longest + slack]]
+
+    best: Optional[Tuple[int, int, int]] = None  # (size, start in tail, start in head)
+    for b in range(min(slack + 1, len(head))):
+        for a in range(len(tail)):
+            size = 0
+            while a + size < len(tail) and b + size < len(head) and tail[a + size] == head[b + size]:
+                size += 1
+            # The run must reach the end of the left transcript, give or take the slack
+            if size and len(tail) - (a + size) <= slack and size <= longest and (best is None or size > best[0]):
+                best = (size, a, b)
+    if best is None:
+        return " ".join(left_words + right_words)
+    size, a, b = best
+    if size >= 2 or len(tail[a]) >= 5:
+        kept = left_words[:len(left_words) - len(tail) + a]
+        return " ".join(kept + right_words[b:])
+    return " ".join(left_words + right_words)
+
+
+class TranscriptionStats:
+    """Per-worker counts of transcriptions by mode and of chunk outcomes, for /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = dict.fromkeys(("single", "chunked"), 0)
+        self.partial = 0
+        self.chunks = 0
+        self.failed_chunks = 0
+        self.retries = 0
+        self.audio_seconds = 0.0
+        self.chunk_seconds = 0.0
+        self.wall_seconds = 0.0
+
+    def record(self, mode: str, audio_seconds: float, wall_seconds: float, chunks: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self.requests[mode] += 1
+            self.audio_seconds += audio_seconds
+            self.wall_seconds += wall_seconds
+            if mode == "chunked":
+                self.chunks += len(chunks)
+                self.failed_chunks += sum(1 for chunk in chunks if chunk["status"] != "ok")
+                self.partial += int(any(chunk["status"] != "ok" for chunk in chunks))
+                self.retries += sum(chunk["attempts"] - 1 for chunk in chunks)
+                self.chunk_seconds += sum(chunk["transcribe_s"] for chunk in chunks)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": dict(self.requests),
+                "partial": self.partial,
+                "chunks": self.chunks,
+                "failed_chunks": self.failed_chunks,
+                "retries": self.retries,
+                "audio_seconds": round(self.audio_seconds, 1),
+                "wall_seconds": round(self.wall_seconds, 3),
+                # Summed chunk time over wall time of the requests: how much the overlap of calls saved
+                "chunk_seconds": round(self.chunk_seconds, 3)
+            }
+
+
+class ChunkedTranscriber:
+    """Transcribes uploads through ``transcribe(audio, filename, mime)``, chunking long ones
+
+    Chunks go through ``transcribe_timed`` when given, and are joined by
+    word time; otherwise through ``transcribe``, joined by stitch().
+    """
+
+    def __init__(
+        self,
+        transcribe: Transcribe,
+        transcribe_timed: Optional[TranscribeTimed] = None,
+        concurrency: int = TRANSCRIBE_CONCURRENCY,
+        long_audio_seconds: float = LONG_AUDIO_SECONDS,
+        chunk_seconds: float = TRANSCRIBE_CHUNK_SECONDS,
+        overlap: float = TRANSCRIBE_OVERLAP_SECONDS
+    ):
+        self.transcribe = transcribe
+        self.transcribe_timed = transcribe_timed
+        # Shared by every request on this worker, so one long upload cannot take all upstream threads
+        self.semaphore = asyncio.Semaphore(max(1, concurrency))
+        self.long_audio_seconds = long_audio_seconds
+        self.chunk_seconds = chunk_seconds
+        self.overlap = overlap
+        self.concurrency = max(1, concurrency)
+        self.stats = TranscriptionStats()
+
+    async def run(self, data: bytes, filename: str = "audio.wav", mime: str = "audio/wav", mode: str = "auto") -> Dict[str, Any]:
+        """Text of an upload plus how it was produced
+
+        Returns ``text``, ``mode`` ("single" or "chunked"), ``duration_s``
+        (None when the format is unknown), ``chunks`` (per-chunk timings,
+        empty for a single call) and ``partial``.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown transcription mode: {mode}")
+        started = time.perf_counter()
+        kind = detect_format(data)
+        if kind is not None:
+            filename, mime = FORMATS[kind]
+        audio: Optional[SlicedAudio] = None
+        # Only decode (or convert) what may need cutting: the estimate is cheap
+        if mode == "chunked" or len(data) > MAX_UPLOAD_BYTES or (
+            mode == "auto" and await asyncio.to_thread(audio_seconds, data) > self.long_audio_seconds
+        ):
+            audio = await asyncio.to_thread(load_audio, data)
+        chunked = audio is not None and (
+            mode == "chunked"
+            or len(data) > MAX_UPLOAD_BYTES
+            or audio.duration > self.long_audio_seconds
+        )
+
+        if not chunked:
+            async with self.semaphore:
+                text = (await asyncio.to_thread(self.transcribe, data, filename, mime)).strip()
+            duration = audio.duration if audio is not None else None
+            self.stats.record("single", duration or 0.0, time.perf_counter() - started, [])
+            return {"text": text, "mode": "single", "duration_s": _round(duration), "chunks": [], "partial": False}
+
+        chunk_seconds = self.chunk_seconds
+        if audio.bytes_per_second:
+            # Keep every chunk under the upload limit: a cut may land up to the search
+            # window late, the last chunk may run 25% long, and both ends overlap
+            room = MAX_UPLOAD_BYTES / audio.bytes_per_second - 2 * self.overlap
+            limit = min(room - TRANSCRIBE_SEARCH_SECONDS, room / 1.25)
+            chunk_seconds = max(10.0, min(chunk_seconds, limit))
+        pauses = await asyncio.to_thread(_find_pauses, audio)
+        chunks = plan_chunks(audio.duration, pauses, chunk_seconds, self.overlap)
+        reports = await asyncio.gather(*(self._transcribe_chunk(audio, chunk) for chunk in chunks))
+
+        text = ""
+        ok = [report["status"] == "ok" for report in reports]
+        for chunk, report in zip(chunks, reports):
+            chunk_text, timed = report.pop("text"), report.pop("timed")
+            if not ok[chunk.index]:
+                continue
+            if timed is not None:
+                # Next to a failed chunk, the overlap is all there is of that speech
+                start = chunk.cut_start if chunk.index == 0 or ok[chunk.index - 1] else chunk.start
+                end = chunk.cut_end if chunk.index == len(chunks) - 1 or ok[chunk.index + 1] else chunk.end
+                text = " ".join([text, *words_between(timed, chunk.start, start, end)]).strip()
+            else:
+                text = stitch(text, chunk_text, self.overlap)
+        partial = not all(ok)
+        if not any(ok):
+            raise RuntimeError(f"All {len(reports)} chunks failed: {reports[0]['error']}")
+        wall = time.perf_counter() - started
+        self.stats.record("chunked", audio.duration, wall, reports)
+        logger.info(
+            f"Transcribed {audio.duration:.0f}s of {audio.format} in {len(chunks)} chunks, "
+            f"{wall:.1f}s wall, {sum(report['transcribe_s'] for report in reports):.1f}s of calls"
+        )
+        return {"text": text, "mode": "chunked", "duration_s": _round(audio.duration), "chunks": reports, "partial": partial}
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats.get_stats(),
+            "concurrency": self.concurrency,
+            "long_audio_seconds": self.long_audio_seconds,
+            "chunk_target_seconds": self.chunk_seconds
+        }
+
+    async def _transcribe_chunk(self, audio: SlicedAudio, chunk: Chunk) -> Dict[str, Any]:
+        filename, mime = FORMATS[audio.format]
+        piece = await asyncio.to_thread(audio.slice, chunk.start, chunk.end)
+        report: Dict[str, Any] = {
+            "index": chunk.index,
+            "start_s": round(chunk.start, 3),
+            "end_s": round(chunk.end, 3),
+            "bytes": len(piece),
+            "queued_s": 0.0,
+            "transcribe_s": 0.0,
+            "attempts": 0,
+            "status": "ok",
+            "words": 0,
+            "text": "",
+            "timed": None
+        }
+        queued = time.perf_counter()
+        with tracing.span("stt.chunk", index=chunk.index, start_s=report["start_s"], end_s=report["end_s"]) as span:
+            async with self.semaphore:
+                report["queued_s"] = round(time.perf_counter() - queued, 3)
+                started = time.perf_counter()
+                while True:
+                    report["attempts"] += 1
+                    try:
+                        if self.transcribe_timed is not None:
+                            text, words = await asyncio.to_thread(self.transcribe_timed, piece, filename, mime)
+                            report["text"] = text.strip()
+                            report["timed"] = timed_words(report["text"], words)
+                        else:
+                            report["text"] = (await asyncio.to_thread(self.transcribe, piece, filename, mime)).strip()
+                        break
+                    except Exception as e:
+                        if report["attempts"] >= TRANSCRIBE_ATTEMPTS:
+                            logger.error(f"Chunk {chunk.index} ({chunk.start:.1f}-{chunk.end:.1f}s) failed: {e}")
+                            report["status"] = "failed"
+                            report["error"] = str(e)
+                            span.record_error(e)
+                            break
+                        logger.warning(f"Chunk {chunk.index} failed (attempt {report['attempts']}), retrying: {e}")
+                        await asyncio.sleep(0.5)
+                report["transcribe_s"] = round(time.perf_counter() - started, 3)
+            span.update({"queued_s": report["queued_s"], "attempts": report["attempts"]})
+        report["words"] = len(report["text"].split())
+        return report
+
+
+def _find_pauses(audio: SlicedAudio) -> List[Tuple[float, float]]:
+    envelope, hop = audio.envelope()
+    voiced = detect_voicing(envelope, hop) if envelope else None
+    return _pause_runs(voiced, hop) if voiced else []
+
+
+def _round(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds, 3) if seconds is not None else None
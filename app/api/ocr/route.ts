@@ -1,4 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
+import { traceHeaders } from '@/lib/tracing';
+import { identityHeaders, readerFor, rememberReader } from '@/lib/service-identity';
 
 const OCR_SERVICE_URL = process.env.OCR_SERVICE_URL || 'http://localhost:8000';
 
@@ -35,15 +37,19 @@ export async function POST(request: NextRequest) {
 
     console.log(`🔄 Forwarding PDF to OCR service: ${file.name} (${file.size} bytes)`);
 
-    // Forward to OCR microservice
+    // Forward to OCR microservice, for this reader: the service keeps
+    // stored pages and search results per caller
+    const reader = readerFor(request);
     const ocrResponse = await fetch(`${OCR_SERVICE_URL}/ocr`, {
       method: 'POST',
+      headers: { ...traceHeaders(request), ...(await identityHeaders(reader)) },
       body: ocrFormData,
     });
+    const traceId = ocrResponse.headers.get('x-trace-id');
 
     if (!ocrResponse.ok) {
       const errorText = await ocrResponse.text();
-      console.error(`❌ OCR service error: ${ocrResponse.status} - ${errorText}`);
+      console.error(`❌ OCR service error: ${ocrResponse.status} - ${errorText} (trace ${traceId})`);
       
       return NextResponse.json(
         { 
@@ -59,7 +65,7 @@ export async function POST(request: NextRequest) {
     console.log(`✅ OCR completed: ${ocrResult.processing_info.text_length} characters extracted`);
 
     // Return the OCR result
-    return NextResponse.json({
+    return rememberReader(NextResponse.json({
       success: true,
       data: ocrResult,
       processing_info: {
@@ -67,9 +73,10 @@ export async function POST(request: NextRequest) {
         service: 'OCRmyPDF',
         language: language,
         optimization: optimize,
-        force_ocr: forceOcr
+        force_ocr: forceOcr,
+        trace_id: traceId
       }
-    });
+    }), reader);
 
   } catch (error) {
     console.error('❌ OCR proxy error:', error);
@@ -0,0 +1,91 @@
+/**
+ * Who a call from the Next.js API routes to the Python services is made for.
+ *
+ * The OCR service keeps stored pages and search results per caller, and the
+ * voice server keeps quotas and history per caller. Without an identity,
+ * every request the app forwards would look like one caller: the Next.js
+ * server's address.
+ *
+ * Each browser gets a random reader id in an httpOnly cookie. It is sent as an
+ * identity token signed with `IDENTITY_SECRET`, the same secret the services
+ * verify with (caller_identity.py). Without a secret it is sent as
+ * `X-Session-ID`, which the services only honour when this server's address is
+ * in their `TRUSTED_PROXIES`.
+ */
+
+import type { NextRequest, NextResponse } from 'next/server';
+
+const IDENTITY_SECRET = process.env.IDENTITY_SECRET ?? '';
+const IDENTITY_TENANT = process.env.IDENTITY_TENANT || 'default';
+const IDENTITY_TOKEN_TTL = Number(process.env.IDENTITY_TOKEN_TTL ?? '300');
+
+const READER_COOKIE = 'reader_id';
+const READER_ID = /^[0-9a-f]{32}$/;
+
+export interface Reader {
+  id: string;
+  // Set when the browser had no reader id yet; rememberReader() stores it
+  isNew: boolean;
+}
+
+function base64url(bytes: Uint8Array): string {
+  let binary = '';
+  bytes.forEach((byte) => {
+    binary += String.fromCharCode(byte);
+  });
+  return btoa(binary).replace(/\+/g, '-').replace(/\//g, '_').replace(/=+$/, '');
+}
+
+/**
+ * A token in caller_identity.sign_identity()'s format:
+ * base64url(JSON claims) + '.' + base64url(HMAC-SHA256 of that).
+ */
+async function signIdentity(claims: Record<string, string>): Promise<string> {
+  const encoder = new TextEncoder();
+  const payload = base64url(
+    encoder.encode(JSON.stringify({ ...claims, exp: Math.floor(Date.now() / 1000) + IDENTITY_TOKEN_TTL }))
+  );
+  const key = await crypto.subtle.importKey(
+    'raw',
+    encoder.encode(IDENTITY_SECRET),
+    { name: 'HMAC', hash: 'SHA-256' },
+    false,
+    ['sign']
+  );
+  const signature = await crypto.subtle.sign('HMAC', key, encoder.encode(payload));
+  return `${payload}.${base64url(new Uint8Array(signature))}`;
+}
+
+/** This browser's reader id, or a new one */
+export function readerFor(request: NextRequest): Reader {
+  const existing = request.cookies.get(READER_COOKIE)?.value;
+  if (existing && READER_ID.test(existing)) {
+    return { id: existing, isNew: false };
+  }
+  return { id: crypto.randomUUID().replace(/-/g, ''), isNew: true };
+}
+
+/** Keep a new reader id in the browser */
+export function rememberReader(response: NextResponse, reader: Reader): NextResponse {
+  if (reader.isNew) {
+    response.cookies.set({
+      name: READER_COOKIE,
+      value: reader.id,
+      httpOnly: true,
+      sameSite: 'lax',
+      path: '/',
+      secure: process.env.NODE_ENV === 'production',
+      maxAge: 60 * 60 * 24 * 365,
+    });
+  }
+  return response;
+}
+
+/** Headers naming the reader to a service */
+export async function identityHeaders(reader: Reader): Promise<Record<string, string>> {
+  if (IDENTITY_SECRET) {
+    const token = await signIdentity({ tenant: IDENTITY_TENANT, session: reader.id });
+    return { Authorization: `Bearer ${token}` };
+  }
+  return { 'X-Tenant-ID': IDENTITY_TENANT, 'X-Session-ID': reader.id };
+}
@@ -0,0 +1,34 @@
+/**
+ * W3C Trace Context for calls from the Next.js API routes to the Python services.
+ *
+ * The OCR service and the voice server continue the trace named in the
+ * `traceparent` header and answer with its id in `X-Trace-Id`, so one id
+ * ties a slow read-along to the OCR, chat and TTS spans behind it.
+ */
+
+const TRACEPARENT = /^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$/;
+
+// Share of new traces the services record; a caller's decision is kept
+const TRACE_SAMPLE_RATE = Number(process.env.TRACE_SAMPLE_RATE ?? '0.1');
+
+function randomHex(bytes: number): string {
+  const values = new Uint8Array(bytes);
+  crypto.getRandomValues(values);
+  return Array.from(values, (value) => value.toString(16).padStart(2, '0')).join('');
+}
+
+/**
+ * Headers for an outgoing call to a service.
+ *
+ * Continues the browser's trace if the request carried a valid `traceparent`,
+ * otherwise starts a new one and makes the sampling decision for it.
+ */
+export function traceHeaders(request?: Request): Record<string, string> {
+  const incoming = request?.headers.get('traceparent')?.trim().toLowerCase();
+  const match = incoming ? TRACEPARENT.exec(incoming) : null;
+  if (match && !/^0+$/.test(match[1]) && !/^0+$/.test(match[2])) {
+    return { traceparent: incoming as string };
+  }
+  const sampled = Math.random() < TRACE_SAMPLE_RATE;
+  return { traceparent: `00-${randomHex(16)}-${randomHex(8)}-${sampled ? '01' : '00'}` };
+}
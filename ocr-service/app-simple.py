@@ -1,19 +1,39 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi import Request, Response
 import tempfile
 import os
+import sys
 import uuid
 import logging
 from pathlib import Path
 from typing import Optional
 import json
 from datetime import datetime
+import asyncio
+import io
 import subprocess
 import shutil
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from service_common.artifact_serving import ArtifactResponse, stats as serving_stats
+from artifacts import create_artifact_store
+from service_common.caller_identity import Caller, InvalidIdentity, identify_caller
+from service_common.readiness import ReadinessTracker, require_binary
+from postprocess import prepare
+from page_dedupe import OwnerPages, create_page_store, fingerprint_image
+from rendering import PageOCRPool, resolve_backend
+from search_index import InvalidQuery, create_search_index
+from supervisor import (
+    OCR_PAGE_TIMEOUT, RETRY_DPI, RETRY_PSM, Deadline, OCRCounters, OCRTimeout,
+    counters, failed_page_text, is_failed_page, ocr_with_retry, run_tesseract
+)
+from service_common.structured_logging import configure_logging
+from timing import StageTimer
+from service_common import tracing
+
+# Configure logging: JSON lines written off the event loop, probes sampled
+log_pipeline = configure_logging("ocr-service")
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
@@ -31,11 +51,70 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Spans per request and pipeline stage, continuing the caller's trace from its
+# traceparent header; added last, so it sees every request first
+tracer = tracing.create_tracer("ocr-service-simple")
+app.add_middleware(tracing.TraceMiddleware, tracer=tracer)
+
+# "pymupdf" renders pages in memory and OCRs them on a worker pool through
+# shared memory; "subprocess" writes PNGs with pdftoppm for the tesseract CLI
+render_backend = resolve_backend()
+ocr_pool = PageOCRPool() if render_backend == "pymupdf" else None
+
+# Ready once the external tools every job shells out to are installed
+readiness = ReadinessTracker()
+binaries = ("tesseract", "pdftotext") if render_backend == "pymupdf" else ("pdftoppm", "tesseract", "pdftotext")
+for binary in binaries:
+    readiness.register(binary, lambda binary=binary: require_binary(binary))
+
+# Page text of completed jobs, searchable through /search
+search_index = create_search_index()
+# OCR text of pages seen before, reused for repeated cover pages and worksheets
+page_store = create_page_store()
+# Processed PDFs for /download, served with Range and conditional GET support
+artifact_store = create_artifact_store()
+
+@app.on_event("startup")
+async def startup_event():
+    readiness.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await readiness.stop()
+    if ocr_pool is not None:
+        await asyncio.to_thread(ocr_pool.shutdown)
+    if search_index is not None:
+        await asyncio.to_thread(search_index.close)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
+@app.get("/metrics")
+async def metrics():
+    """OCR supervision counters, render pool and search index statistics"""
+    return {
+        "ocr": counters.get_stats(),
+        "render": {"backend": render_backend, **(ocr_pool.get_stats() if ocr_pool is not None else {})},
+        "search": await asyncio.to_thread(search_index.get_stats) if search_index is not None else None,
+        "dedupe": await asyncio.to_thread(page_store.get_stats) if page_store is not None else None,
+        "artifacts": {
+            "store": artifact_store.get_stats() if artifact_store is not None else None,
+            "serving": serving_stats.get_stats()
+        },
+        "tracing": tracer.get_stats(),
+        "logging": log_pipeline.get_stats()
+    }
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """Readiness endpoint; 503 until the OCR tools are available"""
+    report = readiness.report()
+    if not report["ready"]:
+        response.status_code = 503
+    return report
+
 @app.get("/languages")
 async def get_supported_languages():
     """Get supported OCR languages"""
@@ -54,12 +133,21 @@ async def get_supported_languages():
     ]
     return {"languages": languages}
 
+def request_caller(request: Request) -> Caller:
+    """Who a request is from; identity headers count only from trusted proxies"""
+    try:
+        return identify_caller(request.headers, request.client.host if request.client else None)
+    except InvalidIdentity as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
 @app.post("/ocr")
 async def process_pdf(
+    request: Request,
     file: UploadFile = File(...),
     language: str = "eng",
     optimize: bool = True,
-    force_ocr: bool = False
+    force_ocr: bool = False,
+    postprocess: bool = True
 ):
     """Process PDF with OCR using Tesseract"""
     
@@ -69,6 +157,15 @@ async def process_pdf(
     
     # Generate unique ID for this job
     job_id = str(uuid.uuid4())
+    request_span = tracer.current()
+    if request_span is not None:
+        # Lets the trace be found from the job id the client gets back
+        request_span.update({"job_id": job_id, "language": language, "bytes": file.size})
+    timer = StageTimer()
+    deadline = Deadline()
+    stats = OCRCounters()
+    # Pages are only ever reused for whoever had them read
+    caller = request_caller(request)
     
     try:
         # Create temporary directory for processing
@@ -78,45 +175,34 @@ async def process_pdf(
             output_dir.mkdir(exist_ok=True)
             
             # Save uploaded file
-            with open(input_path, "wb") as buffer:
+            with timer.stage("upload"), open(input_path, "wb") as buffer:
                 content = await file.read()
                 buffer.write(content)
             
-            logger.info(f"Processing PDF: {file.filename}, Size: {len(content)} bytes")
+            logger.info("Processing PDF: %s, Size: %d bytes", file.filename, len(content), extra={"route": "ocr", "job_id": job_id})
             
-            # Convert PDF to images using pdftoppm (poppler-utils)
-            try:
-                # Convert PDF pages to PNG images
-                cmd = [
-                    "pdftoppm", "-png", "-r", "300",
-                    str(input_path), str(output_dir / "page")
-                ]
-                result = subprocess.run(cmd, capture_output=True, text=True, cwd=temp_dir)
-                
-                if result.returncode != 0:
-                    logger.warning(f"PDF to image conversion failed: {result.stderr}")
-                    # Fallback: try to extract text directly
-                    text_content = extract_text_direct(input_path)
-                else:
-                    # Get list of generated images
-                    image_files = sorted(output_dir.glob("page-*.png"))
-                    if not image_files:
-                        raise Exception("No images generated from PDF")
-                    
-                    # Process each image with Tesseract
-                    text_content = ""
-                    for i, img_file in enumerate(image_files):
-                        page_text = process_image_with_tesseract(img_file, language)
-                        text_content += f"\n--- Page {i+1} ---\n{page_text}\n"
-                    
-                    # Clean up images
-                    for img_file in image_files:
-                        img_file.unlink()
-                
-            except Exception as e:
-                logger.warning(f"Image processing failed: {str(e)}")
-                # Fallback: try to extract text directly
-                text_content = extract_text_direct(input_path)
+            # force_ocr reads every page again instead of reusing earlier results
+            pages = page_store.for_owner(caller.owner, caller.verified) if page_store is not None and not force_ocr else None
+            if ocr_pool is not None:
+                text_content = await ocr_in_memory(content, input_path, language, timer, deadline, stats, pages)
+            else:
+                text_content = ocr_with_subprocess(input_path, output_dir, language, timer, temp_dir, deadline, stats, pages)
+            counters.merge(stats)
+            supervision = stats.get_stats()
+            
+            # Text extraction leaves the PDF as it was; keep the upload for /download
+            artifact_path = None
+            if artifact_store is not None:
+                with timer.stage("store"):
+                    artifact_path = await asyncio.to_thread(artifact_store.put, job_id, input_path)
+            
+            # Reflowed, sentence- and syllable-split text for the reader, worked out once per document
+            reading = None
+            if postprocess:
+                with timer.stage("postprocess"):
+                    reading = await asyncio.to_thread(prepare, text_content, language)
+                if artifact_store is not None:
+                    await asyncio.to_thread(artifact_store.put_reading, job_id, reading)
             
             # Calculate processing metrics
             processing_info = {
@@ -128,51 +214,195 @@ async def process_pdf(
                 "force_ocr": force_ocr,
                 "text_length": len(text_content),
                 "processing_time": "completed",
-                "status": "success",
-                "method": "tesseract"
+                "timings": timer.as_dict(),
+                "status": "partial" if supervision["failed_pages"] else "success",
+                "supervision": supervision,
+                "reused_pages": supervision["reused"],
+                "method": "tesseract",
+                "render_backend": render_backend
             }
             
-            logger.info(f"OCR completed successfully: {job_id}")
+            logger.info("OCR completed successfully: %s", job_id, extra={"route": "ocr", "job_id": job_id})
+            if search_index is not None:
+                search_index.add(job_id, caller.owner, file.filename, language, text_content)
             
             return {
                 "success": True,
                 "job_id": job_id,
                 "text": text_content,
+                "reading": reading,
                 "processing_info": processing_info,
-                "download_url": f"/download/{job_id}"
+                "download_url": f"/download/{job_id}" if artifact_path is not None else None
             }
             
     except Exception as e:
         logger.error(f"OCR processing failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
 
+@app.get("/search")
+async def search_documents(
+    request: Request,
+    q: str,
+    limit: int = 20,
+    language: Optional[str] = None,
+    job_id: Optional[str] = None,
+    order: str = "auto"
+):
+    """Search the text of the caller's processed documents; returns matching pages with offsets"""
+    if search_index is None:
+        raise HTTPException(status_code=503, detail="Search index is disabled")
+    caller = request_caller(request)
+    try:
+        return await asyncio.to_thread(search_index.search, q, caller.owner, limit, language, job_id, order)
+    except InvalidQuery as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/download/{job_id}")
 async def download_processed_pdf(job_id: str):
-    """Download processed PDF (placeholder for file storage)"""
-    return {"message": "Download endpoint - implement file storage"}
+    """Download processed PDF; supports Range requests and conditional GETs"""
+    if artifact_store is None:
+        raise HTTPException(status_code=503, detail="Downloads are disabled")
+    path = await asyncio.to_thread(artifact_store.get, job_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="No processed PDF for this job")
+    # A job's PDF never changes once stored
+    return ArtifactResponse(
+        path,
+        "application/pdf",
+        headers={"Cache-Control": "private, max-age=86400, immutable"},
+        etag=job_id,
+        filename=f"{job_id}.pdf"
+    )
+
+@app.get("/download/{job_id}/reading")
+async def download_reading_text(job_id: str):
+    """Post-processed reading text of a job, as returned by /ocr"""
+    if artifact_store is None:
+        raise HTTPException(status_code=503, detail="Downloads are disabled")
+    path = await asyncio.to_thread(artifact_store.get, job_id, ".reading.json")
+    if path is None:
+        raise HTTPException(status_code=404, detail="No reading text for this job")
+    return ArtifactResponse(path, "application/json", headers={"Cache-Control": "private, max-age=86400, immutable"})
+
+async def ocr_in_memory(
+    content: bytes, input_path: Path, language: str, timer: StageTimer, deadline: Deadline, stats: OCRCounters,
+    pages: Optional[OwnerPages]
+) -> str:
+    """Render pages with PyMuPDF and OCR them on the worker pool; no image files"""
+    try:
+        page_texts, stage_seconds = await asyncio.to_thread(ocr_pool.ocr_pdf, content, language, deadline, stats, pages)
+    except Exception as e:
+        logger.warning(f"In-memory OCR failed: {str(e)}")
+        # Fallback: try to extract text directly
+        with timer.stage("text_extraction"):
+            return extract_text_direct(input_path, deadline.page_timeout())
+    
+    for stage, seconds in stage_seconds.items():
+        timer.add(stage, seconds)
+    return "".join(f"\n--- Page {i+1} ---\n{page_text}\n" for i, page_text in enumerate(page_texts))
 
-def process_image_with_tesseract(image_path: Path, language: str) -> str:
-    """Process image with Tesseract OCR"""
+def ocr_with_subprocess(
+    input_path: Path, output_dir: Path, language: str, timer: StageTimer, temp_dir: str,
+    deadline: Deadline, stats: OCRCounters, pages: Optional[OwnerPages]
+) -> str:
+    """Convert pages to PNGs with pdftoppm, then OCR each file with the tesseract CLI"""
     try:
-        cmd = ["tesseract", str(image_path), "stdout", "-l", language, "--psm", "6"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # Convert PDF pages to PNG images
+        cmd = [
+            "pdftoppm", "-png", "-r", "300",
+            str(input_path), str(output_dir / "page")
+        ]
+        with timer.stage("rasterize"):
+            try:
+                result = subprocess.run(cmd, capture_output=True, text=True, cwd=temp_dir, timeout=deadline.remaining())
+            except subprocess.TimeoutExpired:
+                stats.incr("job_timeouts")
+                raise OCRTimeout("pdftoppm ran past the job deadline")
         
         if result.returncode != 0:
-            logger.warning(f"Tesseract failed: {result.stderr}")
-            return f"OCR failed for {image_path.name}"
+            logger.warning(f"PDF to image conversion failed: {result.stderr}")
+            # Fallback: try to extract text directly
+            with timer.stage("text_extraction"):
+                return extract_text_direct(input_path)
+        
+        # Get list of generated images
+        image_files = sorted(output_dir.glob("page-*.png"))
+        if not image_files:
+            raise Exception("No images generated from PDF")
         
-        return result.stdout.strip()
+        # Process each image with Tesseract, unless the page was read before
+        text_content = ""
+        fresh = []
+        for i, img_file in enumerate(image_files):
+            if deadline.expired:
+                stats.incr("job_timeouts")
+                stats.incr("failed_pages", len(image_files) - i)
+                for page in range(i + 1, len(image_files) + 1):
+                    text_content += f"\n--- Page {page} ---\n{failed_page_text(page, 'job deadline')}\n"
+                break
+            page_fingerprint = None
+            if pages is not None:
+                with timer.stage("dedupe"):
+                    page_fingerprint = fingerprint_image(img_file)
+                    page_text = pages.lookup(page_fingerprint, language)
+                if page_text is not None:
+                    stats.incr("reused")
+                    text_content += f"\n--- Page {i+1} ---\n{page_text}\n"
+                    continue
+            with timer.stage("ocr"), tracing.span("ocr.page", page=i + 1, language=language) as page_span:
+                page_text = ocr_with_retry(
+                    i + 1,
+                    lambda timeout: process_image_with_tesseract(img_file, language, timeout),
+                    lambda timeout: process_image_with_tesseract(img_file, language, timeout, psm=RETRY_PSM, dpi=RETRY_DPI),
+                    deadline,
+                    stats
+                )
+                if is_failed_page(page_text):
+                    page_span.record_error(page_text.strip())
+            if page_fingerprint is not None and not is_failed_page(page_text):
+                fresh.append((page_fingerprint, page_text))
+            text_content += f"\n--- Page {i+1} ---\n{page_text}\n"
+        if fresh:
+            with timer.stage("dedupe"):
+                pages.store(fresh, language)
+        
+        # Clean up images
+        for img_file in image_files:
+            img_file.unlink()
+        return text_content
         
     except Exception as e:
-        logger.warning(f"Tesseract processing failed: {str(e)}")
-        return f"OCR error: {str(e)}"
+        logger.warning(f"Image processing failed: {str(e)}")
+        # Fallback: try to extract text directly
+        with timer.stage("text_extraction"):
+            return extract_text_direct(input_path, deadline.page_timeout())
+
+def process_image_with_tesseract(
+    image_path: Path, language: str, timeout: Optional[float] = None, psm: str = "6", dpi: Optional[int] = None
+) -> str:
+    """Process image with Tesseract OCR; ``dpi`` downsamples the 300 DPI page first
+
+    Raises OCRTimeout past ``timeout`` (tesseract is killed) and RuntimeError on failure.
+    """
+    args = ["stdout", "-l", language, "--psm", psm]
+    if dpi is None:
+        return run_tesseract([str(image_path), *args], timeout)
+    
+    from PIL import Image
+    
+    with Image.open(image_path) as image:
+        scale = dpi / 300
+        smaller = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+    buffer = io.BytesIO()
+    smaller.save(buffer, format="PNG")
+    return run_tesseract(["stdin", *args, "--dpi", str(dpi)], timeout, buffer.getvalue())
 
-def extract_text_direct(pdf_path: Path) -> str:
+def extract_text_direct(pdf_path: Path, timeout: float = OCR_PAGE_TIMEOUT) -> str:
     """Extract text directly from PDF if possible"""
     try:
         # Try using pdftotext (poppler-utils)
         cmd = ["pdftotext", str(pdf_path), "-"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
         
         if result.returncode == 0 and result.stdout.strip():
             return result.stdout.strip()
@@ -185,5 +415,10 @@ def extract_text_direct(pdf_path: Path) -> str:
         return f"Text extraction failed: {str(e)}"
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Serve through uvicorn's import of this module instead: OCR worker processes
+    # import the script that started the service again, and with it every store,
+    # thread and the app set up above, but never uvicorn's entry point
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "--app-dir", str(Path(__file__).resolve().parent),
+        "app-simple:app", "--host", "0.0.0.0", "--port", "8000"
+    ])
@@ -1,18 +1,36 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-import ocrmypdf
+from fastapi import Request, Response
+import asyncio
+import importlib
 import tempfile
 import os
+import sys
 import uuid
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 import json
 from datetime import datetime
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from service_common.artifact_serving import ArtifactResponse, stats as serving_stats
+from artifacts import create_artifact_store
+from service_common.caller_identity import Caller, InvalidIdentity, identify_caller
+from postprocess import prepare
+from service_common.readiness import ReadinessTracker, require_binary
+from page_dedupe import OwnerPages, PageFingerprint, create_page_store, fingerprint_samples
+from search_index import InvalidQuery, create_search_index, split_pages
+from supervisor import (
+    FIRST_ATTEMPT_SHARE, OCR_PAGE_TIMEOUT, RETRY_PSM, Deadline, OCRCounters, OCRCrashed, OCRTimeout,
+    counters, ocrmypdf_job, preload, run_supervised
+)
+from service_common.structured_logging import configure_logging
+from timing import StageTimer
+from service_common import tracing
+
+# Configure logging: JSON lines written off the event loop, probes sampled
+log_pipeline = configure_logging("ocr-service")
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
@@ -30,14 +48,72 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Spans per request and pipeline stage, continuing the caller's trace from its
+# traceparent header; added last, so it sees every request first
+tracer = tracing.create_tracer("ocr-service")
+app.add_middleware(tracing.TraceMiddleware, tracer=tracer)
+
 # OCR processing queue
 ocr_queue = {}
 
+# OCRmyPDF and PyMuPDF take most of the import time; they are loaded after the
+# port is bound and /ready turns 200 once they (and tesseract) are available
+readiness = ReadinessTracker()
+readiness.register("ocrmypdf", lambda: importlib.import_module("ocrmypdf"))
+readiness.register("pymupdf", lambda: importlib.import_module("fitz"))
+readiness.register("tesseract", lambda: require_binary("tesseract"))
+
+# OCRmyPDF runs in a killable child process forked from a server that has it imported
+preload(["ocrmypdf"])
+
+# Page text of completed jobs, searchable through /search
+search_index = create_search_index()
+# OCR text of pages seen before; OCRmyPDF works on whole documents, so it is
+# skipped only when every page of an upload is known
+page_store = create_page_store()
+# Processed PDFs for /download, served with Range and conditional GET support
+artifact_store = create_artifact_store()
+# Pages are fingerprinted from a small render of the upload
+DEDUPE_DPI = 72
+
+@app.on_event("startup")
+async def startup_event():
+    readiness.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await readiness.stop()
+    if search_index is not None:
+        await asyncio.to_thread(search_index.close)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": datetime.utcnow().isoformat()}
 
+@app.get("/metrics")
+async def metrics():
+    """OCR supervision counters and search index statistics"""
+    return {
+        "ocr": counters.get_stats(),
+        "search": await asyncio.to_thread(search_index.get_stats) if search_index is not None else None,
+        "dedupe": await asyncio.to_thread(page_store.get_stats) if page_store is not None else None,
+        "artifacts": {
+            "store": artifact_store.get_stats() if artifact_store is not None else None,
+            "serving": serving_stats.get_stats()
+        },
+        "tracing": tracer.get_stats(),
+        "logging": log_pipeline.get_stats()
+    }
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """Readiness endpoint; 503 until the OCR engine is loaded"""
+    report = readiness.report()
+    if not report["ready"]:
+        response.status_code = 503
+    return report
+
 @app.get("/languages")
 async def get_supported_languages():
     """Get supported OCR languages"""
@@ -56,12 +132,21 @@ async def get_supported_languages():
     ]
     return {"languages": languages}
 
+def request_caller(request: Request) -> Caller:
+    """Who a request is from; identity headers count only from trusted proxies"""
+    try:
+        return identify_caller(request.headers, request.client.host if request.client else None)
+    except InvalidIdentity as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
 @app.post("/ocr")
 async def process_pdf(
+    request: Request,
     file: UploadFile = File(...),
     language: str = "eng",
     optimize: bool = True,
-    force_ocr: bool = False
+    force_ocr: bool = False,
+    postprocess: bool = True
 ):
     """Process PDF with OCR"""
     
@@ -71,6 +156,16 @@ async def process_pdf(
     
     # Generate unique ID for this job
     job_id = str(uuid.uuid4())
+    request_span = tracer.current()
+    if request_span is not None:
+        # Lets the trace be found from the job id the client gets back
+        request_span.update({"job_id": job_id, "language": language, "bytes": file.size})
+    timer = StageTimer()
+    deadline = Deadline()
+    stats = OCRCounters()
+    # Pages are only ever reused for whoever had them read
+    caller = request_caller(request)
+    pages = page_store.for_owner(caller.owner, caller.verified) if page_store is not None else None
     
     try:
         # Create temporary directory for processing
@@ -79,11 +174,11 @@ async def process_pdf(
             output_path = Path(temp_dir) / "output.pdf"
             
             # Save uploaded file
-            with open(input_path, "wb") as buffer:
+            with timer.stage("upload"), open(input_path, "wb") as buffer:
                 content = await file.read()
                 buffer.write(content)
             
-            logger.info(f"Processing PDF: {file.filename}, Size: {len(content)} bytes")
+            logger.info("Processing PDF: %s, Size: %d bytes", file.filename, len(content), extra={"route": "ocr", "job_id": job_id})
             
             # OCRmyPDF options
             options = {
@@ -96,58 +191,205 @@ async def process_pdf(
                 'rotate_pages': True,
                 'remove_background': True,
                 'output_type': 'pdf',
-                'progress_bar': False
+                'progress_bar': False,
+                # Pages that take longer are left without a text layer
+                'tesseract_timeout': OCR_PAGE_TIMEOUT
             }
             
-            # Process with OCRmyPDF
-            result = ocrmypdf.ocr(
-                input_path,
-                output_path,
-                **options
-            )
+            # force_ocr reads every page again instead of reusing earlier results
+            fingerprints: List[PageFingerprint] = []
+            known: List[Optional[str]] = []
+            if pages is not None and not force_ocr:
+                with timer.stage("dedupe"):
+                    fingerprints, known = await asyncio.to_thread(lookup_pages, pages, input_path, language)
+            reused = bool(known) and all(text is not None for text in known)
+            if pages is not None and known:
+                pages.record(len(known), len(known) if reused else 0)
+            
+            if reused:
+                stats.incr("reused", len(known))
+                completed = False
+                text_content = "".join(f"\n--- Page {i + 1} ---\n{text}" for i, text in enumerate(known)).strip()
+            else:
+                # Process with OCRmyPDF (rasterizes internally)
+                with timer.stage("ocr"):
+                    completed = await asyncio.to_thread(run_ocrmypdf, input_path, output_path, options, deadline, stats)
+                
+                # Read the processed PDF and extract text; without one, whatever text the upload already has
+                with timer.stage("text_extraction"):
+                    text_content = extract_text_from_pdf(output_path if completed else input_path)
+                
+                if completed and fingerprints:
+                    with timer.stage("dedupe"):
+                        await asyncio.to_thread(remember_pages, pages, fingerprints, known, text_content, language)
+            counters.merge(stats)
+            processed_size = output_path.stat().st_size if completed else None
             
-            # Read the processed PDF and extract text
-            text_content = extract_text_from_pdf(output_path)
+            # Keep the PDF for /download: OCRmyPDF's output, or the upload when there is none.
+            # Reused pages skip OCRmyPDF, so the upload is kept as it came, without a text layer
+            artifact_path = None
+            if artifact_store is not None:
+                with timer.stage("store"):
+                    artifact_path = await asyncio.to_thread(artifact_store.put, job_id, output_path if completed else input_path)
+            
+            # Reflowed, sentence- and syllable-split text for the reader, worked out once per document
+            reading = None
+            if postprocess:
+                with timer.stage("postprocess"):
+                    reading = await asyncio.to_thread(prepare, text_content, language)
+                if artifact_store is not None:
+                    await asyncio.to_thread(artifact_store.put_reading, job_id, reading)
             
             # Calculate processing metrics
             processing_info = {
                 "job_id": job_id,
                 "filename": file.filename,
                 "original_size": len(content),
-                "processed_size": output_path.stat().st_size,
+                "processed_size": processed_size,
                 "language": language,
                 "optimization": optimize,
                 "force_ocr": force_ocr,
                 "text_length": len(text_content),
                 "processing_time": "completed",
-                "status": "success"
+                "timings": timer.as_dict(),
+                "status": "success" if completed or reused else "partial",
+                "text_layer": completed,
+                "supervision": stats.get_stats(),
+                "reused_pages": stats.get_stats()["reused"]
             }
             
-            logger.info(f"OCR completed successfully: {job_id}")
+            logger.info("OCR completed successfully: %s", job_id, extra={"route": "ocr", "job_id": job_id})
+            if search_index is not None:
+                search_index.add(job_id, caller.owner, file.filename, language, text_content)
             
             return {
                 "success": True,
                 "job_id": job_id,
                 "text": text_content,
+                "reading": reading,
                 "processing_info": processing_info,
-                "download_url": f"/download/{job_id}"
+                "download_url": f"/download/{job_id}" if artifact_path is not None else None
             }
             
     except Exception as e:
         logger.error(f"OCR processing failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"OCR processing failed: {str(e)}")
 
+@app.get("/search")
+async def search_documents(
+    request: Request,
+    q: str,
+    limit: int = 20,
+    language: Optional[str] = None,
+    job_id: Optional[str] = None,
+    order: str = "auto"
+):
+    """Search the text of the caller's processed documents; returns matching pages with offsets"""
+    if search_index is None:
+        raise HTTPException(status_code=503, detail="Search index is disabled")
+    caller = request_caller(request)
+    try:
+        return await asyncio.to_thread(search_index.search, q, caller.owner, limit, language, job_id, order)
+    except InvalidQuery as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/download/{job_id}")
 async def download_processed_pdf(job_id: str):
-    """Download processed PDF (placeholder for file storage)"""
-    return {"message": "Download endpoint - implement file storage"}
+    """Download processed PDF; supports Range requests and conditional GETs"""
+    if artifact_store is None:
+        raise HTTPException(status_code=503, detail="Downloads are disabled")
+    path = await asyncio.to_thread(artifact_store.get, job_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="No processed PDF for this job")
+    # A job's PDF never changes once stored
+    return ArtifactResponse(
+        path,
+        "application/pdf",
+        headers={"Cache-Control": "private, max-age=86400, immutable"},
+        etag=job_id,
+        filename=f"{job_id}.pdf"
+    )
+
+@app.get("/download/{job_id}/reading")
+async def download_reading_text(job_id: str):
+    """Post-processed reading text of a job, as returned by /ocr"""
+    if artifact_store is None:
+        raise HTTPException(status_code=503, detail="Downloads are disabled")
+    path = await asyncio.to_thread(artifact_store.get, job_id, ".reading.json")
+    if path is None:
+        raise HTTPException(status_code=404, detail="No reading text for this job")
+    return ArtifactResponse(path, "application/json", headers={"Cache-Control": "private, max-age=86400, immutable"})
+
+def run_ocrmypdf(input_path: Path, output_path: Path, options: dict, deadline: Deadline, stats: OCRCounters) -> bool:
+    """OCRmyPDF in a supervised process, retried once with cheaper settings
+
+    Returns False when neither attempt finished in time; OCRmyPDF's own
+    errors (encrypted input, existing text layer) are raised as before.
+    """
+    args = (str(input_path), str(output_path))
+    try:
+        with tracing.span("ocr.ocrmypdf", degraded=False):
+            run_supervised(ocrmypdf_job, (*args, options), deadline.remaining() * FIRST_ATTEMPT_SHARE, stats)
+        return True
+    except OCRTimeout as e:
+        stats.incr("job_timeouts")
+        logger.warning(f"OCRmyPDF timed out: {e}")
+    except OCRCrashed as e:
+        logger.warning(str(e))
+    
+    # No image cleanup, no optimization and automatic page segmentation
+    degraded = {
+        **options,
+        'deskew': False,
+        'clean': False,
+        'remove_background': False,
+        'optimize': 0,
+        'tesseract_pagesegmode': int(RETRY_PSM),
+        'tesseract_timeout': OCR_PAGE_TIMEOUT / 2
+    }
+    stats.incr("retries")
+    try:
+        with tracing.span("ocr.ocrmypdf", degraded=True):
+            run_supervised(ocrmypdf_job, (*args, degraded), deadline.remaining(), stats)
+        stats.incr("recovered")
+        return True
+    except OCRTimeout as e:
+        stats.incr("job_timeouts")
+        logger.warning(f"Degraded OCRmyPDF run timed out: {e}")
+    except OCRCrashed as e:
+        logger.warning(f"Degraded OCRmyPDF run: {e}")
+    return False
+
+def lookup_pages(store: OwnerPages, pdf_path: Path, language: str) -> Tuple[List[PageFingerprint], List[Optional[str]]]:
+    """Fingerprint each page of the upload and look it up; None for pages not seen before"""
+    import fitz  # PyMuPDF
+    
+    fingerprints = []
+    with fitz.open(str(pdf_path)) as doc:
+        for page in doc:
+            pixmap = page.get_pixmap(dpi=DEDUPE_DPI, colorspace=fitz.csGRAY, alpha=False)
+            fingerprints.append(fingerprint_samples(pixmap.samples_mv, pixmap.width, pixmap.height, pixmap.stride))
+    return fingerprints, [store.lookup(fingerprint, language, count=False) for fingerprint in fingerprints]
+
+def remember_pages(
+    store: OwnerPages, fingerprints: List[PageFingerprint], known: List[Optional[str]], text: str, language: str
+) -> None:
+    """Store the OCR text of pages that were not known yet"""
+    pages = split_pages(text)
+    if len(pages) != len(fingerprints):
+        return
+    # Empty pages may be ones OCRmyPDF gave up on; don't let them stand in for a later read
+    store.store(
+        [(fingerprint, page) for fingerprint, page, seen in zip(fingerprints, pages, known) if seen is None and page.strip()],
+        language
+    )
 
 def extract_text_from_pdf(pdf_path: Path) -> str:
     """Extract text from processed PDF"""
     try:
         # Use OCRmyPDF's text extraction capabilities
         # This is a simplified version - in production, use proper PDF text extraction
-        import fitz  # PyMuPDF
+        import fitz  # PyMuPDF; cached in sys.modules after readiness warm-up
         
         doc = fitz.open(str(pdf_path))
         text = ""
@@ -165,5 +407,10 @@ def extract_text_from_pdf(pdf_path: Path) -> str:
         return f"Text extraction failed: {str(e)}"
 
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Serve through uvicorn's import of this module instead: OCR worker processes
+    # import the script that started the service again, and with it every store,
+    # thread and the app set up above, but never uvicorn's entry point
+    os.execv(sys.executable, [
+        sys.executable, "-m", "uvicorn", "--app-dir", str(Path(__file__).resolve().parent),
+        "app:app", "--host", "0.0.0.0", "--port", "8000"
+    ])
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Job Artifacts
+Processed PDFs kept per job and served by /download
+
+Each completed job's PDF is moved into ARTIFACT_DIR (empty disables
+downloads) as ``<job_id>.pdf``; for app.py that is the OCRmyPDF output, for
+app-simple.py, which only extracts text, the upload itself. Files are
+written once under a temporary name and renamed, so a download never sees a
+partial file. A gzip variant is kept when it is at least 10% smaller, which
+pays off for PDFs written without stream compression.
+
+The job's post-processed reading text (postprocess.prepare) is kept next to
+it as ``<job_id>.reading.json``, gzipped as well, so the reader loads it
+instead of reworking the raw text on every view.
+
+Serving is artifact_serving.ArtifactResponse: Range requests let PDF viewers
+fetch the pages they show instead of the whole file.
+
+Jobs are kept for ARTIFACT_TTL_SECONDS (0: forever); beyond
+ARTIFACT_MAX_BYTES (0: no cap) the oldest jobs go first. A job's files (PDF,
+reading text and their gzip copies) are always removed together. prune()
+runs on a write at most every ARTIFACT_PRUNE_INTERVAL seconds, the first
+write after startup included.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from service_common.artifact_serving import precompress
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+ARTIFACT_PRECOMPRESS = os.getenv("ARTIFACT_PRECOMPRESS", "1").lower() in ("1", "true", "yes")
+ARTIFACT_TTL_SECONDS = float(os.getenv("ARTIFACT_TTL_SECONDS", str(7 * 86400)))
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", "0"))
+ARTIFACT_PRUNE_INTERVAL = float(os.getenv("ARTIFACT_PRUNE_INTERVAL", "600"))
+# Temporaries older than this are left over from an interrupted write
+STALE_TEMP_SECONDS = 3600
+
+
+class ArtifactStore:
+    """Processed PDFs on disk, one per job"""
+
+    def __init__(
+        self,
+        root: str = ARTIFACT_DIR,
+        compress: bool = ARTIFACT_PRECOMPRESS,
+        ttl: float = ARTIFACT_TTL_SECONDS,
+        max_bytes: int = ARTIFACT_MAX_BYTES,
+        prune_interval: float = ARTIFACT_PRUNE_INTERVAL
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._pruned_at = 0.0
+        self.stored = 0
+        self.stored_bytes = 0
+        self.precompressed = 0
+        self.pruned_jobs = 0
+        self.pruned_bytes = 0
+
+    def path(self, job_id: str, suffix: str = ".pdf") -> Optional[Path]:
+        """Where a job's file lives; None for anything but a job id, so no path escapes the root"""
+        try:
+            if str(uuid.UUID(job_id)) != job_id:
+                return None
+        except ValueError:
+            return None
+        return self.root / f"{job_id}{suffix}"
+
+    def get(self, job_id: str, suffix: str = ".pdf") -> Optional[Path]:
+        path = self.path(job_id, suffix)
+        return path if path is not None and path.is_file() else None
+
+    def put(self, job_id: str, source: Path) -> Path:
+        """Move a finished PDF into the store; ``source`` is gone afterwards"""
+        return self._keep(job_id, ".pdf", lambda tmp: shutil.move(str(source), tmp))
+
+    def put_reading(self, job_id: str, reading: Dict[str, Any]) -> Path:
+        """Store a job's post-processed reading text as JSON"""
+        data = json.dumps(reading, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return self._keep(job_id, ".reading.json", lambda tmp: Path(tmp).write_bytes(data))
+
+    def _keep(self, job_id: str, suffix: str, write) -> Path:
+        path = self.path(job_id, suffix)
+        if path is None:
+            raise ValueError(f"Invalid job id: {job_id}")
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=f".{path.name}.")
+        os.close(fd)
+        try:
+            # For PDFs a rename when the temp dir is on the same filesystem, else a copy
+            write(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        size = path.stat().st_size
+        compressed = self.compress and precompress(path) is not None
+        with self._lock:
+            self.stored += 1
+            self.stored_bytes += size
+            self.precompressed += int(compressed)
+        if time.time() - self._pruned_at >= self.prune_interval:
+            self.prune()
+        return path
+
+    def prune(self) -> int:
+        """Remove jobs past the TTL, then the oldest while over the size cap; returns jobs removed"""
+        if not self._prune_lock.acquire(blocking=False):
+            return 0  # another thread is at it
+        try:
+            now = time.time()
+            self._pruned_at = now
+            jobs: Dict[str, list] = {}
+            for path in self.root.iterdir():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                if path.name.startswith("."):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        path.unlink(missing_ok=True)
+                    continue
+                job = jobs.setdefault(path.name.partition(".")[0], [0.0, 0, []])
+                job[0] = max(job[0], stat.st_mtime)
+                job[1] += stat.st_size
+                job[2].append(path)
+
+            total = sum(size for _, size, _ in jobs.values())
+            removed = removed_bytes = 0
+            for mtime, size, paths in sorted(jobs.values(), key=lambda job: job[0]):
+                expired = self.ttl > 0 and now - mtime > self.ttl
+                if not expired and not (self.max_bytes and total > self.max_bytes):
+                    break
+                # An open download keeps reading the unlinked file
+                for path in paths:
+                    path.unlink(missing_ok=True)
+                total -= size
+                removed += 1
+                removed_bytes += size
+        finally:
+            self._prune_lock.release()
+        if removed:
+            with self._lock:
+                self.pruned_jobs += removed
+                self.pruned_bytes += removed_bytes
+            logger.info(f"Pruned {removed} jobs ({removed_bytes} bytes) from {self.root}")
+        return removed
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "path": str(self.root),
+                "stored": self.stored,
+                "stored_bytes": self.stored_bytes,
+                "precompressed": self.precompressed,
+                "pruned_jobs": self.pruned_jobs,
+                "pruned_bytes": self.pruned_bytes,
+                "ttl_seconds": self.ttl,
+                "max_bytes": self.max_bytes
+            }
+
+
+def create_artifact_store(root: str = ARTIFACT_DIR) -> Optional[ArtifactStore]:
+    """The store at ``root``, or None when downloads are disabled"""
+    if not root:
+        return None
+    return ArtifactStore(root)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+OCR Benchmark Corpus
+Deterministic synthetic PDFs with per-page ground truth for the OCR benchmark
+
+Document kinds:
+    born_digital   text drawn with a real font, no OCR strictly required
+    scanned        the same kind of page rasterized with noise and slight skew,
+                   stored as an image-only page
+    mixed          alternating born-digital and scanned pages
+    multilingual   one scanned document per language (spa, fra, deu, chi_sim)
+    large          a long born-digital document for sustained throughput
+
+The same seed always produces the same text and the same noise, so runs are
+comparable between versions of the service. A manifest.json next to the PDFs
+records every page's ground-truth text.
+
+Usage: python benchmarks/corpus.py --output benchmarks/corpus --seed 7 --large-pages 150
+"""
+
+import argparse
+import io
+import json
+import random
+from pathlib import Path
+from typing import Any, Dict, List
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageFilter
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+MARGIN = 56
+SCAN_DPI = 200
+
+WORDS = {
+    "eng": (
+        "reading sound letter word sentence story teacher student library page "
+        "practice rhythm syllable vowel quiet bright garden river morning window "
+        "because always between through before little every together careful"
+    ).split(),
+    "spa": (
+        "lectura sonido letra palabra frase historia maestro alumno biblioteca "
+        "página práctica ritmo sílaba vocal tranquilo jardín río mañana ventana "
+        "porque siempre entre después pequeño juntos cuidado niño año"
+    ).split(),
+    "fra": (
+        "lecture son lettre mot phrase histoire professeur élève bibliothèque "
+        "page pratique rythme syllabe voyelle calme jardin rivière matin fenêtre "
+        "parce toujours entre après petit ensemble être déjà très"
+    ).split(),
+    "deu": (
+        "Lesen Klang Buchstabe Wort Satz Geschichte Lehrer Schüler Bibliothek "
+        "Seite Übung Rhythmus Silbe Vokal ruhig Garten Fluss Morgen Fenster "
+        "weil immer zwischen durch vorher klein zusammen vorsichtig größer"
+    ).split(),
+    "chi_sim": list("阅读声音字母单词句子故事老师学生图书馆页面练习节奏音节元音安静花园河流早晨窗户"),
+}
+
+FONTS = {"chi_sim": "china-s"}
+DEFAULT_FONT = "helv"
+
+
+def make_text(rng: random.Random, language: str, words: int) -> str:
+    """Sentence-shaped filler text in ``language``"""
+    vocabulary = WORDS[language]
+    if language == "chi_sim":
+        sentences = []
+        while sum(len(s) for s in sentences) < words:
+            sentences.append("".join(rng.choice(vocabulary) for _ in range(rng.randint(8, 16))) + "。")
+        return "\n".join(sentences)
+
+    sentences = []
+    remaining = words
+    while remaining > 0:
+        length = min(remaining, rng.randint(6, 14))
+        sentence = " ".join(rng.choice(vocabulary) for _ in range(length))
+        sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        remaining -= length
+    return " ".join(sentences)
+
+
+def draw_text_page(doc: fitz.Document, text: str, language: str) -> None:
+    """Append a page with ``text`` set in a box; the text must fit on the page"""
+    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+    box = fitz.Rect(MARGIN, MARGIN, PAGE_WIDTH - MARGIN, PAGE_HEIGHT - MARGIN)
+    overflow = page.insert_textbox(box, text, fontsize=12, fontname=FONTS.get(language, DEFAULT_FONT))
+    if overflow < 0:
+        raise ValueError("Generated text does not fit on one page; lower the word count")
+
+
+def scan_page(text: str, language: str, rng: random.Random) -> bytes:
+    """Render a text page to a noisy, slightly rotated greyscale PNG"""
+    scratch = fitz.open()
+    draw_text_page(scratch, text, language)
+    pix = scratch[0].get_pixmap(dpi=SCAN_DPI, colorspace=fitz.csGRAY)
+    scratch.close()
+
+    image = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    image = image.rotate(rng.uniform(-1.5, 1.5), resample=Image.BILINEAR, fillcolor=255)
+    image = image.filter(ImageFilter.GaussianBlur(radius=rng.uniform(0.3, 0.8)))
+
+    # Salt-and-pepper speckle plus a slightly grey background, like a photocopy
+    noise = Image.frombytes("L", image.size, rng.randbytes(image.width * image.height))
+    image = image.point(lambda value: min(value, 235))
+    image.paste(0, mask=noise.point(lambda value: 255 if value < 1 else 0))
+    image.paste(255, mask=noise.point(lambda value: 255 if value > 254 else 0))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def draw_scanned_page(doc: fitz.Document, text: str, language: str, rng: random.Random) -> None:
+    page = doc.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+    page.insert_image(page.rect, stream=scan_page(text, language, rng))
+
+
+def build_document(path: Path, kinds: List[str], language: str, rng: random.Random, words: int) -> List[str]:
+    """Write one PDF whose pages follow ``kinds``; return the ground truth per page"""
+    doc = fitz.open()
+    truth = []
+    for kind in kinds:
+        text = make_text(rng, language, words)
+        if kind == "scanned":
+            draw_scanned_page(doc, text, language, rng)
+        else:
+            draw_text_page(doc, text, language)
+        truth.append(text)
+    # Fixed metadata and file ID keep the output byte-identical for a given seed
+    doc.set_metadata({"producer": "lexitune ocr benchmark corpus", "creationDate": "", "modDate": ""})
+    doc.save(str(path), garbage=3, deflate=True, no_new_id=True)
+    doc.close()
+    return truth
+
+
+def generate(output: Path, seed: int, pages: int, large_pages: int, words: int) -> Dict[str, Any]:
+    output.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    plans = [
+        ("born_digital", "born_digital", "eng", ["text"] * pages),
+        ("scanned", "scanned", "eng", ["scanned"] * pages),
+        ("mixed", "mixed", "eng", ["text" if i % 2 == 0 else "scanned" for i in range(pages)]),
+        *[
+            (f"multilingual_{language}", "multilingual", language, ["scanned"] * pages)
+            for language in ("spa", "fra", "deu", "chi_sim")
+        ],
+        ("large", "large", "eng", ["text"] * large_pages),
+    ]
+
+    documents = []
+    for name, kind, language, page_kinds in plans:
+        filename = f"{name}.pdf"
+        truth = build_document(output / filename, page_kinds, language, rng, words)
+        documents.append({
+            "name": name,
+            "kind": kind,
+            "language": language,
+            "file": filename,
+            "pages": len(truth),
+            "bytes": (output / filename).stat().st_size,
+            "ground_truth": truth,
+        })
+
+    manifest = {"seed": seed, "words_per_page": words, "documents": documents}
+    (output / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    return manifest
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=Path, default=Path(__file__).resolve().parent / "corpus")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--pages", type=int, default=4, help="Pages per small document")
+    parser.add_argument("--large-pages", type=int, default=150)
+    parser.add_argument("--words", type=int, default=180, help="Words (or CJK characters) per page")
+    args = parser.parse_args()
+
+    manifest = generate(args.output, args.seed, args.pages, args.large_pages, args.words)
+    for document in manifest["documents"]:
+        print(f"{document['file']:<28} {document['pages']:>4} pages {document['bytes']:>10} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+OCR Throughput Benchmark
+Drives process_pdf from app.py and app-simple.py over the synthetic corpus
+
+Every (app, concurrency) combination runs in a fresh child process with its
+own temp directory, so peak RSS and temp-disk usage belong to that run alone.
+For each run the report gives pages/sec, per-stage time (upload, rasterize,
+OCR, text extraction) as reported by the service, peak RSS of the process and
+of the OCR subprocesses it started, peak temp-disk usage, blocks read and
+written (the process and its children, from getrusage) and character
+accuracy against the corpus ground truth.
+
+An app may name a render backend for app-simple.py as ``app-simple.py@pymupdf``
+(in-memory rendering, shared-memory OCR workers) or ``app-simple.py@subprocess``
+(pdftoppm PNGs read back by the tesseract CLI) to compare the two pipelines.
+
+Concurrency modes:
+    threads   each job gets its own event loop on a worker thread, so the
+              blocking OCR calls overlap (what offloading or extra workers give)
+    inline    jobs share one event loop, as in a single uvicorn worker today;
+              the blocking calls serialize and concurrency only adds queueing
+
+Generate the corpus first with benchmarks/corpus.py, or pass --generate.
+
+Usage:
+    python benchmarks/ocr_benchmark.py --apps app.py app-simple.py --concurrency 1 2 4 --output ocr.json
+    python benchmarks/ocr_benchmark.py --kinds scanned multilingual --repeat 3 --mode inline
+    python benchmarks/ocr_benchmark.py --apps app-simple.py@subprocess app-simple.py@pymupdf --kinds scanned large
+"""
+
+import argparse
+import asyncio
+import difflib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+SERVICE_DIR = BENCHMARK_DIR.parent
+DEFAULT_CORPUS = BENCHMARK_DIR / "corpus"
+
+PAGE_MARKER = re.compile(r"^--- Page (\d+) ---$", re.MULTILINE)
+STAGES = ("upload", "rasterize", "ocr", "text_extraction")
+
+
+class DiskSampler(threading.Thread):
+    """Polls the size of a directory tree and remembers the largest value seen"""
+
+    def __init__(self, root: Path, interval: float = 0.05):
+        super().__init__(daemon=True)
+        self.root = root
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, directory_size(self.root))
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def directory_size(root: Path) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                # Files come and go while the service works
+                pass
+    return total
+
+
+def normalize(text: str, language: str) -> str:
+    # Tesseract separates CJK glyphs with spaces, so whitespace carries no signal there
+    if language.startswith("chi"):
+        return re.sub(r"\s+", "", text)
+    return " ".join(text.split())
+
+
+def character_accuracy(truth: str, recognized: str) -> float:
+    """1 - (character edits / ground-truth length), floored at zero"""
+    if not truth:
+        return 1.0 if not recognized else 0.0
+    matcher = difflib.SequenceMatcher(None, truth, recognized, autojunk=False)
+    edits = sum(
+        max(i2 - i1, j2 - j1)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    )
+    return max(0.0, 1.0 - edits / len(truth))
+
+
+def split_pages(text: str, page_count: int) -> List[str]:
+    """Split service output on its '--- Page N ---' markers"""
+    pages = [""] * page_count
+    matches = list(PAGE_MARKER.finditer(text))
+    for index, match in enumerate(matches):
+        number = int(match.group(1))
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        if 1 <= number <= page_count:
+            pages[number - 1] = text[match.end():end]
+    if not matches and page_count:
+        # pdftotext fallback output has no markers
+        pages[0] = text
+    return pages
+
+
+def load_app(filename: str):
+    """Import one of the service modules by file name (app-simple.py is not importable by name)"""
+    # The service's own modules, and service_common from the repository root
+    for path in (SERVICE_DIR.parent, SERVICE_DIR):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+    spec = importlib.util.spec_from_file_location("ocr_app_" + Path(filename).stem.replace("-", "_"), SERVICE_DIR / filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+async def run_job(module, document: Dict[str, Any], data: bytes, force_ocr: bool) -> Dict[str, Any]:
+    from fastapi import HTTPException
+    from starlette.datastructures import UploadFile
+
+    upload = UploadFile(file=io.BytesIO(data), size=len(data), filename=document["file"])
+    started = time.perf_counter()
+    try:
+        result = await module.process_pdf(
+            file=upload, language=document["language"], optimize=False, force_ocr=force_ocr
+        )
+    except HTTPException as e:
+        return {"document": document["name"], "ok": False, "error": str(e.detail),
+                "elapsed": time.perf_counter() - started}
+    elapsed = time.perf_counter() - started
+
+    recognized = split_pages(result["text"], document["pages"])
+    language = document["language"]
+    accuracy = [
+        character_accuracy(normalize(truth, language), normalize(page, language))
+        for truth, page in zip(document["ground_truth"], recognized)
+    ]
+    return {
+        "document": document["name"],
+        "ok": True,
+        "elapsed": elapsed,
+        "timings": result["processing_info"].get("timings", {}),
+        "accuracy": accuracy,
+    }
+
+
+async def run_jobs(module, jobs: List[Dict[str, Any]], payloads: Dict[str, bytes],
+                   concurrency: int, mode: str, force_ocr: bool) -> List[Dict[str, Any]]:
+    if mode == "inline":
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(document: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                return await run_job(module, document, payloads[document["name"]], force_ocr)
+
+        return await asyncio.gather(*(limited(document) for document in jobs))
+
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            loop.run_in_executor(pool, asyncio.run, run_job(module, document, payloads[document["name"]], force_ocr))
+            for document in jobs
+        ]
+        return await asyncio.gather(*futures)
+
+
+def child_run(app: str, concurrency: int, args: Dict[str, Any], results: "multiprocessing.Queue") -> None:
+    """One benchmark run; executes in a fresh process"""
+    scratch = Path(tempfile.mkdtemp(prefix="ocr-bench-"))
+    os.environ["TMPDIR"] = str(scratch)
+    tempfile.tempdir = None  # re-read TMPDIR for the service and its subprocesses
+    # Every run starts without stored pages, search index or artifacts from earlier runs
+    os.environ["PAGE_CACHE_PATH"] = str(scratch / "page-cache" / "pages.db")
+    os.environ["SEARCH_INDEX_PATH"] = str(scratch / "search" / "index.db")
+    os.environ["ARTIFACT_DIR"] = str(scratch / "artifacts")
+    os.environ.setdefault("TRACE_FILE", str(scratch / "traces" / "spans.jsonl"))
+
+    try:
+        corpus = Path(args["corpus"])
+        manifest = json.loads((corpus / "manifest.json").read_text(encoding="utf-8"))
+        documents = [d for d in manifest["documents"] if not args["kinds"] or d["kind"] in args["kinds"]]
+        payloads = {d["name"]: (corpus / d["file"]).read_bytes() for d in documents}
+        jobs = [d for _ in range(args["repeat"]) for d in documents]
+        by_name = {d["name"]: d for d in documents}
+
+        filename, _, backend = app.partition("@")
+        if backend:
+            os.environ["RENDER_BACKEND"] = backend
+        module = load_app(filename)
+        # The services configure INFO logging at import; keep per-job lines out of the report
+        logging.getLogger().setLevel(logging.WARNING)
+        sampler = DiskSampler(scratch)
+        sampler.start()
+        started = time.perf_counter()
+        outcomes = asyncio.run(run_jobs(module, jobs, payloads, concurrency, args["mode"], args["force_ocr"]))
+        elapsed = time.perf_counter() - started
+        peak_disk = sampler.stop()
+        # Reap pool workers so their RSS and I/O are counted as children's
+        if getattr(module, "ocr_pool", None) is not None:
+            module.ocr_pool.shutdown()
+
+        results.put(summarize(app, concurrency, args["mode"], outcomes, by_name, elapsed, peak_disk))
+    except Exception as e:
+        results.put({"app": app, "concurrency": concurrency, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def summarize(app: str, concurrency: int, mode: str, outcomes: List[Dict[str, Any]],
+              documents: Dict[str, Dict[str, Any]], elapsed: float, peak_disk: int) -> Dict[str, Any]:
+    succeeded = [o for o in outcomes if o["ok"]]
+    pages = sum(documents[o["document"]]["pages"] for o in succeeded)
+
+    stage_totals: Dict[str, float] = defaultdict(float)
+    for outcome in succeeded:
+        for stage in STAGES:
+            stage_totals[stage] += outcome["timings"].get(stage, 0.0)
+
+    accuracy_by_kind: Dict[str, List[float]] = defaultdict(list)
+    for outcome in succeeded:
+        accuracy_by_kind[documents[outcome["document"]]["kind"]].extend(outcome["accuracy"])
+    all_accuracy = [value for values in accuracy_by_kind.values() for value in values]
+
+    # ru_maxrss is in KiB on Linux
+    own_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    # Block counts are in 512-byte units; page-cache hits don't show up here
+    block_io = {
+        direction: sum(
+            getattr(resource.getrusage(who), field) * 512
+            for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+        ) / (1024 * 1024)
+        for direction, field in (("read", "ru_inblock"), ("written", "ru_oublock"))
+    }
+
+    errors: Dict[str, int] = defaultdict(int)
+    for outcome in outcomes:
+        if not outcome["ok"]:
+            errors[outcome["error"][:120]] += 1
+
+    return {
+        "app": app,
+        "mode": mode,
+        "concurrency": concurrency,
+        "jobs": len(outcomes),
+        "failed": len(outcomes) - len(succeeded),
+        "errors": dict(errors),
+        "pages": pages,
+        "elapsed_s": round(elapsed, 2),
+        "pages_per_sec": round(pages / elapsed, 3) if elapsed else 0.0,
+        "stage_seconds": {stage: round(stage_totals[stage], 3) for stage in STAGES},
+        "stage_ms_per_page": {
+            stage: round(stage_totals[stage] / pages * 1000, 1) if pages else 0.0 for stage in STAGES
+        },
+        "job_latency_s": {
+            "mean": round(sum(o["elapsed"] for o in outcomes) / len(outcomes), 3) if outcomes else 0.0,
+            "max": round(max((o["elapsed"] for o in outcomes), default=0.0), 3),
+        },
+        "peak_rss_mb": {"process": round(own_rss, 1), "largest_subprocess": round(child_rss, 1)},
+        "peak_temp_disk_mb": round(peak_disk / (1024 * 1024), 2),
+        "disk_io_mb": {direction: round(value, 2) for direction, value in block_io.items()},
+        "character_accuracy": {
+            "overall": round(sum(all_accuracy) / len(all_accuracy), 4) if all_accuracy else None,
+            **{kind: round(sum(v) / len(v), 4) for kind, v in sorted(accuracy_by_kind.items())},
+        },
+    }
+
+
+def run_isolated(app: str, concurrency: int, args: Dict[str, Any]) -> Dict[str, Any]:
+    # spawn, not fork: a forked child would inherit the parent's peak RSS
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    proc = context.Process(target=child_run, args=(app, concurrency, args, results))
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--apps", nargs="+", default=["app.py", "app-simple.py"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--mode", choices=["threads", "inline"], default="threads")
+    parser.add_argument("--corpus", type=Path, default=DEFAULT_CORPUS)
+    parser.add_argument("--kinds", nargs="*", default=[],
+                        help="Restrict to document kinds: born_digital scanned mixed multilingual large")
+    parser.add_argument("--repeat", type=int, default=1, help="Times each document is submitted per run")
+    parser.add_argument("--no-force-ocr", dest="force_ocr", action="store_false",
+                        help="Let OCRmyPDF reject pages that already have text")
+    parser.add_argument("--generate", action="store_true", help="Build the corpus first if it is missing")
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    parser.add_argument("--label", help="Free-form label stored in the report, e.g. a git revision")
+    args = parser.parse_args()
+
+    if not (args.corpus / "manifest.json").exists():
+        if not args.generate:
+            raise SystemExit(f"No corpus at {args.corpus}; run benchmarks/corpus.py or pass --generate")
+        from corpus import generate
+
+        generate(args.corpus, seed=7, pages=4, large_pages=150, words=180)
+
+    child_args = {
+        "corpus": str(args.corpus),
+        "kinds": args.kinds,
+        "repeat": args.repeat,
+        "mode": args.mode,
+        "force_ocr": args.force_ocr,
+    }
+    runs = [run_isolated(app, concurrency, child_args) for app in args.apps for concurrency in args.concurrency]
+
+    manifest = json.loads((args.corpus / "manifest.json").read_text(encoding="utf-8"))
+    report = {
+        "config": {
+            "label": args.label,
+            "cpu_count": os.cpu_count(),
+            "corpus_seed": manifest["seed"],
+            **{key: value for key, value in child_args.items() if key != "corpus"},
+        },
+        "runs": runs,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Page Deduplication
+Reuse OCR text for pages an owner has had read before
+
+Stored text belongs to the owner (user, session or address, see
+caller_identity) who uploaded the page and is never handed to anyone else:
+a worksheet with one pupil's answers must not come back as another pupil's
+text. Stores and lookups go through PageStore.for_owner().
+
+Every rendered page gets a SHA-256 digest of its pixels. The same pixels
+under the same owner and OCR language are an exact match, one index probe.
+
+Near-duplicates (the same page re-saved or re-rendered) are looked for only
+for verified owners, and only with DEDUPE_NEAR on. The page is reduced to a
+32x32 grayscale thumbnail (area averaging in NumPy) and a 64-bit DCT hash
+of it; candidates have a hash within DEDUPE_MAX_DISTANCE bits and no
+thumbnail cell more than DEDUPE_MAX_CELL_DIFF grey levels off. That only
+narrows the search: a 32x32 cell is too coarse to see a name written on an
+answer sheet. A candidate is reused when no cell of a detail render at
+least DETAIL_WIDTH cells wide (4x4 pixels of a 300 dpi page, every pixel at
+72 dpi) differs by more than DEDUPE_MAX_DETAIL_DIFF grey levels, which a
+changed word does.
+
+Hashes are split into five chunks that are indexed separately: two hashes
+within 4 bits of each other agree exactly on at least one chunk, so the
+candidates are five index probes plus a popcount. Results are kept in
+SQLite (PAGE_CACHE_PATH; empty disables reuse).
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PAGE_CACHE_PATH = os.getenv("PAGE_CACHE_PATH", "page-cache/pages.db")
+# At most 4: the chunked index only guarantees finding hashes up to 4 bits apart
+DEDUPE_MAX_DISTANCE = min(4, int(os.getenv("DEDUPE_MAX_DISTANCE", "4")))
+DEDUPE_MAX_CELL_DIFF = int(os.getenv("DEDUPE_MAX_CELL_DIFF", "24"))
+DEDUPE_NEAR = os.getenv("DEDUPE_NEAR", "1").lower() in ("1", "true", "yes")
+DEDUPE_MAX_DETAIL_DIFF = int(os.getenv("DEDUPE_MAX_DETAIL_DIFF", "32"))
+
+THUMBNAIL_SIZE = 32
+DETAIL_WIDTH = 512
+HASH_SIZE = 8
+CHUNK_BITS = (13, 13, 13, 13, 12)
+
+
+class PageFingerprint(NamedTuple):
+    hash: int  # 64-bit DCT hash, unsigned
+    thumbnail: bytes  # 32x32 grayscale, row-major
+    digest: str  # SHA-256 of the page's size and pixels
+    detail: bytes  # zlib-compressed grayscale of detail_factor() blocks, row-major
+
+
+def detail_factor(width: int) -> int:
+    """Side of the pixel blocks averaged into one detail cell: at least DETAIL_WIDTH cells across"""
+    # Sums of up to 16x16 8-bit pixels fit in uint16
+    return min(16, max(1, width // DETAIL_WIDTH))
+
+
+def block_average(pixels: np.ndarray, factor: int) -> np.ndarray:
+    """Mean of each ``factor`` x ``factor`` block; partial blocks at the right and bottom are left out"""
+    height = pixels.shape[0] // factor * factor
+    width = pixels.shape[1] // factor * factor
+    # factor**2 strided whole-page adds; reduceat into hundreds of cells is ~6x slower at 300 dpi
+    sums = np.zeros((height // factor, width // factor), dtype=np.uint16)
+    for row in range(factor):
+        for col in range(factor):
+            sums += pixels[row:height:factor, col:width:factor]
+    return sums / (factor * factor)
+
+
+def downsample(pixels: np.ndarray, size: int = THUMBNAIL_SIZE) -> np.ndarray:
+    """Area-average a 2-D grayscale image down to ``size`` x ``size``"""
+    height, width = pixels.shape
+    rows = np.linspace(0, height, size + 1).astype(np.intp)[:-1]
+    cols = np.linspace(0, width, size + 1).astype(np.intp)[:-1]
+    # Columns first: each reduction runs along contiguous rows. uint32 holds a
+    # full cell of 8-bit pixels for any page up to ~16 million pixels per cell
+    sums = np.add.reduceat(np.add.reduceat(pixels, cols, axis=1, dtype=np.uint32), rows, axis=0)
+    counts = np.outer(np.diff(np.append(rows, height)), np.diff(np.append(cols, width)))
+    return sums / counts
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II basis; ``M @ x @ M.T`` is the 2-D transform of ``x``"""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2.0 / size)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+def fingerprint(pixels: np.ndarray) -> PageFingerprint:
+    """Digest, hash, thumbnail and detail render of a 2-D uint8 grayscale page"""
+    height, width = pixels.shape
+    digest = hashlib.sha256(f"{width}x{height}:".encode())
+    digest.update(np.ascontiguousarray(pixels).data)
+    detail = np.round(block_average(pixels, detail_factor(width))).astype(np.uint8)
+    # From the detail render, which is a sixteenth of a 300 dpi page
+    thumbnail = downsample(detail)
+    matrix = _dct_matrix(THUMBNAIL_SIZE)
+    low = (matrix @ thumbnail @ matrix.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # The DC term is the page's mean brightness; comparing against it would waste a bit
+    bits = low > np.median(low[1:])
+    return PageFingerprint(
+        int.from_bytes(np.packbits(bits).tobytes(), "big"),
+        np.round(thumbnail).astype(np.uint8).tobytes(),
+        digest.hexdigest(),
+        zlib.compress(detail.tobytes(), 6)
+    )
+
+
+def fingerprint_samples(samples, width: int, height: int, stride: int) -> PageFingerprint:
+    """Fingerprint an 8-bit grayscale buffer such as a PyMuPDF pixmap's ``samples_mv``"""
+    pixels = np.frombuffer(samples, dtype=np.uint8, count=height * stride).reshape(height, stride)[:, :width]
+    return fingerprint(pixels)
+
+
+def fingerprint_image(path: Path) -> PageFingerprint:
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return fingerprint(np.asarray(image.convert("L")))
+
+
+def _chunks(value: int) -> List[int]:
+    chunks, shift = [], 64
+    for bits in CHUNK_BITS:
+        shift -= bits
+        chunks.append((value >> shift) & ((1 << bits) - 1))
+    return chunks
+
+
+def _signed(value: int) -> int:
+    """SQLite integers are signed 64-bit"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class PageStore:
+    """OCR text of previously seen pages, looked up by owner and fingerprint"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            language TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            hash INTEGER NOT NULL,
+            c0 INTEGER NOT NULL,
+            c1 INTEGER NOT NULL,
+            c2 INTEGER NOT NULL,
+            c3 INTEGER NOT NULL,
+            c4 INTEGER NOT NULL,
+            thumbnail BLOB NOT NULL,
+            detail BLOB NOT NULL,
+            text TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest, owner, language);
+        CREATE INDEX IF NOT EXISTS pages_c0 ON pages (c0, owner, language);
+        CREATE INDEX IF NOT EXISTS pages_c1 ON pages (c1, owner, language);
+        CREATE INDEX IF NOT EXISTS pages_c2 ON pages (c2, owner, language);
+        CREATE INDEX IF NOT EXISTS pages_c3 ON pages (c3, owner, language);
+        CREATE INDEX IF NOT EXISTS pages_c4 ON pages (c4, owner, language);
+    """
+
+    def __init__(
+        self,
+        path: str = PAGE_CACHE_PATH,
+        max_distance: int = DEDUPE_MAX_DISTANCE,
+        max_cell_diff: int = DEDUPE_MAX_CELL_DIFF,
+        max_detail_diff: int = DEDUPE_MAX_DETAIL_DIFF,
+        near: bool = DEDUPE_NEAR
+    ):
+        self.path = path
+        self.max_distance = max_distance
+        self.max_cell_diff = max_cell_diff
+        self.max_detail_diff = max_detail_diff
+        self.near = near
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.reused = 0
+        self.exact_matches = 0
+        self.near_matches = 0
+        self.near_rejected = 0
+        self.stored = 0
+        self.lookup_seconds = 0.0
+
+        with self._connection() as db:
+            columns = {row[1] for row in db.execute("PRAGMA table_info(pages)")}
+            if columns and "owner" not in columns:
+                # Pages stored before they had owners cannot be given back to anyone safely
+                logger.warning(f"Dropping {path}: its pages were stored without owners")
+                db.execute("DROP TABLE pages")
+            db.executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection; sqlite3 connections are not shared across threads"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def for_owner(self, owner: str, verified: bool) -> "OwnerPages":
+        """This store as seen by one owner; near-duplicates are only matched for verified owners"""
+        return OwnerPages(self, owner, self.near and verified)
+
+    def _same_detail(self, page: PageFingerprint, stored: bytes) -> bool:
+        """No cell of the two detail renders differs by more than max_detail_diff"""
+        ours, theirs = zlib.decompress(page.detail), zlib.decompress(stored)
+        if len(ours) != len(theirs):
+            return False
+        ours_cells = np.frombuffer(ours, dtype=np.uint8).astype(np.int16)
+        theirs_cells = np.frombuffer(theirs, dtype=np.uint8).astype(np.int16)
+        return int(np.abs(ours_cells - theirs_cells).max()) <= self.max_detail_diff
+
+    def _near_match(self, db: sqlite3.Connection, page: PageFingerprint, language: str, owner: str) -> Optional[Tuple[int, str]]:
+        chunks = _chunks(page.hash)
+        rows = db.execute(
+            " UNION ".join(
+                f"SELECT id, hash, thumbnail, detail, text FROM pages WHERE c{i} = ? AND owner = ? AND language = ?"
+                for i in range(5)
+            ),
+            [value for chunk in chunks for value in (chunk, owner, language)]
+        ).fetchall()
+
+        candidates = []
+        thumbnail = np.frombuffer(page.thumbnail, dtype=np.uint8).astype(np.int16)
+        for row_id, stored_hash, stored_thumbnail, detail, text in rows:
+            distance = ((stored_hash & 0xFFFFFFFFFFFFFFFF) ^ page.hash).bit_count()
+            if distance > self.max_distance:
+                continue
+            cells = np.frombuffer(stored_thumbnail, dtype=np.uint8).astype(np.int16)
+            if int(np.abs(cells - thumbnail).max()) <= self.max_cell_diff:
+                candidates.append((distance, row_id, detail, text))
+        # Closest first; the detail check is the expensive one
+        for _, row_id, detail, text in sorted(candidates, key=lambda candidate: candidate[0]):
+            if self._same_detail(page, detail):
+                with self._lock:
+                    self.near_matches += 1
+                return row_id, text
+            with self._lock:
+                self.near_rejected += 1
+        return None
+
+    def lookup(
+        self, page: PageFingerprint, language: str, owner: str, near: bool = False, count: bool = True
+    ) -> Optional[str]:
+        """Stored text of the same page read for ``owner``, or None
+
+        With ``near`` a near-duplicate may stand in for the same page. With
+        ``count=False`` the lookup is left out of the reuse rate; the caller
+        records what it actually reused with ``record``.
+        """
+        started = time.perf_counter()
+        db = self._connection()
+        row = db.execute(
+            "SELECT id, text FROM pages WHERE digest = ? AND owner = ? AND language = ? LIMIT 1",
+            (page.digest, owner, language)
+        ).fetchone()
+        if row is not None:
+            with self._lock:
+                self.exact_matches += 1
+        elif near:
+            row = self._near_match(db, page, language, owner)
+
+        with self._lock:
+            self.lookup_seconds += time.perf_counter() - started
+        if count:
+            self.record(1, int(row is not None))
+        if row is None:
+            return None
+        with db:
+            db.execute("UPDATE pages SET hits = hits + 1 WHERE id = ?", (row[0],))
+        return row[1]
+
+    def record(self, checked: int, reused: int) -> None:
+        with self._lock:
+            self.checked += checked
+            self.reused += reused
+
+    def store(self, pages: Iterable[Tuple[PageFingerprint, str]], language: str, owner: str) -> None:
+        """Remember the OCR text of pages newly read for ``owner``, in one transaction"""
+        now = time.time()
+        rows = [
+            (owner, language, page.digest, _signed(page.hash), *_chunks(page.hash), page.thumbnail, page.detail, text, now)
+            for page, text in pages
+        ]
+        if not rows:
+            return
+        db = self._connection()
+        with db:
+            db.executemany(
+                "INSERT INTO pages (owner, language, digest, hash, c0, c1, c2, c3, c4, thumbnail, detail, text, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        with self._lock:
+            self.stored += len(rows)
+
+    def get_stats(self) -> Dict[str, Any]:
+        db = self._connection()
+        count = db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        owners = db.execute("SELECT COUNT(DISTINCT owner) FROM pages").fetchone()[0]
+        with self._lock:
+            return {
+                "path": self.path,
+                "stored_pages": count,
+                "owners": owners,
+                "checked": self.checked,
+                "reused": self.reused,
+                "reuse_rate": round(self.reused / self.checked, 4) if self.checked else None,
+                "exact_matches": self.exact_matches,
+                "near_matches": self.near_matches,
+                "near_rejected": self.near_rejected,
+                "stored": self.stored,
+                "lookup_seconds": round(self.lookup_seconds, 3),
+                "near": self.near,
+                "max_distance": self.max_distance,
+                "max_cell_diff": self.max_cell_diff,
+                "max_detail_diff": self.max_detail_diff
+            }
+
+
+class OwnerPages:
+    """A PageStore bound to one owner; what it stores only it can look up"""
+
+    def __init__(self, pages: PageStore, owner: str, near: bool):
+        self.pages = pages
+        self.owner = owner
+        self.near = near
+
+    def lookup(self, page: PageFingerprint, language: str, count: bool = True) -> Optional[str]:
+        return self.pages.lookup(page, language, self.owner, self.near, count)
+
+    def record(self, checked: int, reused: int) -> None:
+        self.pages.record(checked, reused)
+
+    def store(self, pages: Iterable[Tuple[PageFingerprint, str]], language: str) -> None:
+        self.pages.store(pages, language, self.owner)
+
+
+def create_page_store(path: str = PAGE_CACHE_PATH) -> Optional[PageStore]:
+    """The store at ``path``, or None when reuse is disabled"""
+    if not path:
+        return None
+    return PageStore(path)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Text Post-processing
+Reflowed, sentence-split and syllable-split text with reading-level statistics
+
+OCR and pdftotext output keeps the page's hard line breaks, splits words
+across lines with hyphens and carries ``--- Page N ---`` markers. prepare()
+turns a document's text into pages of paragraphs of sentences, once per
+job, for the reader to display without reworking it on every view:
+
+- Dehyphenation: ``exam-`` / ``ple`` becomes ``example``. The hyphen is kept
+  when the document uses the hyphenated form elsewhere and never the joined
+  one (``well-known``).
+- Paragraph reflow: lines are joined unless a blank line, a list item, or
+  a short line ending a sentence or heading marks a paragraph end. "Short"
+  is relative to the page's own typical line width.
+- Sentence segmentation on terminal punctuation followed by a capital,
+  skipping common abbreviations and initials.
+- Syllable splits of every multi-syllable word. English uses the rules
+  below; other languages use pyphen's hyphenation patterns when it is
+  installed.
+- Reading-level statistics (Flesch-Kincaid, Gunning fog, SMOG, ARI,
+  Coleman-Liau), for English text only, since the formulas are calibrated on it.
+
+All patterns are compiled once, and syllable splits are memoized per word.
+Documents repeat most of their vocabulary, so a few hundred pages take well
+under a second.
+"""
+
+import importlib.util
+import math
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+
+from search_index import FAILED_PAGE, split_pages
+
+PYPHEN_AVAILABLE = importlib.util.find_spec("pyphen") is not None
+
+# OCR language codes with pyphen dictionaries; English uses the built-in rules
+PYPHEN_LANGUAGES = {
+    "spa": "es", "fra": "fr", "deu": "de_DE", "ita": "it_IT", "por": "pt_PT", "rus": "ru_RU"
+}
+
+# Typographic ligatures and invisible characters OCR and PDF text layers produce
+_TRANSLATE = str.maketrans({
+    "\ufb00": "ff", "\ufb01": "fi", "\ufb02": "fl", "\ufb03": "ffi", "\ufb04": "ffl",
+    "\ufb05": "st", "\ufb06": "st", "\u00ad": None, "\u200b": None, "\ufeff": None,
+    "\u00a0": " ", "\t": " "
+})
+_SPACES = re.compile(r" {2,}")
+_WORD = re.compile(r"[^\W\d_]+(?:['’][^\W\d_]+)*")
+# Hyphenated compounds written out mid-line; line-end hyphens are followed by a newline
+_COMPOUND = re.compile(r"[^\W\d_]+-[^\W\d_]+")
+_LINE_END_HYPHEN = re.compile(r"([^\W\d_]+)-$")
+_LINE_START_WORD = re.compile(r"[^\W\d_A-ZÀ-Þ]+")
+_LIST_ITEM = re.compile(r"(?:[-•*▪◦●–]|\(?\d{1,3}[.)]|\(?[a-z][.)])\s")
+_CLOSING_QUOTES = "\"'”’)]"
+_SENTENCE_PUNCTUATION = frozenset(".!?…:")
+_SENTENCE_END = re.compile(r"[.!?…]+[\"'”’)\]]*\s+(?=[\"'“‘(\[]?[A-Z0-9À-Þ])")
+
+# Abbreviations a sentence does not end on (lower case, with their final period)
+ABBREVIATIONS = frozenset("""
+    mr. mrs. ms. dr. prof. sr. jr. st. mt. vs. e.g. i.e. cf. fig. figs. no. nos. vol. p. pp.
+    ch. sec. approx. dept. est. inc. ltd. co. corp. jan. feb. mar. apr. jun. jul. aug. sep.
+    sept. oct. nov. dec. a.m. p.m. u.s. u.k. ph.d.
+""".split())
+
+# A line this much shorter than the page's typical line ends its paragraph
+SHORT_LINE = 0.8
+
+# --- English syllable rules ---
+
+# Vowel runs are syllable nuclei; y is a vowel unless another vowel follows it
+_NUCLEI = re.compile(r"(?:[aeiou]|y(?![aeiou]))+")
+# Consonant pairs that open a syllable together: ta-ble, fa-ther, a-pron
+_ONSETS = frozenset("bl br ch cl cr dr fl fr gl gr kn ph pl pr qu sc sh sk sl sm sn sp st sw th tr tw wh wr".split())
+# Consonant groups that close a syllable together: pack-et, kitch-en
+_CODAS = ("tch", "ck")
+# Suffixes that are their own syllable after an unchanged stem: love-ly, move-ment
+_SUFFIXES = ("ment", "ness", "less", "ful", "ly", "ing")
+# Doubled consonants that stay with the stem before -ing: fall-ing, kiss-ing (but run-ning)
+_KEEP_DOUBLE = frozenset("lsfz")
+# Final -es is its own syllable after these (match-es, box-es), silent elsewhere (make-s)
+_SOUNDED_ES = ("s", "x", "z", "ch", "sh", "g", "c", "j")
+
+
+def _english_cuts(word: str) -> List[int]:
+    """Offsets where a lower-case ASCII word splits into syllables"""
+    for suffix in _SUFFIXES:
+        stem_length = len(word) - len(suffix)
+        if word.endswith(suffix) and stem_length >= 2 and _NUCLEI.search(word, 0, stem_length):
+            stem = word[:stem_length]
+            doubled = stem[-1] == stem[-2] and stem[-1] not in "aeiouy"
+            if doubled and (suffix == "ly" or (suffix == "ing" and stem[-1] not in _KEEP_DOUBLE)):
+                stem_length -= 1  # run-ning, ap-ply
+            return _english_cuts(word[:stem_length]) + [stem_length]
+
+    nuclei = [match.span() for match in _NUCLEI.finditer(word, 1 if word.startswith("y") else 0)]
+    if len(nuclei) > 1:
+        start, end = nuclei[-1]
+        before = word[:start]
+        if end == len(word) and word[start:] == "e" and not (word.endswith("le") and before[-2:-1] not in "aeiouy"):
+            nuclei.pop()  # silent final e: make, but ta-ble
+        elif word.endswith("ed") and start == len(word) - 2 and before[-1:] not in "td":
+            nuclei.pop()  # jumped, but want-ed
+        elif word.endswith("es") and start == len(word) - 2 and not before.endswith(_SOUNDED_ES):
+            nuclei.pop()  # makes, but match-es
+
+    cuts = []
+    for (_, end), (start, _) in zip(nuclei, nuclei[1:]):
+        cluster = word[end:start]
+        coda = next((coda for coda in _CODAS if cluster.startswith(coda)), None)
+        if cluster == "x":
+            cut = end + 1  # box-es, tax-i
+        elif len(cluster) <= 1:
+            cut = end  # V-CV: ba-by
+        elif coda:
+            cut = end + len(coda)
+        elif cluster[-2:] in _ONSETS:
+            cut = start - 2  # VC-CCV: ex-plain, mo-ther
+        else:
+            cut = start - 1  # VC-CV: hap-py, win-dow
+        if 0 < cut < len(word):
+            cuts.append(cut)
+    return cuts
+
+
+@lru_cache(maxsize=65536)
+def _cuts(word: str, language: str) -> Tuple[int, ...]:
+    lower = word.lower()
+    if language == "eng":
+        if not lower.isascii() or not lower.isalpha():
+            return ()
+        return tuple(_english_cuts(lower))
+    if PYPHEN_AVAILABLE and language in PYPHEN_LANGUAGES:
+        return tuple(_pyphen(PYPHEN_LANGUAGES[language]).positions(lower))
+    return ()
+
+
+@lru_cache(maxsize=None)
+def _pyphen(locale: str):
+    import pyphen
+
+    return pyphen.Pyphen(lang=locale, left=1, right=1)
+
+
+def split_syllables(word: str, language: str = "eng") -> List[str]:
+    """``word`` in syllables; one piece when it cannot be split"""
+    base, apostrophe, rest = word.partition("'") if "'" in word else word.partition("’")
+    pieces, previous = [], 0
+    for cut in _cuts(base, language):
+        pieces.append(base[previous:cut])
+        previous = cut
+    pieces.append(base[previous:] + apostrophe + rest)
+    return pieces
+
+
+# --- reflow ---
+
+def _typical_width(lines: List[str]) -> int:
+    widths = sorted(len(line) for line in lines if line)
+    if not widths:
+        return 0
+    return widths[min(len(widths) - 1, int(len(widths) * 0.75))]
+
+
+def reflow(page: str, words: set, compounds: set) -> List[str]:
+    """Paragraphs of a page, with line-end hyphenation undone
+
+    ``words`` and ``compounds`` are the document's vocabulary (lower case),
+    used to tell a split word from a hyphenated compound.
+    """
+    lines = [_SPACES.sub(" ", line.strip()) for line in page.translate(_TRANSLATE).splitlines()]
+    width = _typical_width(lines)
+    paragraphs: List[str] = []
+    current: List[str] = []
+
+    def end_paragraph() -> None:
+        if current:
+            paragraphs.append("".join(current).rstrip())
+            current.clear()
+
+    for index, line in enumerate(lines):
+        if not line:
+            end_paragraph()
+            continue
+        if _LIST_ITEM.match(line):
+            end_paragraph()
+
+        following = lines[index + 1] if index + 1 < len(lines) else ""
+        hyphen = _LINE_END_HYPHEN.search(line)
+        tail = _LINE_START_WORD.match(following) if hyphen and following else None
+        if tail:
+            head_word, tail_word = hyphen.group(1).lower(), tail.group(0)
+            joined = head_word + tail_word
+            keep = f"{head_word}-{tail_word}" in compounds and joined not in words
+            current.append(line if keep else line[:-1])
+            continue  # the next line continues this word
+        current.append(line)
+
+        ends_sentence = line.rstrip(_CLOSING_QUOTES)[-1:] in _SENTENCE_PUNCTUATION
+        short = len(line) < width * SHORT_LINE
+        heading = short and not ends_sentence and following[:1].isupper() and len(line) < width * 0.6
+        if (short and ends_sentence) or heading:
+            end_paragraph()
+        else:
+            current.append(" ")
+    end_paragraph()
+    return paragraphs
+
+
+def split_sentences(paragraph: str) -> List[str]:
+    sentences, start = [], 0
+    for match in _SENTENCE_END.finditer(paragraph):
+        word_start = max(start, paragraph.rfind(" ", start, match.start()) + 1)
+        token = paragraph[word_start:match.start() + 1].lower()
+        # Abbreviations, initials (J. R. R. Tolkien) and list numbers do not end sentences
+        if token in ABBREVIATIONS or (len(token) == 2 and token[0].isalpha() and token[1] == "."):
+            continue
+        if word_start == start and token[:-1].isdigit():
+            continue
+        sentences.append(paragraph[start:match.end()].rstrip())
+        start = match.end()
+    if start < len(paragraph):
+        sentences.append(paragraph[start:].strip())
+    return [sentence for sentence in sentences if sentence]
+
+
+# --- statistics ---
+
+def _grade_level(grade: float) -> str:
+    if grade < 6:
+        return "elementary"
+    if grade < 9:
+        return "middle"
+    if grade < 13:
+        return "high"
+    if grade < 17:
+        return "college"
+    return "graduate"
+
+
+def readability(words: int, sentences: int, syllables: int, polysyllables: int, letters: int) -> Dict[str, Any]:
+    """Standard readability formulas; grades are US school years"""
+    if not words or not sentences:
+        return {}
+    words_per_sentence = words / sentences
+    syllables_per_word = syllables / words
+    grades = {
+        "flesch_kincaid": 0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59,
+        "gunning_fog": 0.4 * (words_per_sentence + 100 * polysyllables / words),
+        "smog": 1.043 * math.sqrt(polysyllables * 30 / sentences) + 3.1291,
+        "ari": 4.71 * letters / words + 0.5 * words_per_sentence - 21.43,
+        "coleman_liau": 0.0588 * (100 * letters / words) - 0.296 * (100 * sentences / words) - 15.8
+    }
+    # Very short sentences of short words push the formulas below zero
+    grades = {name: max(0.0, grade) for name, grade in grades.items()}
+    average = sum(grades.values()) / len(grades)
+    return {
+        "flesch_reading_ease": round(206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word, 1),
+        **{name: round(grade, 1) for name, grade in grades.items()},
+        "average": round(average, 1),
+        "level": _grade_level(average)
+    }
+
+
+def _document_pages(text: str) -> List[str]:
+    pages = split_pages(text)
+    # pdftotext output has no markers but separates pages with form feeds
+    if len(pages) == 1 and "\f" in pages[0]:
+        pages = [page.strip() for page in pages[0].rstrip("\f").split("\f")]
+    return pages
+
+
+def prepare(text: str, language: str = "eng") -> Dict[str, Any]:
+    """Reader-ready structure of a document's service output
+
+    ``pages`` holds paragraphs as lists of sentences; pages that could not be
+    read are flagged ``failed``. ``syllables`` maps each multi-syllable word
+    (lower case) to its pieces, once per document.
+    """
+    pages = _document_pages(text)
+    lowered = text.translate(_TRANSLATE).lower()
+    vocabulary = set(_WORD.findall(lowered))
+    compounds = set(_COMPOUND.findall(lowered))
+
+    result_pages: List[Dict[str, Any]] = []
+    word_counts: Counter = Counter()
+    paragraph_count = sentence_count = 0
+
+    for number, page in enumerate(pages, start=1):
+        if not page or FAILED_PAGE.match(page):
+            result_pages.append({"page": number, "failed": bool(page), "paragraphs": []})
+            continue
+        paragraphs = [split_sentences(paragraph) for paragraph in reflow(page, vocabulary, compounds)]
+        paragraphs = [sentences for sentences in paragraphs if sentences]
+        result_pages.append({"page": number, "paragraphs": paragraphs})
+        paragraph_count += len(paragraphs)
+        sentence_count += sum(len(sentences) for sentences in paragraphs)
+        word_counts.update(_WORD.findall(" ".join(" ".join(sentences) for sentences in paragraphs).lower()))
+
+    # Each distinct word is split once, however often it occurs
+    syllables: Dict[str, List[str]] = {}
+    counts = {"paragraphs": paragraph_count, "sentences": sentence_count, "words": 0, "syllables": 0, "letters": 0}
+    polysyllables = 0
+    for word, occurrences in word_counts.items():
+        pieces = split_syllables(word, language)
+        if len(pieces) > 1:
+            syllables[word] = pieces
+        counts["words"] += occurrences
+        counts["syllables"] += len(pieces) * occurrences
+        counts["letters"] += len(word) * occurrences
+        polysyllables += occurrences if len(pieces) >= 3 else 0
+
+    stats: Dict[str, Any] = {"pages": len(pages), **counts}
+    if counts["words"] and counts["sentences"]:
+        stats["words_per_sentence"] = round(counts["words"] / counts["sentences"], 2)
+        stats["syllables_per_word"] = round(counts["syllables"] / counts["words"], 2)
+    stats["readability"] = readability(
+        counts["words"], counts["sentences"], counts["syllables"], polysyllables, counts["letters"]
+    ) if language == "eng" else None
+    return {"language": language, "pages": result_pages, "syllables": syllables, "stats": stats}
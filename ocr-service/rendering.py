@@ -0,0 +1,549 @@
+"""In-memory page rendering and OCR worker pool
+
+The ``pymupdf`` backend rasterizes each PDF page with PyMuPDF straight into
+a shared memory block and hands the block's name to a pool of OCR worker
+processes, so no page image is ever written to disk. Workers run Tesseract
+through tesserocr when it is installed (one loaded model per worker and
+language), or else pipe the pixels to the ``tesseract`` CLI as a PGM on
+stdin. At most two pages per worker are rendered ahead, which bounds memory.
+
+The pool is shared by every upload, so a page may wait behind other jobs'
+pages. Its timeout only starts when a worker picks it up (workers report
+when they start a task); until then only its job's deadline applies. The
+CLI is killed at the page timeout; tesserocr runs in-process, so a page
+that outlives its timeout has its own worker killed and replaced, and the
+pages of other jobs carry on. Failed pages get a degraded retry, re-rendered
+at OCR_RETRY_DPI (see supervisor.py).
+
+With a page store, each rendered page is fingerprinted before it is handed
+out; pages seen before take their text from the store and skip OCR.
+
+The ``subprocess`` backend is the original pdftoppm + tesseract pipeline in
+app-simple.py. RENDER_BACKEND picks one; ``auto`` prefers pymupdf.
+"""
+
+import importlib.util
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from concurrent.futures import TimeoutError as FuturesTimeout
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from service_common import tracing
+from page_dedupe import OwnerPages, PageFingerprint, fingerprint_samples
+from supervisor import (
+    RETRY_DPI, RETRY_PSM, Deadline, OCRCounters, OCRCrashed, OCRTimeout, failed_page_text, is_failed_page,
+    ocr_with_retry, run_tesseract
+)
+
+logger = logging.getLogger(__name__)
+
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "auto")
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 2)))
+RENDER_DPI = int(os.getenv("RENDER_DPI", "300"))
+TESSERACT_PSM = "6"
+# Extra wait beyond the page timeout, so the CLI's own timeout fires before workers are killed
+KILL_GRACE_SECONDS = 2.0
+# How often the pool checks on its workers when none has anything to report
+WATCH_INTERVAL = 0.5
+
+PYMUPDF_AVAILABLE = importlib.util.find_spec("fitz") is not None
+TESSEROCR_AVAILABLE = importlib.util.find_spec("tesserocr") is not None
+
+
+def resolve_backend(name: str = RENDER_BACKEND) -> str:
+    if name == "auto":
+        return "pymupdf" if PYMUPDF_AVAILABLE else "subprocess"
+    if name not in ("pymupdf", "subprocess"):
+        raise ValueError(f"Unknown RENDER_BACKEND: {name}")
+    return name
+
+
+class QueuedPastDeadline(Exception):
+    """A page was still waiting for a worker when its job's deadline passed"""
+
+
+class WorkerKilled(OCRTimeout):
+    """A task ran past its timeout and the worker running it was killed"""
+
+
+class PoolTask:
+    """Work handed to a WorkerPool: its result, and when and on which worker it started"""
+
+    def __init__(self, token: int):
+        self.token = token
+        self.future: Future = Future()
+        self.started = threading.Event()
+        self.started_at: Optional[float] = None  # time.monotonic(), which is system-wide
+        self.pid: Optional[int] = None
+
+    def cancel(self) -> bool:
+        """Give up on a task no worker has started; its result is dropped if one picks it up anyway"""
+        return self.future.cancel()
+
+
+# Page index, its task (None when reused), shared memory (None when reused), shape,
+# fingerprint and text when reused
+InFlightPage = Tuple[int, Optional[PoolTask], Optional[SharedMemory], Tuple[int, int, int], Optional[PageFingerprint], Optional[str]]
+
+
+# --- worker process side ---
+
+def _worker_main(tasks, events) -> None:
+    """Run tasks from the shared queue until told to stop, reporting each start and result"""
+    # Own process group, so killing a worker also kills the tesseract it is running
+    os.setpgrp()
+    while True:
+        item = tasks.get()
+        if item is None:
+            break
+        token, target, args = item
+        events.send(("start", token, time.monotonic()))
+        try:
+            result = (True, target(*args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            events.send(("done", token, *result))
+        except Exception as e:
+            # The exception would not pickle
+            events.send(("done", token, False, RuntimeError(f"{type(result[1]).__name__}: {result[1]}; {e}")))
+
+
+_apis: Dict[str, object] = {}
+
+
+def _tesserocr_api(language: str, psm: str):
+    api = _apis.get((language, psm))
+    if api is None:
+        import tesserocr
+
+        api = tesserocr.PyTessBaseAPI(lang=language, psm=int(psm))
+        _apis[(language, psm)] = api
+    return api
+
+
+def ocr_shared_page(
+    shm_name: str,
+    width: int,
+    height: int,
+    stride: int,
+    language: str,
+    psm: str = TESSERACT_PSM,
+    timeout: Optional[float] = None
+) -> str:
+    """OCR an 8-bit grayscale page image held in shared memory (runs in a worker)"""
+    # Spawned workers share the parent's resource tracker, and the parent
+    # unlinks the block once the result is in
+    shm = SharedMemory(name=shm_name)
+    try:
+        pixels = bytes(shm.buf[:height * stride])
+    finally:
+        shm.close()
+
+    if TESSEROCR_AVAILABLE:
+        api = _tesserocr_api(language, psm)
+        api.SetImageBytes(pixels, width, height, 1, stride)
+        return api.GetUTF8Text().strip()
+
+    if stride != width:
+        pixels = b"".join(pixels[row * stride:row * stride + width] for row in range(height))
+    header = f"P5\n{width} {height}\n255\n".encode()
+    return run_tesseract(["stdin", "stdout", "-l", language, "--psm", psm], timeout, header + pixels)
+
+
+# --- service process side ---
+
+class _Worker:
+    __slots__ = ("process", "events", "task")
+
+    def __init__(self, process, events):
+        self.process = process
+        self.events = events
+        self.task: Optional[PoolTask] = None
+
+
+class WorkerPool:
+    """Worker processes taking tasks from one queue, each of which can be killed alone
+
+    ProcessPoolExecutor cannot do that: a running call cannot be cancelled, and
+    losing one worker breaks the pool and fails every call in it. Here each
+    worker reports on its own pipe when it starts a task, so a task's time
+    limit can start then, and a worker that died or was killed fails only the
+    task it was running and is replaced. A thread in the service process
+    collects reports and watches for workers that died.
+    """
+
+    def __init__(self, workers: int, context=None):
+        self.size = workers
+        self._context = context or multiprocessing.get_context("spawn")
+        self._tasks = self._context.SimpleQueue()
+        self._lock = threading.Lock()
+        self._workers: Dict[int, _Worker] = {}  # by pid
+        self._pending: Dict[int, PoolTask] = {}  # by token
+        self._tokens = itertools.count()
+        self._closed = False
+        self.started = 0
+        self.killed = 0
+        self.crashed = 0
+        for _ in range(workers):
+            self._start_worker()
+        self._watcher = threading.Thread(target=self._watch, name="ocr-pool-watcher", daemon=True)
+        self._watcher.start()
+
+    def _start_worker(self) -> None:
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_worker_main, args=(self._tasks, sender), daemon=True)
+        process.start()
+        sender.close()
+        self._workers[process.pid] = _Worker(process, receiver)
+        self.started += 1
+
+    def submit(self, target: Callable[..., Any], *args) -> PoolTask:
+        """Queue ``target(*args)``; ``target`` must be importable by name in the workers"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Worker pool is shut down")
+            task = PoolTask(next(self._tokens))
+            self._pending[task.token] = task
+        self._tasks.put((task.token, target, args))
+        return task
+
+    def _watch(self) -> None:
+        while not self._closed:
+            with self._lock:
+                workers = list(self._workers.values())
+            ready = multiprocessing.connection.wait(
+                [w.events for w in workers] + [w.process.sentinel for w in workers], WATCH_INTERVAL
+            )
+            for worker in workers:
+                if worker.events in ready:
+                    try:
+                        self._report(worker, worker.events.recv())
+                        continue
+                    except (EOFError, OSError):
+                        pass  # the worker is gone; its sentinel says so
+                    worker.process.join(1.0)
+                if worker.process.sentinel in ready or not worker.process.is_alive():
+                    # Whatever it sent before exiting is in the pipe
+                    while worker.events.poll():
+                        try:
+                            self._report(worker, worker.events.recv())
+                        except (EOFError, OSError):
+                            break
+                    self._lost(worker)
+
+    def _report(self, worker: _Worker, event: Tuple) -> None:
+        kind, token = event[0], event[1]
+        with self._lock:
+            task = self._pending.get(token)
+            if kind == "start":
+                worker.task = task
+            else:
+                worker.task = None
+                self._pending.pop(token, None)
+        if task is None:
+            return
+        if kind == "start":
+            # Set before the future runs, so wait() finds them once cancel() has failed
+            task.pid = worker.process.pid
+            task.started_at = event[2]
+            if task.future.set_running_or_notify_cancel():
+                task.started.set()
+            return
+        _, _, ok, value = event
+        try:
+            if ok:
+                task.future.set_result(value)
+            else:
+                task.future.set_exception(value)
+        except InvalidStateError:
+            pass  # cancelled, or already failed by a kill
+
+    def _lost(self, worker: _Worker) -> None:
+        """A worker exited: fail the task it was running and put a new worker in its place"""
+        with self._lock:
+            if self._workers.pop(worker.process.pid, None) is None:
+                return
+            task, worker.task = worker.task, None
+            if task is not None:
+                self._pending.pop(task.token, None)
+            if not self._closed:
+                self._start_worker()
+        worker.events.close()
+        worker.process.join(1.0)
+        if task is not None and not task.future.done():
+            self.crashed += 1
+            try:
+                task.future.set_exception(OCRCrashed(f"OCR worker died (exit code {worker.process.exitcode})"))
+            except InvalidStateError:
+                pass
+
+    def kill(self, task: PoolTask) -> bool:
+        """Kill the worker running ``task``, failing the task; False if the task finished first"""
+        with self._lock:
+            worker = self._workers.get(task.pid) if task.pid is not None else None
+            if worker is None or worker.task is not task or task.future.done():
+                return False
+            try:
+                task.future.set_exception(OCRTimeout("OCR worker was killed"))
+            except InvalidStateError:
+                return False
+            try:
+                os.killpg(task.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # Killed before it made its own group
+                worker.process.kill()
+            self.killed += 1
+        return True
+
+    def wait(self, task: PoolTask, timeout: float, deadline: Deadline) -> Any:
+        """Result of ``task``, with ``timeout`` counted from when a worker started it
+
+        A task no worker has started by the job deadline is cancelled
+        (QueuedPastDeadline); one that runs past its timeout has its worker
+        killed (WorkerKilled).
+        """
+        if not task.started.wait(deadline.remaining()) and task.cancel():
+            raise QueuedPastDeadline("Page was still queued for a worker at the job deadline")
+        if task.started_at is not None:
+            remaining = task.started_at + timeout + KILL_GRACE_SECONDS - time.monotonic()
+        else:
+            remaining = 0.0  # failed before any worker started it
+        try:
+            return task.future.result(timeout=max(0.0, remaining))
+        except FuturesTimeout:
+            if not self.kill(task):
+                # Finished just as its time ran out
+                return task.future.result(timeout=KILL_GRACE_SECONDS)
+            raise WorkerKilled(f"OCR worker ran longer than {timeout:.0f}s")
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers.values())
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for task in pending:
+            if not task.cancel() and not task.future.done():
+                try:
+                    task.future.set_exception(RuntimeError("Worker pool shut down"))
+                except InvalidStateError:
+                    pass
+        for _ in workers:
+            self._tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                try:
+                    os.killpg(worker.process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    worker.process.kill()
+                worker.process.join(1.0)
+        self._watcher.join(WATCH_INTERVAL * 2)
+        for worker in workers:
+            worker.events.close()
+        self._tasks.close()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "busy": sum(1 for worker in self._workers.values() if worker.task is not None),
+                "queued": sum(1 for task in self._pending.values() if not task.started.is_set() and not task.future.cancelled()),
+                "workers_started": self.started,
+                "workers_killed": self.killed,
+                "workers_crashed": self.crashed
+            }
+
+
+class PageOCRPool:
+    """Renders pages into shared memory and OCRs them on worker processes"""
+
+    def __init__(self, workers: int = OCR_WORKERS, dpi: int = RENDER_DPI):
+        self.workers = workers
+        self.dpi = dpi
+        self._pool_instance: Optional[WorkerPool] = None
+        self._lock = threading.Lock()
+        self.pages = 0
+
+    def _pool(self) -> WorkerPool:
+        with self._lock:
+            if self._pool_instance is None:
+                # spawn: forking a process that runs an event loop and threads is unsafe
+                self._pool_instance = WorkerPool(self.workers, multiprocessing.get_context("spawn"))
+            return self._pool_instance
+
+    def shutdown(self) -> None:
+        with self._lock:
+            pool, self._pool_instance = self._pool_instance, None
+        if pool is not None:
+            pool.shutdown()
+
+    def _submit(self, *args) -> PoolTask:
+        return self._pool().submit(ocr_shared_page, *args)
+
+    def _wait(self, task: PoolTask, timeout: float, deadline: Deadline, stats: OCRCounters) -> str:
+        try:
+            return self._pool().wait(task, timeout, deadline)
+        except WorkerKilled:
+            stats.incr("workers_killed")
+            raise
+
+    def ocr_pdf(
+        self,
+        pdf_bytes: bytes,
+        language: str,
+        deadline: Optional[Deadline] = None,
+        stats: Optional[OCRCounters] = None,
+        page_store: Optional[OwnerPages] = None
+    ) -> Tuple[List[str], Dict[str, float]]:
+        """Page texts for a PDF plus seconds spent rendering, deduplicating and waiting on OCR
+
+        Pages that cannot be read are marked in place; the rest are returned.
+        """
+        import fitz  # PyMuPDF
+
+        deadline = deadline or Deadline()
+        stats = stats or OCRCounters()
+        in_flight: Deque[InFlightPage] = deque()
+        texts: List[str] = []
+        # Newly OCRed pages, remembered once the document is done
+        fresh: List[Tuple[PageFingerprint, str]] = []
+        # Per-page spans from hand-off to result, so queueing behind other pages shows
+        page_spans: Dict[int, tracing.Span] = {}
+        render_seconds = dedupe_seconds = 0.0
+        started = time.perf_counter()
+
+        def rasterize(index: int, dpi: int):
+            return document.load_page(index).get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+
+        def share(pixmap) -> Tuple[SharedMemory, Tuple[int, int, int]]:
+            size = pixmap.stride * pixmap.height
+            shm = SharedMemory(create=True, size=max(1, size))
+            shm.buf[:size] = pixmap.samples_mv
+            return shm, (pixmap.width, pixmap.height, pixmap.stride)
+
+        def render(index: int, dpi: int) -> Tuple[SharedMemory, Tuple[int, int, int]]:
+            return share(rasterize(index, dpi))
+
+        def collect() -> None:
+            index, task, shm, shape, page_fingerprint, known = in_flight.popleft()
+            if task is None:
+                texts.append(known)  # reused from the page store
+                return
+
+            def attempt(timeout: float) -> str:
+                # Submitted with the page timeout of its hand-off; the worker's clock starts when it picks it up
+                return self._wait(task, timeout, deadline, stats)
+
+            def degraded(timeout: float) -> str:
+                retry_shm, retry_shape = render(index, RETRY_DPI)
+                try:
+                    return self._wait(self._submit(retry_shm.name, *retry_shape, language, RETRY_PSM, timeout), timeout, deadline, stats)
+                finally:
+                    retry_shm.close()
+                    retry_shm.unlink()
+
+            span = page_spans.pop(index, None)
+            text = None
+            try:
+                text = ocr_with_retry(index + 1, attempt, degraded, deadline, stats)
+            finally:
+                shm.close()
+                shm.unlink()
+                if span is not None:
+                    if text is None or is_failed_page(text):
+                        span.record_error(text.strip() if text else "page not read")
+                    span.end()
+            texts.append(text)
+            if page_fingerprint is not None and not is_failed_page(text):
+                fresh.append((page_fingerprint, text))
+
+        document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            for index in range(document.page_count):
+                if len(in_flight) >= 2 * self.workers:
+                    collect()
+                if deadline.expired:
+                    break
+                render_started = time.perf_counter()
+                with tracing.span("ocr.rasterize", page=index + 1, dpi=self.dpi):
+                    pixmap = rasterize(index, self.dpi)
+                render_seconds += time.perf_counter() - render_started
+
+                page_fingerprint = None
+                if page_store is not None:
+                    dedupe_started = time.perf_counter()
+                    page_fingerprint = fingerprint_samples(pixmap.samples_mv, pixmap.width, pixmap.height, pixmap.stride)
+                    known = page_store.lookup(page_fingerprint, language)
+                    dedupe_seconds += time.perf_counter() - dedupe_started
+                    if known is not None:
+                        stats.incr("reused")
+                        in_flight.append((index, None, None, (0, 0, 0), None, known))
+                        continue
+
+                shm, shape = share(pixmap)
+                del pixmap
+                try:
+                    task = self._submit(shm.name, *shape, language, TESSERACT_PSM, deadline.page_timeout())
+                except Exception:
+                    shm.close()
+                    shm.unlink()
+                    raise
+                in_flight.append((index, task, shm, shape, page_fingerprint, None))
+                span = tracing.start_span("ocr.page", page=index + 1, language=language)
+                if span is not None:
+                    page_spans[index] = span
+                self.pages += 1
+            while in_flight:
+                collect()
+
+            if deadline.expired:
+                stats.incr("job_timeouts")
+            if len(texts) < document.page_count:
+                logger.warning(f"Job deadline reached after {len(texts)} of {document.page_count} pages")
+                stats.incr("failed_pages", document.page_count - len(texts))
+                texts.extend(failed_page_text(page, "job deadline") for page in range(len(texts) + 1, document.page_count + 1))
+        finally:
+            document.close()
+            # Only reached with pages left on an error; release their blocks
+            while in_flight:
+                _, task, shm, _, _, _ = in_flight.popleft()
+                if task is not None:
+                    task.cancel()
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+
+        if fresh:
+            dedupe_started = time.perf_counter()
+            page_store.store(fresh, language)
+            dedupe_seconds += time.perf_counter() - dedupe_started
+        total = time.perf_counter() - started
+        return texts, {
+            "rasterize": render_seconds,
+            "dedupe": dedupe_seconds,
+            "ocr": max(0.0, total - render_seconds - dedupe_seconds)
+        }
+
+    def get_stats(self) -> Dict[str, object]:
+        pool = self._pool_instance
+        return {
+            "workers": self.workers,
+            "dpi": self.dpi,
+            "engine": "tesserocr" if TESSEROCR_AVAILABLE else "tesseract-cli",
+            "pages": self.pages,
+            "pool": pool.get_stats() if pool is not None else None
+        }
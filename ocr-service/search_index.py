@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Document Search Index
+Full-text search over OCRed documents, per page, in SQLite FTS5
+
+Each completed OCR job is queued with its page texts and written to the
+index by a background thread, so responses never wait on disk. Page text is
+kept in a ``pages`` table and indexed by an external-content FTS5 table
+(unicode61 tokenizer, diacritics folded, 2- and 3-character prefix indexes),
+so a query is one index lookup regardless of how many documents are
+indexed. Character offsets of the matches are then found in the few pages
+returned.
+
+Every document belongs to the owner (user, session or address, see
+caller_identity.Caller.owner) of the upload, and a search only sees its
+caller's documents. Documents indexed before owners were recorded have none
+and are not returned to anyone.
+
+Query syntax: words must all appear on the page, ``"quoted words"`` must
+appear as a phrase and a trailing ``*`` makes a word a prefix.
+
+Results are ranked by BM25, which has to score every matching page. A short
+prefix can match most of the index, so by default (``order=auto``) prefix
+queries return the most recently indexed pages first instead, which FTS5
+answers from the end of its doclists in well under a millisecond.
+
+SEARCH_INDEX_PATH sets the database file; an empty value disables indexing.
+The file is in WAL mode, so every worker on the host can share it.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search/index.db")
+SEARCH_FLUSH_INTERVAL = float(os.getenv("SEARCH_FLUSH_INTERVAL", "0.2"))
+MAX_RESULTS = 100
+ORDERS = ("auto", "relevance", "recent")
+
+PAGE_MARKER = re.compile(r"^--- Page (\d+) ---$", re.MULTILINE)
+# Placeholder text the services return for pages they could not read
+FAILED_PAGE = re.compile(r"^(OCR failed|OCR error|Text extraction failed)")
+_QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+_WORD = re.compile(r"\w+")
+
+
+class InvalidQuery(ValueError):
+    """The search string has no searchable terms"""
+
+
+class Term(NamedTuple):
+    words: Tuple[str, ...]
+    prefix: bool
+
+
+def split_pages(text: str) -> List[str]:
+    """Page texts from service output with ``--- Page N ---`` markers
+
+    Output without markers (the pdftotext fallback) is a single page.
+    """
+    matches = list(PAGE_MARKER.finditer(text))
+    if not matches:
+        return [text] if text.strip() else []
+    pages = [""] * max(int(match.group(1)) for match in matches)
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        pages[int(match.group(1)) - 1] = text[match.end():end].strip()
+    return pages
+
+
+def parse_query(query: str) -> List[Term]:
+    terms = []
+    for phrase, word in _QUERY_TOKEN.findall(query):
+        prefix = bool(word) and word.endswith("*")
+        words = tuple(_WORD.findall(phrase or word))
+        if words:
+            terms.append(Term(words, prefix))
+    if not terms:
+        raise InvalidQuery("Query has no searchable words")
+    return terms
+
+
+def fts_expression(terms: List[Term]) -> str:
+    """FTS5 MATCH expression; every word is quoted, so no user text is parsed as syntax"""
+    parts = []
+    for term in terms:
+        phrase = '"' + " ".join(term.words) + '"'
+        parts.append(phrase + ("*" if term.prefix else ""))
+    return " AND ".join(parts)
+
+
+def fold(text: str) -> str:
+    """Strip diacritics like the tokenizer does, keeping one character per character"""
+    folded = []
+    for char in text:
+        if char.isascii():
+            folded.append(char)
+            continue
+        base = [c for c in unicodedata.normalize("NFD", char) if not unicodedata.combining(c)]
+        folded.append(base[0] if len(base) == 1 else char)
+    return "".join(folded)
+
+
+def match_offsets(text: str, terms: List[Term], limit: int = 20) -> List[Tuple[int, int]]:
+    """Character spans of each term in ``text``, in order of appearance"""
+    text = fold(text)
+    spans = []
+    for term in terms:
+        pattern = r"\W+".join(re.escape(fold(word)) for word in term.words)
+        pattern = r"\b" + pattern + (r"\w*" if term.prefix else r"\b")
+        spans.extend(match.span() for match in re.finditer(pattern, text, re.IGNORECASE))
+    return sorted(spans)[:limit]
+
+
+class SearchIndex:
+    """Per-page FTS5 index of OCR output with write-behind indexing"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id TEXT NOT NULL UNIQUE,
+            owner TEXT NOT NULL DEFAULT '',
+            filename TEXT NOT NULL,
+            language TEXT NOT NULL,
+            pages INTEGER NOT NULL,
+            indexed_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_id INTEGER NOT NULL REFERENCES documents (id),
+            page INTEGER NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS documents_owner ON documents (owner);
+        CREATE INDEX IF NOT EXISTS pages_document ON pages (document_id, page);
+        CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5 (
+            text,
+            content = 'pages',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
+        );
+    """
+
+    def __init__(self, path: str = SEARCH_INDEX_PATH, flush_interval: float = SEARCH_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending: Deque[Dict[str, Any]] = deque()
+        self._wake = threading.Event()
+        self._flushed = threading.Condition(self._lock)
+        self._closed = False
+        self.documents_indexed = 0
+        self.pages_indexed = 0
+        self.searches = 0
+        self.last_search_ms = 0.0
+
+        with self._connection() as db:
+            columns = {row[1] for row in db.execute("PRAGMA table_info(documents)")}
+            if columns and "owner" not in columns:
+                logger.warning(f"Documents in {path} were indexed without owners; they are no longer searchable")
+                db.execute("ALTER TABLE documents ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            db.executescript(self.SCHEMA)
+        self._writer = threading.Thread(target=self._write_loop, name="search-indexer", daemon=True)
+        self._writer.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection; sqlite3 connections are not shared across threads"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5.0)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.row_factory = sqlite3.Row
+            self._local.db = db
+        return db
+
+    def add(self, job_id: str, owner: str, filename: str, language: str, text: str) -> None:
+        """Queue a finished job's text for indexing under ``owner``; returns immediately"""
+        with self._lock:
+            self._pending.append({
+                "job_id": job_id,
+                "owner": owner,
+                "filename": filename,
+                "language": language,
+                "pages": split_pages(text),
+                "indexed_at": datetime.utcnow().isoformat()
+            })
+        self._wake.set()
+
+    def _write_loop(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self._write_batch()
+            except Exception as e:
+                logger.error(f"Failed to write search index batch: {e}")
+                time.sleep(self.flush_interval)
+
+    def _write_batch(self) -> None:
+        with self._lock:
+            batch = list(self._pending)
+        if not batch:
+            return
+
+        db = self._connection()
+        pages_written = 0
+        with db:
+            for document in batch:
+                self._remove(db, document["job_id"])
+                cursor = db.execute(
+                    "INSERT INTO documents (job_id, owner, filename, language, pages, indexed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (document["job_id"], document["owner"], document["filename"], document["language"],
+                     len(document["pages"]), document["indexed_at"])
+                )
+                document_id = cursor.lastrowid
+                for number, text in enumerate(document["pages"], start=1):
+                    if not text or FAILED_PAGE.match(text):
+                        continue
+                    page_id = db.execute(
+                        "INSERT INTO pages (document_id, page, text) VALUES (?, ?, ?)",
+                        (document_id, number, text)
+                    ).lastrowid
+                    db.execute("INSERT INTO page_text (rowid, text) VALUES (?, ?)", (page_id, text))
+                    pages_written += 1
+
+        # Documents only leave the queue once they are searchable
+        with self._lock:
+            for _ in range(len(batch)):
+                self._pending.popleft()
+            self.documents_indexed += len(batch)
+            self.pages_indexed += pages_written
+            self._flushed.notify_all()
+
+    @staticmethod
+    def _remove(db: sqlite3.Connection, job_id: str) -> bool:
+        row = db.execute("SELECT id FROM documents WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return False
+        # External-content FTS5 rows are deleted by handing back the indexed text
+        db.execute(
+            "INSERT INTO page_text (page_text, rowid, text) SELECT 'delete', id, text FROM pages WHERE document_id = ?",
+            (row["id"],)
+        )
+        db.execute("DELETE FROM pages WHERE document_id = ?", (row["id"],))
+        db.execute("DELETE FROM documents WHERE id = ?", (row["id"],))
+        return True
+
+    def remove(self, job_id: str) -> bool:
+        self.flush()
+        db = self._connection()
+        with db:
+            return self._remove(db, job_id)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Wait until everything queued so far is searchable"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            target = self.documents_indexed + len(self._pending)
+            self._wake.set()
+            while self.documents_indexed < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._writer.is_alive():
+                    return False
+                self._flushed.wait(remaining)
+        return True
+
+    def search(
+        self,
+        query: str,
+        owner: str,
+        limit: int = 20,
+        language: Optional[str] = None,
+        job_id: Optional[str] = None,
+        order: str = "auto"
+    ) -> Dict[str, Any]:
+        """Pages of ``owner``'s documents matching ``query``, with match offsets and a snippet"""
+        started = time.perf_counter()
+        terms = parse_query(query)
+        if order not in ORDERS:
+            raise InvalidQuery(f"order must be one of {', '.join(ORDERS)}")
+        if order == "auto":
+            order = "recent" if any(term.prefix for term in terms) else "relevance"
+        filters, params = " AND d.owner = ?", [fts_expression(terms), owner]
+        if language:
+            filters += " AND d.language = ?"
+            params.append(language)
+        if job_id:
+            filters += " AND d.job_id = ?"
+            params.append(job_id)
+        params.append(max(1, min(limit, MAX_RESULTS)))
+
+        rows = self._connection().execute(
+            f"""
+            SELECT d.job_id, d.filename, d.language, p.page, p.text,
+                   bm25(page_text) AS score,
+                   snippet(page_text, 0, '[', ']', '…', 16) AS snippet
+            FROM page_text
+            JOIN pages p ON p.id = page_text.rowid
+            JOIN documents d ON d.id = p.document_id
+            WHERE page_text MATCH ?{filters}
+            ORDER BY {"rank" if order == "relevance" else "page_text.rowid DESC"}
+            LIMIT ?
+            """,
+            params
+        ).fetchall()
+
+        hits = [
+            {
+                "job_id": row["job_id"],
+                "filename": row["filename"],
+                "language": row["language"],
+                "page": row["page"],
+                "score": round(-row["score"], 4),
+                "offsets": match_offsets(row["text"], terms),
+                "snippet": row["snippet"]
+            }
+            for row in rows
+        ]
+        took_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.searches += 1
+        self.last_search_ms = took_ms
+        return {"query": query, "order": order, "hits": hits, "took_ms": took_ms}
+
+    def close(self) -> None:
+        if not self.flush():
+            logger.warning(f"Search indexer did not flush before shutdown ({len(self._pending)} documents pending)")
+        self._closed = True
+        self._wake.set()
+        self._writer.join(timeout=1.0)
+
+    def get_stats(self) -> Dict[str, Any]:
+        row = self._connection().execute(
+            "SELECT (SELECT COUNT(*) FROM documents) AS documents, (SELECT COUNT(*) FROM pages) AS pages"
+        ).fetchone()
+        return {
+            "path": self.path,
+            "documents": row["documents"],
+            "pages": row["pages"],
+            "pending": len(self._pending),
+            "searches": self.searches,
+            "last_search_ms": self.last_search_ms
+        }
+
+
+def create_search_index(path: str = SEARCH_INDEX_PATH) -> Optional[SearchIndex]:
+    """The index at ``path``, or None when search is disabled or SQLite lacks FTS5"""
+    if not path:
+        return None
+    try:
+        return SearchIndex(path)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Search index unavailable: {e}")
+        return None
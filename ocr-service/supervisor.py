@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+OCR Supervision
+Deadlines, runaway-process kills and degraded retries for OCR work
+
+Every job gets a deadline (OCR_JOB_TIMEOUT) and every page a timeout
+(OCR_PAGE_TIMEOUT, cut short by the job deadline). A page that times out,
+crashes its worker or fails is retried once at a degraded setting (lower
+DPI, automatic page segmentation); if that also fails the page is marked in
+the output and the rest of the document is still returned.
+
+Work that cannot be interrupted in-process (OCRmyPDF, tesserocr) runs in a
+child process that is killed, with everything it started, when its time is
+up. Supervised children fork from a forkserver that has the heavy imports
+preloaded, so they start in milliseconds without inheriting the service's
+threads. Timeouts, retries and failures are counted per job and per worker.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OCR_PAGE_TIMEOUT = float(os.getenv("OCR_PAGE_TIMEOUT", "60"))
+OCR_JOB_TIMEOUT = float(os.getenv("OCR_JOB_TIMEOUT", "600"))
+# Degraded retry: pages re-rendered at this DPI and segmented automatically
+RETRY_DPI = int(os.getenv("OCR_RETRY_DPI", "150"))
+RETRY_PSM = os.getenv("OCR_RETRY_PSM", "3")
+# Share of the job deadline the first OCRmyPDF attempt may use; the rest is for the retry
+FIRST_ATTEMPT_SHARE = 0.7
+
+
+class OCRTimeout(Exception):
+    """OCR work ran past its deadline and was killed"""
+
+
+class OCRCrashed(Exception):
+    """A supervised OCR process died without reporting a result"""
+
+
+class Deadline:
+    """Wall-clock budget for one job"""
+
+    def __init__(self, seconds: float = OCR_JOB_TIMEOUT):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def page_timeout(self, page_timeout: float = OCR_PAGE_TIMEOUT) -> float:
+        """Timeout for the next page: the page limit or what is left of the job, if less"""
+        return min(page_timeout, self.remaining())
+
+
+class OCRCounters:
+    """Supervision counters; one per job, merged into the worker's totals"""
+
+    FIELDS = (
+        "pages", "page_timeouts", "requeued", "retries", "recovered",
+        "failed_pages", "workers_killed", "job_timeouts", "reused"
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += amount
+
+    def merge(self, other: "OCRCounters") -> None:
+        with self._lock:
+            for name, value in other.counts.items():
+                self.counts[name] += value
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+# This worker's totals across jobs, for /metrics
+counters = OCRCounters()
+
+
+def failed_page_text(page: int, reason: str) -> str:
+    """Placeholder for a page that could not be read; the search index skips these"""
+    return f"OCR failed for page {page} ({reason})"
+
+
+def is_failed_page(text: str) -> bool:
+    return text.startswith("OCR failed for page")
+
+
+def run_tesseract(args: list, timeout: Optional[float], input: Optional[bytes] = None) -> str:
+    """Run the tesseract CLI writing to stdout; killed and OCRTimeout raised past ``timeout``"""
+    try:
+        result = subprocess.run(["tesseract", *args], input=input, capture_output=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise OCRTimeout(f"tesseract ran longer than {timeout:.0f}s")
+    if result.returncode != 0:
+        raise RuntimeError(f"Tesseract failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout.decode("utf-8", errors="replace").strip()
+
+
+def ocr_with_retry(
+    page: int,
+    attempt: Callable[[float], str],
+    degraded: Callable[[float], str],
+    deadline: Deadline,
+    stats: OCRCounters
+) -> str:
+    """Text of one page: ``attempt``, then once ``degraded``, else a failure marker
+
+    Both callables take the timeout in seconds for that try.
+    """
+    stats.incr("pages")
+    try:
+        return attempt(deadline.page_timeout())
+    except OCRTimeout as e:
+        stats.incr("page_timeouts")
+        reason = "timeout"
+        logger.warning(f"Page {page}: {e}")
+    except Exception as e:
+        reason = "error"
+        logger.warning(f"Page {page} failed: {e}")
+
+    if deadline.expired:
+        stats.incr("failed_pages")
+        return failed_page_text(page, "job deadline")
+    stats.incr("retries")
+    try:
+        text = degraded(deadline.page_timeout())
+        stats.incr("recovered")
+        return text
+    except OCRTimeout as e:
+        stats.incr("page_timeouts")
+        logger.warning(f"Page {page} degraded retry: {e}")
+    except Exception as e:
+        logger.warning(f"Page {page} degraded retry failed: {e}")
+    stats.incr("failed_pages")
+    return failed_page_text(page, reason)
+
+
+_context = multiprocessing.get_context("forkserver")
+
+
+def preload(modules: List[str]) -> None:
+    """Modules the forkserver imports once for every supervised child; call before the first job"""
+    _context.set_forkserver_preload(modules)
+
+
+def _run_child(target: Callable[..., Any], args: Tuple, connection) -> None:
+    # Own process group, so a kill also takes down whatever the target starts
+    os.setpgrp()
+    try:
+        target(*args)
+        connection.send(None)
+    except BaseException as e:
+        connection.send(f"{type(e).__name__}: {e}")
+    finally:
+        connection.close()
+
+
+def run_supervised(target: Callable[..., Any], args: Tuple, timeout: float, stats: OCRCounters) -> None:
+    """Run ``target(*args)`` in a fresh process; kill it and its children after ``timeout``
+
+    ``target`` must be importable by name and report through files, as its
+    return value is discarded. Its exceptions are re-raised here as
+    RuntimeError; OCRTimeout and OCRCrashed mean it never finished.
+    """
+    receiver, sender = _context.Pipe(duplex=False)
+    process = _context.Process(target=_run_child, args=(target, args, sender), daemon=False)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            stats.incr("workers_killed")
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                # Killed before it made its own group
+                process.kill()
+            raise OCRTimeout(f"OCR process ran longer than {timeout:.0f}s")
+        try:
+            error = receiver.recv()
+        except EOFError:
+            process.join()
+            raise OCRCrashed(f"OCR process crashed (exit code {process.exitcode})")
+        if error:
+            raise RuntimeError(error)
+    finally:
+        process.join(timeout=5)
+        receiver.close()
+
+
+def ocrmypdf_job(input_path: str, output_path: str, options: Dict[str, Any]) -> None:
+    """OCRmyPDF run for run_supervised"""
+    import ocrmypdf
+
+    ocrmypdf.ocr(input_path, output_path, **options)
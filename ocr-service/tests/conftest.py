@@ -0,0 +1,10 @@
+"""Make the service's modules and service_common importable from the tests"""
+
+import sys
+from pathlib import Path
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+
+for path in (SERVICE_DIR.parent, SERVICE_DIR):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
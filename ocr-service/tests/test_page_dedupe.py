@@ -0,0 +1,90 @@
+"""PageStore: exact and near-duplicate reuse, kept to the owner that stored the page"""
+
+import numpy as np
+import pytest
+
+from page_dedupe import PageStore, fingerprint
+
+ALICE = "acme/user:alice"
+BOB = "acme/user:bob"
+
+
+def render_page(seed=0):
+    """A white 850x1100 page with lines of dark "words", like a 100 dpi scan"""
+    rng = np.random.default_rng(seed)
+    page = np.full((1100, 850), 250, dtype=np.uint8)
+    for top in range(80, 1000, 40):
+        left = 60
+        while left < 760:
+            width = int(rng.integers(20, 90))
+            page[top:top + 18, left:left + width] = 30
+            left += width + int(rng.integers(10, 25))
+    return page
+
+
+def rerender(page, seed=1):
+    """The same page with a little pixel noise, as re-saving or re-rendering leaves"""
+    noise = np.random.default_rng(seed).integers(-3, 4, page.shape)
+    return np.clip(page.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return PageStore(str(tmp_path / "pages.db"))
+
+
+def test_exact_match_is_kept_to_its_owner(store):
+    page = fingerprint(render_page())
+    store.for_owner(ALICE, verified=True).store([(page, "page text")], "eng")
+
+    assert store.for_owner(ALICE, verified=True).lookup(page, "eng") == "page text"
+    assert store.for_owner(BOB, verified=True).lookup(page, "eng") is None
+    assert store.for_owner(ALICE, verified=True).lookup(page, "deu") is None
+    stats = store.get_stats()
+    assert stats["exact_matches"] == 1
+    assert stats["checked"] == 3
+    assert stats["reused"] == 1
+
+
+def test_near_duplicate_is_reused_for_a_verified_owner(store):
+    original = render_page()
+    store.for_owner(ALICE, verified=True).store([(fingerprint(original), "page text")], "eng")
+
+    again = fingerprint(rerender(original))
+    assert again.digest != fingerprint(original).digest
+    assert store.for_owner(ALICE, verified=True).lookup(again, "eng") == "page text"
+    assert store.get_stats()["near_matches"] == 1
+    assert store.for_owner(BOB, verified=True).lookup(again, "eng") is None
+
+
+def test_no_near_matching_for_anonymous_owners(store):
+    owner = "default/ip:203.0.113.9"
+    original = render_page()
+    store.for_owner(owner, verified=False).store([(fingerprint(original), "page text")], "eng")
+    assert store.for_owner(owner, verified=False).lookup(fingerprint(rerender(original)), "eng") is None
+    assert store.get_stats()["near_matches"] == 0
+
+
+def test_no_near_matching_when_disabled(tmp_path):
+    store = PageStore(str(tmp_path / "pages.db"), near=False)
+    original = render_page()
+    store.for_owner(ALICE, verified=True).store([(fingerprint(original), "page text")], "eng")
+    assert store.for_owner(ALICE, verified=True).lookup(fingerprint(rerender(original)), "eng") is None
+
+
+def test_a_changed_word_is_not_a_near_duplicate(store):
+    original = render_page()
+    store.for_owner(ALICE, verified=True).store([(fingerprint(original), "page text")], "eng")
+
+    # Small enough to pass the hash and thumbnail checks; only the detail render sees it
+    changed = original.copy()
+    changed[1040:1050, 400:408] = 30
+    assert store.for_owner(ALICE, verified=True).lookup(fingerprint(changed), "eng") is None
+    stats = store.get_stats()
+    assert stats["near_rejected"] == 1
+    assert stats["near_matches"] == 0
+
+
+def test_different_page_is_not_matched(store):
+    store.for_owner(ALICE, verified=True).store([(fingerprint(render_page(0)), "page text")], "eng")
+    assert store.for_owner(ALICE, verified=True).lookup(fingerprint(render_page(1)), "eng") is None
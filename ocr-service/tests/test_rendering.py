@@ -0,0 +1,60 @@
+"""PageOCRPool and WorkerPool: killing a hung page, crashes and the job deadline"""
+
+import os
+import time
+
+import pytest
+
+from rendering import PageOCRPool, QueuedPastDeadline, WorkerKilled
+from supervisor import Deadline, OCRCounters, OCRCrashed
+
+
+@pytest.fixture
+def ocr_pool():
+    ocr_pool = PageOCRPool(workers=2)
+    yield ocr_pool
+    ocr_pool.shutdown()
+
+
+def test_hung_page_is_killed_without_failing_the_others(ocr_pool):
+    pool = ocr_pool._pool()
+    deadline, stats = Deadline(60), OCRCounters()
+    hung = pool.submit(time.sleep, 30)
+    other = pool.submit(pow, 3, 4)
+
+    started = time.monotonic()
+    with pytest.raises(WorkerKilled):
+        ocr_pool._wait(hung, 0.5, deadline, stats)
+    # The limit runs from when a worker took the page, plus the kill grace
+    assert time.monotonic() - started < 10
+    assert stats.get_stats()["workers_killed"] == 1
+    assert ocr_pool._wait(other, 5, deadline, stats) == 81
+
+    # The killed worker is replaced and the pool keeps serving
+    assert ocr_pool._wait(pool.submit(pow, 2, 10), 5, deadline, stats) == 1024
+    pool_stats = ocr_pool.get_stats()["pool"]
+    assert pool_stats["workers_killed"] == 1
+    assert pool_stats["workers_started"] == 3
+
+
+def test_worker_crash_fails_only_its_task(ocr_pool):
+    pool = ocr_pool._pool()
+    deadline, stats = Deadline(60), OCRCounters()
+    with pytest.raises(OCRCrashed):
+        ocr_pool._wait(pool.submit(os._exit, 3), 10, deadline, stats)
+    assert ocr_pool._wait(pool.submit(pow, 2, 3), 10, deadline, stats) == 8
+    assert ocr_pool.get_stats()["pool"]["workers_crashed"] == 1
+
+
+def test_page_still_queued_at_the_job_deadline_is_cancelled(ocr_pool):
+    pool = ocr_pool._pool()
+    stats = OCRCounters()
+    # Both workers busy, so the third task never starts
+    busy = [pool.submit(time.sleep, 2) for _ in range(2)]
+    queued = pool.submit(pow, 2, 2)
+    with pytest.raises(QueuedPastDeadline):
+        ocr_pool._wait(queued, 10, Deadline(0.5), stats)
+    assert queued.future.cancelled()
+    assert stats.get_stats()["workers_killed"] == 0
+    for task in busy:
+        ocr_pool._wait(task, 10, Deadline(60), stats)
@@ -0,0 +1,71 @@
+"""SearchIndex: owner scoping, page splitting, query parsing and re-indexing"""
+
+import pytest
+
+from search_index import InvalidQuery, SearchIndex, fts_expression, parse_query, split_pages
+
+ALICE = "acme/user:alice"
+BOB = "acme/user:bob"
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "index.db"), flush_interval=0.01)
+    yield index
+    index.close()
+
+
+def job_ids(result):
+    return sorted(hit["job_id"] for hit in result["hits"])
+
+
+def test_split_pages():
+    text = "--- Page 1 ---\nphotosynthesis\n\n--- Page 3 ---\nchlorophyll"
+    assert split_pages(text) == ["photosynthesis", "", "chlorophyll"]
+    assert split_pages("no markers here") == ["no markers here"]
+    assert split_pages("   ") == []
+
+
+def test_query_syntax_is_quoted():
+    assert fts_expression(parse_query('photo* "light reaction" OR')) == '"photo"* AND "light reaction" AND "OR"'
+    with pytest.raises(InvalidQuery):
+        parse_query("*** ---")
+
+
+def test_search_only_returns_the_owners_documents(index):
+    index.add("job-a", ALICE, "alice.pdf", "eng", "--- Page 1 ---\nPhotosynthesis in plants")
+    index.add("job-b", BOB, "bob.pdf", "eng", "--- Page 1 ---\nPhotosynthesis and respiration")
+    assert index.flush()
+
+    assert job_ids(index.search("photosynthesis", ALICE)) == ["job-a"]
+    assert job_ids(index.search("photosynthesis", BOB)) == ["job-b"]
+    assert index.search("photosynthesis", "acme/ip:203.0.113.9")["hits"] == []
+    # Filtering by another owner's job id does not reach it either
+    assert index.search("photosynthesis", ALICE, job_id="job-b")["hits"] == []
+
+
+def test_hits_name_the_page_and_match_offsets(index):
+    text = "--- Page 1 ---\nIntroduction\n\n--- Page 2 ---\nThe café serves photosynthesis snacks"
+    index.add("job-a", ALICE, "alice.pdf", "eng", text)
+    assert index.flush()
+
+    [hit] = index.search("cafe", ALICE)["hits"]
+    assert hit["page"] == 2
+    assert hit["offsets"] == [(4, 8)]
+    assert index.search("photo*", ALICE)["order"] == "recent"
+
+
+def test_failed_pages_are_not_indexed(index):
+    index.add("job-a", ALICE, "alice.pdf", "eng", "--- Page 1 ---\nOCR failed for page 1: timeout")
+    assert index.flush()
+    assert index.search("timeout", ALICE)["hits"] == []
+
+
+def test_reindexing_a_job_replaces_its_pages(index):
+    index.add("job-a", ALICE, "alice.pdf", "eng", "--- Page 1 ---\nfirst draft")
+    index.add("job-a", ALICE, "alice.pdf", "eng", "--- Page 1 ---\nfinal version")
+    assert index.flush()
+    assert index.search("draft", ALICE)["hits"] == []
+    assert job_ids(index.search("final", ALICE)) == ["job-a"]
+    assert index.remove("job-a")
+    assert index.search("final", ALICE)["hits"] == []
@@ -0,0 +1,36 @@
+"""Per-stage wall-clock timing for OCR jobs
+
+Each timed stage is also a span (``stage.<name>``) in the request's trace.
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from service_common import tracing
+
+
+class StageTimer:
+    """Accumulates elapsed seconds per named stage of a job"""
+
+    def __init__(self):
+        self.timings: Dict[str, float] = {}
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"stage.{name}"):
+                yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def add(self, name: str, seconds: float) -> None:
+        """Record time measured elsewhere, e.g. by a worker pool"""
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def as_dict(self) -> Dict[str, float]:
+        result = {name: round(seconds, 4) for name, seconds in self.timings.items()}
+        result["total"] = round(time.perf_counter() - self._started, 4)
+        return result
@@ -0,0 +1,8 @@
+"""
+Service Common
+Modules the OCR service and the voice server both run
+
+Each service's image copies this package next to its own modules (both are
+built from the repository root); run a service locally with the repository
+root on PYTHONPATH.
+"""
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Artifact Serving
+Range, conditional and precompressed responses for files on disk
+
+ArtifactResponse streams a file without ever holding all of it in memory.
+It answers single-range ``Range`` requests (honouring ``If-Range``) with 206,
+so audio can seek and PDF viewers can fetch the pages they show, and
+``If-None-Match`` / ``If-Modified-Since`` revalidations with 304. When the
+client accepts it and a ``.br`` or ``.gz`` variant at least as new as the file
+sits next to it, the variant is sent with ``Content-Encoding`` instead. A
+request with ``Range`` always gets the file itself: byte offsets into the
+compressed variant are not what audio players and PDF viewers seek by.
+
+If the ASGI server offers the ``http.response.zerocopy`` extension the body
+goes out through the server's sendfile; otherwise it is read in CHUNK_SIZE
+pieces with ``os.pread`` off the event loop, so memory per response stays
+bounded either way.
+"""
+
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+# Content codings in order of preference, with the suffix of their precompressed variant
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested range starts past the end of the file"""
+
+
+class ServingStats:
+    """Counts of artifact responses by outcome, for /metrics"""
+
+    FIELDS = ("full", "partial", "not_modified", "unsatisfiable", "precompressed", "zerocopy", "bytes_sent")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += amount
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+
+# This worker's totals, for /metrics
+stats = ServingStats()
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """First and last byte of a single ``bytes=`` range, or None to send the whole file
+
+    Malformed and multi-range headers are ignored, as RFC 9110 allows.
+    Raises RangeNotSatisfiable when the range lies wholly past the end.
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - length), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def _etag_list(value: str) -> List[str]:
+    return [tag.strip() for tag in value.split(",") if tag.strip()]
+
+
+def _weak_match(header: str, etag: str) -> bool:
+    """If-None-Match comparison: weak, so ``W/"x"`` matches ``"x"``"""
+    bare = etag.removeprefix("W/")
+    return any(tag == "*" or tag.removeprefix("W/") == bare for tag in _etag_list(header))
+
+
+def _http_date_seconds(value: str) -> Optional[int]:
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def accepted_encodings(value: Optional[str]) -> Dict[str, float]:
+    """Quality value per content coding from an Accept-Encoding header"""
+    accepted: Dict[str, float] = {}
+    for item in (value or "").split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, number = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(number)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.lower()] = quality
+    return accepted
+
+
+class _Selected(NamedTuple):
+    file: BinaryIO
+    size: int  # of what is sent
+    # Validators come from the file itself, also when a variant is sent
+    source_size: int
+    source_mtime_ns: int
+    encoding: Optional[str]
+    has_variants: bool
+
+
+def _select(path: str, accepted: Dict[str, float]) -> Optional[_Selected]:
+    """Open the representation to send: a precompressed variant if acceptable, else the file"""
+    try:
+        original = os.stat(path)
+    except FileNotFoundError:
+        return None
+    chosen: Optional[Tuple[str, str]] = None
+    has_variants = False
+    for encoding, suffix in ENCODINGS:
+        try:
+            variant = os.stat(path + suffix)
+        except FileNotFoundError:
+            continue
+        has_variants = True
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        # An older variant was made from a previous version of the file
+        if chosen is None and quality > 0 and variant.st_mtime_ns >= original.st_mtime_ns:
+            chosen = (encoding, path + suffix)
+
+    encoding, serve_path = chosen if chosen else (None, path)
+    try:
+        file = open(serve_path, "rb")
+    except FileNotFoundError:
+        return None
+    # Stat what was opened: a file replaced since still has its old inode here
+    opened = os.fstat(file.fileno())
+    source = original if encoding else opened
+    return _Selected(file, opened.st_size, source.st_size, source.st_mtime_ns, encoding, has_variants)
+
+
+class ArtifactResponse(Response):
+    """A file on disk, with Range, conditional GET and precompressed variants
+
+    ``etag`` replaces the default size/mtime validator, e.g. with the content
+    hash of a content-addressed file. Request headers are read when the
+    response is sent, so endpoints only name the file.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        media_type: str,
+        headers: Optional[Mapping[str, str]] = None,
+        etag: Optional[str] = None,
+        filename: Optional[str] = None,
+        content_disposition_type: str = "inline",
+        precompressed: bool = True
+    ):
+        self.path = str(path)
+        self.status_code = 200
+        self.media_type = media_type
+        self.background = None
+        self.etag = etag
+        self.precompressed = precompressed
+        self.init_headers(headers)
+        self.headers.setdefault("accept-ranges", "bytes")
+        if filename is not None:
+            self.headers.setdefault("content-disposition", f'{content_disposition_type}; filename="{filename}"')
+
+    def _validators(self, selected: _Selected) -> Tuple[str, str]:
+        if self.etag is not None:
+            tag = self.etag if selected.encoding is None else f"{self.etag}-{selected.encoding}"
+        else:
+            tag = f"{selected.source_size:x}-{selected.source_mtime_ns:x}"
+            if selected.encoding is not None:
+                tag += f"-{selected.encoding}"
+        return f'"{tag}"', formatdate(selected.source_mtime_ns / 1e9, usegmt=True)
+
+    def _not_modified(self, request: Headers, etag: str, mtime: int) -> bool:
+        if_none_match = request.get("if-none-match")
+        if if_none_match is not None:
+            return _weak_match(if_none_match, etag)
+        since = request.get("if-modified-since")
+        if since is not None:
+            since_seconds = _http_date_seconds(since)
+            return since_seconds is not None and mtime <= since_seconds
+        return False
+
+    def _range_applies(self, request: Headers, etag: str, last_modified: str) -> bool:
+        """If-Range: use the range only if the client's copy is still current"""
+        if_range = request.get("if-range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"'):
+            return if_range == etag
+        if if_range.startswith("W/"):
+            return False  # weak validators never match here
+        return if_range == last_modified
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        request = Headers(scope=scope)
+        # Ranges are offsets into the file itself, never into a compressed variant
+        use_variant = self.precompressed and request.get("range") is None
+        accepted = accepted_encodings(request.get("accept-encoding")) if use_variant else {}
+        selected = await asyncio.to_thread(_select, self.path, accepted)
+        if selected is None:
+            await Response(status_code=404)(scope, receive, send)
+            return
+
+        try:
+            etag, last_modified = self._validators(selected)
+            headers = [(k, v) for k, v in self.raw_headers if k != b"content-length"]
+            headers += [(b"etag", etag.encode("latin-1")), (b"last-modified", last_modified.encode("latin-1"))]
+            if selected.has_variants:
+                headers.append((b"vary", b"Accept-Encoding"))
+            if selected.encoding is not None:
+                headers.append((b"content-encoding", selected.encoding.encode("latin-1")))
+
+            if self._not_modified(request, etag, selected.source_mtime_ns // 1_000_000_000):
+                stats.incr("not_modified")
+                headers = [(k, v) for k, v in headers if k not in (b"content-type", b"content-encoding")]
+                await send({"type": "http.response.start", "status": 304, "headers": headers})
+                await send({"type": "http.response.body", "body": b""})
+                return
+
+            start, end, status = 0, selected.size - 1, 200
+            range_header = request.get("range")
+            if range_header is not None and self._range_applies(request, etag, last_modified):
+                try:
+                    byte_range = parse_range(range_header, selected.size)
+                except RangeNotSatisfiable:
+                    stats.incr("unsatisfiable")
+                    headers = [(k, v) for k, v in headers if k not in (b"content-type", b"content-encoding")]
+                    headers += [(b"content-range", f"bytes */{selected.size}".encode()), (b"content-length", b"0")]
+                    await send({"type": "http.response.start", "status": 416, "headers": headers})
+                    await send({"type": "http.response.body", "body": b""})
+                    return
+                if byte_range is not None:
+                    start, end = byte_range
+                    status = 206
+                    headers.append((b"content-range", f"bytes {start}-{end}/{selected.size}".encode()))
+
+            length = end - start + 1
+            headers.append((b"content-length", str(length).encode()))
+            stats.incr("partial" if status == 206 else "full")
+            if selected.encoding is not None:
+                stats.incr("precompressed")
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            if scope.get("method") == "HEAD" or length == 0:
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await self._send_body(scope, send, selected.file, start, length)
+        finally:
+            selected.file.close()
+
+    async def _send_body(self, scope: Scope, send: Send, file: BinaryIO, offset: int, count: int) -> None:
+        if "http.response.zerocopy" in scope.get("extensions", {}):
+            stats.incr("zerocopy")
+            await send({"type": "http.response.zerocopy", "file": file, "offset": offset, "count": count, "more_body": False})
+            stats.incr("bytes_sent", count)
+            return
+
+        fd = file.fileno()
+        remaining = count
+        while remaining > 0:
+            chunk = await asyncio.to_thread(os.pread, fd, min(CHUNK_SIZE, remaining), offset)
+            if not chunk:
+                # Truncated in place since it was opened; the client sees a short body
+                logger.warning(f"{self.path} ended {remaining} bytes early")
+                break
+            offset += len(chunk)
+            remaining -= len(chunk)
+            stats.incr("bytes_sent", len(chunk))
+            await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b""})
+
+
+def precompress(path: Union[str, Path], min_saving: float = 0.1) -> Optional[Path]:
+    """Write ``<path>.gz`` next to a file if it is at least ``min_saving`` smaller
+
+    Returns the variant, or None (removing any stale one) when gzip does not
+    pay off, as with MP3 audio or already-compressed PDFs.
+    """
+    path = Path(path)
+    variant = path.with_name(path.name + ".gz")
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{variant.name}.")
+    try:
+        with open(path, "rb") as source, os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0) as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+        if os.path.getsize(tmp) <= path.stat().st_size * (1 - min_saving):
+            os.replace(tmp, variant)
+            return variant
+        os.unlink(tmp)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    variant.unlink(missing_ok=True)
+    return None
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Caller Identity
+Who a request is from, taken only from what the service can verify
+
+A caller is a tenant (e.g. a school) plus, when known, a user or session.
+They are read from, in order:
+
+- an identity token, ``Authorization: Bearer <token>`` (or ``?token=`` on a
+  WebSocket), signed with IDENTITY_SECRET by the app that signed the user
+  in; sign_identity() makes one,
+- ``X-Tenant-ID``, ``X-User-ID`` and ``X-Session-ID``, honoured only on
+  connections from TRUSTED_PROXIES (the Next.js app, or an ingress that
+  sets them after authenticating the user).
+
+Anyone else is anonymous and known by address alone; the headers are
+ignored, so a client cannot pass itself off as another user to get their
+quota or their documents. Behind a trusted proxy the address is the last
+untrusted hop in ``X-Forwarded-For``.
+
+TRUSTED_PROXIES is a comma-separated list of addresses or CIDR blocks;
+loopback by default.
+"""
+
+import base64
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import re
+import time
+from typing import List, NamedTuple, Optional, Union
+
+TRUSTED_PROXIES = os.getenv("TRUSTED_PROXIES", "127.0.0.1/32,::1/128")
+IDENTITY_SECRET = os.getenv("IDENTITY_SECRET", "")
+IDENTITY_TOKEN_TTL = int(os.getenv("IDENTITY_TOKEN_TTL", "3600"))
+
+DEFAULT_TENANT = "default"
+
+# base64url(claims) "." base64url(HMAC-SHA256), as sign_identity() makes them
+IDENTITY_TOKEN = re.compile(r"[A-Za-z0-9_-]+\.[A-Za-z0-9_-]{43}")
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class InvalidIdentity(ValueError):
+    """An identity token was given but is malformed, forged or expired"""
+
+
+class Caller(NamedTuple):
+    tenant: str
+    user: Optional[str]
+    session: Optional[str]
+    address: str
+
+    @property
+    def verified(self) -> bool:
+        """Named by a token or a trusted proxy, not just by address"""
+        return self.user is not None or self.session is not None
+
+    @property
+    def owner(self) -> str:
+        """Key that data belonging to this caller is stored under"""
+        if self.user is not None:
+            return f"{self.tenant}/user:{self.user}"
+        if self.session is not None:
+            return f"{self.tenant}/session:{self.session}"
+        return f"{self.tenant}/ip:{self.address}"
+
+
+def parse_networks(value: str) -> List[Network]:
+    networks = []
+    for item in value.split(","):
+        item = item.strip()
+        if item:
+            networks.append(ipaddress.ip_network(item, strict=False))
+    return networks
+
+
+_trusted = parse_networks(TRUSTED_PROXIES)
+
+
+def is_trusted(host: Optional[str], networks: Optional[List[Network]] = None) -> bool:
+    if not host:
+        return False
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in (_trusted if networks is None else networks))
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _signature(payload: str, secret: str) -> str:
+    return _b64encode(hmac.new(secret.encode(), payload.encode("ascii"), hashlib.sha256).digest())
+
+
+def sign_identity(
+    user: Optional[str] = None,
+    tenant: str = DEFAULT_TENANT,
+    session: Optional[str] = None,
+    ttl: int = IDENTITY_TOKEN_TTL,
+    secret: Optional[str] = None
+) -> str:
+    """A token naming ``user`` (or ``session``) in ``tenant``, valid for ``ttl`` seconds"""
+    secret = IDENTITY_SECRET if secret is None else secret
+    if not secret:
+        raise ValueError("IDENTITY_SECRET is not set")
+    claims = {"tenant": tenant, "exp": int(time.time()) + ttl}
+    if user:
+        claims["user"] = user
+    if session:
+        claims["session"] = session
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return f"{payload}.{_signature(payload, secret)}"
+
+
+def verify_identity(token: str, secret: Optional[str] = None) -> dict:
+    """Claims of a token made by sign_identity(); raises InvalidIdentity"""
+    secret = IDENTITY_SECRET if secret is None else secret
+    if not secret:
+        raise InvalidIdentity("Identity tokens are not accepted (IDENTITY_SECRET is not set)")
+    payload, _, signature = token.partition(".")
+    if not payload or not hmac.compare_digest(signature, _signature(payload, secret)):
+        raise InvalidIdentity("Invalid identity token")
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        raise InvalidIdentity("Invalid identity token")
+    if not isinstance(claims, dict) or not isinstance(claims.get("exp"), int) or claims["exp"] < time.time():
+        raise InvalidIdentity("Identity token has expired")
+    return claims
+
+
+def _bearer(headers) -> Optional[str]:
+    """An identity token from the Authorization header
+
+    Other bearer tokens (API keys, JWTs for some other service) are not ours
+    to reject: they are ignored, as is every bearer token when no
+    IDENTITY_SECRET is set.
+    """
+    scheme, _, token = (headers.get("authorization") or "").partition(" ")
+    token = token.strip()
+    if scheme.lower() != "bearer" or not IDENTITY_SECRET or not IDENTITY_TOKEN.fullmatch(token):
+        return None
+    return token
+
+
+def identify_caller(headers, client_host: Optional[str], token: Optional[str] = None) -> Caller:
+    """The caller of a request (or WebSocket) from its headers and peer address
+
+    ``token`` is an identity token passed some other way than the
+    Authorization header, e.g. a WebSocket query parameter.
+    """
+    address = client_host or "unknown"
+    trusted = is_trusted(client_host)
+    if trusted:
+        # Right to left, the first hop that is not one of our proxies is the client
+        for hop in reversed((headers.get("x-forwarded-for") or "").split(",")):
+            hop = hop.strip()
+            if hop and not is_trusted(hop):
+                address = hop
+                break
+
+    token = token or _bearer(headers)
+    if token:
+        claims = verify_identity(token)
+        return Caller(str(claims.get("tenant") or DEFAULT_TENANT), claims.get("user"), claims.get("session"), address)
+    if trusted:
+        return Caller(
+            headers.get("x-tenant-id") or DEFAULT_TENANT,
+            headers.get("x-user-id") or None,
+            headers.get("x-session-id") or None,
+            address
+        )
+    return Caller(DEFAULT_TENANT, None, None, address)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Readiness Tracking
+Warms up slow components in the background and reports when a worker can take traffic
+
+/health only says the process is alive. A worker is *ready* once every
+registered component (the voice server's OpenAI client and tokenizer, the
+OCR service's engine imports and binaries) has been initialized, so the
+first real request does not pay for imports or connection setup. Failed
+components are retried until they succeed.
+"""
+
+import asyncio
+import logging
+import shutil
+import time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ReadinessTracker:
+    """Runs registered warm-up callables off the event loop and records the outcome"""
+
+    def __init__(self, retry_interval: float = 2.0):
+        self.retry_interval = retry_interval
+        self.started_at = time.monotonic()
+        self.ready_at: Optional[float] = None
+        self._warm_ups: Dict[str, Callable[[], Any]] = {}
+        self._components: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, warm_up: Callable[[], Any]) -> None:
+        """Add a blocking callable that initializes one component"""
+        self._warm_ups[name] = warm_up
+        self._components[name] = {"ready": False, "seconds": None, "attempts": 0, "error": None}
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_at is not None
+
+    def start(self) -> asyncio.Task:
+        """Schedule warm-up on the running loop; call from a startup hook"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.warm_up())
+        return self._task
+
+    async def warm_up(self) -> None:
+        await asyncio.gather(*(self._warm_up_component(name) for name in self._warm_ups))
+        self.ready_at = time.monotonic()
+        logger.info(f"Worker ready after {self.ready_at - self.started_at:.2f}s")
+
+    async def _warm_up_component(self, name: str) -> None:
+        component = self._components[name]
+        while True:
+            component["attempts"] += 1
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._warm_ups[name])
+            except Exception as e:
+                component["error"] = f"{type(e).__name__}: {e}"
+                logger.warning(f"Warm-up of {name} failed (attempt {component['attempts']}): {e}")
+                await asyncio.sleep(self.retry_interval)
+                continue
+            component.update(ready=True, seconds=round(time.perf_counter() - started, 3), error=None)
+            return
+
+    async def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "startup_seconds": round(self.ready_at - self.started_at, 3) if self.ready else None,
+            "components": {name: dict(component) for name, component in self._components.items()}
+        }
+
+
+def require_binary(name: str) -> str:
+    """Warm-up check for an external program the service shells out to"""
+    path = shutil.which(name)
+    if path is None:
+        raise FileNotFoundError(f"{name} not found on PATH")
+    return path
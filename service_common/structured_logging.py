@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Structured Logging
+JSON log lines written by a background thread, with per-route sampling and payload truncation
+
+configure_logging() replaces logging.basicConfig for a service. Loggers keep
+their usual ``logger.info(...)`` interface; what changes is the handler
+behind them. The root logger gets a QueueHandler, so the calling thread (for
+the servers, the event loop) only filters, truncates and enqueues a record;
+formatting and the write to stderr happen on a QueueListener thread. The
+queue is bounded by LOG_QUEUE_SIZE: when the writer falls behind, records
+are dropped and counted rather than blocking the loop. Since messages are
+formatted later, log values, not objects that change after the call.
+
+Records carry the trace and span ids of the span active when they were
+logged (tracing.current_span), so a log line can be found from the
+``X-Trace-Id`` a response carried, and the other way round.
+
+LOG_SAMPLE keeps a share of INFO and lower records per route, as
+``route=rate`` pairs separated by commas; a route ending in ``*`` matches as
+a prefix. A record's route is the ``route`` given in ``extra``, or for
+uvicorn's access log the request path, so probes and scrapes can be thinned
+without touching the endpoints. Within a request the decision follows the
+trace id, so a request's lines are kept or dropped together. WARNING and
+above, and access lines for 4xx/5xx responses, are always kept.
+
+String arguments and ``extra`` values longer than LOG_MAX_CHARS are cut,
+with the number of characters left out, so a pasted passage or transcript
+cannot turn a log line into a payload dump.
+
+LOG_FORMAT selects the output:
+    json  - one JSON object per line (python-json-logger)
+    text  - the previous human-readable format
+"""
+
+import atexit
+import logging
+import os
+import queue
+import random
+import socket
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional, Tuple
+
+from service_common.tracing import current_span
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", "512"))
+LOG_SAMPLE = os.getenv("LOG_SAMPLE", "/health=0.01,/livez=0.01,/ready=0.01,/metrics=0.01")
+FORMATS = ("json", "text")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# Loggers uvicorn configures with handlers of its own before the app is imported
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+# Every attribute a LogRecord has before ``extra`` is applied
+_RECORD_ATTRS = frozenset(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """``"/health=0.01,chat=0.5"`` as a route -> rate mapping; malformed pairs are ignored"""
+    rates: Dict[str, float] = {}
+    for pair in value.split(","):
+        route, _, rate = pair.strip().partition("=")
+        try:
+            rates[route.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    rates.pop("", None)
+    return rates
+
+
+def truncate(value: str, limit: int = LOG_MAX_CHARS) -> str:
+    if len(value) <= limit:
+        return value
+    return f"{value[:limit]}... [{len(value) - limit} more chars]"
+
+
+class RouteSampler(logging.Filter):
+    """Keeps a per-route share of low-severity records"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = {route: rate for route, rate in rates.items() if not route.endswith("*")}
+        self.prefixes: Tuple[Tuple[str, float], ...] = tuple(
+            (route[:-1], rate) for route, rate in rates.items() if route.endswith("*")
+        )
+        self.sampled_out: Dict[str, int] = {}
+
+    def rate(self, route: str) -> float:
+        rate = self.rates.get(route)
+        if rate is not None:
+            return rate
+        for prefix, rate in self.prefixes:
+            if route.startswith(prefix):
+                return rate
+        return 1.0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        route = getattr(record, "route", None)
+        if route is None:
+            if record.name != "uvicorn.access" or not isinstance(record.args, tuple) or len(record.args) != 5:
+                return True
+            # (client, method, path, http version, status)
+            if isinstance(record.args[4], int) and record.args[4] >= 400:
+                return True
+            route = str(record.args[2]).partition("?")[0]
+        rate = self.rate(route)
+        if rate >= 1.0:
+            return True
+        span = current_span()
+        # The tracer's own rule: the low 64 bits of a trace id are uniform
+        keep = (int(span.context.trace_id[16:], 16) < rate * 2 ** 64) if span is not None else random.random() < rate
+        if not keep:
+            self.sampled_out[route] = self.sampled_out.get(route, 0) + 1
+        return keep
+
+
+class AsyncQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them"""
+
+    def __init__(self, log_queue: "queue.SimpleQueue[logging.LogRecord]", max_size: int, max_chars: int = LOG_MAX_CHARS):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.max_chars = max_chars
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler.prepare formats here, on the caller's thread; that is the listener's job.
+        # Only what is gone by then is taken now: the active span, and short copies of payloads.
+        limit = self.max_chars
+        if record.args:
+            if isinstance(record.args, tuple):
+                record.args = tuple(
+                    truncate(arg, limit) if isinstance(arg, str) and len(arg) > limit else arg for arg in record.args
+                )
+        elif isinstance(record.msg, str) and len(record.msg) > limit:
+            record.msg = truncate(record.msg, limit)
+        for key in record.__dict__.keys() - _RECORD_ATTRS:
+            value = record.__dict__[key]
+            if isinstance(value, str) and len(value) > limit:
+                record.__dict__[key] = truncate(value, limit)
+        span = current_span()
+        if span is not None:
+            record.trace_id = span.context.trace_id
+            record.span_id = span.context.span_id
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # A SimpleQueue puts in a fraction of a bounded Queue's time; the bound is checked here
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+        self.enqueued += 1
+
+
+def create_formatter(fmt: str, service: str) -> logging.Formatter:
+    if fmt == "text":
+        return logging.Formatter(TEXT_FORMAT)
+    from pythonjsonlogger.jsonlogger import RESERVED_ATTRS, JsonFormatter
+
+    return JsonFormatter(
+        "%(levelname)s %(name)s %(process)d %(message)s",
+        rename_fields={"levelname": "level", "name": "logger", "process": "pid"},
+        static_fields={"service": service, "host": socket.gethostname()},
+        json_ensure_ascii=False,
+        timestamp=True,
+        # uvicorn's copy of the message with terminal colours
+        reserved_attrs=(*RESERVED_ATTRS, "color_message")
+    )
+
+
+class LogPipeline:
+    """A queue handler with its sampler, and the thread that formats and writes its records"""
+
+    def __init__(
+        self,
+        service: str,
+        fmt: str = LOG_FORMAT,
+        queue_size: int = LOG_QUEUE_SIZE,
+        sample: str = LOG_SAMPLE,
+        max_chars: int = LOG_MAX_CHARS,
+        stream=None
+    ):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown LOG_FORMAT {fmt!r}; expected one of {', '.join(FORMATS)}")
+        self.format = fmt
+        writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+        writer.setFormatter(create_formatter(fmt, service))
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        self.sampler = RouteSampler(parse_sample_rates(sample))
+        self.handler = AsyncQueueHandler(log_queue, queue_size, max_chars)
+        self.handler.addFilter(self.sampler)
+        self.listener = QueueListener(log_queue, writer)
+        self._lock = threading.Lock()
+        self._running = False
+
+    def start(self) -> "LogPipeline":
+        with self._lock:
+            if not self._running:
+                self.listener.start()
+                self._running = True
+        return self
+
+    def stop(self) -> None:
+        """Write out what is queued and end the writer thread"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        self.listener.stop()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "format": self.format,
+            "queued": self.handler.queue.qsize(),
+            "enqueued": self.handler.enqueued,
+            "dropped": self.handler.dropped,
+            "sampled_out": dict(self.sampler.sampled_out)
+        }
+
+
+_pipeline: Optional[LogPipeline] = None
+
+
+def configure_logging(service: str, level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None) -> LogPipeline:
+    """Route this process's logging through a LogPipeline; later calls return the first one
+
+    uvicorn's loggers are rerouted on every call: ``uvicorn.run`` from a
+    script that already configured logging sets up its own handlers again
+    before it imports the app.
+    """
+    global _pipeline
+    # uvicorn's loggers keep their levels but write through the queue like the rest
+    for name in UVICORN_LOGGERS:
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+    if _pipeline is not None:
+        return _pipeline
+
+    pipeline = LogPipeline(os.getenv("OTEL_SERVICE_NAME", service), fmt, stream=stream)
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(pipeline.handler)
+    root.setLevel(level)
+    _pipeline = pipeline.start()
+    atexit.register(pipeline.stop)
+    return pipeline
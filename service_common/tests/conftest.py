@@ -0,0 +1,9 @@
+"""Make service_common importable from the tests"""
+
+import sys
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent.parent
+
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
@@ -0,0 +1,123 @@
+"""ArtifactResponse: byte ranges, If-Range, conditional GET and precompressed variants"""
+
+import gzip
+
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from service_common.artifact_serving import ArtifactResponse, RangeNotSatisfiable, parse_range
+
+BODY = bytes(range(256)) * 40  # 10240 bytes
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 1023)),
+    ("bytes=-100", (924, 1023)),
+    ("bytes=-5000", (0, 1023)),
+    ("bytes=1000-5000", (1000, 1023)),
+    ("BYTES = 0-0", (0, 0)),
+    ("bytes=0-10,20-30", None),
+    ("bytes=10-5", None),
+    ("bytes=a-b", None),
+    ("bytes=-", None),
+    ("items=0-10", None),
+])
+def test_parse_range(value, expected):
+    assert parse_range(value, 1024) == expected
+
+
+@pytest.mark.parametrize("value, size", [("bytes=1024-", 1024), ("bytes=-0", 1024), ("bytes=-10", 0)])
+def test_parse_range_not_satisfiable(value, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(value, size)
+
+
+@pytest.fixture
+def artifact(tmp_path):
+    path = tmp_path / "page.txt"
+    path.write_bytes(BODY)
+    return path
+
+
+@pytest.fixture
+def client(artifact):
+    async def serve(request):
+        return ArtifactResponse(artifact, "text/plain")
+
+    return TestClient(Starlette(routes=[Route("/artifact", serve)]))
+
+
+def test_full_response_has_validators(client):
+    response = client.get("/artifact", headers={"accept-encoding": "identity"})
+    assert response.status_code == 200
+    assert response.content == BODY
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"].startswith('"')
+    assert "last-modified" in response.headers
+
+
+def test_range_request(client):
+    response = client.get("/artifact", headers={"range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(BODY)}"
+    assert response.content == BODY[100:200]
+
+
+def test_range_past_the_end(client):
+    response = client.get("/artifact", headers={"range": f"bytes={len(BODY)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(BODY)}"
+
+
+def test_if_range_with_current_validator(client):
+    etag = client.get("/artifact").headers["etag"]
+    response = client.get("/artifact", headers={"range": "bytes=0-9", "if-range": etag})
+    assert response.status_code == 206
+    assert response.content == BODY[:10]
+
+
+def test_if_range_with_stale_validator_sends_everything(client):
+    response = client.get("/artifact", headers={"range": "bytes=0-9", "if-range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == BODY
+
+
+def test_if_none_match(client):
+    etag = client.get("/artifact").headers["etag"]
+    response = client.get("/artifact", headers={"if-none-match": f"W/{etag}"})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+    assert client.get("/artifact", headers={"if-none-match": '"stale"'}).status_code == 200
+
+
+def test_if_modified_since(client):
+    last_modified = client.get("/artifact").headers["last-modified"]
+    assert client.get("/artifact", headers={"if-modified-since": last_modified}).status_code == 304
+    old = "Mon, 01 Jan 2001 00:00:00 GMT"
+    assert client.get("/artifact", headers={"if-modified-since": old}).status_code == 200
+
+
+def test_precompressed_variant_is_sent_when_accepted(client, artifact):
+    artifact.with_name(artifact.name + ".gz").write_bytes(gzip.compress(BODY))
+    response = client.get("/artifact", headers={"accept-encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content == BODY
+
+
+def test_range_request_never_gets_the_compressed_variant(client, artifact):
+    artifact.with_name(artifact.name + ".gz").write_bytes(gzip.compress(BODY))
+    response = client.get("/artifact", headers={"accept-encoding": "gzip", "range": "bytes=10-19"})
+    assert response.status_code == 206
+    assert "content-encoding" not in response.headers
+    assert response.content == BODY[10:20]
+
+
+def test_missing_file(client, artifact):
+    artifact.unlink()
+    assert client.get("/artifact").status_code == 404
@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Tracing
+OpenTelemetry-compatible spans with W3C trace context, sampled and exported off the request path
+
+A trace follows one request across the Next.js app, the voice server and the
+OCR service: each hop reads the ``traceparent`` header (W3C Trace Context),
+continues that trace, and passes it on. Within a service, spans nest through
+a context variable, which ``asyncio.to_thread`` copies, so a span opened in
+an endpoint is the parent of spans opened in the blocking code it calls.
+
+Only a TRACE_SAMPLE_RATE share of new traces is recorded, decided from the
+trace id as OpenTelemetry's TraceIdRatioBased sampler does; a caller's
+sampling decision is kept. Unsampled spans carry ids for propagation and
+nothing else. Finished spans go on a bounded queue (TRACE_QUEUE_SIZE; spans
+beyond it are dropped and counted) that a background thread writes out in
+batches, and no trace records more than TRACE_MAX_SPANS spans per process,
+so a 500-page document does not flood the exporter.
+
+TRACE_EXPORTER selects where spans go:
+    file     - TRACE_FILE, one OTLP/JSON ExportTraceServiceRequest per line,
+               which the OpenTelemetry Collector's otlpjsonfile receiver reads
+    console  - one log line per span
+    none     - propagate trace context only
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Mapping, MutableMapping, NamedTuple, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "file")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces/spans.jsonl")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "4096"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "512"))
+# Probes and scrapes would otherwise make up most traces
+TRACE_SKIP_PATHS = frozenset(filter(None, os.getenv("TRACE_SKIP_PATHS", "/health,/livez,/ready,/metrics").split(",")))
+EXPORTERS = ("file", "console", "none")
+
+EXPORT_BATCH = 512
+EXPORT_INTERVAL = 2.0
+# OTLP SpanKind and StatusCode values
+KINDS = {"internal": 1, "server": 2, "client": 3, "producer": 4, "consumer": 5}
+STATUS_ERROR = 2
+
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+
+
+class SpanContext(NamedTuple):
+    """What crosses process boundaries: trace id, span id and the sampling decision"""
+
+    trace_id: str  # 32 hex digits
+    span_id: str  # 16 hex digits
+    sampled: bool
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    """The caller's span from a ``traceparent`` header, or None if absent or invalid"""
+    match = _TRACEPARENT.match((value or "").strip().lower())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    # Version 00 has no trailing fields; later versions may add some
+    if version == "ff" or (version == "00" and rest) or trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 0x01))
+
+
+class Span:
+    """One timed operation; use Tracer.span() rather than creating these directly"""
+
+    __slots__ = (
+        "tracer", "name", "context", "parent_id", "kind", "start_ns", "end_ns",
+        "attributes", "error", "recording", "budget"
+    )
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        context: SpanContext,
+        parent_id: Optional[str],
+        kind: str,
+        start_ns: int,
+        recording: bool,
+        budget: List[int]
+    ):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_ns = start_ns
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.recording = recording
+        # Spans this trace may still record in this process, shared with its children
+        self.budget = budget
+
+    def set(self, key: str, value: Any) -> "Span":
+        if self.recording and value is not None:
+            self.attributes[key] = value
+        return self
+
+    def update(self, attributes: Mapping[str, Any]) -> "Span":
+        for key, value in attributes.items():
+            self.set(key, value)
+        return self
+
+    def record_error(self, error: Union[BaseException, str]) -> None:
+        if self.recording:
+            self.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        if self.end_ns is not None:
+            return
+        self.end_ns = end_ns or time.time_ns()
+        if self.recording:
+            self.tracer._finish(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span: Dict[str, Any] = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": KINDS.get(self.kind, 1),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": _attributes(self.attributes)
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            span["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return span
+
+
+def _attributes(values: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    encoded = []
+    for key, value in values.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}  # int64 is a string in OTLP/JSON
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        encoded.append({"key": key, "value": typed})
+    return encoded
+
+
+_current: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+class FileExporter:
+    """Appends OTLP/JSON lines to a file; several workers may share it"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, service: str, spans: List[Span]) -> None:
+        request = {"resourceSpans": [{
+            "resource": {"attributes": _attributes({"service.name": service, "process.pid": os.getpid()})},
+            "scopeSpans": [{"scope": {"name": "tracing"}, "spans": [span.to_otlp() for span in spans]}]
+        }]}
+        line = (json.dumps(request, separators=(",", ":")) + "\n").encode("utf-8")
+        # One O_APPEND write per batch, so lines from different workers don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            view = memoryview(line)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+
+class ConsoleExporter:
+    """One log line per span, for reading traces while developing"""
+
+    def export(self, service: str, spans: List[Span]) -> None:
+        for span in spans:
+            attributes = " ".join(f"{key}={value}" for key, value in span.attributes.items())
+            status = f" error={span.error!r}" if span.error else ""
+            logger.info(
+                f"span {service} {span.name} {span.duration_ms:.1f}ms trace={span.context.trace_id} "
+                f"span={span.context.span_id} parent={span.parent_id or '-'} {attributes}{status}"
+            )
+
+
+def create_exporter(name: str = TRACE_EXPORTER, path: str = TRACE_FILE):
+    if name not in EXPORTERS:
+        raise ValueError(f"Unknown trace exporter: {name}")
+    if name == "file":
+        return FileExporter(path)
+    if name == "console":
+        return ConsoleExporter()
+    return None
+
+
+class Tracer:
+    """Creates spans, propagates their context and exports the sampled ones in the background"""
+
+    def __init__(
+        self,
+        service: str,
+        exporter=None,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        queue_size: int = TRACE_QUEUE_SIZE,
+        max_spans: int = TRACE_MAX_SPANS
+    ):
+        self.service = service
+        self.exporter = exporter
+        self.sample_rate = min(1.0, max(0.0, sample_rate))
+        self.queue_size = queue_size
+        self.max_spans = max_spans
+        self._queue: Deque[Span] = deque()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._thread: Optional[threading.Thread] = None
+        self._pid = os.getpid()
+        self.started = 0
+        self.sampled = 0
+        self.exported = 0
+        self.dropped = 0
+        self.over_budget = 0
+        self.export_errors = 0
+        atexit.register(self.flush)
+
+    def _sample(self, trace_id: str) -> bool:
+        # TraceIdRatioBased: the low 64 bits of a random trace id are uniform
+        return int(trace_id[16:], 16) < self.sample_rate * 2 ** 64
+
+    def start_span(
+        self,
+        name: str,
+        parent: Union[Span, SpanContext, None, bool] = True,
+        kind: str = "internal",
+        attributes: Optional[Mapping[str, Any]] = None,
+        start_ns: Optional[int] = None
+    ) -> Span:
+        """A started span; ``parent=True`` (the default) means the current span, None a new trace"""
+        if parent is True:
+            parent = _current.get()
+        span_id = f"{random.getrandbits(64) or 1:016x}"
+        if isinstance(parent, Span):
+            context = SpanContext(parent.context.trace_id, span_id, parent.context.sampled)
+            parent_id, budget = parent.context.span_id, parent.budget
+        elif isinstance(parent, SpanContext):
+            context = SpanContext(parent.trace_id, span_id, parent.sampled)
+            parent_id, budget = parent.span_id, [self.max_spans]
+        else:
+            trace_id = f"{random.getrandbits(128) or 1:032x}"
+            context = SpanContext(trace_id, span_id, self._sample(trace_id))
+            parent_id, budget = None, [self.max_spans]
+
+        recording = context.sampled and self.exporter is not None
+        if recording:
+            if budget[0] <= 0:
+                recording = False
+                self.over_budget += 1
+            else:
+                budget[0] -= 1
+                self.sampled += 1
+        self.started += 1
+        span = Span(self, name, context, parent_id, kind, start_ns or time.time_ns(), recording, budget)
+        if attributes:
+            span.update(attributes)
+        return span
+
+    @contextmanager
+    def span(
+        self,
+        name: str,
+        parent: Union[Span, SpanContext, None, bool] = True,
+        kind: str = "internal",
+        **attributes: Any
+    ) -> Iterator[Span]:
+        """Run a block as the current span; an exception marks the span as failed and is re-raised"""
+        span = self.start_span(name, parent, kind, attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+    @staticmethod
+    def current() -> Optional[Span]:
+        return _current.get()
+
+    @staticmethod
+    def extract(headers: Mapping[str, str]) -> Optional[SpanContext]:
+        return parse_traceparent(headers.get("traceparent"))
+
+    @staticmethod
+    def inject(headers: Optional[MutableMapping[str, str]] = None, span: Optional[Span] = None) -> MutableMapping[str, str]:
+        """Add the current (or given) span's ``traceparent`` to outgoing headers"""
+        headers = {} if headers is None else headers
+        span = span or _current.get()
+        if span is not None:
+            headers["traceparent"] = span.context.traceparent
+        return headers
+
+    def _finish(self, span: Span) -> None:
+        with self._lock:
+            if len(self._queue) >= self.queue_size:
+                self.dropped += 1
+                return
+            self._queue.append(span)
+            # A forked child does not inherit the parent's thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="trace-export", daemon=True)
+                self._thread.start()
+            if len(self._queue) >= EXPORT_BATCH:
+                self._wake.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                self._wake.wait_for(lambda: len(self._queue) >= EXPORT_BATCH, timeout=EXPORT_INTERVAL)
+            self.flush()
+
+    def flush(self) -> None:
+        """Export everything queued so far"""
+        while True:
+            with self._lock:
+                batch = [self._queue.popleft() for _ in range(min(EXPORT_BATCH, len(self._queue)))]
+            if not batch:
+                return
+            try:
+                self.exporter.export(self.service, batch)
+                with self._lock:
+                    self.exported += len(batch)
+            except Exception as e:
+                with self._lock:
+                    self.export_errors += 1
+                logger.warning(f"Trace export failed, {len(batch)} spans lost: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "service": self.service,
+                "exporter": type(self.exporter).__name__ if self.exporter is not None else None,
+                "sample_rate": self.sample_rate,
+                "spans_started": self.started,
+                "spans_sampled": self.sampled,
+                "spans_exported": self.exported,
+                "spans_dropped": self.dropped,
+                "spans_over_budget": self.over_budget,
+                "export_errors": self.export_errors,
+                "queued": len(self._queue)
+            }
+
+
+class TraceMiddleware:
+    """ASGI middleware: a server span per HTTP request, continuing the caller's trace
+
+    The trace id is returned in ``X-Trace-Id`` so a slow response can be
+    looked up in the exported spans.
+    """
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or scope.get("path") in TRACE_SKIP_PATHS:
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope.get("headers", ())}
+        method = scope.get("method", "GET")
+        with self.tracer.span(
+            f"{method} {scope.get('path', '')}",
+            parent=self.tracer.extract(headers),
+            kind="server",
+            **{"http.method": method, "http.target": scope.get("path", "")}
+        ) as span:
+            async def send_with_trace(message) -> None:
+                if message["type"] == "http.response.start":
+                    span.set("http.status_code", message["status"])
+                    if message["status"] >= 500:
+                        span.record_error(f"HTTP {message['status']}")
+                    message = {
+                        **message,
+                        "headers": [*message.get("headers", []), (b"x-trace-id", span.context.trace_id.encode())]
+                    }
+                await send(message)
+
+            await self.app(scope, receive, send_with_trace)
+            route = _route_template(scope)
+            if route is not None:
+                # The route template keeps span names from growing with every job id
+                span.name = f"{method} {route}"
+                span.set("http.route", route)
+
+
+def _route_template(scope) -> Optional[str]:
+    """``/download/{job_id}`` for ``/download/3f2a...``, from what the router matched"""
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    if "endpoint" not in scope:
+        return None
+    path = scope.get("path", "")
+    for name, value in scope.get("path_params", {}).items():
+        path = path.replace(str(value), f"{{{name}}}", 1)
+    return path
+
+
+# Stands in when no span is active: its spans record nothing
+_idle = Tracer("", None)
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes: Any) -> Iterator[Span]:
+    """A child of the current span, for code that has no tracer of its own
+
+    Outside any span (scripts, benchmarks) this records nothing.
+    """
+    parent = _current.get()
+    with (parent.tracer if parent is not None else _idle).span(name, parent, kind, **attributes) as child:
+        yield child
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def start_span(name: str, kind: str = "internal", **attributes: Any) -> Optional[Span]:
+    """A started child of the current span, or None unless that span is recorded
+
+    For work that ends somewhere else, such as a message written by another
+    task; the caller ends it.
+    """
+    parent = _current.get()
+    if parent is None or not parent.recording:
+        return None
+    return parent.tracer.start_span(name, parent, kind, attributes)
+
+
+def create_tracer(service: str, exporter: str = TRACE_EXPORTER, path: str = TRACE_FILE) -> Tracer:
+    """This process's tracer; OTEL_SERVICE_NAME overrides the service name"""
+    return Tracer(os.getenv("OTEL_SERVICE_NAME", service), create_exporter(exporter, path))